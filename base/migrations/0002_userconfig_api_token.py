@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-19 15:55
+
+import secrets
+
+from django.db import migrations, models
+
+
+def fill_api_tokens(apps, schema_editor):
+    UserConfig = apps.get_model('base', 'UserConfig')
+    for config in UserConfig.objects.filter(api_token__isnull=True):
+        config.api_token = secrets.token_urlsafe(32)
+        config.save(update_fields=['api_token'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userconfig',
+            name='api_token',
+            field=models.CharField(blank=True, help_text='任务提交 API / 命令行客户端的鉴权 token；清空后保存会生成新的 token', max_length=128, null=True, unique=True, verbose_name='API Token'),
+        ),
+        migrations.RunPython(fill_api_tokens, migrations.RunPython.noop),
+    ]
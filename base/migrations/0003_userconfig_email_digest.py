@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 16:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0002_userconfig_api_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userconfig',
+            name='email_digest',
+            field=models.SmallIntegerField(choices=[(0, '逐个任务发送'), (1, '任务数组汇总'), (2, '分组汇总')], default=0, help_text='汇总时不再逐个发送开始/完成/失败邮件，任务数组（或分组）的任务全部结束后发一封汇总邮件', verbose_name='邮件通知方式'),
+        ),
+    ]
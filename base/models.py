@@ -1,13 +1,37 @@
+import secrets
+
 from django.db import models
 from django.contrib.auth.models import User
 
 
+def generate_api_token():
+    return secrets.token_urlsafe(32)
+
+
 class UserConfig(models.Model):
+    EMAIL_DIGEST_CHOICE = (
+        (0, '逐个任务发送'),
+        (1, '任务数组汇总'),
+        (2, '分组汇总'),
+    )
     user = models.OneToOneField(User, verbose_name='用户', on_delete=models.CASCADE, related_name='config', primary_key=True)
     server_username = models.CharField('服务器用户名', max_length=100)
     server_private_key = models.TextField('私钥')
     server_private_key_path = models.FilePathField(path='private_key', verbose_name="私钥文件", blank=True, null=True)
+    api_token = models.CharField(
+        'API Token', max_length=128, blank=True, null=True, unique=True,
+        help_text='任务提交 API / 命令行客户端的鉴权 token；清空后保存会生成新的 token',
+    )
+    email_digest = models.SmallIntegerField(
+        '邮件通知方式', choices=EMAIL_DIGEST_CHOICE, default=0,
+        help_text='汇总时不再逐个发送开始/完成/失败邮件，任务数组（或分组）的任务全部结束后发一封汇总邮件',
+    )
 
     class Meta:
         verbose_name = '用户设置'
         verbose_name_plural = '用户设置'
+
+    def save(self, *args, **kwargs):
+        if not self.api_token:
+            self.api_token = generate_api_token()
+        super().save(*args, **kwargs)
@@ -0,0 +1,348 @@
+"""运行时指标（Prometheus 文本格式）。
+
+以前唯一的运行时信息是调度器日志里的 `Running processes: N`。这里提供一个很小的进程内指标库：
+
+- Counter / Histogram 在热路径上更新：一次字典查找 + 一把锁，不做 I/O，不依赖 prometheus_client；
+- 各进程（uwsgi 的多个 worker、ASGI 上报服务、调度器）每 GPUTASKER_METRICS_FLUSH_SECONDS（默认 5）秒
+  由后台线程把自己的计数写到 GPUTASKER_METRICS_DIR（默认 server_log/metrics）下的 <pid>.json；
+  Web 的 /metrics 合并所有进程的计数（已退出进程的计数并入 dead.json，计数不回退）；
+- 排队深度、运行中任务、各服务器 GPU 占用、失联节点数等是数据库里的状态，抓取时由 collector 现算，
+  不在进程里维护（见 gpu_info.cluster.cluster_gauges）。
+
+只有计数器和直方图跨进程合并（求和），因此进程内不提供 Gauge。
+"""
+import bisect
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DEAD_FILE = 'dead.json'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+task_logger = logging.getLogger('django.task')
+
+
+def metrics_dir():
+    """多进程共享计数的目录；设为空字符串时不共享（只输出本进程的计数）。"""
+    value = os.getenv('GPUTASKER_METRICS_DIR')
+    if value is None:
+        from django.conf import settings
+        value = os.path.join(settings.SERVER_LOG_DIR, 'metrics')
+    return value
+
+
+def flush_seconds():
+    try:
+        return max(0.5, float(os.getenv('GPUTASKER_METRICS_FLUSH_SECONDS', '5')))
+    except ValueError:
+        return 5.0
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        self.registry = REGISTRY if registry is None else registry
+        self.registry.register(self)
+
+    def _key(self, labels):
+        try:
+            return tuple(str(labels[name]) for name in self.labelnames)
+        except KeyError as exc:
+            raise ValueError('{} requires label {}'.format(self.name, exc))
+
+    def definition(self):
+        return {'kind': self.kind, 'help': self.documentation, 'labelnames': list(self.labelnames)}
+
+    def values(self):
+        with self._lock:
+            return [(key, list(value) if isinstance(value, list) else value) for key, value in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        self.registry.touch()
+
+
+class Histogram(_Metric):
+    """直方图：每组标签存 [各桶计数（不累计）..., +Inf 桶计数, 总和]。"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(float(b) for b in buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def definition(self):
+        return dict(super().definition(), buckets=list(self.buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[slot] += 1
+            state[-1] += value
+        self.registry.touch()
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._flusher_started = False
+        self._flusher_lock = threading.Lock()
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError('duplicated metric {}'.format(metric.name))
+        self._metrics[metric.name] = metric
+
+    def touch(self):
+        # 热路径上只多一次属性判断；第一次更新时（fork 出的子进程里也一样）才启动写盘线程
+        if not self._flusher_started:
+            self._start_flusher()
+
+    def _start_flusher(self):
+        with self._flusher_lock:
+            if self._flusher_started:
+                return
+            self._flusher_started = True
+            if self is REGISTRY and metrics_dir():
+                threading.Thread(target=self._flush_forever, name='metrics-flush', daemon=True).start()
+
+    def _after_fork(self):
+        # 子进程没有父进程的线程，也不应继承父进程的计数（否则合并时会重复计算）
+        self._flusher_started = False
+        self._flusher_lock = threading.Lock()
+        for metric in self._metrics.values():
+            metric._lock = threading.Lock()
+            metric._values = {}
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(flush_seconds())
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def snapshot(self):
+        return {
+            name: dict(metric.definition(), values=[[list(key), value] for key, value in metric.values()])
+            for name, metric in self._metrics.items()
+        }
+
+    def flush(self, directory=None):
+        """把本进程的计数写到共享目录（原子替换）。"""
+        directory = directory or metrics_dir()
+        if not directory:
+            return
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, '{}.json'.format(os.getpid()))
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'pid': os.getpid(), 'metrics': self.snapshot()}, f)
+        os.replace(tmp, path)
+
+    def collect(self, shared=True):
+        """本进程的计数，shared 时再合并共享目录里其他进程（含已退出进程）的计数。"""
+        families = self.snapshot()
+        directory = metrics_dir() if shared else ''
+        if directory and os.path.isdir(directory):
+            for snapshot in _read_shared(directory, exclude_pid=os.getpid()):
+                _merge(families, snapshot)
+        return families
+
+
+REGISTRY = Registry()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=REGISTRY._after_fork)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _read_shared(directory, exclude_pid):
+    """读取其他进程的快照；已退出进程的快照并入 dead.json 后删除（加文件锁，避免并发抓取重复合并）。"""
+    with open(os.path.join(directory, '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            dead_path = os.path.join(directory, DEAD_FILE)
+            dead = (_load(dead_path) or {}).get('metrics', {})
+            dead_changed = False
+            live = []
+            for name in os.listdir(directory):
+                if not name.endswith('.json') or name == DEAD_FILE:
+                    continue
+                try:
+                    pid = int(name[:-5])
+                except ValueError:
+                    continue
+                if pid == exclude_pid:
+                    continue
+                data = _load(os.path.join(directory, name))
+                if data is None:
+                    continue
+                if _pid_alive(pid):
+                    live.append(data['metrics'])
+                    continue
+                _merge(dead, data['metrics'])
+                dead_changed = True
+                os.remove(os.path.join(directory, name))
+            if dead_changed:
+                tmp = dead_path + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump({'metrics': dead}, f)
+                os.replace(tmp, dead_path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return live + [dead]
+
+
+def _merge(families, other):
+    for name, family in other.items():
+        target = families.get(name)
+        if target is None:
+            families[name] = target = dict(family, values=[])
+        elif target['kind'] != family['kind'] or target.get('buckets') != family.get('buckets'):
+            continue
+        index = {tuple(labels): i for i, (labels, _) in enumerate(target['values'])}
+        for labels, value in family['values']:
+            i = index.get(tuple(labels))
+            if i is None:
+                target['values'].append([list(labels), list(value) if isinstance(value, list) else value])
+                index[tuple(labels)] = len(target['values']) - 1
+            elif isinstance(value, list):
+                target['values'][i][1] = [a + b for a, b in zip(target['values'][i][1], value)]
+            else:
+                target['values'][i][1] += value
+
+
+def gauge(name, documentation, samples, labelnames=()):
+    """抓取时现算的 gauge；samples 为 [(标签值元组, 数值), ...]。"""
+    return name, {
+        'kind': 'gauge',
+        'help': documentation,
+        'labelnames': list(labelnames),
+        'values': [[list(labels), value] for labels, value in samples],
+    }
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+
+
+def _number(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def render(families):
+    """按 Prometheus 文本格式输出 {名称: 定义与取值}。"""
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        names = family['labelnames']
+        lines.append('# HELP {} {}'.format(name, family['help'].replace('\\', '\\\\').replace('\n', '\\n')))
+        lines.append('# TYPE {} {}'.format(name, family['kind']))
+        for labels, value in sorted(family['values'], key=lambda item: item[0]):
+            if family['kind'] != 'histogram':
+                lines.append('{}{} {}'.format(name, _labels(names, labels), _number(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(family['buckets'] + [float('inf')], value[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, _labels(names, labels, [('le', _number(float(bound)))]), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _labels(names, labels), _number(float(value[-1]))))
+            lines.append('{}_count{} {}'.format(name, _labels(names, labels), cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+def start_http_server(address, families):
+    """在后台线程用 HTTP 暴露指标（GET /metrics）；families() 返回要输出的指标。address 形如 127.0.0.1:9108。"""
+    host, _, port = address.rpartition(':')
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            try:
+                body = render(families()).encode('utf-8')
+            except Exception as exc:
+                task_logger.error('render metrics failed: %s', exc)
+                self.send_error(500)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host or '0.0.0.0', int(port)), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
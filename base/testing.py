@@ -0,0 +1,47 @@
+import os
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test.runner import DiscoverRunner
+from django.test.utils import CaptureQueriesContext
+
+
+class TestRunner(DiscoverRunner):
+    """测试期间关闭指标写盘：不在 server_log/metrics 下留下 <pid>.json。需要共享目录的测试自行指定临时目录。"""
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._metrics_dir = os.environ.get('GPUTASKER_METRICS_DIR')
+        os.environ['GPUTASKER_METRICS_DIR'] = ''
+
+    def teardown_test_environment(self, **kwargs):
+        if self._metrics_dir is None:
+            os.environ.pop('GPUTASKER_METRICS_DIR', None)
+        else:
+            os.environ['GPUTASKER_METRICS_DIR'] = self._metrics_dir
+        super().teardown_test_environment(**kwargs)
+
+
+class QueryPlanAssertionsMixin:
+    """热点查询的执行计划断言；配合 assertNumQueries 做查询预算。"""
+
+    @contextmanager
+    def assertMaxNumQueries(self, num):
+        """查询数上限：用于页面渲染这类总数随 Django 版本略有浮动、但不应随行数增长的场景。"""
+        with CaptureQueriesContext(connection) as ctx:
+            yield ctx
+        executed = len(ctx.captured_queries)
+        self.assertLessEqual(executed, num, '{} queries executed, at most {} expected:\n{}'.format(
+            executed, num, '\n'.join(q['sql'] for q in ctx.captured_queries)))
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan, 'expected index {} in plan:\n{}'.format(index_name, plan))
+        return plan
+
+    def assertNoSortStep(self, queryset):
+        """ORDER BY 应由索引顺序直接满足，而不是额外排序。"""
+        plan = queryset.explain()
+        if connection.vendor == 'sqlite':
+            self.assertNotIn('TEMP B-TREE', plan, 'unexpected sort in plan:\n{}'.format(plan))
+        return plan
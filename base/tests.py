@@ -1,3 +1,127 @@
-from django.test import TestCase
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from . import telemetry
+from .utils import PeriodicJob, env_float, env_int
+
+
+class TelemetryTest(SimpleTestCase):
+    """进程内指标：文本格式、跨进程合并（含已退出进程）与更新开销。"""
+
+    def setUp(self):
+        self.registry = telemetry.Registry()
+        self.registry._flusher_started = True
+        self.dir = tempfile.mkdtemp()
+        env = mock.patch.dict(os.environ, {'GPUTASKER_METRICS_DIR': self.dir})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def _write(self, pid, families):
+        with open(os.path.join(self.dir, '{}.json'.format(pid)), 'w') as f:
+            json.dump({'pid': pid, 'metrics': families}, f)
+
+    def test_render(self):
+        requests = telemetry.Counter('t_requests_total', 'Requests', ('code',), registry=self.registry)
+        latency = telemetry.Histogram('t_seconds', 'Latency', buckets=(0.1, 1), registry=self.registry)
+        requests.inc(code=200)
+        requests.inc(2, code='5"x')
+        for value in (0.05, 0.1, 0.5, 3):
+            latency.observe(value)
+        self.assertEqual(telemetry.render(self.registry.collect(shared=False)), '\n'.join([
+            '# HELP t_requests_total Requests',
+            '# TYPE t_requests_total counter',
+            't_requests_total{code="200"} 1',
+            't_requests_total{code="5\\"x"} 2',
+            '# HELP t_seconds Latency',
+            '# TYPE t_seconds histogram',
+            't_seconds_bucket{le="0.1"} 2',
+            't_seconds_bucket{le="1.0"} 3',
+            't_seconds_bucket{le="+Inf"} 4',
+            't_seconds_sum 3.65',
+            't_seconds_count 4',
+        ]) + '\n')
+        with self.assertRaises(ValueError):
+            requests.inc()
+
+    def test_merges_live_and_dead_processes(self):
+        requests = telemetry.Counter('t_requests_total', 'Requests', ('code',), registry=self.registry)
+        latency = telemetry.Histogram('t_seconds', 'Latency', buckets=(1,), registry=self.registry)
+        requests.inc(code=200)
+        latency.observe(0.5)
+        snapshot = self.registry.snapshot()
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        self._write(os.getppid(), snapshot)
+        self._write(dead.pid, snapshot)
+        # 本进程自己的快照文件不重复计算
+        self._write(os.getpid(), snapshot)
+
+        families = self.registry.collect()
+        self.assertEqual(families['t_requests_total']['values'], [[['200'], 3]])
+        self.assertEqual(families['t_seconds']['values'], [[[], [3, 0, 1.5]]])
+        # 已退出进程的计数并入 dead.json，再次抓取不丢也不重复
+        self.assertFalse(os.path.exists(os.path.join(self.dir, '{}.json'.format(dead.pid))))
+        self.assertEqual(self.registry.collect()['t_requests_total']['values'], [[['200'], 3]])
+
+    def test_update_is_cheap(self):
+        requests = telemetry.Counter('t_requests_total', 'Requests', ('code',), registry=self.registry)
+        latency = telemetry.Histogram('t_seconds', 'Latency', ('endpoint',), registry=self.registry)
+        start = time.perf_counter()
+        for i in range(50000):
+            requests.inc(code=200)
+            latency.observe(i * 1e-4, endpoint='report_gpu')
+        # 实测每次更新约 1 微秒，这里给足余量
+        self.assertLess(time.perf_counter() - start, 1.0)
+
+
+class TestRunnerTest(SimpleTestCase):
+    def test_metrics_are_not_flushed_to_server_log(self):
+        # base.testing.TestRunner 关闭了指标写盘
+        self.assertEqual(telemetry.metrics_dir(), '')
+
+
+class UtilsTest(SimpleTestCase):
+    def test_env_numbers(self):
+        with mock.patch.dict(os.environ, {'X_FLOAT': '0.5', 'X_INT': '-3', 'X_BAD': 'abc'}):
+            self.assertEqual(env_float('X_FLOAT', 2, 1.0), 1.0)
+            self.assertEqual(env_float('X_BAD', 2), 2.0)
+            self.assertEqual(env_float('X_MISSING', 2.5), 2.5)
+            self.assertEqual(env_int('X_INT', 5), -3)
+            self.assertEqual(env_int('X_INT', 5, 1), 1)
+            self.assertEqual(env_int('X_BAD', 5, 1), 5)
+
+    def test_periodic_job_is_throttled_and_never_overlaps(self):
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def work(arg):
+            calls.append(arg)
+            started.set()
+            release.wait(5)
+            raise ValueError('boom')
+
+        interval = [0.0]
+        job = PeriodicJob('test-job', work, lambda: interval[0])
+        with self.assertLogs('django.task', 'ERROR') as logs:
+            self.assertTrue(job.maybe_start(1))
+            self.assertTrue(started.wait(5))
+            # 上一次还没结束：不重叠
+            self.assertFalse(job.maybe_start(2))
+            release.set()
+            self.assertTrue(job.lock.acquire(timeout=5))
+            job.lock.release()
+        self.assertEqual(calls, [1])
+        self.assertIn('test-job failed: boom', logs.output[0])
+        # 限频：间隔内不再启动；enabled 为假时不启动
+        interval[0] = 3600
+        self.assertFalse(job.maybe_start(3))
+        job.last_start = 0.0
+        job.enabled = lambda: False
+        self.assertFalse(job.maybe_start(4))
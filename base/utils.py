@@ -1,4 +1,12 @@
+import logging
+import os
+import threading
+import time
+
 from django.contrib.auth.models import User
+from django.db import connection
+
+task_logger = logging.getLogger('django.task')
 
 
 def get_admin_config():
@@ -11,3 +19,55 @@ def get_admin_config():
             'Please login admin site and create a config for user {}!'.format(admin_users[0].username)
         )
     return admin_users[0].config.server_username, admin_users[0].config.server_private_key_path
+
+
+def env_float(name, default, minimum=0.0):
+    """数值型环境变量；无效时取默认值，有效值不小于 minimum。"""
+    try:
+        return max(minimum, float(os.getenv(name, str(default))))
+    except ValueError:
+        return float(default)
+
+
+def env_int(name, default, minimum=None):
+    """整数型环境变量；无效时取默认值，minimum 非空时有效值不小于它。"""
+    try:
+        value = int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+    return value if minimum is None else max(minimum, value)
+
+
+class PeriodicJob:
+    """调度器每个循环调用 maybe_start()：距上次启动不少于 interval() 秒、且上一次已经结束时，
+    在名为 name 的后台线程里执行 fn，不阻塞调度。enabled 非空且返回假时不启动。
+    """
+
+    def __init__(self, name, fn, interval, enabled=None):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.last_start = 0.0
+
+    def _run(self, args):
+        try:
+            self.fn(*args)
+        except Exception as exc:
+            task_logger.error('%s failed: %s', self.name, exc)
+        finally:
+            connection.close()
+            self.lock.release()
+
+    def maybe_start(self, *args):
+        if self.enabled is not None and not self.enabled():
+            return False
+        now = time.monotonic()
+        if now - self.last_start < self.interval():
+            return False
+        if not self.lock.acquire(blocking=False):
+            return False
+        self.last_start = now
+        threading.Thread(target=self._run, args=(args,), name=self.name, daemon=True).start()
+        return True
@@ -1,3 +1,43 @@
-from django.shortcuts import render
+import hmac
+import os
 
-# Create your views here.
+from django.db import close_old_connections
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse
+
+from gpu_info.cluster import cluster_gauges
+from . import telemetry
+
+
+def _metrics_allowed(request):
+    token = os.getenv('GPUTASKER_METRICS_TOKEN', '')
+    if token:
+        scheme, _, value = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+        return scheme.lower() == 'bearer' and hmac.compare_digest(value.strip().encode('utf-8'), token.encode('utf-8'))
+    if os.getenv('GPUTASKER_METRICS_PUBLIC', '0') == '1':
+        return True
+    user = request.user
+    return user.is_active and user.is_staff
+
+
+def all_families(shared=True):
+    """本进程（shared 时含同机其他进程）的计数器/直方图，加上抓取时现算的集群 gauge。"""
+    families = telemetry.REGISTRY.collect(shared=shared)
+    families.update(cluster_gauges())
+    return families
+
+
+def scheduler_families():
+    """调度器进程内 HTTP 线程调用：用完关闭本线程的数据库连接。"""
+    try:
+        return all_families(shared=False)
+    finally:
+        close_old_connections()
+
+
+def metrics(request):
+    """Prometheus 文本格式的运行时指标。"""
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    if not _metrics_allowed(request):
+        return JsonResponse({'ok': False, 'error': 'forbidden'}, status=403)
+    return HttpResponse(telemetry.render(all_families()), content_type=telemetry.CONTENT_TYPE)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""GPU Tasker 命令行客户端（只依赖标准库）：批量提交、列出、取消任务。
+
+配置（环境变量或命令行参数）：
+    GPUTASKER_URL        Master 地址，如 http://<master_host>:8888
+    GPUTASKER_API_TOKEN  后台“用户设置”里的 API Token
+
+示例：
+    # 从 JSON / JSON Lines 文件提交（每个任务至少包含 cmd、workspace）
+    python3 gputasker.py submit tasks.jsonl --group 3
+    # 超参数网格：{lr}、{bs} 会被替换，按笛卡尔积生成任务
+    python3 gputasker.py submit --workspace ~/proj --cmd 'python train.py --lr {lr} --bs {bs}' \\
+        --name 'sweep-lr{lr}-bs{bs}' --sweep lr=1e-3,1e-4 --sweep bs=32,64 --gpus 1
+    python3 gputasker.py list --status 0,1
+    python3 gputasker.py cancel 101 102 103
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import urllib.error
+import urllib.request
+
+DEFAULT_BATCH = 1000
+
+
+class ApiError(Exception):
+    pass
+
+
+class Client:
+    def __init__(self, url, token, timeout=60):
+        self.url = url.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+
+    def request(self, method, path, body=None, content_type='application/json'):
+        headers = {'Authorization': 'Bearer ' + self.token, 'Accept': 'application/json'}
+        data = None
+        if body is not None:
+            data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = content_type
+        req = urllib.request.Request(self.url + path, data=data, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                return json.loads(resp.read().decode('utf-8'))
+        except urllib.error.HTTPError as exc:
+            try:
+                payload = json.loads(exc.read().decode('utf-8'))
+            except ValueError:
+                raise ApiError('HTTP {} {}'.format(exc.code, exc.reason))
+            raise ApiError(_format_error(payload))
+        except urllib.error.URLError as exc:
+            raise ApiError('cannot reach {}: {}'.format(self.url, exc.reason))
+
+    def submit(self, tasks, defaults=None, batch=DEFAULT_BATCH):
+        """分批提交；某一批校验失败时停止，已提交的批次不回滚。返回全部新任务 id。"""
+        ids = []
+        for i in range(0, len(tasks), batch):
+            result = self.request('POST', '/api/v1/tasks/', {'defaults': defaults or {}, 'tasks': tasks[i:i + batch]})
+            ids.extend(result['ids'])
+        return ids
+
+    def list(self, status=None, group=None, limit=100):
+        query = {'limit': str(limit)}
+        if status:
+            query['status'] = status
+        if group:
+            query['group'] = str(group)
+        path = '/api/v1/tasks/?' + '&'.join('{}={}'.format(k, urllib.request.quote(v)) for k, v in query.items())
+        return self.request('GET', path)['tasks']
+
+    def cancel(self, ids):
+        return self.request('POST', '/api/v1/tasks/cancel/', {'ids': ids})
+
+
+def _format_error(payload):
+    message = payload.get('error', 'unknown_error')
+    for item in payload.get('errors', [])[:20]:
+        fields = '; '.join('{}: {}'.format(k, ', '.join(v)) for k, v in item['errors'].items())
+        message += '\n  task #{}: {}'.format(item['index'], fields)
+    return message
+
+
+def _load_tasks(path):
+    stream = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    with stream:
+        text = stream.read()
+    stripped = text.lstrip()
+    if stripped.startswith('[') or stripped.startswith('{"tasks"'):
+        payload = json.loads(text)
+        return payload if isinstance(payload, list) else payload['tasks']
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def _expand_sweep(args):
+    axes = []
+    for spec in args.sweep or []:
+        key, _, values = spec.partition('=')
+        if not key or not values:
+            raise SystemExit('invalid --sweep {!r}, expected key=v1,v2'.format(spec))
+        axes.append((key, values.split(',')))
+    keys = [key for key, _ in axes]
+    tasks = []
+    for combo in itertools.product(*(values for _, values in axes)):
+        params = dict(zip(keys, combo))
+        task = {'cmd': args.cmd.format(**params)}
+        if args.name:
+            task['name'] = args.name.format(**params)
+        tasks.append(task)
+    return tasks
+
+
+def cmd_submit(client, args):
+    if args.cmd:
+        tasks = _expand_sweep(args)
+    elif args.file:
+        tasks = _load_tasks(args.file)
+    else:
+        raise SystemExit('submit needs a task file or --cmd')
+    defaults = {}
+    for key in ('workspace', 'group', 'priority', 'metric_patterns'):
+        value = getattr(args, key)
+        if value is not None:
+            defaults[key] = value
+    if args.gpus is not None:
+        defaults['gpu_requirement'] = args.gpus
+    if args.not_ready:
+        defaults['ready'] = False
+    ids = client.submit(tasks, defaults, batch=args.batch)
+    print('submitted {} tasks: {}'.format(len(ids), _id_ranges(ids)))
+
+
+def _id_ranges(ids):
+    ranges = []
+    for key, group in itertools.groupby(enumerate(sorted(ids)), lambda p: p[1] - p[0]):
+        group = [v for _, v in group]
+        ranges.append(str(group[0]) if len(group) == 1 else '{}-{}'.format(group[0], group[-1]))
+    return ','.join(ranges)
+
+
+def cmd_list(client, args):
+    tasks = client.list(status=args.status, group=args.group, limit=args.limit)
+    print('{:>8}  {:<10}  {:>4}  {:>4}  {}'.format('ID', 'STATUS', 'GPU', 'PRI', 'NAME'))
+    for task in tasks:
+        print('{:>8}  {:<10}  {:>4}  {:>4}  {}'.format(
+            task['id'], task['status_display'], task['gpu_requirement'], task['priority'], task['name']))
+
+
+def cmd_cancel(client, args):
+    ids = list(args.ids)
+    if not ids:
+        ids = [int(token) for token in sys.stdin.read().split()]
+    result = client.cancel(ids)
+    print('cancelled {} queued, stopping {} running'.format(result['cancelled'], result['kill_queued']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='GPU Tasker command line client')
+    parser.add_argument('--url', default=os.environ.get('GPUTASKER_URL', 'http://127.0.0.1:8888'))
+    parser.add_argument('--token', default=os.environ.get('GPUTASKER_API_TOKEN', ''))
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('submit', help='submit tasks from a JSON/JSONL file (- for stdin) or a --cmd sweep')
+    p.add_argument('file', nargs='?')
+    p.add_argument('--cmd', help='command template, {key} is replaced by --sweep values')
+    p.add_argument('--name', help='name template')
+    p.add_argument('--sweep', action='append', metavar='KEY=V1,V2', help='sweep axis, may be repeated')
+    p.add_argument('--workspace')
+    p.add_argument('--group', type=int)
+    p.add_argument('--gpus', type=int)
+    p.add_argument('--priority', type=int)
+    p.add_argument('--metric-patterns', dest='metric_patterns')
+    p.add_argument('--not-ready', action='store_true', help='submit as not ready (won\'t be scheduled)')
+    p.add_argument('--batch', type=int, default=DEFAULT_BATCH, help='tasks per request')
+    p.set_defaults(func=cmd_submit)
+
+    p = sub.add_parser('list', help='list your tasks, newest first')
+    p.add_argument('--status', help='comma separated status codes, e.g. 0,1')
+    p.add_argument('--group', type=int)
+    p.add_argument('--limit', type=int, default=100)
+    p.set_defaults(func=cmd_list)
+
+    p = sub.add_parser('cancel', help='cancel queued tasks and kill running ones (ids from args or stdin)')
+    p.add_argument('ids', nargs='*', type=int)
+    p.set_defaults(func=cmd_cancel)
+
+    args = parser.parse_args(argv)
+    if not args.token:
+        parser.error('missing API token (--token or GPUTASKER_API_TOKEN)')
+    try:
+        args.func(Client(args.url, args.token), args)
+    except ApiError as exc:
+        print('error: {}'.format(exc), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
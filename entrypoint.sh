@@ -4,4 +4,5 @@ python manage.py collectstatic --no-input
 
 uwsgi --ini /gpu_tasker/uwsgi/uwsgi.ini
 
-python main.py
+# exec：docker stop 的 SIGTERM 直接送达调度器，优雅退出
+exec python main.py
@@ -1,11 +1,12 @@
 import os
+from datetime import timedelta
 
 from django.contrib import admin, messages
-from django.urls import reverse
+from django.db.models import BooleanField, Count, ExpressionWrapper, Q
 from django.utils import timezone
 
 from base.utils import get_admin_config
-from .models import GPUServer, GPUInfo
+from .models import GPUServer, GPUInfo, GPUProcess, gpu_update_mode, node_stale_seconds
 from .utils import start_node_agent, stop_node_agent, restart_node_agent
 from .utils import build_report_gpu_url
 
@@ -17,6 +18,9 @@ class GPUInfoInline(admin.TabularInline):
 
     show_change_link = True
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('server').prefetch_related('gpu_processes')
+
     def usernames(self, obj):
         return obj.usernames()
 
@@ -43,7 +47,7 @@ class GPUInfoInline(admin.TabularInline):
 
 @admin.register(GPUServer)
 class GPUServerAdmin(admin.ModelAdmin):
-    list_display = ('ip', 'hostname', 'port', 'available_status', 'can_use', 'last_report_at', 'report_token')
+    list_display = ('ip', 'hostname', 'port', 'available_status', 'free_gpus', 'can_use', 'last_report_at', 'report_token')
     list_editable = ('can_use',)
     search_fields = ('ip', 'hostname', 'port', 'valid', 'can_use')
     list_display_links = ('ip',)
@@ -72,18 +76,30 @@ class GPUServerAdmin(admin.ModelAdmin):
     def has_delete_permission(self, request, obj=None):
         return request.user.is_superuser
 
+    def get_queryset(self, request):
+        # 可用状态与空闲 GPU 数随列表一起算出：配置每个请求只读一次，不再逐行查 GPU
+        if gpu_update_mode() == 'report':
+            available = Q(last_report_at__gte=timezone.now() - timedelta(seconds=node_stale_seconds()))
+        else:
+            available = Q(valid=True)
+        return super().get_queryset(request).annotate(
+            is_available=ExpressionWrapper(available, output_field=BooleanField()),
+            gpu_total=Count('gpus'),
+            gpu_free=Count('gpus', filter=Q(gpus__use_by_self=False, gpus__complete_free=True)),
+        )
+
     def available_status(self, obj: GPUServer):
-        update_mode = (os.getenv('GPUTASKER_GPU_UPDATE_MODE', 'report') or 'report').strip().lower()
-        if update_mode != 'report':
-            return bool(obj.valid)
-        stale_seconds = int(os.getenv('GPUTASKER_NODE_STALE_SECONDS', '180'))
-        if obj.last_report_at is None:
-            return False
-        delta = timezone.now() - obj.last_report_at
-        return delta.total_seconds() <= stale_seconds
+        return bool(obj.is_available)
 
     available_status.boolean = True
     available_status.short_description = '是否可用'
+    available_status.admin_order_field = 'is_available'
+
+    def free_gpus(self, obj: GPUServer):
+        return '{} / {}'.format(obj.gpu_free, obj.gpu_total)
+
+    free_gpus.short_description = '空闲GPU'
+    free_gpus.admin_order_field = 'gpu_free'
 
     actions = ('restart_selected_agents',)
 
@@ -141,6 +157,24 @@ class GPUServerAdmin(admin.ModelAdmin):
         super().delete_queryset(request, queryset)
 
 
+class GPUProcessInline(admin.TabularInline):
+    model = GPUProcess
+    fields = ('pid', 'username', 'command', 'gpu_memory_usage')
+    readonly_fields = ('pid', 'username', 'command', 'gpu_memory_usage')
+
+    def get_extra(self, request, obj, **kwargs):
+        return 0
+
+    def has_add_permission(self, request, obj):
+        return False
+
+    def has_change_permission(self, request, obj):
+        return False
+
+    def has_delete_permission(self, request, obj):
+        return False
+
+
 @admin.register(GPUInfo)
 class GPUInfoAdmin(admin.ModelAdmin):
     list_display = ('index', 'name', 'server', 'utilization', 'memory_usage', 'usernames', 'complete_free', 'update_at')
@@ -148,7 +182,11 @@ class GPUInfoAdmin(admin.ModelAdmin):
     search_fields = ('uuid', 'name', 'memory_used', 'server',)
     list_display_links = ('name',)
     ordering = ('server', 'index')
-    readonly_fields = ('uuid', 'name', 'index', 'utilization', 'memory_total', 'memory_used','server', 'processes', 'use_by_self', 'complete_free', 'update_at')
+    readonly_fields = ('uuid', 'name', 'index', 'utilization', 'memory_total', 'memory_used','server', 'use_by_self', 'complete_free', 'update_at')
+    inlines = (GPUProcessInline,)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('server').prefetch_related('gpu_processes')
 
     def usernames(self, obj):
         return obj.usernames()
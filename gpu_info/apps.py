@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class GpuInfoConfig(AppConfig):
     name = 'gpu_info'
     verbose_name = 'GPU管理'
+
+    def ready(self):
+        # 注册上报鉴权缓存的失效信号
+        from . import report_auth  # noqa: F401
@@ -0,0 +1,186 @@
+"""集群概况快照：供大屏与脚本轮询的只读数据（/api/v1/cluster/）。
+
+轮询方原先抓后台 HTML 看空闲 GPU，每次都要渲染整页。这里把服务器/GPU 状态、排队深度、
+各用户运行中的任务汇总成一份快照：
+
+- 快照在进程内缓存，最多每个上报周期重算一次（GPUTASKER_CLUSTER_SNAPSHOT_SECONDS，
+  默认取节点上报周期 GPUTASKER_REPORT_INTERVAL=30；ssh 模式下取主循环间隔）；
+  并发请求在重算时只有一个去查库，其余等待同一份结果；
+- 快照带 ETag（内容摘要，不含生成时间），客户端带 If-None-Match 轮询时未变化直接 304。
+
+缓存是进程级的：多 worker 部署时每个进程各自每周期最多重算一次。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import timedelta
+
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from base.telemetry import gauge
+from task.models import GPUTask
+from .models import GPUServer, GPUInfo, GPUProcess, gpu_update_mode, node_stale_seconds
+
+
+def snapshot_seconds():
+    value = os.getenv('GPUTASKER_CLUSTER_SNAPSHOT_SECONDS')
+    if value is None:
+        if gpu_update_mode() == 'report':
+            value = os.getenv('GPUTASKER_REPORT_INTERVAL', '30')
+        else:
+            value = os.getenv('GPUTASKER_LOOP_INTERVAL_SECONDS', '10')
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return 30.0
+
+
+def _timestamp(dt):
+    return int(dt.timestamp()) if dt is not None else None
+
+
+def build_snapshot():
+    """查库生成快照数据（固定 5 条查询，与服务器/GPU/任务数量无关）。"""
+    now = timezone.now()
+    report_mode = gpu_update_mode() == 'report'
+    alive_after = now - timedelta(seconds=node_stale_seconds())
+
+    users_by_gpu = {}
+    for gpu_id, username in GPUProcess.objects.order_by('gpu_id', 'pid').values_list('gpu_id', 'username'):
+        names = users_by_gpu.setdefault(gpu_id, [])
+        if username and username not in names:
+            names.append(username)
+
+    gpus_by_server = {}
+    for gpu in GPUInfo.objects.order_by('server_id', 'index').values(
+            'uuid', 'index', 'name', 'utilization', 'memory_total', 'memory_used', 'server_id',
+            'use_by_self', 'busy_by_log_id', 'complete_free'):
+        server_id = gpu.pop('server_id')
+        gpu['users'] = users_by_gpu.get(gpu['uuid'], [])
+        # 与调度一致：独占需求只认完全空闲且未被本系统占用的卡
+        gpu['free'] = gpu['complete_free'] and not gpu['use_by_self']
+        gpus_by_server.setdefault(server_id, []).append(gpu)
+
+    servers = []
+    for server in GPUServer.objects.order_by('ip', 'port').values(
+            'id', 'ip', 'hostname', 'port', 'valid', 'can_use', 'last_report_at'):
+        if report_mode:
+            available = server['last_report_at'] is not None and server['last_report_at'] >= alive_after
+        else:
+            available = server['valid']
+        gpus = gpus_by_server.get(server['id'], [])
+        servers.append({
+            'id': server['id'],
+            'ip': server['ip'],
+            'hostname': server['hostname'],
+            'port': server['port'],
+            'available': available,
+            'can_use': server['can_use'],
+            'last_report_at': _timestamp(server['last_report_at']),
+            'gpu_total': len(gpus),
+            'gpu_free': sum(1 for gpu in gpus if gpu['free']),
+            'gpus': gpus,
+        })
+
+    by_priority = {
+        str(row['priority']): row['n']
+        for row in GPUTask.objects.filter(status=0).values('priority').annotate(n=Count('id')).order_by('-priority')
+    }
+    running_by_user = {
+        row['user__username']: {'tasks': row['n'], 'gpus': row['gpus'] or 0}
+        for row in GPUTask.objects.filter(status=1).values('user__username')
+        .annotate(n=Count('id'), gpus=Sum('gpu_requirement')).order_by('user__username')
+    }
+    schedulable = [s for s in servers if s['available'] and s['can_use']]
+    return {
+        'generated_at': int(now.timestamp()),
+        'summary': {
+            'servers': len(servers),
+            'servers_available': sum(1 for s in servers if s['available']),
+            'gpus': sum(s['gpu_total'] for s in servers),
+            'gpus_free': sum(s['gpu_free'] for s in schedulable),
+            'queued': sum(by_priority.values()),
+            'running': sum(u['tasks'] for u in running_by_user.values()),
+        },
+        'servers': servers,
+        'queue': {'by_priority': by_priority},
+        'running': {'by_user': running_by_user},
+    }
+
+
+class Snapshot:
+    __slots__ = ('data', 'body', 'etag', 'created_at')
+
+    def __init__(self, data, created_at):
+        self.data = data
+        self.created_at = created_at
+        content = dict(data)
+        generated_at = content.pop('generated_at')
+        digest = hashlib.sha1(json.dumps(content, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+        # 内容相同但生成时间不同的两份响应语义等价，用弱 ETag
+        self.etag = 'W/"{}"'.format(digest.hexdigest()[:20])
+        self.body = json.dumps({'ok': True, **content, 'generated_at': generated_at},
+                               ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class ClusterSnapshotCache:
+    """进程内快照缓存：过期后由第一个请求重算，其余请求等待同一次结果。"""
+
+    def __init__(self, ttl_seconds=None, builder=build_snapshot, clock=time.monotonic):
+        self._ttl = ttl_seconds
+        self._builder = builder
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    @property
+    def ttl(self):
+        return snapshot_seconds() if self._ttl is None else self._ttl
+
+    def _fresh(self, snapshot):
+        return snapshot is not None and self._clock() - snapshot.created_at < self.ttl
+
+    def get(self):
+        snapshot = self._snapshot
+        if self._fresh(snapshot):
+            return snapshot
+        with self._lock:
+            snapshot = self._snapshot
+            if not self._fresh(snapshot):
+                snapshot = Snapshot(self._builder(), self._clock())
+                self._snapshot = snapshot
+        return snapshot
+
+    def max_age(self, snapshot):
+        """距下次重算的剩余秒数，用于 Cache-Control。"""
+        return max(0, int(self.ttl - (self._clock() - snapshot.created_at)))
+
+    def clear(self):
+        with self._lock:
+            self._snapshot = None
+
+
+snapshot_cache = ClusterSnapshotCache()
+
+
+def cluster_gauges():
+    """/metrics 抓取时的集群状态 gauge，复用概况快照（最多滞后一个快照周期）。"""
+    data = snapshot_cache.get().data
+    gpus = []
+    for server in data['servers']:
+        name = '{}:{}'.format(server['ip'], server['port'])
+        locked = sum(1 for gpu in server['gpus'] if gpu['use_by_self'])
+        free = sum(1 for gpu in server['gpus'] if gpu['free'])
+        gpus += [((name, 'locked'), locked), ((name, 'free'), free), ((name, 'busy'), server['gpu_total'] - locked - free)]
+    return dict([
+        gauge('gputasker_gpus', 'GPU 数量：locked 被本系统任务占用，free 完全空闲，busy 被其他进程使用',
+              gpus, ('server', 'state')),
+        gauge('gputasker_stale_nodes', '不可用的节点数（上报模式下超过 GPUTASKER_NODE_STALE_SECONDS 未上报）',
+              [((), data['summary']['servers'] - data['summary']['servers_available'])]),
+        gauge('gputasker_ready_queue_depth', '准备就绪（排队中）的任务数',
+              [((priority,), n) for priority, n in data['queue']['by_priority'].items()], ('priority',)),
+        gauge('gputasker_running_tasks', '运行中的任务数', [((), data['summary']['running'])]),
+    ])
@@ -0,0 +1,254 @@
+"""调度器进程内的集群状态缓存：服务器与 GPU 的紧凑内存模型。
+
+以前每轮调度和每个 run_task 线程都重新查 GPUServer、逐台查 GPUInfo 选卡，而两轮之间变化的只有最近上报过的那些行。
+ClusterState 在调度器进程里保留一份服务器/GPU 视图：
+
+- 每台服务器一条 ServerRecord，其 GPU 按序号存成数组（GPURecord，均为 __slots__ 记录）；
+- 每轮调度开始时 refresh()：按 update_at 增量拉取变化的服务器与 GPU（与上次拉到的最大 update_at 重叠
+  POLL_OVERLAP_SECONDS，防止同一时刻提交的写入被漏掉）；删除的服务器/GPU 靠定期全量重建
+  （GPUTASKER_CLUSTER_STATE_RESYNC_SECONDS，默认 300 秒）清掉；
+- 选卡只读内存（ServerRecord.get_available_gpus 与 GPUServer 同义），不查库；
+- 占用/释放仍以数据库的条件更新为准（跨进程互斥），成功后经 gpu_info.models 的监听写穿到缓存，
+  同一轮里后派发的任务立刻看到前面任务占用的卡。缓存与数据库短暂不一致时最多导致一次占用失败，
+  下一轮增量拉取即纠正。
+
+节点上报写在 Web 进程里，调度器看不到它的内存事件，所以用增量拉取而不是订阅。
+"""
+import os
+import threading
+import time
+from datetime import timedelta
+
+from django.utils import timezone
+
+from base.telemetry import Counter
+from .models import GPUInfo, GPUServer, add_lock_listener, gpu_update_mode, node_stale_seconds, \
+    remove_lock_listener
+
+POLL_OVERLAP_SECONDS = 5
+
+STATE_REFRESHES = Counter(
+    'gputasker_cluster_state_refreshes_total', '调度器集群状态缓存刷新次数：full 全量重建，poll 增量拉取', ('mode',))
+STATE_ROWS = Counter(
+    'gputasker_cluster_state_rows_total', '集群状态缓存刷新读到的行数', ('kind',))
+
+_SERVER_FIELDS = ('id', 'ip', 'hostname', 'port', 'valid', 'can_use', 'last_report_at', 'update_at')
+_GPU_FIELDS = ('uuid', 'server_id', 'index', 'utilization', 'memory_total', 'memory_used', 'use_by_self',
+               'busy_by_log_id', 'complete_free', 'update_at')
+
+
+def resync_seconds():
+    try:
+        return max(0.0, float(os.getenv('GPUTASKER_CLUSTER_STATE_RESYNC_SECONDS', '300')))
+    except ValueError:
+        return 300.0
+
+
+def _latest(seen, rows):
+    return max([row['update_at'] for row in rows] + ([seen] if seen is not None else []), default=None)
+
+
+class GPURecord:
+    __slots__ = ('uuid', 'index', 'utilization', 'memory_total', 'memory_used', 'use_by_self', 'busy_by_log_id',
+                 'complete_free')
+
+    def __init__(self, row):
+        self.uuid = row['uuid']
+        self.update(row)
+
+    def update(self, row):
+        self.index = row['index']
+        self.utilization = row['utilization']
+        self.memory_total = row['memory_total']
+        self.memory_used = row['memory_used']
+        self.use_by_self = row['use_by_self']
+        self.busy_by_log_id = row['busy_by_log_id']
+        self.complete_free = row['complete_free']
+
+    def check_available(self, exclusive, memory, utilization):
+        # 与 GPUInfo.check_available 一致
+        if exclusive:
+            return not self.use_by_self and self.complete_free
+        return not self.use_by_self and self.memory_total - self.memory_used > memory \
+            and 100 - self.utilization > utilization
+
+
+class ServerRecord:
+    __slots__ = ('id', 'ip', 'hostname', 'port', 'valid', 'can_use', 'last_report_at', 'gpus')
+
+    def __init__(self, row):
+        self.id = row['id']
+        self.gpus = []
+        self.update(row)
+
+    def update(self, row):
+        self.ip = row['ip']
+        self.hostname = row['hostname']
+        self.port = row['port']
+        self.valid = row['valid']
+        self.can_use = row['can_use']
+        self.last_report_at = row['last_report_at']
+
+    def is_available(self, now=None):
+        # 与 GPUServer.get_available_gpus 的节点可用性判断一致
+        if not self.can_use:
+            return False
+        if gpu_update_mode() == 'report':
+            if self.last_report_at is None:
+                return False
+            now = now or timezone.now()
+            return (now - self.last_report_at).total_seconds() <= node_stale_seconds()
+        return self.valid
+
+    def get_available_gpus(self, gpu_num, exclusive, memory, utilization):
+        if not self.is_available():
+            return None
+        available = [gpu.index for gpu in self.gpus if gpu.check_available(exclusive, memory, utilization)]
+        return available if len(available) >= gpu_num else None
+
+    def gpu(self, index):
+        for gpu in self.gpus:
+            if gpu.index == index:
+                return gpu
+        return None
+
+    def to_model(self):
+        """供 run_task 写运行记录、占用 GPU 与 ssh 使用的 GPUServer 实例（不查库；其余字段按需延迟加载）。"""
+        return GPUServer.from_db(
+            'default',
+            ['id', 'ip', 'hostname', 'port', 'valid', 'can_use', 'last_report_at'],
+            [self.id, self.ip, self.hostname, self.port, self.valid, self.can_use, self.last_report_at],
+        )
+
+
+class ClusterState:
+    def __init__(self, resync=None, clock=time.monotonic):
+        self._resync = resync
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._servers = {}
+        # uuid -> 所在服务器 id，GPU 换了服务器时据此从旧数组里移除
+        self._gpu_server = {}
+        self._server_seen = None
+        self._gpu_seen = None
+        self._loaded_at = None
+
+    @property
+    def resync_seconds(self):
+        return resync_seconds() if self._resync is None else self._resync
+
+    def enable(self):
+        """开始接收本进程 GPU 占用/释放的写穿。"""
+        add_lock_listener(self.on_lock)
+        return self
+
+    def disable(self):
+        remove_lock_listener(self.on_lock)
+
+    def _apply_gpu(self, row):
+        uuid, server_id = row['uuid'], row['server_id']
+        previous = self._gpu_server.get(uuid)
+        record = None
+        if previous is not None and previous in self._servers:
+            old = self._servers[previous]
+            record = next((gpu for gpu in old.gpus if gpu.uuid == uuid), None)
+            if record is not None and previous != server_id:
+                old.gpus.remove(record)
+        server = self._servers.get(server_id)
+        if server is None:
+            # 服务器还不在视图里：下次拉取（仍在重叠窗口内）或全量重建时补上
+            self._gpu_server.pop(uuid, None)
+            return
+        if record is None:
+            record = GPURecord(row)
+            server.gpus.append(record)
+        else:
+            record.update(row)
+            if previous != server_id:
+                server.gpus.append(record)
+        self._gpu_server[uuid] = server_id
+        server.gpus.sort(key=lambda gpu: gpu.index)
+
+    def load(self):
+        """全量重建（2 条查询）。"""
+        servers = {row['id']: row for row in GPUServer.objects.order_by().values(*_SERVER_FIELDS)}
+        gpus = list(GPUInfo.objects.order_by().values(*_GPU_FIELDS))
+        with self._lock:
+            self._servers = {pk: ServerRecord(row) for pk, row in servers.items()}
+            self._gpu_server = {}
+            for row in gpus:
+                self._apply_gpu(row)
+            self._server_seen = _latest(None, servers.values())
+            self._gpu_seen = _latest(None, gpus)
+            self._loaded_at = self._clock()
+        STATE_REFRESHES.inc(mode='full')
+        STATE_ROWS.inc(len(servers), kind='server')
+        STATE_ROWS.inc(len(gpus), kind='gpu')
+
+    def _since(self, seen):
+        return (seen or timezone.now()) - timedelta(seconds=POLL_OVERLAP_SECONDS)
+
+    def poll(self):
+        """增量拉取 update_at 在上次拉到的最大值（减去重叠窗口）之后的服务器与 GPU（2 条查询）。"""
+        # 去掉模型默认排序，按 update_at 索引取范围
+        servers = list(
+            GPUServer.objects.filter(update_at__gte=self._since(self._server_seen)).order_by().values(*_SERVER_FIELDS))
+        gpus = list(GPUInfo.objects.filter(update_at__gte=self._since(self._gpu_seen)).order_by().values(*_GPU_FIELDS))
+        with self._lock:
+            for row in servers:
+                record = self._servers.get(row['id'])
+                if record is None:
+                    self._servers[row['id']] = ServerRecord(row)
+                else:
+                    record.update(row)
+            for row in gpus:
+                self._apply_gpu(row)
+            self._server_seen = _latest(self._server_seen, servers)
+            self._gpu_seen = _latest(self._gpu_seen, gpus)
+        STATE_REFRESHES.inc(mode='poll')
+        STATE_ROWS.inc(len(servers), kind='server')
+        STATE_ROWS.inc(len(gpus), kind='gpu')
+
+    def refresh(self):
+        if self._loaded_at is None or self._clock() - self._loaded_at >= self.resync_seconds:
+            self.load()
+        else:
+            self.poll()
+
+    def servers(self, server_ids=None):
+        """按 IP 排序（与 GPUServer 的默认排序一致）的服务器记录；server_ids 非空时只取其中的。"""
+        with self._lock:
+            records = list(self._servers.values()) if server_ids is None else \
+                [self._servers[pk] for pk in server_ids if pk in self._servers]
+        return sorted(records, key=lambda record: record.ip)
+
+    def get(self, server_id):
+        return self._servers.get(server_id)
+
+    def max_unlocked_gpus(self, server_ids):
+        """这些服务器中单台上未被本系统占用的 GPU 数的最大值。"""
+        with self._lock:
+            return max(
+                (sum(1 for gpu in self._servers[pk].gpus if not gpu.use_by_self)
+                 for pk in server_ids if pk in self._servers),
+                default=0,
+            )
+
+    def on_lock(self, server_id, gpu_indices, busy_by_log_id, locked, count):
+        """数据库占用/释放成功后写穿到缓存。"""
+        with self._lock:
+            server = self._servers.get(server_id)
+            if server is None:
+                return
+            for index in gpu_indices:
+                gpu = server.gpu(index)
+                if gpu is None:
+                    continue
+                if locked:
+                    # 部分占用失败说明其余的卡已被占用：一律视为占用，归属以下次拉取为准
+                    gpu.use_by_self = True
+                    if count == len(gpu_indices):
+                        gpu.busy_by_log_id = busy_by_log_id
+                elif count and (busy_by_log_id is None or gpu.busy_by_log_id == busy_by_log_id):
+                    gpu.use_by_self = False
+                    gpu.busy_by_log_id = None
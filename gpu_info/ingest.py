@@ -0,0 +1,120 @@
+"""异步上报接入：有界线程池执行 DB 写入。
+
+ASGI 事件循环负责接住大量 agent 连接，真正的 ORM 写入交给固定大小的线程池；
+排队任务数超过上限时直接返回 503，让 agent 在下一个上报周期重试，而不是无限堆积。
+"""
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import OperationalError, close_old_connections, connection
+
+from base.telemetry import Counter, Histogram
+from base.utils import env_int
+
+REPORT_REQUESTS = Counter('gputasker_report_requests_total', '节点上报请求数（按接口与 HTTP 状态码）', ('endpoint', 'code'))
+REPORT_SECONDS = Histogram('gputasker_report_seconds', '节点上报请求处理耗时（秒）', ('endpoint',))
+REPORT_DB_SECONDS = Histogram(
+    'gputasker_report_db_seconds', '节点上报写库耗时（秒，含等待数据库写锁的时间）', ('endpoint',),
+)
+DB_LOCKED = Counter('gputasker_db_locked_total', '节点上报因数据库被锁而失败的次数', ('endpoint',))
+
+
+class IngestOverloaded(Exception):
+    pass
+
+
+def _run_job(fn, args, kwargs):
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        # 与 WSGI 的 request_finished 对齐：用完即按 CONN_MAX_AGE 回收连接
+        close_old_connections()
+
+
+class BoundedIngestExecutor:
+    def __init__(self, workers=None, max_pending=None):
+        self.workers = workers or env_int('GPUTASKER_INGEST_WORKERS', 4, 1)
+        self.max_pending = max_pending or env_int('GPUTASKER_INGEST_MAX_PENDING', 1000, 1)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers,
+                        thread_name_prefix='gputasker-ingest',
+                    )
+        return self._executor
+
+    async def run(self, fn, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            raise IngestOverloaded()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._get_executor(),
+                functools.partial(_run_job, fn, args, kwargs),
+            )
+        finally:
+            self._slots.release()
+
+
+ingest_executor = BoundedIngestExecutor()
+
+
+def instrument_report(endpoint):
+    """记录上报接口的请求数与耗时；同步、异步视图都适用。"""
+    def observe(start, response):
+        REPORT_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+        REPORT_REQUESTS.inc(endpoint=endpoint, code=response.status_code)
+
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                start = time.perf_counter()
+                response = await view(request, *args, **kwargs)
+                observe(start, response)
+                return response
+        else:
+            @functools.wraps(view)
+            def wrapper(request, *args, **kwargs):
+                start = time.perf_counter()
+                response = view(request, *args, **kwargs)
+                observe(start, response)
+                return response
+        return wrapper
+    return decorator
+
+
+def instrument_db(endpoint):
+    """记录一次上报写库的查询耗时，以及“database is locked”失败次数。用于 WSGI/ASGI 共用的写库函数。"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            spent = [0.0]
+
+            def timed(execute, sql, params, many, context):
+                start = time.perf_counter()
+                try:
+                    return execute(sql, params, many, context)
+                finally:
+                    spent[0] += time.perf_counter() - start
+
+            try:
+                with connection.execute_wrapper(timed):
+                    return fn(*args, **kwargs)
+            except OperationalError as exc:
+                if 'locked' in str(exc):
+                    DB_LOCKED.inc(endpoint=endpoint)
+                raise
+            finally:
+                REPORT_DB_SECONDS.observe(spent[0], endpoint=endpoint)
+        return wrapper
+    return decorator
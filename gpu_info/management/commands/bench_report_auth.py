@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import queue
+import random
+import secrets
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from base.benchmark import temporary_database, format_latency_ms
+from gpu_info.models import GPUServer
+from gpu_info.report_auth import ReportTokenCache, LivenessRecorder
+
+
+class Command(BaseCommand):
+    help = 'Microbenchmark report endpoint auth overhead (per-request DB lookup vs cached token + batched liveness).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--agents', type=int, default=500, help='Number of simulated node agents.')
+        parser.add_argument('--rounds', type=int, default=20, help='Reports per agent.')
+        parser.add_argument('--workers', type=int, default=16, help='Concurrent request handler threads.')
+        parser.add_argument('--flush-interval', type=float, default=5.0, help='Liveness flush interval (seconds).')
+
+    def handle(self, *args, **options):
+        agents = options['agents']
+        rounds = options['rounds']
+        workers = options['workers']
+
+        with temporary_database():
+            GPUServer.objects.bulk_create([
+                GPUServer(ip='10.0.{}.{}'.format(i // 250, i % 250), port=22, report_token=secrets.token_urlsafe(32))
+                for i in range(agents)
+            ])
+            tokens = list(GPUServer.objects.values_list('report_token', flat=True))
+            requests = tokens * rounds
+            random.Random(0).shuffle(requests)
+
+            def baseline(token):
+                server = GPUServer.objects.get(report_token=token)
+                server.valid = True
+                server.last_report_at = timezone.now()
+                server.save(update_fields=['valid', 'last_report_at'])
+
+            cache = ReportTokenCache(ttl_seconds=60)
+            recorder = LivenessRecorder(flush_interval=options['flush_interval'])
+
+            def cached(token):
+                server = cache.resolve(token)
+                recorder.touch(server.pk)
+
+            for name, fn in (('db-per-request', baseline), ('cached+batched', cached)):
+                latencies, errors, elapsed = self._run(fn, requests, workers)
+                recorder.flush()
+                self.stdout.write(
+                    '[{}] agents={} requests={} workers={} errors={} throughput={:.0f} req/s {}'.format(
+                        name, agents, len(requests), workers, errors,
+                        len(requests) / elapsed if elapsed > 0 else 0.0,
+                        format_latency_ms(latencies),
+                    )
+                )
+
+    @staticmethod
+    def _run(fn, requests, workers):
+        q = queue.Queue()
+        for token in requests:
+            q.put(token)
+        latencies = []
+        errors = [0]
+        lock = threading.Lock()
+
+        def worker():
+            local = []
+            local_errors = 0
+            try:
+                while True:
+                    try:
+                        token = q.get_nowait()
+                    except queue.Empty:
+                        break
+                    t0 = time.perf_counter()
+                    try:
+                        fn(token)
+                    except Exception:
+                        local_errors += 1
+                    local.append(time.perf_counter() - t0)
+            finally:
+                connection.close()
+            with lock:
+                latencies.extend(local)
+                errors[0] += local_errors
+
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return latencies, errors[0], time.perf_counter() - start
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from base.benchmark import temporary_database, format_latency_ms
+from gpu_info import timeseries
+from gpu_info.models import GPUServer, GPUSampleRollup, GPUUserRollup
+
+
+class Command(BaseCommand):
+    help = 'Benchmark GPU time-series insert rate and range-query latency.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--gpus', type=int, default=500, help='Number of GPUs (8 per server).')
+        parser.add_argument('--days', type=int, default=30, help='Days of history covered by hourly rollups.')
+        parser.add_argument('--minute-days', type=float, default=1.0, help='Days of history covered by 1-minute rollups.')
+        parser.add_argument('--raw-minutes', type=int, default=60, help='Minutes of raw samples inserted through record_samples.')
+        parser.add_argument('--interval', type=int, default=30, help='Agent report interval (seconds).')
+        parser.add_argument('--users', type=int, default=50, help='Number of distinct GPU users.')
+        parser.add_argument('--queries', type=int, default=20, help='Repetitions per query shape.')
+
+    def handle(self, *args, **options):
+        gpus_per_server = 8
+        n_servers = max(1, (options['gpus'] + gpus_per_server - 1) // gpus_per_server)
+        rng = random.Random(0)
+        users = ['user{:02d}'.format(i) for i in range(options['users'])]
+        now = int(time.time()) // 3600 * 3600
+
+        with temporary_database():
+            GPUServer.objects.bulk_create([
+                GPUServer(ip='10.1.{}.{}'.format(i // 250, i % 250), report_token='bench-{}'.format(i))
+                for i in range(n_servers)
+            ])
+            servers = list(GPUServer.objects.all())
+            owner = {(s.pk, g): rng.choice(users) for s in servers for g in range(gpus_per_server)}
+
+            # 1) 原始采样写入：按真实上报路径，每个节点每次上报一批
+            steps = options['raw_minutes'] * 60 // options['interval']
+            raw_start = now - steps * options['interval']
+            rows = 0
+            t0 = time.perf_counter()
+            for step in range(steps):
+                ts = raw_start + step * options['interval']
+                for s in servers:
+                    payload = [
+                        {
+                            'index': g,
+                            'utilization': rng.randint(0, 100),
+                            'memory_total': 81920,
+                            'memory_used': rng.randint(0, 81920),
+                            'processes': [{'username': owner[(s.pk, g)]}] if rng.random() < 0.7 else [],
+                        }
+                        for g in range(gpus_per_server)
+                    ]
+                    rows += timeseries.record_samples(s, payload, ts=ts, force=True)
+            elapsed = time.perf_counter() - t0
+            self.stdout.write('[insert] rows={} reports={} elapsed={:.2f}s rate={:.0f} samples/s'.format(
+                rows, steps * len(servers), elapsed, rows / elapsed if elapsed else 0.0))
+
+            t0 = time.perf_counter()
+            timeseries.rollup(now=now + timeseries.ROLLUP_GRACE_SECONDS)
+            self.stdout.write('[rollup] raw->1m->1h over {} min of raw: {:.2f}s'.format(
+                options['raw_minutes'], time.perf_counter() - t0))
+
+            # 2) 历史数据：直接构造汇总行（30 天原始数据量过大，不经过 rollup）
+            t0 = time.perf_counter()
+            seeded = self._seed_rollups(
+                servers, gpus_per_server, owner, rng,
+                timeseries.HOUR, now - options['days'] * 86400, raw_start, options['interval'],
+            )
+            seeded += self._seed_rollups(
+                servers, gpus_per_server, owner, rng,
+                timeseries.MINUTE, now - int(options['minute_days'] * 86400), raw_start, options['interval'],
+            )
+            self.stdout.write('[seed] rollup rows={} elapsed={:.1f}s'.format(seeded, time.perf_counter() - t0))
+
+            # 3) 区间查询
+            windows = [('1h', 3600), ('1d', 86400), ('7d', 7 * 86400), ('30d', options['days'] * 86400)]
+            for label, span in windows:
+                for shape in ('gpu', 'server', 'user'):
+                    latencies = []
+                    points = 0
+                    resolution = None
+                    for _ in range(options['queries']):
+                        s = rng.choice(servers)
+                        kwargs = {}
+                        if shape == 'gpu':
+                            kwargs = {'server_id': s.pk, 'gpu_index': rng.randrange(gpus_per_server)}
+                        elif shape == 'server':
+                            kwargs = {'server_id': s.pk}
+                        else:
+                            kwargs = {'username': rng.choice(users)}
+                        q0 = time.perf_counter()
+                        resolution, res = timeseries.query_series(now - span, now, **kwargs)
+                        latencies.append(time.perf_counter() - q0)
+                        points = len(res)
+                    self.stdout.write('[query] range={} target={} resolution={} points={} {}'.format(
+                        label, shape, resolution, points, format_latency_ms(latencies)))
+
+    @staticmethod
+    def _seed_rollups(servers, gpus_per_server, owner, rng, resolution, start, end, interval):
+        per_bucket = max(1, resolution // interval)
+        gpu_rows = []
+        user_rows = {}
+        total = 0
+        start = start - start % resolution
+        for bucket in range(start, end - end % resolution, resolution):
+            for s in servers:
+                for g in range(gpus_per_server):
+                    util = rng.randint(0, 100)
+                    gpu_rows.append(GPUSampleRollup(
+                        resolution=resolution, bucket=bucket, server_id=s.pk, gpu_index=g,
+                        samples=per_bucket, busy_samples=per_bucket, utilization_sum=util * per_bucket,
+                        utilization_max=util, memory_used_sum=40000 * per_bucket, memory_used_max=40000,
+                        memory_total=81920,
+                    ))
+                    key = (owner[(s.pk, g)], s.pk)
+                    acc = user_rows.setdefault(key, [0, 0])
+                    acc[0] += per_bucket
+                    acc[1] += util * per_bucket
+                for (username, server_id), acc in user_rows.items():
+                    gpu_rows.append(GPUUserRollup(
+                        resolution=resolution, bucket=bucket, username=username, server_id=server_id,
+                        samples=acc[0], utilization_sum=acc[1],
+                    ))
+                user_rows = {}
+            if len(gpu_rows) >= 20000:
+                total += _flush(gpu_rows)
+                gpu_rows = []
+        total += _flush(gpu_rows)
+        return total
+
+
+def _flush(rows):
+    gpu = [r for r in rows if isinstance(r, GPUSampleRollup)]
+    user = [r for r in rows if isinstance(r, GPUUserRollup)]
+    GPUSampleRollup.objects.bulk_create(gpu, batch_size=2000, ignore_conflicts=True)
+    GPUUserRollup.objects.bulk_create(user, batch_size=2000, ignore_conflicts=True)
+    return len(rows)
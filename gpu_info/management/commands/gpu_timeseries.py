@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gpu_info import timeseries
+
+
+class Command(BaseCommand):
+    help = 'Maintain and query the GPU sample time series (rollup / prune / query).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['rollup', 'prune', 'query'], help='rollup/prune/query')
+        parser.add_argument('--server', type=int, default=None, help='GPUServer id (query).')
+        parser.add_argument('--index', type=int, default=None, help='GPU index on the server (query).')
+        parser.add_argument('--user', default='', help='Username (query).')
+        parser.add_argument('--hours', type=float, default=24.0, help='Query the last N hours.')
+        parser.add_argument('--resolution', choices=['raw', '1m', '1h'], default=None, help='Force a resolution.')
+
+    def handle(self, *args, **options):
+        action = options['action']
+        if action == 'rollup':
+            minute_end, hour_end = timeseries.rollup()
+            self.stdout.write(f'rolled up to minute={minute_end} hour={hour_end}')
+            return
+        if action == 'prune':
+            deleted = timeseries.prune()
+            self.stdout.write(f'pruned {deleted} rows')
+            return
+
+        username = (options['user'] or '').strip() or None
+        if options['server'] is None and username is None:
+            raise CommandError('query requires --server or --user')
+        end = int(time.time())
+        start = end - int(options['hours'] * 3600)
+        resolution = {'raw': timeseries.RAW, '1m': timeseries.MINUTE, '1h': timeseries.HOUR}.get(options['resolution'])
+        resolution, points = timeseries.query_series(
+            start, end, options['server'], options['index'], username, resolution,
+        )
+        self.stdout.write(json.dumps({'resolution': resolution, 'points': points}, ensure_ascii=False))
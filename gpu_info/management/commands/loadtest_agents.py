@@ -0,0 +1,440 @@
+from __future__ import annotations
+
+import collections
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import re
+import secrets
+import subprocess
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from base import telemetry
+from base.benchmark import format_latency_ms, percentile
+from gpu_info.models import GPUServer, GPUSample, GPUSampleRollup, GPUUserRollup
+from task.log_janitor import delete_tasks
+from task.models import GPUTask, GPUTaskRunningLog, GPUUsage
+
+# 模拟节点用 198.18.0.0/15（RFC 2544 基准测试网段），hostname 以此前缀标记
+HOSTNAME_PREFIX = 'loadtest-'
+LOADTEST_USER = 'loadtest'
+ENDPOINTS = ('report_gpu', 'report_tasks')
+PATTERNS = ('steady', 'burst', 'herd')
+PHASES = ('all', 'before', 'recovery', 'after')
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def synthetic_gpus(rng, agent, gpus, busy):
+    """与 agent/gpu_agent.collect_gpu_data 相同结构的 GPU 列表；前 busy 块 GPU 上有进程。"""
+    result = []
+    for index in range(gpus):
+        memory_total = 81920
+        processes = []
+        if index < busy:
+            processes.append({
+                'pid': 10000 + index,
+                'command': 'python',
+                'gpu_memory_usage': rng.randint(1000, 60000),
+                'username': 'user{}'.format(rng.randint(0, 20)),
+            })
+        result.append({
+            'uuid': 'GPU-{}{}-{}'.format(HOSTNAME_PREFIX, agent, index),
+            'index': index,
+            'name': 'NVIDIA A100-SXM4-80GB',
+            'utilization': rng.randint(60, 100) if processes else rng.randint(0, 3),
+            'memory_total': memory_total,
+            'memory_used': sum(p['gpu_memory_usage'] for p in processes),
+            'processes': processes,
+        })
+    return result
+
+
+def synthetic_tasks(log_ids):
+    """与 agent/gpu_agent.collect_running_tasks 相同结构的运行中任务列表。"""
+    return [{'running_log_id': log_id, 'remote_pid': 20000 + i, 'remote_pgid': 20000 + i}
+            for i, log_id in enumerate(log_ids)]
+
+
+def parse_metrics(text):
+    """Prometheus 文本格式 -> {(名称, ((标签, 值), ...)): 数值}。"""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        head, _, value = line.rpartition(' ')
+        name, _, labels = head.partition('{')
+        try:
+            samples[(name, tuple(sorted(_LABEL.findall(labels))))] = float(value)
+        except ValueError:
+            continue
+    return samples
+
+
+def histogram_delta(before, after, name, **labels):
+    """两次抓取之间某个直方图的 (各桶累计计数 [(上界, 计数)], 总和, 次数)。"""
+    want = set(labels.items())
+    buckets = {}
+    for (sample, sample_labels), value in after.items():
+        if sample != name + '_bucket' or not want <= set(sample_labels):
+            continue
+        le = dict(sample_labels)['le']
+        bound = float('inf') if le == '+Inf' else float(le)
+        buckets[bound] = buckets.get(bound, 0) + value - before.get((sample, sample_labels), 0)
+
+    def total(suffix):
+        return sum(
+            value - before.get((sample, sample_labels), 0)
+            for (sample, sample_labels), value in after.items()
+            if sample == name + suffix and want <= set(sample_labels)
+        )
+    return sorted(buckets.items()), total('_sum'), total('_count')
+
+
+def histogram_quantile(q, buckets):
+    """按桶线性插值估算分位数（与 Prometheus 的 histogram_quantile 相同）。"""
+    if not buckets or buckets[-1][1] <= 0:
+        return None
+    rank = q * buckets[-1][1]
+    lower, lower_count = 0.0, 0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float('inf'):
+                return lower
+            if count == lower_count:
+                return bound
+            return lower + (bound - lower) * (rank - lower_count) / (count - lower_count)
+        lower, lower_count = bound, count
+    return lower
+
+
+def cpu_seconds(pid):
+    """进程累计 CPU 时间（用户态 + 内核态，秒）；读不到时返回 None（仅 Linux）。"""
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            fields = f.read().rpartition(')')[2].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def master_pids():
+    """同机 master 进程：共享指标目录里仍存活的 <pid>.json。"""
+    directory = telemetry.metrics_dir()
+    pids = []
+    if directory and os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.endswith('.json') and name[:-5].isdigit() and cpu_seconds(int(name[:-5])) is not None:
+                pids.append(int(name[:-5]))
+    return sorted(pids)
+
+
+class Plan:
+    """各模拟节点的上报时刻：steady 在一个周期内均匀错开，burst 全部同时，
+    herd 先均匀错开，在 herd_at 起的 outage 秒内 master 不可用，恢复时所有节点同时补报。"""
+
+    def __init__(self, pattern, agents, interval, duration, herd_at, outage):
+        self.pattern = pattern
+        self.agents = agents
+        self.interval = interval
+        self.duration = duration
+        self.herd_at = herd_at
+        self.outage = outage
+
+    def offset(self, agent):
+        return 0.0 if self.pattern == 'burst' else self.interval * agent / max(1, self.agents)
+
+    def times(self, agent):
+        """相对开始时间的上报时刻（升序）。"""
+        times = []
+        t = self.offset(agent)
+        while t < self.duration:
+            times.append(t)
+            t += self.interval
+        if self.pattern != 'herd':
+            return times
+        recover = self.herd_at + self.outage
+        times = [t for t in times if not self.herd_at <= t < recover]
+        if recover < self.duration:
+            times.append(recover)
+        return sorted(times)
+
+    def phase(self, t):
+        if self.pattern != 'herd':
+            return 'all'
+        recover = self.herd_at + self.outage
+        if t < self.herd_at:
+            return 'before'
+        if t < recover + self.interval:
+            return 'recovery'
+        return 'after'
+
+
+def _post(parts, path, payload, timeout):
+    # 与真实 agent（requests.post）一样每次新建连接
+    conn_cls = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    conn = conn_cls(parts.hostname, parts.port, timeout=timeout)
+    try:
+        conn.request('POST', path, body=json.dumps(payload), headers={'Content-Type': 'application/json'})
+        resp = conn.getresponse()
+        resp.read()
+        return resp.status
+    finally:
+        conn.close()
+
+
+def run_agents(base_url, agents, plan, gpus, timeout, started_at):
+    """在本进程用线程模拟 agents=[(序号, token, [running_log_id])]，返回 [(接口, 阶段, 耗时, 状态)]。"""
+    parts = urlsplit(base_url)
+    prefix = parts.path.rstrip('/')
+    results = []
+    lock = threading.Lock()
+
+    def agent_loop(index, token, log_ids):
+        rng = random.Random(index)
+        local = []
+        for t in plan.times(index):
+            delay = started_at + t - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            phase = plan.phase(t)
+            busy = min(gpus, len(log_ids))
+            for endpoint, payload in (
+                ('report_gpu', {'token': token, 'gpus': synthetic_gpus(rng, index, gpus, busy)}),
+                ('report_tasks', {'token': token, 'tasks': synthetic_tasks(log_ids)}),
+            ):
+                payload['timestamp'] = int(time.time())
+                start = time.perf_counter()
+                try:
+                    status = _post(parts, '{}/api/v1/{}/'.format(prefix, endpoint), payload, timeout)
+                except Exception as exc:
+                    status = type(exc).__name__
+                local.append((endpoint, phase, time.perf_counter() - start, status))
+        with lock:
+            results.extend(local)
+
+    threads = [threading.Thread(target=agent_loop, args=agent, daemon=True) for agent in agents]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def _worker(queue, *args):
+    queue.put(run_agents(*args))
+
+
+class Command(BaseCommand):
+    help = (
+        'End-to-end load test with simulated node agents: setup creates N fake (unschedulable) nodes with '
+        'running tasks, run posts report_gpu/report_tasks to a running master like agent/gpu_agent.py, '
+        'teardown removes everything.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['setup', 'run', 'teardown'])
+        parser.add_argument('--url', default='http://127.0.0.1:8888', help='Base URL of the master under test.')
+        parser.add_argument('--agents', type=int, default=500, help='Number of simulated nodes.')
+        parser.add_argument('--gpus', type=int, default=8, help='GPUs per node.')
+        parser.add_argument('--tasks', type=int, default=4, help='Running tasks per node (setup).')
+        parser.add_argument('--pattern', choices=PATTERNS, default='steady')
+        parser.add_argument('--interval', type=float, default=30.0, help='Report interval of each agent (seconds).')
+        parser.add_argument('--duration', type=float, default=120.0, help='Test length (seconds).')
+        parser.add_argument('--herd-at', type=float, default=None, help='herd: outage start (default duration/3).')
+        parser.add_argument('--outage', type=float, default=20.0, help='herd: seconds the master is unreachable.')
+        parser.add_argument('--restart-cmd', default='', help='herd: shell command that really restarts the master.')
+        parser.add_argument('--processes', type=int, default=1, help='Spread agents over this many processes.')
+        parser.add_argument('--timeout', type=float, default=10.0, help='Per-request timeout (seconds).')
+        parser.add_argument('--metrics-token', default=os.getenv('GPUTASKER_METRICS_TOKEN', ''),
+                            help='Bearer token for the master /metrics (GPUTASKER_METRICS_TOKEN).')
+        parser.add_argument('--master-pid', type=int, action='append', default=[],
+                            help='Master process id(s) for CPU accounting; default: live pids in the metrics dir.')
+
+    def handle(self, *args, **options):
+        getattr(self, '_' + options['action'])(options)
+
+    # ---- setup / teardown ----
+
+    def _setup(self, options):
+        if GPUServer.objects.filter(hostname__startswith=HOSTNAME_PREFIX).exists():
+            raise CommandError('simulated nodes already exist; run teardown first')
+        user, _ = User.objects.get_or_create(username=LOADTEST_USER, defaults={'is_active': False})
+        servers = [
+            GPUServer(
+                ip='198.18.{}.{}'.format(i // 250, i % 250 + 1),
+                hostname='{}{}'.format(HOSTNAME_PREFIX, i),
+                # 模拟节点不可调度，调度器不会往上派发真实任务
+                can_use=False,
+                report_token=secrets.token_urlsafe(32),
+            )
+            for i in range(options['agents'])
+        ]
+        GPUServer.objects.bulk_create(servers, batch_size=500)
+        servers = list(GPUServer.objects.filter(hostname__startswith=HOSTNAME_PREFIX).order_by('id'))
+        tasks = [
+            GPUTask(name='{}{}-{}'.format(HOSTNAME_PREFIX, s.pk, j), user=user, workspace='~', cmd='true',
+                    assign_server=s, status=1)
+            for s in servers for j in range(options['tasks'])
+        ]
+        GPUTask.objects.bulk_create(tasks, batch_size=1000)
+        tasks = GPUTask.objects.filter(user=user, status=1).order_by('id').values_list('id', 'assign_server_id')
+        GPUTaskRunningLog.objects.bulk_create(
+            [
+                GPUTaskRunningLog(index=0, task_id=task_id, server_id=server_id, pid=-1, gpus=str(i % max(1, options['tasks'])),
+                                  log_file_path='', status=1)
+                for i, (task_id, server_id) in enumerate(tasks)
+            ],
+            batch_size=1000,
+        )
+        self.stdout.write('created {} simulated nodes with {} running tasks'.format(len(servers), len(tasks)))
+
+    def _teardown(self, options):
+        servers = list(GPUServer.objects.filter(hostname__startswith=HOSTNAME_PREFIX).values_list('id', flat=True))
+        user = User.objects.filter(username=LOADTEST_USER).first()
+        if user is not None:
+            delete_tasks(GPUTask.objects.filter(user=user))
+            GPUUsage.objects.filter(user=user).delete()
+            user.delete()
+        for model in (GPUSample, GPUSampleRollup, GPUUserRollup):
+            model.objects.filter(server_id__in=servers).delete()
+        GPUServer.objects.filter(id__in=servers).delete()
+        self.stdout.write('removed {} simulated nodes'.format(len(servers)))
+
+    # ---- run ----
+
+    def _agents(self, limit):
+        servers = list(
+            GPUServer.objects.filter(hostname__startswith=HOSTNAME_PREFIX).order_by('id').values_list('id', 'report_token')[:limit]
+        )
+        if not servers:
+            raise CommandError('no simulated nodes; run setup first')
+        logs = collections.defaultdict(list)
+        for log_id, server_id in GPUTaskRunningLog.objects.filter(
+                server_id__in=[pk for pk, _ in servers], task__user__username=LOADTEST_USER).values_list('id', 'server_id'):
+            logs[server_id].append(log_id)
+        return [(i, token, logs[pk]) for i, (pk, token) in enumerate(servers)]
+
+    def _scrape(self, base_url, token):
+        parts = urlsplit(base_url)
+        conn_cls = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        conn = conn_cls(parts.hostname, parts.port, timeout=10)
+        try:
+            headers = {'Authorization': 'Bearer ' + token} if token else {}
+            conn.request('GET', parts.path.rstrip('/') + '/metrics', headers=headers)
+            resp = conn.getresponse()
+            body = resp.read().decode('utf-8', errors='replace')
+        except OSError as exc:
+            return None, str(exc)
+        finally:
+            conn.close()
+        if resp.status != 200:
+            return None, 'HTTP {}'.format(resp.status)
+        return parse_metrics(body), None
+
+    def _run(self, options):
+        base_url = options['url'].rstrip('/')
+        agents = self._agents(options['agents'])
+        duration = options['duration']
+        herd_at = options['herd_at'] if options['herd_at'] is not None else duration / 3
+        plan = Plan(options['pattern'], len(agents), options['interval'], duration, herd_at, options['outage'])
+        pids = options['master_pid'] or master_pids()
+
+        before, scrape_error = self._scrape(base_url, options['metrics_token'])
+        cpu_before = {pid: cpu_seconds(pid) for pid in pids}
+        started_at = time.time() + 1.0
+        processes = max(1, min(options['processes'], len(agents)))
+        self.stdout.write('pattern={} agents={} gpus/node={} interval={}s duration={}s processes={}'.format(
+            plan.pattern, len(agents), options['gpus'], plan.interval, duration, processes))
+
+        restart = None
+        if plan.pattern == 'herd' and options['restart_cmd']:
+            restart = threading.Timer(max(0.0, started_at + herd_at - time.time()), subprocess.call,
+                                      args=(options['restart_cmd'],), kwargs={'shell': True})
+            restart.start()
+        args = (base_url, plan, options['gpus'], options['timeout'], started_at)
+        if processes == 1:
+            results = run_agents(base_url, agents, *args[1:])
+        else:
+            # fork 出的子进程只发 HTTP，不碰数据库
+            ctx = multiprocessing.get_context('fork')
+            queue = ctx.Queue()
+            workers = [ctx.Process(target=_worker, args=(queue, base_url, agents[i::processes]) + args[1:], daemon=True)
+                       for i in range(processes)]
+            for w in workers:
+                w.start()
+            results = []
+            for _ in workers:
+                results.extend(queue.get())
+            for w in workers:
+                w.join()
+        if restart is not None:
+            restart.join()
+        elapsed = time.time() - started_at
+        after, _ = self._scrape(base_url, options['metrics_token']) if before is not None else (None, None)
+
+        self._report_client(results, elapsed)
+        if before is None or after is None:
+            self.stdout.write('master metrics unavailable: {}'.format(scrape_error or 'scrape failed'))
+        else:
+            self._report_master(before, after)
+        self._report_cpu(pids, cpu_before, elapsed)
+
+    def _report_client(self, results, elapsed):
+        groups = collections.defaultdict(list)
+        for endpoint, phase, latency, status in results:
+            groups[(endpoint, phase)].append((latency, status))
+        for (endpoint, phase), items in sorted(groups.items(), key=lambda item: (item[0][0], PHASES.index(item[0][1]))):
+            statuses = collections.Counter(status for _, status in items)
+            errors = sum(n for status, n in statuses.items() if status != 200)
+            self.stdout.write('[{}] phase={} requests={} errors={} ({:.1%}) statuses={} {:.0f} req/s {}'.format(
+                endpoint, phase, len(items), errors, errors / len(items), dict(statuses),
+                len(items) / elapsed if elapsed > 0 else 0.0, format_latency_ms([lat for lat, _ in items])))
+        if any(phase == 'recovery' for _, phase in groups):
+            # 恢复后所有节点各至少成功一次所需的时间
+            ok = [lat for (endpoint, phase), items in groups.items() if phase == 'recovery'
+                  for lat, status in items if status == 200]
+            self.stdout.write('recovery: slowest successful report {:.3f}s, p99 {:.3f}s'.format(
+                max(ok) if ok else 0.0, percentile(ok, 99)))
+
+    def _report_master(self, before, after):
+        for endpoint in ENDPOINTS:
+            buckets, total, count = histogram_delta(before, after, 'gputasker_report_seconds', endpoint=endpoint)
+            db_buckets, db_total, db_count = histogram_delta(before, after, 'gputasker_report_db_seconds', endpoint=endpoint)
+            locked = sum(
+                value - before.get(key, 0) for key, value in after.items()
+                if key[0] == 'gputasker_db_locked_total' and ('endpoint', endpoint) in key[1]
+            )
+            if not count:
+                self.stdout.write('master [{}]: no requests recorded'.format(endpoint))
+                continue
+            self.stdout.write(
+                'master [{}]: handled={:.0f} p50~{:.1f}ms p95~{:.1f}ms avg={:.1f}ms | db avg={:.1f}ms p95~{:.1f}ms '
+                'share={:.0%} locked={:.0f}'.format(
+                    endpoint, count,
+                    (histogram_quantile(0.5, buckets) or 0) * 1000, (histogram_quantile(0.95, buckets) or 0) * 1000,
+                    total / count * 1000,
+                    db_total / db_count * 1000 if db_count else 0.0, (histogram_quantile(0.95, db_buckets) or 0) * 1000,
+                    db_total / total if total else 0.0, locked,
+                )
+            )
+
+    def _report_cpu(self, pids, cpu_before, elapsed):
+        used = {}
+        for pid in pids:
+            now = cpu_seconds(pid)
+            if now is not None and cpu_before.get(pid) is not None:
+                used[pid] = now - cpu_before[pid]
+        if not used:
+            self.stdout.write('master cpu: unavailable (pass --master-pid on the master host)')
+            return
+        total = sum(used.values())
+        self.stdout.write('master cpu: {:.1f}s over {:.0f}s = {:.0%} of one core ({})'.format(
+            total, elapsed, total / elapsed if elapsed > 0 else 0.0,
+            ', '.join('{}: {:.1f}s'.format(pid, sec) for pid, sec in sorted(used.items()))))
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import collections
+import http.client
+import json
+import queue
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from base.benchmark import format_latency_ms
+from gpu_info.models import GPUServer
+
+
+class Command(BaseCommand):
+    help = (
+        'Load-test the report ingestion path and compare latency between deployments, e.g. '
+        '--target wsgi=http://127.0.0.1:8888 --target asgi=http://127.0.0.1:8890'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--target',
+            action='append',
+            default=[],
+            help='NAME=BASE_URL of a running master. Can be provided multiple times.',
+        )
+        parser.add_argument('--token', action='append', default=[], help='Report token(s); default: tokens of GPUServers in DB.')
+        parser.add_argument('--agents', type=int, default=500, help='Max distinct tokens to use.')
+        parser.add_argument('--concurrency', type=int, default=200, help='Concurrent keep-alive connections.')
+        parser.add_argument('--requests', type=int, default=5000, help='Total requests per target.')
+        parser.add_argument('--timeout', type=float, default=10.0, help='Per-request timeout (seconds).')
+
+    def handle(self, *args, **options):
+        targets = []
+        for item in options['target']:
+            if '=' not in item:
+                raise CommandError(f'invalid --target {item!r}, expected NAME=BASE_URL')
+            name, url = item.split('=', 1)
+            targets.append((name.strip(), url.strip().rstrip('/')))
+        if not targets:
+            raise CommandError('at least one --target is required')
+
+        tokens = [t for t in options['token'] if t]
+        if not tokens:
+            tokens = list(
+                GPUServer.objects.exclude(report_token__isnull=True)
+                .values_list('report_token', flat=True)[:options['agents']]
+            )
+        if not tokens:
+            raise CommandError('no report tokens available; add GPUServers or pass --token')
+
+        for name, base_url in targets:
+            latencies, statuses, elapsed = self._run(
+                base_url + '/api/v1/report_tasks/',
+                tokens,
+                options['concurrency'],
+                options['requests'],
+                options['timeout'],
+            )
+            ok = statuses.get(200, 0)
+            errors = sum(v for k, v in statuses.items() if k != 200)
+            self.stdout.write(
+                '[{}] requests={} ok={} errors={} statuses={} throughput={:.0f} req/s {}'.format(
+                    name,
+                    options['requests'],
+                    ok,
+                    errors,
+                    dict(statuses),
+                    options['requests'] / elapsed if elapsed > 0 else 0.0,
+                    format_latency_ms(latencies),
+                )
+            )
+
+    @staticmethod
+    def _run(url, tokens, concurrency, total, timeout):
+        parts = urlsplit(url)
+        conn_cls = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        work = queue.Queue()
+        for i in range(total):
+            work.put(tokens[i % len(tokens)])
+
+        latencies = []
+        statuses = collections.Counter()
+        lock = threading.Lock()
+
+        def worker():
+            local_latencies = []
+            local_statuses = collections.Counter()
+            conn = None
+            while True:
+                try:
+                    token = work.get_nowait()
+                except queue.Empty:
+                    break
+                body = json.dumps({'token': token, 'tasks': [], 'timestamp': int(time.time())})
+                t0 = time.perf_counter()
+                try:
+                    if conn is None:
+                        conn = conn_cls(parts.hostname, parts.port, timeout=timeout)
+                    conn.request('POST', parts.path, body=body, headers={'Content-Type': 'application/json'})
+                    resp = conn.getresponse()
+                    resp.read()
+                    local_statuses[resp.status] += 1
+                    if resp.getheader('Connection', '').lower() == 'close':
+                        conn.close()
+                        conn = None
+                except Exception as exc:
+                    local_statuses[type(exc).__name__] += 1
+                    if conn is not None:
+                        conn.close()
+                    conn = None
+                local_latencies.append(time.perf_counter() - t0)
+            if conn is not None:
+                conn.close()
+            with lock:
+                latencies.extend(local_latencies)
+                statuses.update(local_statuses)
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, concurrency))]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return latencies, statuses, time.perf_counter() - start
@@ -0,0 +1,89 @@
+# Generated by Django 4.2.30 on 2026-10-19 15:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gpu_info', '0003_gpuinfo_busy_by_log_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GPUSampleRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.PositiveIntegerField(choices=[(60, '1分钟'), (3600, '1小时')], verbose_name='粒度(秒)')),
+                ('bucket', models.IntegerField(verbose_name='时间桶')),
+                ('gpu_index', models.PositiveSmallIntegerField(verbose_name='序号')),
+                ('samples', models.PositiveIntegerField(verbose_name='采样数')),
+                ('busy_samples', models.PositiveIntegerField(default=0, verbose_name='有进程的采样数')),
+                ('utilization_sum', models.BigIntegerField(verbose_name='利用率之和')),
+                ('utilization_max', models.PositiveSmallIntegerField(verbose_name='最大利用率')),
+                ('memory_used_sum', models.BigIntegerField(verbose_name='已用显存之和')),
+                ('memory_used_max', models.PositiveIntegerField(verbose_name='最大已用显存')),
+                ('memory_total', models.PositiveIntegerField(verbose_name='总显存')),
+                ('server', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='gpu_info.gpuserver', verbose_name='服务器')),
+            ],
+            options={
+                'verbose_name': 'GPU采样汇总',
+                'verbose_name_plural': 'GPU采样汇总',
+            },
+        ),
+        migrations.CreateModel(
+            name='GPUSample',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ts', models.IntegerField(verbose_name='采样时间戳')),
+                ('gpu_index', models.PositiveSmallIntegerField(verbose_name='序号')),
+                ('utilization', models.PositiveSmallIntegerField(verbose_name='利用率')),
+                ('memory_used', models.PositiveIntegerField(verbose_name='已用显存')),
+                ('memory_total', models.PositiveIntegerField(verbose_name='总显存')),
+                ('users', models.CharField(blank=True, default='', max_length=200, verbose_name='使用者')),
+                ('server', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='gpu_info.gpuserver', verbose_name='服务器')),
+            ],
+            options={
+                'verbose_name': 'GPU采样',
+                'verbose_name_plural': 'GPU采样',
+            },
+        ),
+        migrations.CreateModel(
+            name='GPUUserRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.PositiveIntegerField(choices=[(60, '1分钟'), (3600, '1小时')], verbose_name='粒度(秒)')),
+                ('bucket', models.IntegerField(verbose_name='时间桶')),
+                ('username', models.CharField(max_length=100, verbose_name='用户名')),
+                ('samples', models.PositiveIntegerField(verbose_name='采样数')),
+                ('utilization_sum', models.BigIntegerField(verbose_name='利用率之和')),
+                ('server', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='gpu_info.gpuserver', verbose_name='服务器')),
+            ],
+            options={
+                'verbose_name': '用户GPU占用汇总',
+                'verbose_name_plural': '用户GPU占用汇总',
+                'indexes': [models.Index(fields=['resolution', 'bucket'], name='userrollup_res_bucket_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='gpuuserrollup',
+            constraint=models.UniqueConstraint(fields=('resolution', 'username', 'server', 'bucket'), name='uniq_gpuuserrollup_user_bucket'),
+        ),
+        migrations.AddIndex(
+            model_name='gpusamplerollup',
+            index=models.Index(fields=['resolution', 'bucket'], name='gpurollup_res_bucket_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='gpusamplerollup',
+            constraint=models.UniqueConstraint(fields=('resolution', 'server', 'gpu_index', 'bucket'), name='uniq_gpusamplerollup_gpu_bucket'),
+        ),
+        migrations.AddIndex(
+            model_name='gpusample',
+            index=models.Index(fields=['server', 'gpu_index', 'ts'], name='gpusample_gpu_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gpusample',
+            index=models.Index(fields=['ts'], name='gpusample_ts_idx'),
+        ),
+    ]
@@ -0,0 +1,89 @@
+# Generated by Django 4.2.30 on 2026-10-19 15:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+import json
+
+
+def copy_processes(apps, schema_editor):
+    """把 GPUInfo.processes（逐行 JSON）拆成 GPUProcess 行。"""
+    GPUInfo = apps.get_model('gpu_info', 'GPUInfo')
+    GPUProcess = apps.get_model('gpu_info', 'GPUProcess')
+    rows = []
+    for uuid, processes in GPUInfo.objects.exclude(processes='').values_list('uuid', 'processes').iterator():
+        seen = set()
+        for line in processes.split('\n'):
+            try:
+                item = json.loads(line)
+                pid = int(item['pid'])
+                gpu_memory_usage = max(0, int(item.get('gpu_memory_usage') or 0))
+            except Exception:
+                continue
+            if pid < 0 or pid in seen:
+                continue
+            seen.add(pid)
+            rows.append(GPUProcess(
+                gpu_id=uuid,
+                pid=pid,
+                username=str(item.get('username') or '')[:100],
+                command=str(item.get('command') or '')[:255],
+                gpu_memory_usage=gpu_memory_usage,
+            ))
+    GPUProcess.objects.bulk_create(rows, batch_size=500)
+
+
+def restore_processes(apps, schema_editor):
+    GPUInfo = apps.get_model('gpu_info', 'GPUInfo')
+    GPUProcess = apps.get_model('gpu_info', 'GPUProcess')
+    lines = {}
+    for p in GPUProcess.objects.order_by('gpu_id', 'pid').iterator():
+        lines.setdefault(p.gpu_id, []).append(json.dumps({
+            'pid': p.pid,
+            'command': p.command,
+            'gpu_memory_usage': p.gpu_memory_usage,
+            'username': p.username,
+        }, ensure_ascii=False, separators=(',', ':')))
+    for uuid, items in lines.items():
+        GPUInfo.objects.filter(uuid=uuid).update(processes='\n'.join(items))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gpu_info', '0004_gpu_timeseries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GPUProcess',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pid', models.PositiveIntegerField(verbose_name='PID')),
+                ('username', models.CharField(blank=True, default='', max_length=100, verbose_name='用户名')),
+                ('command', models.CharField(blank=True, default='', max_length=255, verbose_name='命令')),
+                ('gpu_memory_usage', models.PositiveIntegerField(default=0, verbose_name='显存占用')),
+                ('gpu', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='gpu_processes', to='gpu_info.gpuinfo', verbose_name='GPU')),
+            ],
+            options={
+                'verbose_name': 'GPU进程',
+                'verbose_name_plural': 'GPU进程',
+                'ordering': ('gpu', 'pid'),
+                'indexes': [models.Index(fields=['username'], name='gpuprocess_username_idx'), models.Index(fields=['pid'], name='gpuprocess_pid_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='gpuprocess',
+            constraint=models.UniqueConstraint(fields=('gpu', 'pid'), name='uniq_gpuprocess_gpu_pid'),
+        ),
+        # 带上默认值，回滚时才能给已有行重新加回该列
+        migrations.AlterField(
+            model_name='gpuinfo',
+            name='processes',
+            field=models.TextField(blank=True, default='', verbose_name='进程'),
+        ),
+        migrations.RunPython(copy_processes, restore_processes),
+        migrations.RemoveField(
+            model_name='gpuinfo',
+            name='processes',
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-19 15:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gpu_info', '0005_gpuprocess'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='gpuinfo',
+            index=models.Index(fields=['server', 'index', 'use_by_self'], name='gpuinfo_server_index_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-19 21:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gpu_info', '0006_gpuinfo_server_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gpuserver',
+            name='update_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='更新时间'),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='gpuserver',
+            index=models.Index(fields=['update_at'], name='gpuserver_update_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gpuinfo',
+            index=models.Index(fields=['update_at'], name='gpuinfo_update_idx'),
+        ),
+    ]
@@ -1,5 +1,3 @@
-import json
-
 import secrets
 import os
 
@@ -7,6 +5,15 @@ from django.db import models
 from django.utils import timezone
 
 
+def gpu_update_mode():
+    """GPU 信息更新模式：report（节点上报，默认）或 ssh（中心端扫描）。"""
+    return (os.getenv('GPUTASKER_GPU_UPDATE_MODE', 'report') or 'report').strip().lower()
+
+
+def node_stale_seconds():
+    return int(os.getenv('GPUTASKER_NODE_STALE_SECONDS', '180'))
+
+
 class GPUServer(models.Model):
     ip = models.CharField('IP地址', max_length=50)
     hostname = models.CharField('主机名', max_length=50, blank=True, null=True)
@@ -15,6 +22,8 @@ class GPUServer(models.Model):
     can_use = models.BooleanField('是否可调度', default=True)
     report_token = models.CharField('上报Token', max_length=128, blank=True, null=True, unique=True)
     last_report_at = models.DateTimeField('最近上报时间', blank=True, null=True)
+    # 调度器的集群状态缓存按 update_at 增量拉取（见 gpu_info.cluster_state）
+    update_at = models.DateTimeField('更新时间', auto_now=True)
     # TODO(Yuhao Wang): CPU使用率
 
     class Meta:
@@ -22,6 +31,9 @@ class GPUServer(models.Model):
         verbose_name = 'GPU服务器'
         verbose_name_plural = 'GPU服务器'
         unique_together = (('ip', 'port'),)
+        indexes = [
+            models.Index(fields=['update_at'], name='gpuserver_update_idx'),
+        ]
 
     def __str__(self):
         return '{}:{:d}'.format(self.ip, self.port)
@@ -34,16 +46,14 @@ class GPUServer(models.Model):
 
     def is_reporting_alive(self):
         """节点上报模式下：根据最近上报时间判断是否可用。"""
-        stale_seconds = int(os.getenv('GPUTASKER_NODE_STALE_SECONDS', '180'))
         if self.last_report_at is None:
             return False
         delta = timezone.now() - self.last_report_at
-        return delta.total_seconds() <= stale_seconds
+        return delta.total_seconds() <= node_stale_seconds()
 
     def get_available_gpus(self, gpu_num, exclusive, memory, utilization):
         available_gpu_list = []
-        update_mode = (os.getenv('GPUTASKER_GPU_UPDATE_MODE', 'report') or 'report').strip().lower()
-        if update_mode == 'report':
+        if gpu_update_mode() == 'report':
             available = self.is_reporting_alive() and self.can_use
         else:
             available = self.valid and self.can_use
@@ -60,10 +70,10 @@ class GPUServer(models.Model):
             return None
     
     def set_gpus_busy(self, gpu_list):
-        self.gpus.filter(index__in=gpu_list).update(use_by_self=True)
+        self.gpus.filter(index__in=gpu_list).update(use_by_self=True, update_at=timezone.now())
 
     def set_gpus_free(self, gpu_list):
-        self.gpus.filter(index__in=gpu_list).update(use_by_self=False)
+        self.gpus.filter(index__in=gpu_list).update(use_by_self=False, update_at=timezone.now())
 
 
 class GPUInfo(models.Model):
@@ -73,7 +83,6 @@ class GPUInfo(models.Model):
     utilization = models.PositiveSmallIntegerField('利用率')
     memory_total = models.PositiveIntegerField('总显存')
     memory_used = models.PositiveIntegerField('已用显存')
-    processes = models.TextField('进程')
     server = models.ForeignKey(GPUServer, verbose_name='服务器', on_delete=models.CASCADE, related_name='gpus')
     use_by_self = models.BooleanField('是否被gputasker进程占用', default=False)
     busy_by_log_id = models.IntegerField('占用运行记录ID', blank=True, null=True)
@@ -84,6 +93,12 @@ class GPUInfo(models.Model):
         ordering = ('server', 'index',)
         verbose_name = 'GPU信息'
         verbose_name_plural = 'GPU信息'
+        indexes = [
+            # try_lock_gpus / release_gpus：按 server + index 定位，并带上占用标记
+            models.Index(fields=['server', 'index', 'use_by_self'], name='gpuinfo_server_index_idx'),
+            # 集群状态缓存的增量拉取
+            models.Index(fields=['update_at'], name='gpuinfo_update_idx'),
+        ]
 
     def __str__(self):
         return self.name + '[' + str(self.index) + '-' + self.server.ip + ']'
@@ -104,20 +119,205 @@ class GPUInfo(models.Model):
 
     def usernames(self):
         r"""
-        convert processes string to usernames string array.
-        :return: string array of usernames.
+        convert processes to usernames string.
+        :return: first two usernames joined by comma.
         """
-        if self.processes != '':
-            arr = self.processes.split('\n')
-            # only show first two usernames
-            username_arr = [json.loads(item)['username'] for item in arr[:2]]
-            res = ', '.join(username_arr)
-            # others use ... to note
-            if len(arr) > 2:
-                res = res + ', ...'
-            return res
-        else:
+        # 走 gpu_processes.all() 以便命中 prefetch_related 缓存
+        processes = list(self.gpu_processes.all())
+        if not processes:
             return '-'
+        # only show first two usernames
+        res = ', '.join(p.username for p in processes[:2])
+        # others use ... to note
+        if len(processes) > 2:
+            res = res + ', ...'
+        return res
+
+
+class GPUProcess(models.Model):
+    """GPU 上的计算进程，由上报/轮询按 (gpu, pid) 增量同步。"""
+    gpu = models.ForeignKey(GPUInfo, verbose_name='GPU', on_delete=models.CASCADE, related_name='gpu_processes')
+    pid = models.PositiveIntegerField('PID')
+    username = models.CharField('用户名', max_length=100, blank=True, default='')
+    command = models.CharField('命令', max_length=255, blank=True, default='')
+    gpu_memory_usage = models.PositiveIntegerField('显存占用', default=0)
+
+    class Meta:
+        ordering = ('gpu', 'pid')
+        verbose_name = 'GPU进程'
+        verbose_name_plural = 'GPU进程'
+        constraints = [
+            models.UniqueConstraint(fields=['gpu', 'pid'], name='uniq_gpuprocess_gpu_pid'),
+        ]
+        indexes = [
+            models.Index(fields=['username'], name='gpuprocess_username_idx'),
+            models.Index(fields=['pid'], name='gpuprocess_pid_idx'),
+        ]
+
+    def __str__(self):
+        return '{}({:d})'.format(self.username or '-', self.pid)
+
+
+def _normalize_processes(processes):
+    """把上报的进程列表规整为 {pid: (username, command, gpu_memory_usage)}，同一 pid 取最后一条。"""
+    res = {}
+    if not isinstance(processes, list):
+        return res
+    for proc in processes:
+        if not isinstance(proc, dict):
+            continue
+        try:
+            pid = int(proc.get('pid'))
+            gpu_memory_usage = max(0, int(proc.get('gpu_memory_usage') or 0))
+        except Exception:
+            continue
+        if pid < 0:
+            continue
+        username = str(proc.get('username') or '')[:100]
+        command = str(proc.get('command') or '')[:255]
+        res[pid] = (username, command, gpu_memory_usage)
+    return res
+
+
+def sync_gpu_processes(processes_by_gpu):
+    """按 {gpu_uuid: processes} 增量同步 GPUProcess。
+
+    一次查询读出这些 GPU 现有的进程，只对新增/变化/消失的进程写库；
+    进程不变时（绝大多数上报）不产生任何写入。返回 (新增, 更新, 删除) 数量。
+    """
+    if not processes_by_gpu:
+        return 0, 0, 0
+    wanted = {
+        (gpu_id, pid): values
+        for gpu_id, processes in processes_by_gpu.items()
+        for pid, values in _normalize_processes(processes).items()
+    }
+    existing = {
+        (p.gpu_id, p.pid): p
+        for p in GPUProcess.objects.filter(gpu_id__in=list(processes_by_gpu.keys()))
+    }
+
+    to_create = []
+    to_update = []
+    for key, (username, command, gpu_memory_usage) in wanted.items():
+        obj = existing.get(key)
+        if obj is None:
+            to_create.append(GPUProcess(
+                gpu_id=key[0],
+                pid=key[1],
+                username=username,
+                command=command,
+                gpu_memory_usage=gpu_memory_usage,
+            ))
+        elif (obj.username, obj.command, obj.gpu_memory_usage) != (username, command, gpu_memory_usage):
+            obj.username = username
+            obj.command = command
+            obj.gpu_memory_usage = gpu_memory_usage
+            to_update.append(obj)
+    stale = [obj.pk for key, obj in existing.items() if key not in wanted]
+
+    if stale:
+        GPUProcess.objects.filter(pk__in=stale).delete()
+    if to_update:
+        GPUProcess.objects.bulk_update(to_update, ['username', 'command', 'gpu_memory_usage'])
+    if to_create:
+        GPUProcess.objects.bulk_create(to_create, ignore_conflicts=True)
+    return len(to_create), len(to_update), len(stale)
+
+
+class GPUSample(models.Model):
+    """GPU 原始采样，只追加不修改；由 gpu_info.timeseries 汇总与清理。"""
+    ts = models.IntegerField('采样时间戳')
+    server = models.ForeignKey(
+        GPUServer,
+        verbose_name='服务器',
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        db_index=False,
+        related_name='+',
+    )
+    gpu_index = models.PositiveSmallIntegerField('序号')
+    utilization = models.PositiveSmallIntegerField('利用率')
+    memory_used = models.PositiveIntegerField('已用显存')
+    memory_total = models.PositiveIntegerField('总显存')
+    users = models.CharField('使用者', max_length=200, blank=True, default='')
+
+    class Meta:
+        verbose_name = 'GPU采样'
+        verbose_name_plural = 'GPU采样'
+        indexes = [
+            models.Index(fields=['server', 'gpu_index', 'ts'], name='gpusample_gpu_ts_idx'),
+            models.Index(fields=['ts'], name='gpusample_ts_idx'),
+        ]
+
+
+class GPUSampleRollup(models.Model):
+    """按 1 分钟 / 1 小时聚合的 GPU 采样。"""
+    RESOLUTION_CHOICE = (
+        (60, '1分钟'),
+        (3600, '1小时'),
+    )
+    resolution = models.PositiveIntegerField('粒度(秒)', choices=RESOLUTION_CHOICE)
+    bucket = models.IntegerField('时间桶')
+    server = models.ForeignKey(
+        GPUServer,
+        verbose_name='服务器',
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        db_index=False,
+        related_name='+',
+    )
+    gpu_index = models.PositiveSmallIntegerField('序号')
+    samples = models.PositiveIntegerField('采样数')
+    busy_samples = models.PositiveIntegerField('有进程的采样数', default=0)
+    utilization_sum = models.BigIntegerField('利用率之和')
+    utilization_max = models.PositiveSmallIntegerField('最大利用率')
+    memory_used_sum = models.BigIntegerField('已用显存之和')
+    memory_used_max = models.PositiveIntegerField('最大已用显存')
+    memory_total = models.PositiveIntegerField('总显存')
+
+    class Meta:
+        verbose_name = 'GPU采样汇总'
+        verbose_name_plural = 'GPU采样汇总'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['resolution', 'server', 'gpu_index', 'bucket'],
+                name='uniq_gpusamplerollup_gpu_bucket',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['resolution', 'bucket'], name='gpurollup_res_bucket_idx'),
+        ]
+
+
+class GPUUserRollup(models.Model):
+    """按用户聚合的 GPU 占用：samples 为该用户出现的 (GPU, 采样) 次数。"""
+    resolution = models.PositiveIntegerField('粒度(秒)', choices=GPUSampleRollup.RESOLUTION_CHOICE)
+    bucket = models.IntegerField('时间桶')
+    username = models.CharField('用户名', max_length=100)
+    server = models.ForeignKey(
+        GPUServer,
+        verbose_name='服务器',
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        db_index=False,
+        related_name='+',
+    )
+    samples = models.PositiveIntegerField('采样数')
+    utilization_sum = models.BigIntegerField('利用率之和')
+
+    class Meta:
+        verbose_name = '用户GPU占用汇总'
+        verbose_name_plural = '用户GPU占用汇总'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['resolution', 'username', 'server', 'bucket'],
+                name='uniq_gpuuserrollup_user_bucket',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['resolution', 'bucket'], name='userrollup_res_bucket_idx'),
+        ]
 
 
 def _normalize_gpu_indices(gpu_list):
@@ -134,6 +334,26 @@ def _normalize_gpu_indices(gpu_list):
     return res
 
 
+# 本进程内 GPU 占用/释放的监听者：调度器的集群状态缓存据此写穿（见 gpu_info.cluster_state）
+_lock_listeners = []
+
+
+def add_lock_listener(listener):
+    """listener(server_id, gpu_indices, busy_by_log_id, locked, count)：locked 为 True 表示占用，count 为更新行数。"""
+    if listener not in _lock_listeners:
+        _lock_listeners.append(listener)
+
+
+def remove_lock_listener(listener):
+    if listener in _lock_listeners:
+        _lock_listeners.remove(listener)
+
+
+def _notify_lock(server, gpu_indices, busy_by_log_id, locked, count):
+    for listener in list(_lock_listeners):
+        listener(getattr(server, 'pk', server), gpu_indices, busy_by_log_id, locked, count)
+
+
 def try_lock_gpus(server, gpu_list, busy_by_log_id):
     """原子占用指定 GPU：仅当当前 use_by_self=False 时才会占用。
 
@@ -142,11 +362,13 @@ def try_lock_gpus(server, gpu_list, busy_by_log_id):
     gpu_indices = _normalize_gpu_indices(gpu_list)
     if not gpu_indices:
         return 0
-    return GPUInfo.objects.filter(
+    count = GPUInfo.objects.filter(
         server=server,
         index__in=gpu_indices,
         use_by_self=False,
-    ).update(use_by_self=True, busy_by_log_id=busy_by_log_id)
+    ).update(use_by_self=True, busy_by_log_id=busy_by_log_id, update_at=timezone.now())
+    _notify_lock(server, gpu_indices, busy_by_log_id, True, count)
+    return count
 
 
 def release_gpus(server, gpu_list, busy_by_log_id=None):
@@ -161,4 +383,6 @@ def release_gpus(server, gpu_list, busy_by_log_id=None):
     qs = GPUInfo.objects.filter(server=server, index__in=gpu_indices)
     if busy_by_log_id is not None:
         qs = qs.filter(busy_by_log_id=busy_by_log_id)
-    return qs.update(use_by_self=False, busy_by_log_id=None)
+    count = qs.update(use_by_self=False, busy_by_log_id=None, update_at=timezone.now())
+    _notify_lock(server, gpu_indices, busy_by_log_id, False, count)
+    return count
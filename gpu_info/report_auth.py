@@ -0,0 +1,181 @@
+"""节点上报接口的鉴权缓存与存活时间批量落库。
+
+report_gpu / report_tasks 每次请求都要按 token 查 GPUServer，并写一次 last_report_at。
+节点数量上来后，这两条 SQL 占了上报请求的大头：
+
+- token -> GPUServer 的解析结果按 TTL 缓存在进程内，GPUServer 保存/删除时失效；
+- last_report_at 先记在内存里，按固定间隔批量 bulk_update，而不是每个请求一条 UPDATE；
+  同一条 bulk_update 顺带把节点标记为可用（valid=True），上报请求本身不写库。
+
+缓存是进程级的：多 worker 部署时，其他进程依赖 TTL 过期感知 token 变更。
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from base.utils import env_float
+from .models import GPUServer
+
+task_logger = logging.getLogger('django.task')
+
+
+class ReportTokenCache:
+    """token -> GPUServer 的 TTL 缓存（含短时负缓存，挡住无效 token 的反复查库）。"""
+
+    NEGATIVE_TTL_SECONDS = 5.0
+
+    def __init__(self, ttl_seconds=None):
+        self._ttl = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    @property
+    def ttl(self):
+        if self._ttl is not None:
+            return self._ttl
+        return env_float('GPUTASKER_REPORT_TOKEN_CACHE_SECONDS', 60)
+
+    def get_cached(self, token):
+        """只查缓存不查库，返回 (是否命中, server)；供异步视图避免线程切换。"""
+        with self._lock:
+            entry = self._entries.get(token)
+        if entry is not None and entry[1] > time.monotonic():
+            return True, entry[0]
+        return False, None
+
+    def resolve(self, token):
+        ttl = self.ttl
+        now = time.monotonic()
+        if ttl > 0:
+            hit, server = self.get_cached(token)
+            if hit:
+                return server
+
+        server = GPUServer.objects.filter(report_token=token).first()
+        if ttl > 0:
+            expires_at = now + (ttl if server is not None else min(ttl, self.NEGATIVE_TTL_SECONDS))
+            with self._lock:
+                self._entries[token] = (server, expires_at)
+        return server
+
+    def invalidate_server(self, server_id, token=None):
+        with self._lock:
+            if token:
+                self._entries.pop(token, None)
+            stale = [k for k, (s, _) in self._entries.items() if s is not None and s.pk == server_id]
+            for k in stale:
+                del self._entries[k]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class LivenessRecorder:
+    """在内存中记录节点最近上报时间，按间隔批量写回 GPUServer.last_report_at（并标记 valid=True）。
+
+    flush 由上报请求顺带触发（无需常驻线程），低流量时退化为每次直接写库。
+    """
+
+    def __init__(self, flush_interval=None):
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_flush = 0.0
+
+    @property
+    def flush_interval(self):
+        if self._flush_interval is not None:
+            return self._flush_interval
+        return env_float('GPUTASKER_LIVENESS_FLUSH_SECONDS', 5)
+
+    def touch(self, server_id, ts=None):
+        ts = ts or timezone.now()
+        now = time.monotonic()
+        with self._lock:
+            self._pending[server_id] = ts
+            if now - self._last_flush < self.flush_interval:
+                return
+            batch = self._pending
+            self._pending = {}
+            self._last_flush = now
+        try:
+            self._write(batch)
+        except Exception as exc:
+            # 不影响本次上报请求；数据已放回队列，下次 flush 重试
+            task_logger.warning('flush last_report_at failed: %s', exc)
+
+    def flush(self):
+        with self._lock:
+            batch = self._pending
+            self._pending = {}
+            self._last_flush = time.monotonic()
+        self._write(batch)
+
+    def pending(self):
+        with self._lock:
+            return dict(self._pending)
+
+    def _write(self, batch):
+        if not batch:
+            return
+        # update_at 取写库时间而不是上报时间：集群状态缓存按 update_at 增量拉取，批量写回不能让它倒退。
+        # 有上报就说明节点可用：ssh 模式下调度器（另一个进程）标记的不可用在这里恢复，不必每个请求单独写一次
+        now = timezone.now()
+        objs = [GPUServer(pk=server_id, last_report_at=ts, valid=True, update_at=now)
+                for server_id, ts in batch.items()]
+        try:
+            GPUServer.objects.bulk_update(objs, ['last_report_at', 'valid', 'update_at'])
+        except Exception:
+            # 写库失败时放回队列，等下一次 flush 重试（保留较新的时间）
+            with self._lock:
+                for server_id, ts in batch.items():
+                    cur = self._pending.get(server_id)
+                    if cur is None or cur < ts:
+                        self._pending[server_id] = ts
+            raise
+
+
+token_cache = ReportTokenCache()
+liveness = LivenessRecorder()
+
+
+@atexit.register
+def _flush_liveness_at_exit():
+    try:
+        liveness.flush()
+    except Exception:
+        pass
+
+
+def resolve_report_token(token):
+    """按 token 找到 GPUServer；无效 token 返回 None。"""
+    if not token or not isinstance(token, str):
+        return None
+    return token_cache.resolve(token)
+
+
+def peek_report_token(token):
+    if not token or not isinstance(token, str):
+        return True, None
+    return token_cache.get_cached(token)
+
+
+def record_report(server, now=None):
+    """登记一次节点上报：存活时间与可用标记交给批量写回（见 LivenessRecorder），本身不写库。"""
+    now = now or timezone.now()
+    server.valid = True
+    server.last_report_at = now
+    liveness.touch(server.pk, now)
+    return now
+
+
+@receiver(post_save, sender=GPUServer)
+@receiver(post_delete, sender=GPUServer)
+def _invalidate_on_server_change(sender, instance, **kwargs):
+    token_cache.invalidate_server(instance.pk, token=instance.report_token)
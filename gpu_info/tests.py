@@ -1,3 +1,847 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import random
+import threading
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.utils import timezone
+
+from base.benchmark import bulk_insert
+from base.telemetry import Histogram, Registry, render
+from base.testing import QueryPlanAssertionsMixin
+from task.models import GPUTask, GPUTaskRunningLog
+from task.views import report_tasks, report_tasks_async
+from . import timeseries
+from .cluster import ClusterSnapshotCache, snapshot_cache
+from .cluster_state import ClusterState
+from .ingest import REPORT_DB_SECONDS, REPORT_REQUESTS, BoundedIngestExecutor
+from .management.commands import loadtest_agents
+from .models import GPUServer, GPUInfo, GPUProcess, GPUSample, GPUSampleRollup, GPUUserRollup, try_lock_gpus, \
+    release_gpus, sync_gpu_processes
+from .report_auth import LivenessRecorder, ReportTokenCache, record_report, resolve_report_token, token_cache
+from .views import report_gpu, report_gpu_async
+
+
+class GPULockHotPathTest(QueryPlanAssertionsMixin, TestCase):
+    """GPU 占用/释放与进程同步的查询预算与执行计划。"""
+
+    SERVERS = 500
+    GPUS_PER_SERVER = 8
+
+    @classmethod
+    def setUpTestData(cls):
+        GPUServer.objects.bulk_create([
+            GPUServer(ip='10.1.{}.{}'.format(i // 250, i % 250), report_token='seed-{}'.format(i))
+            for i in range(cls.SERVERS)
+        ])
+        server_ids = list(GPUServer.objects.values_list('id', flat=True))
+        now = timezone.now()
+        cls.server = GPUServer.objects.get(pk=server_ids[0])
+        bulk_insert(
+            GPUInfo,
+            ['uuid', 'index', 'name', 'utilization', 'memory_total', 'memory_used', 'server',
+             'use_by_self', 'complete_free', 'update_at'],
+            (
+                ('GPU-{}-{}'.format(server_id, index), index, 'A100', 0, 81920, 0, server_id, False, True, now)
+                for server_id in server_ids
+                for index in range(cls.GPUS_PER_SERVER)
+            ),
+        )
+
+    def test_lock_and_release_budget(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(try_lock_gpus(self.server, [0, 1], busy_by_log_id=42), 2)
+        # 已被占用的 GPU 不能重复占用
+        with self.assertNumQueries(1):
+            self.assertEqual(try_lock_gpus(self.server, '1,2', busy_by_log_id=43), 1)
+        # 只释放属于自己的占用
+        with self.assertNumQueries(1):
+            self.assertEqual(release_gpus(self.server, [0, 1, 2], busy_by_log_id=42), 2)
+        self.assertEqual(
+            list(GPUInfo.objects.filter(server=self.server, use_by_self=True).values_list('index', flat=True)),
+            [2],
+        )
+
+    def test_lock_plan(self):
+        qs = GPUInfo.objects.filter(server=self.server, index__in=[0, 1], use_by_self=False)
+        self.assertUsesIndex(qs, 'gpuinfo_server_index_idx')
+        qs = GPUInfo.objects.filter(server=self.server, index__in=[0, 1], busy_by_log_id=42)
+        self.assertUsesIndex(qs, 'gpuinfo_server_index_idx')
+
+    def test_process_sync_budget(self):
+        uuid = 'GPU-{}-0'.format(self.server.pk)
+        procs = [
+            {'pid': 100, 'username': 'alice', 'command': 'python', 'gpu_memory_usage': 1000},
+            {'pid': 101, 'username': 'bob', 'command': 'python', 'gpu_memory_usage': 2000},
+        ]
+        with self.assertNumQueries(2):
+            self.assertEqual(sync_gpu_processes({uuid: procs}), (2, 0, 0))
+        # 进程不变时只读不写
+        with self.assertNumQueries(1):
+            self.assertEqual(sync_gpu_processes({uuid: procs}), (0, 0, 0))
+
+        procs = [
+            {'pid': 100, 'username': 'alice', 'command': 'python', 'gpu_memory_usage': 3000},
+            {'pid': 102, 'username': 'carol', 'command': 'python', 'gpu_memory_usage': 10},
+        ]
+        self.assertEqual(sync_gpu_processes({uuid: procs}), (1, 1, 1))
+        self.assertEqual(
+            list(GPUProcess.objects.filter(gpu_id=uuid).values_list('pid', 'username', 'gpu_memory_usage')),
+            [(100, 'alice', 3000), (102, 'carol', 10)],
+        )
+        self.assertUsesIndex(GPUProcess.objects.filter(username='alice'), 'gpuprocess_username_idx')
+
+    def test_process_sync_diff(self):
+        a, b, c = ('GPU-{}-{}'.format(self.server.pk, i) for i in range(3))
+        proc = {'username': 'alice', 'command': 'python', 'gpu_memory_usage': 100}
+        sync_gpu_processes({a: [dict(proc, pid=1), dict(proc, pid=2)], b: [dict(proc, pid=1)], c: [dict(proc, pid=9)]})
+
+        self.assertEqual(sync_gpu_processes({
+            # 同一 pid 以最后一条为准；无效条目跳过
+            a: [dict(proc, pid=1), dict(proc, pid=1, gpu_memory_usage=500), {'pid': 'x'}, 'junk', dict(proc, pid=-3),
+                dict(proc, pid=3, gpu_memory_usage=-5)],
+            # 空列表：该卡上的进程全部删除
+            b: [],
+        }), (1, 1, 2))
+        self.assertEqual(
+            list(GPUProcess.objects.filter(gpu_id__in=[a, b, c]).values_list('gpu_id', 'pid', 'gpu_memory_usage')),
+            # 未出现在本次上报里的卡不受影响
+            [(a, 1, 500), (a, 3, 0), (c, 9, 100)],
+        )
+
+
+class GPUProcessMigrationTest(TransactionTestCase):
+    """0005_gpuprocess：旧的逐行 JSON 进程字段拆成 GPUProcess 行，回滚时拼回去。"""
+
+    before = [('gpu_info', '0004_gpu_timeseries')]
+    after = [('gpu_info', '0005_gpuprocess')]
+
+    def _migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_forward_copies_and_reverse_restores(self):
+        apps = self._migrate(self.before)
+        server = apps.get_model('gpu_info', 'GPUServer').objects.create(ip='10.9.3.1')
+        GPUInfo = apps.get_model('gpu_info', 'GPUInfo')
+        lines = [
+            json.dumps({'pid': 10, 'command': 'python train.py', 'gpu_memory_usage': 2048, 'username': 'alice'}),
+            'not json',
+            json.dumps({'pid': 11, 'command': 'python eval.py', 'gpu_memory_usage': None, 'username': 'bob'}),
+            # 重复的 pid 只保留第一条，负 pid 丢弃
+            json.dumps({'pid': 10, 'command': 'dup', 'gpu_memory_usage': 1, 'username': 'x'}),
+            json.dumps({'pid': -1, 'command': 'bad', 'gpu_memory_usage': 1, 'username': 'x'}),
+        ]
+        for i, processes in enumerate(['\n'.join(lines), '']):
+            GPUInfo.objects.create(uuid='GPU-mig-{}'.format(i), index=i, name='A100', utilization=0, memory_total=100,
+                                   memory_used=0, server=server, processes=processes)
+
+        apps = self._migrate(self.after)
+        GPUProcess = apps.get_model('gpu_info', 'GPUProcess')
+        self.assertEqual(
+            list(GPUProcess.objects.order_by('gpu_id', 'pid')
+                 .values_list('gpu_id', 'pid', 'username', 'command', 'gpu_memory_usage')),
+            [('GPU-mig-0', 10, 'alice', 'python train.py', 2048), ('GPU-mig-0', 11, 'bob', 'python eval.py', 0)],
+        )
+
+        apps = self._migrate(self.before)
+        restored = dict(apps.get_model('gpu_info', 'GPUInfo').objects.values_list('uuid', 'processes'))
+        self.assertEqual(restored['GPU-mig-1'], '')
+        self.assertEqual(
+            [json.loads(line) for line in restored['GPU-mig-0'].split('\n')],
+            [
+                {'pid': 10, 'command': 'python train.py', 'gpu_memory_usage': 2048, 'username': 'alice'},
+                {'pid': 11, 'command': 'python eval.py', 'gpu_memory_usage': 0, 'username': 'bob'},
+            ],
+        )
+
+
+class ClusterStateTest(QueryPlanAssertionsMixin, TestCase):
+    """调度器的服务器/GPU 缓存：选卡不查库、按 update_at 增量拉取、占用与释放写穿。"""
+
+    SERVERS = 200
+    GPUS_PER_SERVER = 8
+
+    @classmethod
+    def setUpTestData(cls):
+        GPUServer.objects.bulk_create([
+            GPUServer(ip='10.2.{}.{}'.format(i // 250, i % 250), report_token='state-{}'.format(i))
+            for i in range(cls.SERVERS)
+        ])
+        old = timezone.now() - timedelta(hours=1)
+        GPUServer.objects.update(last_report_at=timezone.now(), update_at=old)
+        cls.server, cls.other, cls.third = GPUServer.objects.order_by('id')[:3]
+        bulk_insert(
+            GPUInfo,
+            ['uuid', 'index', 'name', 'utilization', 'memory_total', 'memory_used', 'server',
+             'use_by_self', 'complete_free', 'update_at'],
+            (
+                ('GPU-{}-{}'.format(server_id, index), index, 'A100', 0, 81920, 0, server_id, False, True, old)
+                for server_id in GPUServer.objects.values_list('id', flat=True)
+                for index in range(cls.GPUS_PER_SERVER)
+            ),
+        )
+
+    def _state(self):
+        state = ClusterState()
+        with self.assertNumQueries(2):
+            state.load()
+        return state
+
+    def test_placement_reads_memory_only(self):
+        state = self._state()
+        # 与 GPUServer 的默认排序一致：按 IP
+        by_ip = [s.pk for s in sorted([self.server, self.other], key=lambda s: s.ip)]
+        with self.assertNumQueries(0):
+            self.assertEqual(len(state.servers()), self.SERVERS)
+            self.assertEqual([r.id for r in state.servers([self.other.pk, self.server.pk, -1])], by_ip)
+            record = state.get(self.server.pk)
+            available = record.get_available_gpus(2, True, 0, 0)
+            self.assertIsNone(record.get_available_gpus(9, True, 0, 0))
+            model = record.to_model()
+            self.assertEqual((model.pk, model.ip, model.port), (self.server.pk, self.server.ip, self.server.port))
+            self.assertEqual(state.max_unlocked_gpus([self.server.pk, self.other.pk]), self.GPUS_PER_SERVER)
+        self.assertEqual(available, self.server.get_available_gpus(2, True, 0, 0))
+        self.assertEqual(available, list(range(self.GPUS_PER_SERVER)))
+
+    def test_poll_reads_changed_rows_and_resync_drops_deleted(self):
+        state = self._state()
+        gpu = GPUInfo.objects.get(server=self.server, index=1)
+        gpu.utilization = 40
+        gpu.save()
+        state.poll()
+        self.assertEqual(state.get(self.server.pk).gpu(1).utilization, 40)
+        # 不带 update_at 的修改增量拉取看不到，只有全量重建能看到
+        GPUInfo.objects.filter(server=self.server, index=0).update(utilization=99)
+        gpu.utilization = 50
+        gpu.save()
+        other = GPUServer.objects.get(pk=self.other.pk)
+        other.can_use = False
+        other.save()
+        with self.assertNumQueries(2):
+            state.poll()
+        record = state.get(self.server.pk)
+        self.assertEqual((record.gpu(0).utilization, record.gpu(1).utilization), (0, 50))
+        self.assertIsNone(state.get(self.other.pk).get_available_gpus(1, False, 0, 0))
+
+        # GPU 换到另一台服务器
+        GPUInfo.objects.filter(server=self.server, index=7).update(server=self.third, index=8, update_at=timezone.now())
+        state.poll()
+        self.assertEqual([g.index for g in state.get(self.server.pk).gpus], list(range(7)))
+        self.assertEqual([g.index for g in state.get(self.third.pk).gpus], list(range(9)))
+
+        GPUServer.objects.filter(pk=self.third.pk).delete()
+        state.poll()
+        self.assertIsNotNone(state.get(self.third.pk))
+        state.load()
+        self.assertIsNone(state.get(self.third.pk))
+        self.assertEqual(state.get(self.server.pk).gpu(0).utilization, 99)
+
+    def test_refresh_polls_until_resync_is_due(self):
+        now = [0.0]
+        state = ClusterState(resync=60, clock=lambda: now[0])
+        with mock.patch.object(state, 'poll') as poll:
+            state.refresh()
+            now[0] = 59
+            state.refresh()
+            now[0] = 60
+            state.refresh()
+        self.assertEqual(poll.call_count, 1)
+        self.assertEqual(state._loaded_at, 60)
+
+    def test_lock_and_release_write_through(self):
+        state = self._state().enable()
+        self.addCleanup(state.disable)
+        record = state.get(self.server.pk)
+        self.assertEqual(try_lock_gpus(self.server, [0, 1], busy_by_log_id=42), 2)
+        self.assertEqual(try_lock_gpus(self.server, [1, 2], busy_by_log_id=43), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(record.get_available_gpus(1, True, 0, 0), list(range(3, self.GPUS_PER_SERVER)))
+            self.assertEqual(record.gpu(0).busy_by_log_id, 42)
+        self.assertEqual(release_gpus(self.server, [0, 1, 2], busy_by_log_id=42), 2)
+        self.assertEqual([g.index for g in record.gpus if g.use_by_self], [2])
+        # 部分占用时的归属由下一次拉取补上（占用与释放都会更新 update_at）
+        state.poll()
+        self.assertEqual(state.get(self.server.pk).gpu(2).busy_by_log_id, 43)
+        state.disable()
+        release_gpus(self.server, [2])
+        self.assertTrue(state.get(self.server.pk).gpu(2).use_by_self)
+
+    def test_poll_plan(self):
+        since = timezone.now()
+        self.assertUsesIndex(GPUInfo.objects.filter(update_at__gte=since).order_by(), 'gpuinfo_update_idx')
+        self.assertUsesIndex(GPUServer.objects.filter(update_at__gte=since).order_by(), 'gpuserver_update_idx')
+
+
+class GPUServerAdminQueryTest(QueryPlanAssertionsMixin, TestCase):
+    """服务器列表页的查询数不随服务器/GPU 数增长。"""
+
+    SERVERS = 100
+    GPUS_PER_SERVER = 8
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'x')
+        now = timezone.now()
+        GPUServer.objects.bulk_create([
+            GPUServer(ip='10.2.0.{}'.format(i), report_token='admin-{}'.format(i),
+                      last_report_at=now if i % 2 == 0 else now - timedelta(hours=1))
+            for i in range(cls.SERVERS)
+        ])
+        bulk_insert(
+            GPUInfo,
+            ['uuid', 'index', 'name', 'utilization', 'memory_total', 'memory_used', 'server',
+             'use_by_self', 'complete_free', 'update_at'],
+            (
+                ('GPU-{}-{}'.format(server_id, index), index, 'A100', 0, 81920, 0, server_id,
+                 index == 0, index < 4, now)
+                for server_id in GPUServer.objects.values_list('id', flat=True)
+                for index in range(cls.GPUS_PER_SERVER)
+            ),
+        )
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def test_server_changelist_budget(self):
+        with self.assertMaxNumQueries(6):
+            response = self.client.get('/admin/gpu_info/gpuserver/')
+        self.assertEqual(response.status_code, 200)
+        servers = response.context['cl'].result_list
+        self.assertEqual(len(servers), self.SERVERS)
+        self.assertEqual({(s.gpu_free, s.gpu_total) for s in servers}, {(3, 8)})
+        self.assertEqual(sum(s.is_available for s in servers), self.SERVERS // 2)
+
+    def test_server_change_page_budget(self):
+        server = GPUServer.objects.first()
+        with self.assertMaxNumQueries(9):
+            response = self.client.get('/admin/gpu_info/gpuserver/{}/change/'.format(server.pk))
+        self.assertEqual(response.status_code, 200)
+
+    def test_gpu_changelist_budget(self):
+        with self.assertMaxNumQueries(9):
+            response = self.client.get('/admin/gpu_info/gpuinfo/')
+        self.assertEqual(response.status_code, 200)
+
+
+class ClusterOverviewTest(TestCase):
+    URL = '/api/v1/cluster/'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create(username='ops', is_staff=True)
+        alice = User.objects.create(username='alice')
+        now = timezone.now()
+        alive = GPUServer.objects.create(ip='10.4.0.1', last_report_at=now)
+        GPUServer.objects.create(ip='10.4.0.2', last_report_at=now - timedelta(hours=1))
+        GPUInfo.objects.bulk_create([
+            GPUInfo(uuid='GPU-a-{}'.format(i), index=i, name='A100', utilization=0, memory_total=100, memory_used=0,
+                    server=alive, complete_free=i != 1, use_by_self=i == 2)
+            for i in range(4)
+        ])
+        GPUProcess.objects.create(gpu_id='GPU-a-1', pid=10, username='bob')
+        for status, priority, gpus in ((0, 0, 1), (0, 0, 1), (0, 5, 1), (1, 0, 2), (1, 0, 1)):
+            GPUTask.objects.create(name='t', user=alice, workspace='~', cmd='true', gpu_requirement=gpus,
+                                   status=status, priority=priority)
+
+    def setUp(self):
+        snapshot_cache.clear()
+        self.addCleanup(snapshot_cache.clear)
+        env = mock.patch.dict(os.environ, {'GPUTASKER_CLUSTER_SNAPSHOT_SECONDS': '60', 'GPUTASKER_GPU_UPDATE_MODE': 'report'})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def test_requires_staff_unless_public(self):
+        self.assertEqual(self.client.get(self.URL).status_code, 403)
+        with mock.patch.dict(os.environ, {'GPUTASKER_CLUSTER_API_PUBLIC': '1'}):
+            self.assertEqual(self.client.get(self.URL).status_code, 200)
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get(self.URL).status_code, 200)
+
+    def test_snapshot_content(self):
+        self.client.force_login(self.staff)
+        data = self.client.get(self.URL).json()
+        self.assertEqual(data['summary'], {
+            'servers': 2, 'servers_available': 1, 'gpus': 4, 'gpus_free': 2, 'queued': 3, 'running': 2,
+        })
+        server = data['servers'][0]
+        self.assertEqual((server['ip'], server['available'], server['gpu_free']), ('10.4.0.1', True, 2))
+        self.assertEqual(server['gpus'][1]['users'], ['bob'])
+        self.assertEqual(data['queue']['by_priority'], {'5': 1, '0': 2})
+        self.assertEqual(data['running']['by_user'], {'alice': {'tasks': 2, 'gpus': 3}})
+
+    def test_cached_poll_with_etag_is_free(self):
+        with mock.patch.dict(os.environ, {'GPUTASKER_CLUSTER_API_PUBLIC': '1'}):
+            first = self.client.get(self.URL)
+            etag = first['ETag']
+            # 快照有效期内：不查库；ETag 匹配时 304 且不带响应体
+            with self.assertNumQueries(0):
+                again = self.client.get(self.URL, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(again.status_code, 304)
+            self.assertEqual(again.content, b'')
+            self.assertEqual(self.client.get(self.URL, HTTP_IF_NONE_MATCH='W/"other"').status_code, 200)
+
+    def test_rebuilds_once_per_cycle_and_etag_ignores_generation_time(self):
+        now = [0.0]
+        calls = []
+
+        def build():
+            calls.append(now[0])
+            return {'generated_at': int(now[0]), 'servers': []}
+
+        cache = ClusterSnapshotCache(ttl_seconds=30, builder=build, clock=lambda: now[0])
+        first = cache.get()
+        now[0] = 29
+        self.assertIs(cache.get(), first)
+        self.assertEqual(cache.max_age(first), 1)
+        now[0] = 31
+        second = cache.get()
+        self.assertEqual(calls, [0, 31])
+        self.assertEqual(second.etag, first.etag)
+        self.assertNotEqual(second.body, first.body)
+
+
+class GPUTimeseriesTest(TestCase):
+    """GPU 采样序列：按分钟/小时汇总、按保留期清理、按时间范围选粒度、后台维护。"""
+
+    T0 = 10000 * timeseries.HOUR
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.server = GPUServer.objects.create(ip='10.9.2.1')
+
+    def _sample(self, ts, utilization, users=(), index=0):
+        processes = [{'username': name} for name in users]
+        timeseries.record_samples(self.server, [{'index': index, 'utilization': utilization, 'memory_total': 100,
+                                                 'memory_used': utilization, 'processes': processes}],
+                                  ts=ts, force=True)
+
+    def test_rollup_buckets(self):
+        self._sample(self.T0 + 5, 10, ['alice'])
+        self._sample(self.T0 + 35, 30, ['alice', 'bob'])
+        self._sample(self.T0 + 35, 0, index=1)
+        self._sample(self.T0 + 65, 50)
+
+        now = self.T0 + timeseries.HOUR + 2 * timeseries.MINUTE
+        # 留出迟到窗口后封口到 T0+1h+1m；小时表封口到 T0+1h
+        self.assertEqual(timeseries.rollup(now), (self.T0 + timeseries.HOUR + 60, self.T0 + timeseries.HOUR))
+        minutes = GPUSampleRollup.objects.filter(resolution=timeseries.MINUTE).order_by('bucket', 'gpu_index')
+        self.assertEqual(
+            list(minutes.values_list('bucket', 'gpu_index', 'samples', 'busy_samples', 'utilization_sum',
+                                     'utilization_max')),
+            [(self.T0, 0, 2, 2, 40, 30), (self.T0, 1, 1, 0, 0, 0), (self.T0 + 60, 0, 1, 0, 50, 50)],
+        )
+        self.assertEqual(
+            list(GPUUserRollup.objects.filter(resolution=timeseries.MINUTE).order_by('username')
+                 .values_list('bucket', 'username', 'samples', 'utilization_sum')),
+            [(self.T0, 'alice', 2, 40), (self.T0, 'bob', 1, 30)],
+        )
+        self.assertEqual(
+            list(GPUSampleRollup.objects.filter(resolution=timeseries.HOUR, gpu_index=0)
+                 .values_list('bucket', 'samples', 'busy_samples', 'utilization_sum', 'utilization_max')),
+            [(self.T0, 3, 2, 90, 50)],
+        )
+
+        # 已封口的分钟不再重复汇总，迟到的采样也不会改写它
+        self._sample(self.T0 + 10, 100)
+        timeseries.rollup(now)
+        self.assertEqual(minutes.get(bucket=self.T0, gpu_index=0).samples, 2)
+
+        _, points = timeseries.query_series(self.T0, self.T0 + 120, self.server.pk, 0, resolution=timeseries.MINUTE)
+        self.assertEqual([(p['ts'], p['samples'], p['utilization_avg'], p['utilization_max']) for p in points],
+                         [(self.T0, 2, 20.0, 30), (self.T0 + 60, 1, 50.0, 50)])
+        with mock.patch.dict(os.environ, {'GPUTASKER_REPORT_INTERVAL': '30'}):
+            _, points = timeseries.query_series(self.T0, self.T0 + 120, username='alice', resolution=timeseries.MINUTE)
+        # 每分钟应有 2 次上报，alice 2 次采样占用：平均 1 张卡
+        self.assertEqual(points, [{'ts': self.T0, 'samples': 2, 'utilization_avg': 20.0, 'gpus_avg': 1.0}])
+
+    def test_prune_keeps_each_resolution_for_its_retention(self):
+        now = self.T0 + 30 * 86400
+        for ts in (now - 2 * timeseries.HOUR, now - 60):
+            self._sample(ts, 10, ['alice'])
+        for resolution, ages in ((timeseries.MINUTE, (3 * 86400, 60)), (timeseries.HOUR, (10 * 86400, 3 * 86400))):
+            for age in ages:
+                bucket = now - age
+                GPUSampleRollup.objects.create(
+                    resolution=resolution, bucket=bucket, server_id=self.server.pk, gpu_index=0, samples=1,
+                    utilization_sum=0, utilization_max=0, memory_used_sum=0, memory_used_max=0, memory_total=0)
+                GPUUserRollup.objects.create(resolution=resolution, bucket=bucket, username='alice',
+                                             server_id=self.server.pk, samples=1, utilization_sum=0)
+
+        with mock.patch.dict(os.environ, {'GPUTASKER_TS_RAW_RETENTION_HOURS': '1',
+                                          'GPUTASKER_TS_MINUTE_RETENTION_DAYS': '2',
+                                          'GPUTASKER_TS_HOUR_RETENTION_DAYS': '5'}):
+            self.assertEqual(timeseries.prune(now), 5)
+        self.assertEqual(list(GPUSample.objects.values_list('ts', flat=True)), [now - 60])
+        self.assertEqual(
+            sorted(GPUSampleRollup.objects.values_list('resolution', 'bucket')),
+            [(timeseries.MINUTE, now - 60), (timeseries.HOUR, now - 3 * 86400)],
+        )
+        self.assertEqual(GPUUserRollup.objects.count(), 2)
+
+    def test_pick_resolution_by_range(self):
+        now = self.T0
+        hour, day = timeseries.HOUR, 86400
+        with mock.patch.dict(os.environ, {'GPUTASKER_REPORT_INTERVAL': '30'}):
+            # 近 1 小时：原始采样 120 个点
+            self.assertEqual(timeseries.pick_resolution(now - hour, now, now), timeseries.RAW)
+            # 近 1 天：原始采样超过 MAX_POINTS，按分钟 1440 个点
+            self.assertEqual(timeseries.pick_resolution(now - day, now, now), timeseries.MINUTE)
+            # 近 3 天：超出原始采样保留期（48 小时），按分钟又超过 MAX_POINTS
+            self.assertEqual(timeseries.pick_resolution(now - 3 * day, now, now), timeseries.HOUR)
+            # 20 天前的一小时：超出分钟汇总保留期（14 天）
+            self.assertEqual(timeseries.pick_resolution(now - 20 * day, now - 20 * day + hour, now), timeseries.HOUR)
+
+    def test_maintenance_runs_in_background(self):
+        done = threading.Event()
+        timeseries.MAINTENANCE_JOB.last_start = 0.0
+        self.addCleanup(setattr, timeseries.MAINTENANCE_JOB, 'last_start', 0.0)
+        with mock.patch('gpu_info.timeseries.rollup') as rollup, \
+                mock.patch('gpu_info.timeseries.prune', side_effect=lambda: done.set() or 0):
+            self.assertTrue(timeseries.maybe_run_maintenance_in_background())
+            self.assertTrue(done.wait(5))
+            # 限频：间隔内不再启动
+            self.assertFalse(timeseries.maybe_run_maintenance_in_background())
+        rollup.assert_called_once_with()
+        # 后台线程结束后释放锁
+        self.assertTrue(timeseries.MAINTENANCE_JOB.lock.acquire(timeout=5))
+        timeseries.MAINTENANCE_JOB.lock.release()
+
+
+class ReportAuthTest(TestCase):
+    """上报鉴权缓存（TTL、负缓存、保存/删除时失效）与存活时间批量写回。"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.server = GPUServer.objects.create(ip='10.9.0.1', report_token='auth-token')
+        cls.other = GPUServer.objects.create(ip='10.9.0.2', report_token='auth-other')
+
+    def setUp(self):
+        clock = mock.patch('gpu_info.report_auth.time')
+        self.clock = clock.start().monotonic
+        self.clock.return_value = 1000.0
+        self.addCleanup(clock.stop)
+        token_cache.clear()
+        self.addCleanup(token_cache.clear)
+
+    def test_token_ttl(self):
+        cache = ReportTokenCache(ttl_seconds=60)
+        with self.assertNumQueries(1):
+            self.assertEqual(cache.resolve('auth-token'), self.server)
+        self.clock.return_value = 1059.0
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.resolve('auth-token'), self.server)
+        self.assertEqual(cache.get_cached('auth-token'), (True, self.server))
+        self.clock.return_value = 1061.0
+        self.assertEqual(cache.get_cached('auth-token'), (False, None))
+        with self.assertNumQueries(1):
+            cache.resolve('auth-token')
+
+    def test_unknown_token_uses_short_negative_ttl(self):
+        cache = ReportTokenCache(ttl_seconds=60)
+        with self.assertNumQueries(1):
+            self.assertIsNone(cache.resolve('bogus'))
+        self.clock.return_value = 1000.0 + ReportTokenCache.NEGATIVE_TTL_SECONDS - 1
+        with self.assertNumQueries(0):
+            self.assertIsNone(cache.resolve('bogus'))
+        self.clock.return_value = 1000.0 + ReportTokenCache.NEGATIVE_TTL_SECONDS + 1
+        with self.assertNumQueries(1):
+            self.assertIsNone(cache.resolve('bogus'))
+
+    def test_save_and_delete_invalidate(self):
+        with mock.patch.dict(os.environ, {'GPUTASKER_REPORT_TOKEN_CACHE_SECONDS': '60'}):
+            resolve_report_token('auth-token')
+            resolve_report_token('auth-other')
+            # 换 token：旧 token 立即失效，其他服务器的缓存不受影响
+            server = GPUServer.objects.get(pk=self.server.pk)
+            server.report_token = 'auth-rotated'
+            server.save()
+            with self.assertNumQueries(1):
+                self.assertIsNone(resolve_report_token('auth-token'))
+            with self.assertNumQueries(0):
+                self.assertEqual(resolve_report_token('auth-other'), self.other)
+
+            GPUServer.objects.get(pk=self.other.pk).delete()
+            with self.assertNumQueries(1):
+                self.assertIsNone(resolve_report_token('auth-other'))
+
+    def test_liveness_batches_writes(self):
+        recorder = LivenessRecorder(flush_interval=5)
+        start = timezone.now()
+        # 第一次上报直接写库，之后间隔内的上报只记在内存
+        with self.assertNumQueries(1):
+            recorder.touch(self.server.pk, start)
+        with self.assertNumQueries(0):
+            recorder.touch(self.server.pk, start + timedelta(seconds=1))
+            recorder.touch(self.other.pk, start + timedelta(seconds=2))
+        self.assertEqual(len(recorder.pending()), 2)
+        self.clock.return_value = 1006.0
+        with self.assertNumQueries(1):
+            recorder.touch(self.server.pk, start + timedelta(seconds=6))
+        self.assertEqual(recorder.pending(), {})
+        self.assertEqual(
+            dict(GPUServer.objects.values_list('pk', 'last_report_at')),
+            {self.server.pk: start + timedelta(seconds=6), self.other.pk: start + timedelta(seconds=2)},
+        )
+
+    def test_failed_write_is_requeued(self):
+        recorder = LivenessRecorder(flush_interval=5)
+        start = timezone.now()
+        recorder.touch(self.server.pk, start)
+        recorder.touch(self.server.pk, start + timedelta(seconds=1))
+        self.clock.return_value = 1006.0
+        with mock.patch.object(GPUServer.objects, 'bulk_update', side_effect=DatabaseError('database is locked')), \
+                mock.patch('gpu_info.report_auth.task_logger') as logger:
+            recorder.touch(self.other.pk, start + timedelta(seconds=6))
+        logger.warning.assert_called_once()
+        # 批次放回队列；写库失败期间的更新上报保留较新的时间
+        self.assertEqual(recorder.pending(), {self.server.pk: start + timedelta(seconds=1),
+                                              self.other.pk: start + timedelta(seconds=6)})
+        recorder.flush()
+        self.assertEqual(recorder.pending(), {})
+        self.assertEqual(GPUServer.objects.get(pk=self.other.pk).last_report_at, start + timedelta(seconds=6))
+
+    def test_report_revives_server_marked_invalid_elsewhere(self):
+        cached = resolve_report_token('auth-token')
+        # 调度器（另一个进程）ssh 更新失败后标记不可用，本进程的缓存实例仍是 valid=True
+        GPUServer.objects.filter(pk=self.server.pk).update(valid=False)
+        self.assertTrue(cached.valid)
+        recorder = LivenessRecorder(flush_interval=5)
+        recorder.touch(self.other.pk)
+        # 上报请求本身不写库，恢复可用随存活时间一起批量写回
+        with mock.patch('gpu_info.report_auth.liveness', recorder), self.assertNumQueries(0):
+            record_report(cached)
+        self.assertFalse(GPUServer.objects.get(pk=self.server.pk).valid)
+        with self.assertNumQueries(1):
+            recorder.flush()
+        self.assertTrue(GPUServer.objects.get(pk=self.server.pk).valid)
+
+
+class IngestEndpointTest(TransactionTestCase):
+    """异步上报接口：队列满时 503、token 命中缓存时不切线程、与同步接口的响应一致。
+
+    写库在真实的线程池里执行，用 TransactionTestCase 让工作线程的连接看到已提交的数据。
+    """
+
+    def setUp(self):
+        self.server = GPUServer.objects.create(ip='10.9.1.1', report_token='ingest-token')
+        user = User.objects.create(username='alice')
+        task = GPUTask.objects.create(name='t', user=user, workspace='~', cmd='true', status=1)
+        self.running_log = GPUTaskRunningLog.objects.create(index=0, task=task, server=self.server, pid=1, gpus='0',
+                                                            log_file_path='/dev/null', status=1)
+        self.factory = RequestFactory()
+        self.executor = BoundedIngestExecutor(workers=1, max_pending=2)
+        self.addCleanup(lambda: self.executor._executor and self.executor._executor.shutdown())
+        for patcher in (mock.patch('gpu_info.views.ingest_executor', self.executor),
+                        mock.patch('task.views.ingest_executor', self.executor),
+                        mock.patch('gpu_info.report_auth.liveness.touch')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        token_cache.clear()
+        self.addCleanup(token_cache.clear)
+
+    def _gpu_payload(self, token='ingest-token'):
+        return {'token': token, 'gpus': [{'uuid': 'GPU-ingest-0', 'index': 0, 'name': 'A100', 'utilization': 5,
+                                          'memory_total': 100, 'memory_used': 10, 'processes': []}]}
+
+    def _post(self, view, payload, path='/api/v1/report_gpu/'):
+        body = payload if isinstance(payload, str) else json.dumps(payload)
+        request = self.factory.post(path, data=body, content_type='application/json')
+        if asyncio.iscoroutinefunction(view):
+            return asyncio.run(view(request))
+        return view(request)
+
+    def _result(self, response):
+        data = json.loads(response.content)
+        data.pop('ts', None)
+        return response.status_code, data
+
+    def test_full_queue_returns_503(self):
+        before = dict(REPORT_REQUESTS.values()).get(('report_gpu', '503'), 0)
+        resolve_report_token('ingest-token')
+        for _ in range(self.executor.max_pending):
+            self.assertTrue(self.executor._slots.acquire(blocking=False))
+        self.addCleanup(lambda: [self.executor._slots.release() for _ in range(self.executor.max_pending)])
+
+        response = self._post(report_gpu_async, self._gpu_payload())
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '5')
+        self.assertEqual(json.loads(response.content), {'ok': False, 'error': 'overloaded'})
+        self.assertEqual(dict(REPORT_REQUESTS.values())[('report_gpu', '503')], before + 1)
+        self.assertFalse(GPUInfo.objects.filter(uuid='GPU-ingest-0').exists())
+
+    def test_cached_token_skips_thread_hop(self):
+        with mock.patch.object(self.executor, 'run', wraps=self.executor.run) as run:
+            self.assertEqual(self._post(report_gpu_async, self._gpu_payload()).status_code, 200)
+            # 未命中缓存：解析 token 与写库各一次
+            self.assertEqual([c.args[0].__name__ for c in run.call_args_list],
+                             ['resolve_report_token', 'ingest_gpu_report'])
+            run.reset_mock()
+            self.assertEqual(self._post(report_gpu_async, self._gpu_payload()).status_code, 200)
+            self.assertEqual([c.args[0].__name__ for c in run.call_args_list], ['ingest_gpu_report'])
+        # 无效 token 的负缓存同样不进线程池
+        self._post(report_gpu_async, self._gpu_payload('bogus'))
+        with mock.patch.object(self.executor, 'run', wraps=self.executor.run) as run:
+            self.assertEqual(self._post(report_gpu_async, self._gpu_payload('bogus')).status_code, 403)
+        run.assert_not_called()
+
+    def test_async_and_sync_endpoints_agree(self):
+        heartbeat = {'token': 'ingest-token', 'tasks': [{'running_log_id': self.running_log.pk},
+                                                        {'running_log_id': 0}]}
+        cases = [
+            (report_gpu, report_gpu_async, '/api/v1/report_gpu/', self._gpu_payload()),
+            (report_gpu, report_gpu_async, '/api/v1/report_gpu/', self._gpu_payload('bogus')),
+            (report_gpu, report_gpu_async, '/api/v1/report_gpu/', {'token': 'ingest-token'}),
+            (report_gpu, report_gpu_async, '/api/v1/report_gpu/', {'gpus': []}),
+            (report_gpu, report_gpu_async, '/api/v1/report_gpu/', '{not json'),
+            (report_tasks, report_tasks_async, '/api/v1/report_tasks/', heartbeat),
+            (report_tasks, report_tasks_async, '/api/v1/report_tasks/', {'token': 'ingest-token', 'tasks': {}}),
+        ]
+        for sync_view, async_view, path, payload in cases:
+            with self.subTest(path=path, payload=payload):
+                expected = self._result(self._post(sync_view, payload, path))
+                token_cache.clear()
+                self.assertEqual(self._result(self._post(async_view, payload, path)), expected)
+        request = self.factory.get('/api/v1/report_gpu/')
+        self.assertEqual(report_gpu(request).status_code, asyncio.run(report_gpu_async(request)).status_code)
+
+
+class MetricsEndpointTest(TestCase):
+    URL = '/metrics'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create(username='ops', is_staff=True)
+        alice = User.objects.create(username='alice')
+        now = timezone.now()
+        cls.server = GPUServer.objects.create(ip='10.7.0.1', last_report_at=now)
+        GPUServer.objects.create(ip='10.7.0.2', last_report_at=now - timedelta(hours=1))
+        GPUInfo.objects.bulk_create([
+            GPUInfo(uuid='GPU-m-{}'.format(i), index=i, name='A100', utilization=0, memory_total=100, memory_used=0,
+                    server=cls.server, complete_free=i != 1, use_by_self=i == 2)
+            for i in range(4)
+        ])
+        for status in (0, 0, 1):
+            GPUTask.objects.create(name='t', user=alice, workspace='~', cmd='true', status=status)
+
+    def setUp(self):
+        snapshot_cache.clear()
+        self.addCleanup(snapshot_cache.clear)
+        env = mock.patch.dict(os.environ, {
+            'GPUTASKER_GPU_UPDATE_MODE': 'report',
+            'GPUTASKER_METRICS_DIR': '',
+            'GPUTASKER_METRICS_TOKEN': 'scrape-secret',
+        })
+        env.start()
+        self.addCleanup(env.stop)
+
+    def _scrape(self):
+        response = self.client.get(self.URL, HTTP_AUTHORIZATION='Bearer scrape-secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return response.content.decode('utf-8').splitlines()
+
+    def test_requires_token(self):
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get(self.URL).status_code, 403)
+        self.assertEqual(self.client.get(self.URL, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+
+    def test_cluster_gauges_and_report_counters(self):
+        before = dict(REPORT_REQUESTS.values()).get(('report_gpu', '200'), 0)
+        response = self.client.post('/api/v1/report_gpu/', data='{"token": "%s", "gpus": []}' % self.server.report_token,
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        lines = self._scrape()
+        self.assertIn('gputasker_gpus{server="10.7.0.1:22",state="locked"} 1', lines)
+        self.assertIn('gputasker_gpus{server="10.7.0.1:22",state="free"} 2', lines)
+        self.assertIn('gputasker_gpus{server="10.7.0.1:22",state="busy"} 1', lines)
+        self.assertIn('gputasker_stale_nodes 1', lines)
+        self.assertIn('gputasker_ready_queue_depth{priority="0"} 2', lines)
+        self.assertIn('gputasker_running_tasks 1', lines)
+        self.assertIn('gputasker_report_requests_total{endpoint="report_gpu",code="200"} ' + str(before + 1), lines)
+        self.assertTrue(any(line.startswith('gputasker_report_seconds_count{endpoint="report_gpu"}') for line in lines))
+        # 调度器的指标已注册，未发生时只输出 HELP/TYPE
+        self.assertIn('# TYPE gputasker_scheduler_phase_seconds histogram', lines)
+
+
+class LoadTestAgentsTest(TestCase):
+    def setUp(self):
+        env = mock.patch.dict(os.environ, {'GPUTASKER_GPU_UPDATE_MODE': 'report', 'GPUTASKER_METRICS_DIR': ''})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def test_setup_payloads_and_teardown(self):
+        call_command('loadtest_agents', 'setup', agents=3, tasks=2, stdout=StringIO())
+        servers = GPUServer.objects.filter(hostname__startswith=loadtest_agents.HOSTNAME_PREFIX)
+        self.assertEqual(servers.count(), 3)
+        self.assertFalse(servers.filter(can_use=True).exists())
+        agents = loadtest_agents.Command()._agents(10)
+        self.assertEqual([len(logs) for _, _, logs in agents], [2, 2, 2])
+
+        # 模拟节点的报文与真实 agent 相同，上报接口照常处理并记录写库耗时
+        _, token, log_ids = agents[0]
+        db_before = dict(REPORT_DB_SECONDS.values()).get(('report_gpu',), [0])
+        gpus = loadtest_agents.synthetic_gpus(random.Random(0), 0, 4, len(log_ids))
+        response = self.client.post('/api/v1/report_gpu/', data=json.dumps({'token': token, 'gpus': gpus}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(GPUInfo.objects.filter(server__report_token=token).count(), 4)
+        db_after = dict(REPORT_DB_SECONDS.values())[('report_gpu',)]
+        self.assertEqual(sum(db_after[:-1]), sum(db_before[:-1]) + 1)
+        response = self.client.post(
+            '/api/v1/report_tasks/',
+            data=json.dumps({'token': token, 'tasks': loadtest_agents.synthetic_tasks(log_ids)}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            GPUTaskRunningLog.objects.filter(pk__in=log_ids, last_heartbeat_at__isnull=False).count(), len(log_ids),
+        )
+
+        call_command('loadtest_agents', 'teardown', stdout=StringIO())
+        self.assertFalse(GPUServer.objects.filter(hostname__startswith=loadtest_agents.HOSTNAME_PREFIX).exists())
+        self.assertFalse(GPUTask.objects.filter(user__username=loadtest_agents.LOADTEST_USER).exists())
+        self.assertFalse(User.objects.filter(username=loadtest_agents.LOADTEST_USER).exists())
+
+    def test_plan_patterns(self):
+        steady = loadtest_agents.Plan('steady', 4, 10.0, 30.0, 0.0, 0.0)
+        self.assertEqual(steady.times(1), [2.5, 12.5, 22.5])
+        burst = loadtest_agents.Plan('burst', 4, 10.0, 30.0, 0.0, 0.0)
+        self.assertEqual({burst.times(i)[0] for i in range(4)}, {0.0})
+        # master 在 [10, 25) 不可用，恢复时所有节点同时补报
+        herd = loadtest_agents.Plan('herd', 4, 10.0, 40.0, 10.0, 15.0)
+        self.assertEqual(herd.times(1), [2.5, 25.0, 32.5])
+        self.assertTrue(all(25.0 in herd.times(i) for i in range(4)))
+        self.assertEqual([herd.phase(t) for t in (2.5, 25.0, 36.0)], ['before', 'recovery', 'after'])
+
+    def test_histogram_quantile_from_scrapes(self):
+        registry = Registry()
+        histogram = Histogram('lt_seconds', 'x', ('endpoint',), buckets=(0.1, 0.2, 0.4), registry=registry)
+        histogram.observe(0.05, endpoint='a')
+        before = loadtest_agents.parse_metrics(render(registry.collect(shared=False)))
+        for value in (0.15, 0.15, 0.3, 0.3):
+            histogram.observe(value, endpoint='a')
+        histogram.observe(0.05, endpoint='b')
+        after = loadtest_agents.parse_metrics(render(registry.collect(shared=False)))
+
+        buckets, total, count = loadtest_agents.histogram_delta(before, after, 'lt_seconds', endpoint='a')
+        self.assertEqual(buckets, [(0.1, 0), (0.2, 2), (0.4, 4), (float('inf'), 4)])
+        self.assertEqual(count, 4)
+        self.assertAlmostEqual(total, 0.9)
+        self.assertAlmostEqual(loadtest_agents.histogram_quantile(0.5, buckets), 0.2)
+        self.assertAlmostEqual(loadtest_agents.histogram_quantile(0.75, buckets), 0.3)
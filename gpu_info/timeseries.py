@@ -0,0 +1,408 @@
+"""GPU 采样时间序列：原始采样追加写入，后台汇总为 1 分钟 / 1 小时粒度并按保留期清理。
+
+- 写入：每次节点上报（或 SSH 扫描）把该节点所有 GPU 的一行采样 bulk_create 进 GPUSample；
+- 汇总：rollup() 把已经“封口”的原始采样聚合进 GPUSampleRollup / GPUUserRollup；
+- 清理：prune() 按保留期删除过期的原始采样与汇总；
+- 查询：query_series() 按 GPU / 服务器 / 用户取一段时间的序列，自动挑选合适的粒度。
+
+相关环境变量：
+    GPUTASKER_TS_ENABLED                 是否记录采样（默认 1）
+    GPUTASKER_TS_MIN_INTERVAL_SECONDS    同一节点两次采样的最小间隔（默认 10）
+    GPUTASKER_TS_RAW_RETENTION_HOURS     原始采样保留小时数（默认 48）
+    GPUTASKER_TS_MINUTE_RETENTION_DAYS   1 分钟汇总保留天数（默认 14）
+    GPUTASKER_TS_HOUR_RETENTION_DAYS     1 小时汇总保留天数（默认 365）
+    GPUTASKER_TS_MAINTENANCE_SECONDS     后台汇总/清理的最小间隔（默认 60）
+"""
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from django.db.models import Count, F, Max, Min, Sum
+from django.db.models.functions import Mod
+
+from base.utils import PeriodicJob, env_int
+
+from .models import GPUSample, GPUSampleRollup, GPUUserRollup
+
+RAW = 0
+MINUTE = 60
+HOUR = 3600
+
+# rollup 时对原始采样留出的迟到窗口（秒）
+ROLLUP_GRACE_SECONDS = 60
+# 单次 rollup 处理的最大时间跨度，限制内存占用
+ROLLUP_CHUNK_SECONDS = 6 * HOUR
+# 自动选择粒度时单条序列的最大点数
+MAX_POINTS = 2000
+
+task_logger = logging.getLogger('django.task')
+
+
+def is_enabled():
+    return (os.getenv('GPUTASKER_TS_ENABLED', '1') or '1').strip() not in {'0', 'false', 'False'}
+
+
+def retention_seconds(resolution):
+    if resolution == RAW:
+        return env_int('GPUTASKER_TS_RAW_RETENTION_HOURS', 48, 1) * HOUR
+    if resolution == MINUTE:
+        return env_int('GPUTASKER_TS_MINUTE_RETENTION_DAYS', 14, 1) * 86400
+    return env_int('GPUTASKER_TS_HOUR_RETENTION_DAYS', 365, 1) * 86400
+
+
+def report_interval_seconds():
+    """agent 上报间隔，用于把“用户采样次数”折算成平均占用卡数。"""
+    return env_int('GPUTASKER_REPORT_INTERVAL', 30, 1)
+
+
+_last_sample_at = {}
+_last_sample_lock = threading.Lock()
+
+
+def _usernames(processes):
+    names = set()
+    for proc in processes or []:
+        if isinstance(proc, dict):
+            name = str(proc.get('username') or '').strip()
+            if name and name != 'unknown':
+                names.add(name.replace(',', '_'))
+    return ','.join(sorted(names))[:200]
+
+
+def record_samples(server, gpus, ts=None, force=False):
+    """记录一次上报中的所有 GPU 采样。
+
+    gpus 的元素与 agent 上报格式一致：index/utilization/memory_total/memory_used/processes。
+    返回写入的行数。
+    """
+    if not is_enabled() or not gpus:
+        return 0
+    ts = int(ts if ts is not None else time.time())
+    if not force:
+        min_interval = env_int('GPUTASKER_TS_MIN_INTERVAL_SECONDS', 10)
+        with _last_sample_lock:
+            last = _last_sample_at.get(server.pk)
+            if last is not None and ts - last < min_interval:
+                return 0
+            _last_sample_at[server.pk] = ts
+
+    rows = []
+    for gpu in gpus:
+        if not isinstance(gpu, dict):
+            continue
+        try:
+            rows.append(GPUSample(
+                ts=ts,
+                server_id=server.pk,
+                gpu_index=int(gpu.get('index', 0)),
+                utilization=max(0, min(100, int(gpu.get('utilization', 0)))),
+                memory_used=max(0, int(gpu.get('memory_used', 0))),
+                memory_total=max(0, int(gpu.get('memory_total', 0))),
+                users=_usernames(gpu.get('processes')),
+            ))
+        except (TypeError, ValueError):
+            continue
+    if rows:
+        GPUSample.objects.bulk_create(rows)
+    return len(rows)
+
+
+def _last_bucket(model, resolution):
+    return model.objects.filter(resolution=resolution).aggregate(v=Max('bucket'))['v']
+
+
+def _first_bucket(resolution):
+    return GPUSampleRollup.objects.filter(resolution=resolution).aggregate(v=Min('bucket'))['v']
+
+
+def _rollup_raw(start, end):
+    """把 [start, end) 内的原始采样聚合为 1 分钟粒度。"""
+    raw = GPUSample.objects.filter(ts__gte=start, ts__lt=end)
+    gpu_rows = (
+        raw.annotate(b=F('ts') - Mod('ts', MINUTE))
+        .values('server_id', 'gpu_index', 'b')
+        .annotate(
+            n=Count('id'),
+            util_sum=Sum('utilization'),
+            util_max=Max('utilization'),
+            mem_sum=Sum('memory_used'),
+            mem_max=Max('memory_used'),
+            mem_total=Max('memory_total'),
+        )
+    )
+    busy = defaultdict(int)
+    users = defaultdict(lambda: [0, 0])
+    for server_id, gpu_index, ts, utilization, names in (
+        raw.exclude(users='').values_list('server_id', 'gpu_index', 'ts', 'utilization', 'users').iterator(chunk_size=5000)
+    ):
+        b = ts - ts % MINUTE
+        busy[(server_id, gpu_index, b)] += 1
+        for name in names.split(','):
+            acc = users[(name, server_id, b)]
+            acc[0] += 1
+            acc[1] += utilization
+
+    GPUSampleRollup.objects.bulk_create(
+        [
+            GPUSampleRollup(
+                resolution=MINUTE,
+                bucket=r['b'],
+                server_id=r['server_id'],
+                gpu_index=r['gpu_index'],
+                samples=r['n'],
+                busy_samples=busy.get((r['server_id'], r['gpu_index'], r['b']), 0),
+                utilization_sum=r['util_sum'] or 0,
+                utilization_max=r['util_max'] or 0,
+                memory_used_sum=r['mem_sum'] or 0,
+                memory_used_max=r['mem_max'] or 0,
+                memory_total=r['mem_total'] or 0,
+            )
+            for r in gpu_rows
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+    GPUUserRollup.objects.bulk_create(
+        [
+            GPUUserRollup(
+                resolution=MINUTE,
+                bucket=b,
+                username=name,
+                server_id=server_id,
+                samples=acc[0],
+                utilization_sum=acc[1],
+            )
+            for (name, server_id, b), acc in users.items()
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+def _rollup_minutes(start, end):
+    """把 [start, end) 内的 1 分钟汇总再聚合为 1 小时粒度。"""
+    minutes = GPUSampleRollup.objects.filter(resolution=MINUTE, bucket__gte=start, bucket__lt=end)
+    gpu_rows = (
+        minutes.annotate(b=F('bucket') - Mod('bucket', HOUR))
+        .values('server_id', 'gpu_index', 'b')
+        .annotate(
+            n=Sum('samples'),
+            busy=Sum('busy_samples'),
+            util_sum=Sum('utilization_sum'),
+            util_max=Max('utilization_max'),
+            mem_sum=Sum('memory_used_sum'),
+            mem_max=Max('memory_used_max'),
+            mem_total=Max('memory_total'),
+        )
+    )
+    GPUSampleRollup.objects.bulk_create(
+        [
+            GPUSampleRollup(
+                resolution=HOUR,
+                bucket=r['b'],
+                server_id=r['server_id'],
+                gpu_index=r['gpu_index'],
+                samples=r['n'] or 0,
+                busy_samples=r['busy'] or 0,
+                utilization_sum=r['util_sum'] or 0,
+                utilization_max=r['util_max'] or 0,
+                memory_used_sum=r['mem_sum'] or 0,
+                memory_used_max=r['mem_max'] or 0,
+                memory_total=r['mem_total'] or 0,
+            )
+            for r in gpu_rows
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+    user_rows = (
+        GPUUserRollup.objects.filter(resolution=MINUTE, bucket__gte=start, bucket__lt=end)
+        .annotate(b=F('bucket') - Mod('bucket', HOUR))
+        .values('username', 'server_id', 'b')
+        .annotate(n=Sum('samples'), util_sum=Sum('utilization_sum'))
+    )
+    GPUUserRollup.objects.bulk_create(
+        [
+            GPUUserRollup(
+                resolution=HOUR,
+                bucket=r['b'],
+                username=r['username'],
+                server_id=r['server_id'],
+                samples=r['n'] or 0,
+                utilization_sum=r['util_sum'] or 0,
+            )
+            for r in user_rows
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+def rollup(now=None):
+    """把已封口的时间段汇总进 1 分钟 / 1 小时表，返回 (汇总到的分钟, 汇总到的小时)。"""
+    now = int(now if now is not None else time.time())
+
+    minute_end = (now - ROLLUP_GRACE_SECONDS) // MINUTE * MINUTE
+    last = _last_bucket(GPUSampleRollup, MINUTE)
+    if last is not None:
+        start = last + MINUTE
+    else:
+        first = GPUSample.objects.aggregate(v=Min('ts'))['v']
+        start = first - first % MINUTE if first is not None else minute_end
+    while start < minute_end:
+        end = min(minute_end, start + ROLLUP_CHUNK_SECONDS)
+        _rollup_raw(start, end)
+        start = end
+
+    hour_end = minute_end // HOUR * HOUR
+    last = _last_bucket(GPUSampleRollup, HOUR)
+    if last is not None:
+        start = last + HOUR
+    else:
+        first = _first_bucket(MINUTE)
+        start = first - first % HOUR if first is not None else hour_end
+    while start < hour_end:
+        end = min(hour_end, start + ROLLUP_CHUNK_SECONDS)
+        _rollup_minutes(start, end)
+        start = end
+    return minute_end, hour_end
+
+
+def prune(now=None):
+    """按保留期删除过期数据，返回删除的行数。"""
+    now = int(now if now is not None else time.time())
+    deleted = GPUSample.objects.filter(ts__lt=now - retention_seconds(RAW)).delete()[0]
+    for resolution in (MINUTE, HOUR):
+        cutoff = now - retention_seconds(resolution)
+        deleted += GPUSampleRollup.objects.filter(resolution=resolution, bucket__lt=cutoff).delete()[0]
+        deleted += GPUUserRollup.objects.filter(resolution=resolution, bucket__lt=cutoff).delete()[0]
+    return deleted
+
+
+def maintenance_seconds():
+    return env_int('GPUTASKER_TS_MAINTENANCE_SECONDS', 60, 1)
+
+
+def _maintain():
+    rollup()
+    deleted = prune()
+    if deleted:
+        task_logger.info('gpu timeseries: pruned %d expired rows', deleted)
+
+
+MAINTENANCE_JOB = PeriodicJob('gpu-timeseries', _maintain, maintenance_seconds)
+maybe_run_maintenance_in_background = MAINTENANCE_JOB.maybe_start
+
+
+def pick_resolution(start, end, now=None):
+    """选出覆盖 start 且点数不超过 MAX_POINTS 的最细粒度。"""
+    now = int(now if now is not None else time.time())
+    span = max(1, end - start)
+    for resolution in (RAW, MINUTE, HOUR):
+        step = resolution or report_interval_seconds()
+        if start >= now - retention_seconds(resolution) and span / step <= MAX_POINTS:
+            return resolution
+    return HOUR
+
+
+def query_series(start, end, server_id=None, gpu_index=None, username=None, resolution=None):
+    """查询 [start, end) 的时间序列。
+
+    - 指定 server_id + gpu_index：单卡序列；
+    - 只指定 server_id：整台服务器（各卡平均）；
+    - 指定 username：该用户占用的卡（可再按 server_id 过滤），gpus_avg 为平均占用卡数的估算。
+
+    返回 (resolution, points)，points 按时间升序。
+    """
+    start = int(start)
+    end = int(end)
+    if resolution is None:
+        resolution = pick_resolution(start, end)
+    if username:
+        return resolution, _query_user(start, end, username, server_id, resolution)
+    return resolution, _query_gpus(start, end, server_id, gpu_index, resolution)
+
+
+def _query_gpus(start, end, server_id, gpu_index, resolution):
+    if resolution == RAW:
+        qs = GPUSample.objects.filter(ts__gte=start, ts__lt=end)
+        if server_id is not None:
+            qs = qs.filter(server_id=server_id)
+        if gpu_index is not None:
+            qs = qs.filter(gpu_index=gpu_index)
+        rows = qs.values('ts').annotate(
+            n=Count('id'),
+            util_sum=Sum('utilization'),
+            util_max=Max('utilization'),
+            mem_sum=Sum('memory_used'),
+            mem_max=Max('memory_used'),
+        ).order_by('ts')
+        key = 'ts'
+    else:
+        qs = GPUSampleRollup.objects.filter(resolution=resolution, bucket__gte=start, bucket__lt=end)
+        if server_id is not None:
+            qs = qs.filter(server_id=server_id)
+        if gpu_index is not None:
+            qs = qs.filter(gpu_index=gpu_index)
+        rows = qs.values('bucket').annotate(
+            n=Sum('samples'),
+            util_sum=Sum('utilization_sum'),
+            util_max=Max('utilization_max'),
+            mem_sum=Sum('memory_used_sum'),
+            mem_max=Max('memory_used_max'),
+        ).order_by('bucket')
+        key = 'bucket'
+
+    points = []
+    for r in rows:
+        n = r['n'] or 0
+        if not n:
+            continue
+        points.append({
+            'ts': r[key],
+            'samples': n,
+            'utilization_avg': round((r['util_sum'] or 0) / n, 2),
+            'utilization_max': r['util_max'] or 0,
+            'memory_used_avg': round((r['mem_sum'] or 0) / n, 1),
+            'memory_used_max': r['mem_max'] or 0,
+        })
+    return points
+
+
+def _query_user(start, end, username, server_id, resolution):
+    if resolution == RAW:
+        qs = GPUSample.objects.filter(ts__gte=start, ts__lt=end, users__contains=username)
+        if server_id is not None:
+            qs = qs.filter(server_id=server_id)
+        acc = defaultdict(lambda: [0, 0])
+        for ts, utilization, names in qs.values_list('ts', 'utilization', 'users').iterator(chunk_size=5000):
+            if username not in names.split(','):
+                continue
+            acc[ts][0] += 1
+            acc[ts][1] += utilization
+        return [
+            {
+                'ts': ts,
+                'samples': n,
+                'utilization_avg': round(util_sum / n, 2),
+                'gpus_avg': n,
+            }
+            for ts, (n, util_sum) in sorted(acc.items())
+        ]
+
+    qs = GPUUserRollup.objects.filter(resolution=resolution, username=username, bucket__gte=start, bucket__lt=end)
+    if server_id is not None:
+        qs = qs.filter(server_id=server_id)
+    rows = qs.values('bucket').annotate(n=Sum('samples'), util_sum=Sum('utilization_sum')).order_by('bucket')
+    expected = max(1.0, resolution / report_interval_seconds())
+    return [
+        {
+            'ts': r['bucket'],
+            'samples': r['n'],
+            'utilization_avg': round((r['util_sum'] or 0) / r['n'], 2),
+            'gpus_avg': round(r['n'] / expected, 2),
+        }
+        for r in rows if r['n']
+    ]
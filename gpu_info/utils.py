@@ -4,14 +4,34 @@ import json
 import logging
 import base64
 import hashlib
+import time
+from contextlib import contextmanager
 from typing import Optional
 
-from .models import GPUServer, GPUInfo
+from base.telemetry import Counter, Histogram
+from .models import GPUServer, GPUInfo, sync_gpu_processes
+from .timeseries import record_samples
 
 from django.conf import settings
 
 task_logger = logging.getLogger('django.task')
 
+SSH_SECONDS = Histogram('gputasker_ssh_seconds', 'SSH 调用耗时（秒）', ('op',))
+SSH_FAILURES = Counter('gputasker_ssh_failures_total', 'SSH 调用失败次数（非零退出、超时等）', ('op',))
+
+
+@contextmanager
+def observe_ssh(op):
+    """记录一次 SSH 调用的耗时；抛出异常时计一次失败。"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        SSH_FAILURES.inc(op=op)
+        raise
+    finally:
+        SSH_SECONDS.observe(time.perf_counter() - start, op=op)
+
 
 def build_report_gpu_url():
     """生成 Node 上报接口 URL。
@@ -38,11 +58,12 @@ def _ssh_run(host, user, remote_cmd, port=22, private_key_path=None, timeout=60)
     if private_key_path:
         args += ['-i', private_key_path]
     args += [f'{user}@{host}', remote_cmd]
-    proc = subprocess.run(args, capture_output=True, text=True, timeout=timeout)
-    stdout = (proc.stdout or '').strip()
-    stderr = (proc.stderr or '').strip()
-    if proc.returncode != 0:
-        raise RuntimeError(f'ssh failed rc={proc.returncode}: {stderr or stdout or "(no output)"}')
+    with observe_ssh('agent'):
+        proc = subprocess.run(args, capture_output=True, text=True, timeout=timeout)
+        stdout = (proc.stdout or '').strip()
+        stderr = (proc.stderr or '').strip()
+        if proc.returncode != 0:
+            raise RuntimeError(f'ssh failed rc={proc.returncode}: {stderr or stdout or "(no output)"}')
     return stdout
 
 
@@ -354,7 +375,8 @@ def ssh_execute(host, user, exec_cmd, port=22, private_key_path=None):
         cmd = "ssh -o StrictHostKeyChecking=no -p {:d} {}@{} \"{}\"".format(port, user, host, exec_cmd)
     else:
         cmd = "ssh -o StrictHostKeyChecking=no -p {:d} -i {} {}@{} \"{}\"".format(port, private_key_path, user, host, exec_cmd)
-    return subprocess.check_output(cmd, timeout=60, shell=True)
+    with observe_ssh('query'):
+        return subprocess.check_output(cmd, timeout=60, shell=True)
 
 
 def get_hostname(host, user, port=22, private_key_path=None):
@@ -452,8 +474,11 @@ class GPUInfoUpdater:
                 self.utilization_history[uuid].pop(0)
             return max(self.utilization_history[uuid])
 
-    def update_gpu_info(self):
+    def update_gpu_info(self, server_ids=None):
+        # server_ids：多实例调度时只更新本实例分到的节点
         server_list = GPUServer.objects.all()
+        if server_ids is not None:
+            server_list = server_list.filter(id__in=server_ids)
         for server in server_list:
             try:
                 if server.hostname is None or server.hostname == '':
@@ -471,7 +496,6 @@ class GPUInfoUpdater:
                             utilization=self.update_utilization(gpu['uuid'], gpu['utilization.gpu']),
                             memory_total=gpu['memory.total'],
                             memory_used=gpu['memory.used'],
-                            processes='\n'.join(map(lambda x: json.dumps(x), gpu['processes'])),
                             complete_free=len(gpu['processes']) == 0,
                             server=server
                         )
@@ -482,8 +506,21 @@ class GPUInfoUpdater:
                         gpu_info.memory_total = gpu['memory.total']
                         gpu_info.memory_used = gpu['memory.used']
                         gpu_info.complete_free = len(gpu['processes']) == 0
-                        gpu_info.processes = '\n'.join(map(lambda x: json.dumps(x), gpu['processes']))
                         gpu_info.save()
+                sync_gpu_processes({gpu['uuid']: gpu['processes'] for gpu in gpu_info_json})
+                try:
+                    record_samples(server, [
+                        {
+                            'index': gpu['index'],
+                            'utilization': gpu['utilization.gpu'],
+                            'memory_total': gpu['memory.total'],
+                            'memory_used': gpu['memory.used'],
+                            'processes': gpu['processes'],
+                        }
+                        for gpu in gpu_info_json
+                    ])
+                except Exception as exc:
+                    task_logger.warning('record gpu samples failed: %s', exc)
             except (subprocess.CalledProcessError, subprocess.TimeoutExpired, RuntimeError):
                 task_logger.error('Update ' + server.ip + ' failed')
                 server.valid = False
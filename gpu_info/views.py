@@ -1,48 +1,47 @@
 import json
+import logging
+import os
 import time
 
-from django.http import JsonResponse, HttpResponseNotAllowed
-from django.utils import timezone
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse, JsonResponse, HttpResponseNotAllowed
+from django.utils.cache import get_conditional_response
 from django.views.decorators.csrf import csrf_exempt
 
-from .models import GPUServer, GPUInfo
+from .models import GPUInfo, sync_gpu_processes
+from .report_auth import resolve_report_token, peek_report_token, record_report
+from .ingest import ingest_executor, instrument_db, instrument_report, IngestOverloaded
+from .cluster import snapshot_cache
+from .timeseries import record_samples, query_series, RAW, MINUTE, HOUR
 
+task_logger = logging.getLogger('django.task')
 
-def _compact_json_lines(items):
-	if not items:
-		return ''
-	return '\n'.join(json.dumps(item, ensure_ascii=False, separators=(',', ':')) for item in items)
-
-
-@csrf_exempt
-def report_gpu(request):
-	if request.method != 'POST':
-		return HttpResponseNotAllowed(['POST'])
 
+def _parse_gpu_payload(body):
+	"""解析并校验 report_gpu 请求体，返回 (token, gpus, error_response)。"""
 	try:
-		payload = json.loads(request.body.decode('utf-8') or '{}')
+		payload = json.loads(body.decode('utf-8') or '{}')
 	except Exception:
-		return JsonResponse({'ok': False, 'error': 'invalid_json'}, status=400)
+		return None, None, JsonResponse({'ok': False, 'error': 'invalid_json'}, status=400)
 
 	token = payload.get('token')
 	gpus = payload.get('gpus')
 	if not token or not isinstance(token, str):
-		return JsonResponse({'ok': False, 'error': 'missing_token'}, status=401)
+		return None, None, JsonResponse({'ok': False, 'error': 'missing_token'}, status=401)
 	if gpus is None:
-		return JsonResponse({'ok': False, 'error': 'missing_gpus'}, status=400)
+		return None, None, JsonResponse({'ok': False, 'error': 'missing_gpus'}, status=400)
 	if not isinstance(gpus, list):
-		return JsonResponse({'ok': False, 'error': 'invalid_gpus'}, status=400)
+		return None, None, JsonResponse({'ok': False, 'error': 'invalid_gpus'}, status=400)
+	return token, gpus, None
 
-	try:
-		server = GPUServer.objects.get(report_token=token)
-	except GPUServer.DoesNotExist:
-		return JsonResponse({'ok': False, 'error': 'invalid_token'}, status=403)
 
-	server.valid = True
-	server.last_report_at = timezone.now()
-	server.save()
+@instrument_db('report_gpu')
+def ingest_gpu_report(server, gpus):
+	"""把一次 GPU 上报写入数据库，返回更新的 GPU 数量。WSGI/ASGI 两条入口共用。"""
+	record_report(server)
 
 	updated = 0
+	processes_by_gpu = {}
 	for gpu in gpus:
 		if not isinstance(gpu, dict):
 			continue
@@ -63,7 +62,6 @@ def report_gpu(request):
 		if not isinstance(processes, list):
 			processes = []
 
-		processes_str = _compact_json_lines(processes)
 		complete_free = len(processes) == 0
 
 		obj, created = GPUInfo.objects.get_or_create(
@@ -74,7 +72,6 @@ def report_gpu(request):
 				'utilization': utilization,
 				'memory_total': memory_total,
 				'memory_used': memory_used,
-				'processes': processes_str,
 				'complete_free': complete_free,
 				'server': server,
 			},
@@ -86,11 +83,135 @@ def report_gpu(request):
 			obj.utilization = utilization
 			obj.memory_total = memory_total
 			obj.memory_used = memory_used
-			obj.processes = processes_str
 			obj.complete_free = complete_free
 			obj.server = server
 			obj.save()
+		processes_by_gpu[uuid] = processes
 		updated += 1
 
+	sync_gpu_processes(processes_by_gpu)
+
+	try:
+		record_samples(server, gpus)
+	except Exception as exc:
+		# 历史采样是旁路数据，写失败不影响本次上报
+		task_logger.warning('record gpu samples failed: %s', exc)
+	return updated
+
+
+def _gpu_report_response(server, updated):
 	return JsonResponse({'ok': True, 'updated': updated, 'server': str(server), 'ts': int(time.time())})
 
+
+def overloaded_response():
+	response = JsonResponse({'ok': False, 'error': 'overloaded'}, status=503)
+	response['Retry-After'] = '5'
+	return response
+
+
+@csrf_exempt
+@instrument_report('report_gpu')
+def report_gpu(request):
+	if request.method != 'POST':
+		return HttpResponseNotAllowed(['POST'])
+
+	token, gpus, error = _parse_gpu_payload(request.body)
+	if error is not None:
+		return error
+
+	server = resolve_report_token(token)
+	if server is None:
+		return JsonResponse({'ok': False, 'error': 'invalid_token'}, status=403)
+
+	updated = ingest_gpu_report(server, gpus)
+	return _gpu_report_response(server, updated)
+
+
+@instrument_report('report_gpu')
+async def report_gpu_async(request):
+	"""report_gpu 的异步版本：鉴权命中缓存时不占线程，写库交给有界线程池。"""
+	if request.method != 'POST':
+		return HttpResponseNotAllowed(['POST'])
+
+	token, gpus, error = _parse_gpu_payload(request.body)
+	if error is not None:
+		return error
+
+	try:
+		hit, server = peek_report_token(token)
+		if not hit:
+			server = await ingest_executor.run(resolve_report_token, token)
+		if server is None:
+			return JsonResponse({'ok': False, 'error': 'invalid_token'}, status=403)
+		updated = await ingest_executor.run(ingest_gpu_report, server, gpus)
+	except IngestOverloaded:
+		return overloaded_response()
+	return _gpu_report_response(server, updated)
+
+
+# Django 4.2 的 csrf_exempt 会把协程函数包成同步函数，这里直接打标记
+report_gpu_async.csrf_exempt = True
+
+
+_RESOLUTION_PARAM = {'raw': RAW, '1m': MINUTE, '1h': HOUR}
+
+
+@staff_member_required
+def gpu_history(request):
+	"""GPU 历史序列查询：?server=<id>&index=<n> | ?uuid=<uuid> | ?user=<name>，start/end 为秒级时间戳。"""
+	params = request.GET
+	try:
+		end = int(params.get('end') or time.time())
+		start = int(params.get('start') or end - 86400)
+		server_id = int(params['server']) if params.get('server') else None
+		gpu_index = int(params['index']) if params.get('index') else None
+	except ValueError:
+		return JsonResponse({'ok': False, 'error': 'invalid_params'}, status=400)
+	if start >= end:
+		return JsonResponse({'ok': False, 'error': 'invalid_range'}, status=400)
+
+	resolution = params.get('resolution')
+	if resolution:
+		if resolution not in _RESOLUTION_PARAM:
+			return JsonResponse({'ok': False, 'error': 'invalid_resolution'}, status=400)
+		resolution = _RESOLUTION_PARAM[resolution]
+	else:
+		resolution = None
+
+	uuid = params.get('uuid')
+	if uuid:
+		gpu = GPUInfo.objects.filter(uuid=uuid).values('server_id', 'index').first()
+		if gpu is None:
+			return JsonResponse({'ok': False, 'error': 'gpu_not_found'}, status=404)
+		server_id, gpu_index = gpu['server_id'], gpu['index']
+
+	username = (params.get('user') or '').strip() or None
+	if username is None and server_id is None:
+		return JsonResponse({'ok': False, 'error': 'missing_target'}, status=400)
+
+	resolution, points = query_series(start, end, server_id, gpu_index, username, resolution)
+	return JsonResponse({'ok': True, 'resolution': resolution, 'start': start, 'end': end, 'points': points})
+
+
+def _cluster_api_allowed(request):
+	if os.getenv('GPUTASKER_CLUSTER_API_PUBLIC', '0') == '1':
+		return True
+	user = request.user
+	return user.is_active and user.is_staff
+
+
+def cluster_overview(request):
+	"""集群概况（只读）：服务器/GPU 状态、各优先级排队数、各用户运行中的任务。支持 If-None-Match。"""
+	if request.method not in ('GET', 'HEAD'):
+		return HttpResponseNotAllowed(['GET', 'HEAD'])
+	if not _cluster_api_allowed(request):
+		return JsonResponse({'ok': False, 'error': 'forbidden'}, status=403)
+
+	snapshot = snapshot_cache.get()
+	# 快照未变化时直接 304，不重新序列化也不查库
+	response = get_conditional_response(request, etag=snapshot.etag)
+	if response is None:
+		response = HttpResponse(snapshot.body, content_type='application/json')
+	response['ETag'] = snapshot.etag
+	response['Cache-Control'] = 'private, max-age={}'.format(snapshot_cache.max_age(snapshot))
+	return response
@@ -0,0 +1,14 @@
+"""
+ASGI config for the gpu_tasker report ingestion service.
+
+只承载 agent 上报接口，与 admin 所在的 uwsgi/WSGI worker 隔离，
+避免上报洪峰或 SQLite 锁等待拖慢交互页面。
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gpu_tasker.ingest_settings')
+
+application = get_asgi_application()
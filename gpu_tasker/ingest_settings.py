@@ -0,0 +1,17 @@
+"""
+独立的节点上报（ingest）服务配置。
+
+与 Web 共用同一套 models/数据库配置，但去掉 admin 相关中间件和路由，
+只暴露 agent 上报接口，由 ASGI 服务器单独运行：
+
+    uvicorn gpu_tasker.ingest_asgi:application --host 0.0.0.0 --port 8890
+"""
+
+from .settings import *  # noqa: F401,F403
+
+ROOT_URLCONF = 'gpu_tasker.ingest_urls'
+
+# agent 只带 token 调 JSON 接口，不需要 session/csrf/auth/messages
+MIDDLEWARE = [
+    'django.middleware.common.CommonMiddleware',
+]
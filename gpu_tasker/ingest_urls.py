@@ -0,0 +1,11 @@
+"""节点上报（ingest）服务的 URL 配置：与主站路径一致，换成异步视图。"""
+from django.urls import path
+
+from gpu_info.views import report_gpu_async
+from task.views import report_tasks_async
+
+
+urlpatterns = [
+    path('api/v1/report_gpu/', report_gpu_async),
+    path('api/v1/report_tasks/', report_tasks_async),
+]
@@ -156,6 +156,8 @@ SERVER_LOG_DIR = os.path.join(BASE_DIR, 'server_log')
 if not os.path.isdir(SERVER_LOG_DIR):
     os.makedirs(SERVER_LOG_DIR)
 
+TEST_RUNNER = 'base.testing.TestRunner'
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': True,
@@ -17,8 +17,9 @@ from django.contrib import admin
 from django.urls import path
 from django.shortcuts import redirect
 
-from gpu_info.views import report_gpu
-from task.views import report_tasks
+from base.views import metrics
+from gpu_info.views import report_gpu, gpu_history, cluster_overview
+from task.views import report_tasks, tasks_api, cancel_tasks, dispatch_stats, gpu_usage
 
 
 admin.site.site_header = 'GPU任务管理平台'
@@ -33,5 +34,12 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/v1/report_gpu/', report_gpu),
     path('api/v1/report_tasks/', report_tasks),
+    path('api/v1/gpu_history/', gpu_history),
+    path('api/v1/cluster/', cluster_overview),
+    path('api/v1/tasks/', tasks_api),
+    path('api/v1/tasks/cancel/', cancel_tasks),
+    path('api/v1/dispatch_stats/', dispatch_stats),
+    path('api/v1/gpu_usage/', gpu_usage),
+    path('metrics', metrics),
     path('', index_view)
 ]
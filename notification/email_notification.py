@@ -1,8 +1,8 @@
-import traceback
+import logging
 
-from django.core.mail import send_mail
+from .outbox import enqueue, notification_enabled
 
-from gpu_tasker.settings import EMAIL_NOTIFICATION
+task_logger = logging.getLogger('django.task')
 
 
 TASK_START_NOTIFICATION_TITLE = '任务开始运行'
@@ -56,24 +56,17 @@ TASK_FAIL_NOTIFICATION_TEMPLATE = \
 '''
 
 
-def send_email(address, title, content):
-    if EMAIL_NOTIFICATION:
-        try:
-            from gpu_tasker.settings import DEFAULT_FROM_EMAIL
-            send_mail(title, content, DEFAULT_FROM_EMAIL, [address], fail_silently=False)
-        except Exception:
-            es = traceback.format_exc()
-            print('Send email fail')
-            print(es)
-
-
 def check_email_config(func):
+    # 通知只是附带的：写发件箱失败（数据库忙等）只记日志，不能影响调用方记录运行状态、释放 GPU
     def wrapper(*args, **kw):
-        if EMAIL_NOTIFICATION:
+        if notification_enabled():
             running_log = args[0]
-            address = running_log.task.user.email
-            if address is not None and address != '':
-                return func(*args, **kw)
+            try:
+                address = running_log.task.user.email
+                if address is not None and address != '':
+                    return func(*args, **kw)
+            except Exception:
+                task_logger.exception('enqueue %s for running log %s failed', func.__name__, running_log.id)
     return wrapper
 
 
@@ -90,7 +83,7 @@ def send_task_start_email(running_log):
         running_log.gpus,
         running_log.start_at.strftime("%Y-%m-%d %H:%M:%S")
     )
-    send_email(address, title, content)
+    enqueue(running_log.task, address, 'start', title, content)
 
 
 @check_email_config
@@ -106,7 +99,7 @@ def send_task_finish_email(running_log):
         running_log.gpus,
         running_log.update_at.strftime("%Y-%m-%d %H:%M:%S")
     )
-    send_email(address, title, content)
+    enqueue(running_log.task, address, 'finish', title, content)
 
 
 @check_email_config
@@ -122,4 +115,4 @@ def send_task_fail_email(running_log):
         running_log.gpus,
         running_log.update_at.strftime("%Y-%m-%d %H:%M:%S")
     )
-    send_email(address, title, content)
+    enqueue(running_log.task, address, 'fail', title, content)
@@ -0,0 +1,238 @@
+"""通知发件箱：任务开始/完成/失败的邮件先写入 Notification 表，由调度器后台线程发送。
+
+以前 run_task 线程里同步 send_mail，SMTP 慢时会拖慢运行状态的记录，而且每封邮件都新建一次 SMTP 连接。现在：
+
+- run_task 只写发件箱（enqueue），不碰网络；
+- 调度器每隔 GPUTASKER_NOTIFY_SECONDS（默认 10）秒在后台线程发送到期的邮件，一批邮件复用同一个 SMTP 连接；
+- 发送失败按指数退避重试（首次间隔 GPUTASKER_NOTIFY_RETRY_SECONDS，默认 30 秒，最长 1 小时），
+  累计 GPUTASKER_NOTIFY_MAX_ATTEMPTS（默认 8）次失败后标记为“发送失败”，可在后台“通知发件箱”里重新发送；
+- 用户设置里选择“任务数组汇总”或“分组汇总”时，不发开始通知，完成/失败通知先留在发件箱，
+  数组（或分组）的任务全部结束后合并成一封汇总邮件。
+
+发送成功后才删除发件箱中的行，进程在发送过程中退出时可能重复发送，不会丢失。
+手动发送：`python manage.py send_notifications`。
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from base.models import UserConfig
+from base.utils import PeriodicJob, env_float
+from task.models import GPUTask, Notification, TaskArray, TaskGroup
+
+BATCH_SIZE = 100
+MAX_RETRY_SECONDS = 3600
+# 汇总邮件里最多列出的任务数
+DIGEST_MAX_LISTED = 100
+# 还没结束的任务状态：准备就绪、运行中
+UNFINISHED_STATUS = (0, 1)
+
+PENDING, HELD, FAILED = 0, 1, -1
+
+task_logger = logging.getLogger('django.task')
+
+
+def notify_seconds():
+    return env_float('GPUTASKER_NOTIFY_SECONDS', 10, 1.0)
+
+
+def retry_seconds(attempts):
+    """第 attempts 次失败后的重试间隔。"""
+    base = env_float('GPUTASKER_NOTIFY_RETRY_SECONDS', 30, 1.0)
+    return min(MAX_RETRY_SECONDS, base * 2 ** (attempts - 1))
+
+
+def max_attempts():
+    return int(env_float('GPUTASKER_NOTIFY_MAX_ATTEMPTS', 8, 1))
+
+
+def notification_enabled():
+    return getattr(settings, 'EMAIL_NOTIFICATION', False)
+
+
+def digest_key(task, mode):
+    if mode == 2 and task.group_id:
+        return 'group:{}'.format(task.group_id)
+    if mode in (1, 2) and task.array_id:
+        return 'array:{}'.format(task.array_id)
+    return ''
+
+
+def enqueue(task, address, event, subject, body):
+    """写入发件箱；选择汇总时开始通知直接丢弃，完成/失败通知留待汇总。返回 Notification 或 None。"""
+    mode = UserConfig.objects.filter(user_id=task.user_id).values_list('email_digest', flat=True).first() or 0
+    key = digest_key(task, mode)
+    if key and event == 'start':
+        return None
+    return Notification.objects.create(
+        user_id=task.user_id,
+        address=address,
+        event=event,
+        task_name=task.name[:100],
+        subject=subject,
+        body=body,
+        digest_key=key,
+        status=HELD if key else PENDING,
+    )
+
+
+def _digest_scope(key, user_id):
+    """返回 (标题, 该范围内 user_id 的任务, 该范围内 user_id 的任务数组)；对象已删除时标题为 None。
+
+    分组是多人共用的：只看汇总所属用户自己的任务，别人在同一分组里排队/运行的任务不影响他的汇总。
+    """
+    kind, _, pk = key.partition(':')
+    if kind == 'array':
+        name = TaskArray.objects.filter(pk=pk).values_list('name', flat=True).first()
+        title = '任务数组[{}]'.format(name) if name is not None else None
+        return title, GPUTask.objects.filter(array_id=pk, user_id=user_id), \
+            TaskArray.objects.filter(pk=pk, user_id=user_id)
+    group = TaskGroup.objects.select_related('project').filter(pk=pk).first()
+    title = '分组[{}]'.format(group) if group is not None else None
+    return title, GPUTask.objects.filter(group_id=pk, user_id=user_id), \
+        TaskArray.objects.filter(group_id=pk, user_id=user_id)
+
+
+def _digest_finished(tasks, arrays):
+    if tasks.filter(status__in=UNFINISHED_STATUS).exists():
+        return False
+    # 还有未展开的子任务（暂停的数组不算）
+    return not arrays.filter(active=True, materialized__lt=F('size')).exists()
+
+
+def _render_digest(title, held):
+    failed = [n for n in held if n.event == 'fail']
+    finished = [n for n in held if n.event == 'finish']
+    lines = [
+        '{}的任务已全部结束'.format(title),
+        '运行完成：{}'.format(len(finished)),
+        '运行失败：{}'.format(len(failed)),
+    ]
+    for label, items in (('运行失败的任务', failed), ('运行完成的任务', finished)):
+        if not items:
+            continue
+        lines += ['', '{}：'.format(label)]
+        for n in items[:DIGEST_MAX_LISTED]:
+            lines.append('  {}  {}'.format(n.create_at.strftime('%Y-%m-%d %H:%M:%S'), n.task_name))
+        if len(items) > DIGEST_MAX_LISTED:
+            lines.append('  ……共 {} 个'.format(len(items)))
+    lines += ['', '请登录GPUTasker查看运行结果']
+    subject = '任务汇总：{}（完成 {}，失败 {}）'.format(title, len(finished), len(failed))
+    return subject[:255], '\n'.join(lines) + '\n'
+
+
+def collect_digests():
+    """把已全部结束的任务数组/分组的待汇总通知合并成一封汇总邮件，返回生成的汇总数。"""
+    created = 0
+    keys = (
+        Notification.objects.filter(status=HELD)
+        .values_list('user_id', 'address', 'digest_key').distinct().order_by()
+    )
+    finished = {}
+    for user_id, address, key in list(keys):
+        if (user_id, key) not in finished:
+            title, tasks, arrays = _digest_scope(key, user_id)
+            finished[user_id, key] = (title, title is None or _digest_finished(tasks, arrays))
+        title, done = finished[user_id, key]
+        if not done:
+            continue
+        with transaction.atomic():
+            held = list(
+                Notification.objects.select_for_update()
+                .filter(status=HELD, user_id=user_id, address=address, digest_key=key).order_by('id')
+            )
+            if not held:
+                continue
+            subject, body = _render_digest(title or key, held)
+            # 多个调度器同时汇总时只有删除成功的一方生成汇总
+            if Notification.objects.filter(id__in=[n.id for n in held], status=HELD).delete()[0] != len(held):
+                transaction.set_rollback(True)
+                continue
+            Notification.objects.create(
+                user_id=user_id, address=address, event='digest', subject=subject, body=body, status=PENDING,
+            )
+        created += 1
+    return created
+
+
+def _defer(notifications, exc):
+    now = timezone.now()
+    limit = max_attempts()
+    for n in notifications:
+        attempts = n.attempts + 1
+        Notification.objects.filter(pk=n.pk).update(
+            attempts=attempts,
+            status=FAILED if attempts >= limit else PENDING,
+            next_attempt_at=now + timedelta(seconds=retry_seconds(attempts)),
+            last_error=str(exc)[:2000],
+        )
+        if attempts >= limit:
+            task_logger.error('notification %d to %s dropped after %d attempts: %s', n.pk, n.address, attempts, exc)
+
+
+def deliver_pending(batch_size=BATCH_SIZE, max_batches=None):
+    """发送到期的邮件，返回发送成功的封数。一批邮件复用同一个 SMTP 连接，出错后重连。"""
+    sent = 0
+    batches = 0
+    connection = None
+    try:
+        while max_batches is None or batches < max_batches:
+            batch = list(
+                Notification.objects.filter(status=PENDING, next_attempt_at__lte=timezone.now())
+                .order_by('id')[:batch_size]
+            )
+            if not batch:
+                break
+            batches += 1
+            delivered = []
+            for i, n in enumerate(batch):
+                if connection is None:
+                    connection = get_connection(fail_silently=False)
+                    try:
+                        connection.open()
+                    except Exception as exc:
+                        # 连不上服务器：本批剩下的一起推迟，不逐封重试
+                        connection = None
+                        _defer(batch[i:], exc)
+                        Notification.objects.filter(id__in=delivered).delete()
+                        return sent + len(delivered)
+                try:
+                    EmailMessage(n.subject, n.body, None, [n.address], connection=connection).send()
+                except Exception as exc:
+                    _defer([n], exc)
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+                    connection = None
+                else:
+                    delivered.append(n.id)
+            Notification.objects.filter(id__in=delivered).delete()
+            sent += len(delivered)
+    finally:
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+    return sent
+
+
+def process_outbox():
+    """汇总 + 发送，返回 (生成的汇总数, 发送成功的封数)。"""
+    return collect_digests(), deliver_pending()
+
+
+def _deliver():
+    digests, sent = process_outbox()
+    if digests or sent:
+        task_logger.info('notification outbox: %d digests, %d emails sent', digests, sent)
+
+
+DELIVER_JOB = PeriodicJob('notification-outbox', _deliver, notify_seconds, enabled=notification_enabled)
+maybe_deliver_in_background = DELIVER_JOB.maybe_start
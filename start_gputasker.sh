@@ -27,7 +27,8 @@ sleep 5
 
 # 启动主调度器
 echo "启动GPU任务调度器..."
-nohup bash -c "$ACTIVATE_CMD && python main.py" > "$LOG_DIR/scheduler.log" 2>&1 &
+# exec：PID 文件里记的就是调度器本身，stop 时 SIGTERM 能直接送达并优雅退出
+nohup bash -c "$ACTIVATE_CMD && exec python main.py" > "$LOG_DIR/scheduler.log" 2>&1 &
 SCHEDULER_PID=$!
 echo "Scheduler PID: $SCHEDULER_PID"
 
@@ -38,6 +38,12 @@ if [ -f "$LOG_DIR/scheduler.pid" ]; then
     if kill -0 "$SCHEDULER_PID" 2>/dev/null; then
         echo "停止调度器服务 (PID: $SCHEDULER_PID)..."
         kill "$SCHEDULER_PID"
+        # 调度器会等正在启动的任务拿到远端进程再退出（GPUTASKER_SCHEDULER_DRAIN_SECONDS，默认 30 秒），
+        # 运行中的任务留在节点上，下次启动时重新接管
+        for _ in $(seq 1 40); do
+            kill -0 "$SCHEDULER_PID" 2>/dev/null || break
+            sleep 1
+        done
         rm -f "$LOG_DIR/scheduler.pid"
     else
         echo "调度器服务未运行"
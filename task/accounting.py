@@ -0,0 +1,246 @@
+"""GPU 用量记账：按天、用户、项目、分组、服务器汇总 GPU·小时。
+
+以前统计“本月每个用户用了多少 GPU·小时”要扫描全部运行记录并逐条解析 gpus 字符串。现在：
+
+- 运行记录结束、失败（含手动结束）或失联时，把“上次记账截止 → 本次截止”这段时间乘以 GPU 数，
+  按自然日切开累加到 GPUUsage；记账截止时间保存在运行记录的 accounted_until 上，
+  用比较后更新保证同一段时间只记一次（失联后又恢复的任务，结束时补记剩下的部分）；
+- 报表与 CSV 导出只读 GPUUsage（后台“GPU用量”、/api/v1/gpu_usage/）；
+- `python manage.py rebuild_gpu_usage` 从历史运行记录重建汇总：按块读取、累加并提交，内存占用与单个事务的长度都有上限。
+
+运行中的任务在结束（或失联）时才计入。
+"""
+import csv
+import logging
+from datetime import datetime, time, timedelta
+
+from django.db import transaction
+from django.db.models import Case, F, Sum, When
+from django.db.models.functions import Coalesce
+
+from .models import GPUTaskRunningLog, GPUUsage
+
+# 报表可用的分组维度 -> 显示用的字段
+DIMENSIONS = {
+    'day': 'day',
+    'user': 'user__username',
+    'project': 'project__name',
+    'group': 'group__name',
+    'server': 'server__ip',
+}
+REBUILD_CHUNK_SIZE = 5000
+# 重建时内存里最多攒这么多个汇总键，超过就写库
+REBUILD_FLUSH_KEYS = 10000
+
+task_logger = logging.getLogger('django.task')
+
+_RUN_FIELDS = (
+    'status', 'gpus', 'start_at', 'marker_at', 'finished_at', 'last_heartbeat_at', 'update_at', 'accounted_until',
+    'server_id', 'task__user_id', 'task__group_id', 'task__group__project_id',
+)
+
+
+def gpu_count(gpus):
+    return len([g for g in (gpus or '').split(',') if g.strip()])
+
+
+def run_end(row):
+    """运行记录的记账截止时间：结束时间；失联的取最后心跳；升级前的记录取最后更新时间。"""
+    if row['finished_at'] is not None:
+        return row['finished_at']
+    if row['status'] == -2 and row['last_heartbeat_at'] is not None:
+        return row['last_heartbeat_at']
+    return row['update_at']
+
+
+# 与 run_end 一致的 SQL 表达式，重建时整体回填 accounted_until
+RUN_END = Coalesce(F('finished_at'), Case(When(status=-2, then=F('last_heartbeat_at'))), F('update_at'))
+
+
+def split_days(begin, end):
+    """把 [begin, end) 按自然日切开，返回 [(日期, 秒数)]。"""
+    segments = []
+    while begin < end:
+        next_day = datetime.combine(begin.date() + timedelta(days=1), time.min)
+        stop = min(end, next_day)
+        segments.append((begin.date(), (stop - begin).total_seconds()))
+        begin = stop
+    return segments
+
+
+def usage_key(day, user_id, project_id, group_id, server_id):
+    return '{}/{}/{}/{}/{}'.format(day.isoformat(), user_id, project_id or 0, group_id or 0, server_id or 0)
+
+
+def _accumulate(totals, row, begin, end, first):
+    """把一条运行记录 [begin, end) 的用量累加到 totals（汇总键 -> [维度, 次数, GPU·秒, 时长]）。"""
+    gpus = gpu_count(row['gpus'])
+    dims = (row['task__user_id'], row['task__group__project_id'], row['task__group_id'], row['server_id'])
+    segments = split_days(begin, end) or [(begin.date(), 0.0)]
+    for i, (day, seconds) in enumerate(segments):
+        key = usage_key(day, *dims)
+        entry = totals.get(key)
+        if entry is None:
+            entry = totals[key] = [(day,) + dims, 0, 0.0, 0.0]
+        # 运行次数记在开始的那一天
+        entry[1] += 1 if first and i == 0 else 0
+        entry[2] += seconds * gpus
+        entry[3] += seconds
+
+
+def _apply(totals):
+    """把 totals 加到 GPUUsage：先补齐不存在的汇总行（已存在的忽略），再逐行累加。"""
+    if not totals:
+        return
+    GPUUsage.objects.bulk_create(
+        [
+            GPUUsage(key=key, day=day, user_id=user_id, project_id=project_id, group_id=group_id, server_id=server_id)
+            for key, ((day, user_id, project_id, group_id, server_id), _, _, _) in totals.items()
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+    for key, (_, runs, gpu_seconds, wall_seconds) in totals.items():
+        GPUUsage.objects.filter(key=key).update(
+            runs=F('runs') + runs,
+            gpu_seconds=F('gpu_seconds') + gpu_seconds,
+            wall_seconds=F('wall_seconds') + wall_seconds,
+        )
+
+
+def account_run(running_log_id, until=None):
+    """把运行记录从上次记账截止到 until（默认 run_end）的用量记入汇总，返回记入的 GPU·秒。可重复调用。"""
+    with transaction.atomic():
+        row = GPUTaskRunningLog.objects.filter(pk=running_log_id).values(*_RUN_FIELDS).first()
+        if row is None or row['task__user_id'] is None:
+            return 0.0
+        end = until or run_end(row)
+        previous = row['accounted_until']
+        begin = previous or row['marker_at'] or row['start_at']
+        if end is None or (previous is not None and end <= previous):
+            return 0.0
+        begin = min(begin, end)
+        # 比较后更新：并发记账时只有一方成功
+        claimed = GPUTaskRunningLog.objects.filter(pk=running_log_id)
+        if previous is None:
+            claimed = claimed.filter(accounted_until__isnull=True)
+        else:
+            claimed = claimed.filter(accounted_until=previous)
+        if not claimed.update(accounted_until=end):
+            return 0.0
+        totals = {}
+        _accumulate(totals, row, begin, end, first=previous is None)
+        _apply(totals)
+    return sum(entry[2] for entry in totals.values())
+
+
+def safe_account_run(running_log_id, until=None):
+    """记账失败不影响任务状态的记录。"""
+    try:
+        return account_run(running_log_id, until)
+    except Exception:
+        task_logger.exception('gpu usage accounting failed for running log %s', running_log_id)
+        return 0.0
+
+
+class _RebuildConflict(Exception):
+    """重建的一批运行记录里有的被并发记账抢先了，回滚这一批后重试。"""
+
+
+def _rebuild_batch(after_id, chunk_size, flush_keys):
+    """记账 id 大于 after_id 的下一批（最多 chunk_size 条）尚未记账的已结束运行记录，单独一个事务。
+
+    返回 (本批最后一条的 id, 记账的运行记录数)；没有剩余时 id 为 None。
+    """
+    with transaction.atomic():
+        rows = list(
+            GPUTaskRunningLog.objects.exclude(status=1)
+            .filter(task__isnull=False, pk__gt=after_id, accounted_until__isnull=True)
+            .select_for_update()
+            .order_by('id')
+            .values('id', *_RUN_FIELDS)[:chunk_size]
+        )
+        if not rows:
+            return None, 0
+        ids = [row['id'] for row in rows]
+        runs = 0
+        totals = {}
+        for row in rows:
+            end = run_end(row)
+            if end is None:
+                continue
+            begin = min(row['marker_at'] or row['start_at'], end)
+            _accumulate(totals, row, begin, end, first=True)
+            runs += 1
+            if len(totals) >= flush_keys:
+                _apply(totals)
+                totals = {}
+        _apply(totals)
+        # 比较后更新：读出之后被并发记账的记录不能再算一次
+        claimed = GPUTaskRunningLog.objects.filter(pk__in=ids, accounted_until__isnull=True).update(
+            accounted_until=RUN_END)
+        if claimed != len(ids):
+            raise _RebuildConflict()
+    return ids[-1], runs
+
+
+def rebuild(chunk_size=REBUILD_CHUNK_SIZE, flush_keys=REBUILD_FLUSH_KEYS, retries=3):
+    """从运行记录重建 GPUUsage，返回 (记账的运行记录数, 汇总行数)。运行中的记录不计入，结束时再记。
+
+    清空汇总与记账截止时间在一个短事务里完成；之后按 id 每 chunk_size 条运行记录一个事务累加并回填截止时间，
+    不会在整个重建期间占着写锁（SQLite 上节点上报与调度照常写库）。重建期间结束的运行记录由 account_run
+    照常记账，重建跳过已有截止时间的记录，不会重复。重建完成前报表只包含已处理的部分。
+    """
+    with transaction.atomic():
+        GPUUsage.objects.all().delete()
+        GPUTaskRunningLog.objects.filter(accounted_until__isnull=False).update(accounted_until=None)
+
+    runs = 0
+    after_id = 0
+    conflicts = 0
+    while True:
+        try:
+            last_id, batch_runs = _rebuild_batch(after_id, chunk_size, flush_keys)
+        except _RebuildConflict:
+            conflicts += 1
+            if conflicts > retries:
+                raise
+            continue
+        if last_id is None:
+            break
+        after_id = last_id
+        runs += batch_runs
+        conflicts = 0
+    return runs, GPUUsage.objects.count()
+
+
+def usage_report(start_day, end_day, group_by=('user',), user_id=None):
+    """[start_day, end_day] 内的用量，按 group_by（DIMENSIONS 的子集）汇总，只读 GPUUsage。"""
+    qs = GPUUsage.objects.filter(day__gte=start_day, day__lte=end_day)
+    if user_id is not None:
+        qs = qs.filter(user_id=user_id)
+    columns = [DIMENSIONS[d] for d in group_by]
+    rows = (
+        qs.values(*columns)
+        .annotate(runs_total=Sum('runs'), gpu_seconds_total=Sum('gpu_seconds'), wall_seconds_total=Sum('wall_seconds'))
+        .order_by(*columns)
+    )
+    result = []
+    for row in rows:
+        item = {d: row[DIMENSIONS[d]] for d in group_by}
+        if 'day' in item:
+            item['day'] = item['day'].isoformat()
+        item['runs'] = row['runs_total'] or 0
+        item['gpu_hours'] = round((row['gpu_seconds_total'] or 0) / 3600.0, 3)
+        item['wall_hours'] = round((row['wall_seconds_total'] or 0) / 3600.0, 3)
+        result.append(item)
+    return result
+
+
+def write_csv(out, rows, group_by):
+    """把 usage_report 的结果写成 CSV。"""
+    writer = csv.writer(out)
+    columns = list(group_by) + ['runs', 'gpu_hours', 'wall_hours']
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(['' if row[c] is None else row[c] for c in columns])
@@ -1,14 +1,79 @@
+import io
+import json
+import sqlite3
+
 from django import forms
 from django.contrib import admin, messages
 from django.contrib.admin import helpers
-from django.http import HttpResponseRedirect
+from django.contrib.admin.models import DELETION, LogEntry
+from django.contrib.admin.options import get_content_type_for_model
+from django.db import transaction
+from django.db.models import Count, OuterRef, Q, QuerySet, Subquery
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, Http404, StreamingHttpResponse
 from django.template.response import TemplateResponse
 from django.urls import path
 from django.urls import reverse
 from django.utils import timezone
-from django.utils.html import format_html
-from .models import GPUTask, GPUTaskRunningLog, Project, TaskGroup
-from .utils import kill_running_log
+from django.utils.html import format_html, format_html_join
+from gpu_info.models import GPUServer
+from .models import GPUTask, GPUTaskRunningLog, GPUUsage, Notification, Project, SchedulerInstance, TaskArray, \
+    TaskGroup
+from .utils import cancel_tasks, kill_running_log
+from .wakeup import notify_scheduler
+from .log_archive import log_size
+from .log_janitor import delete_running_logs, delete_tasks, journal_logs
+from .log_reader import LogReader, DEFAULT_TAIL_LINES
+from .log_search import LogSearchIndex, snippets as log_search_snippets
+from .metrics import read_series
+from .lifecycle import timeline
+from .accounting import write_csv
+from .sharding import assign_servers, live_members
+from .log_stream import LogEventStream, acquire_stream_slot, acquire_watcher_slot
+
+
+class SetBasedDeleteMixin:
+    """删除走查询集整体删除（子类实现 delete_objects(queryset)），不再逐个对象 delete()。
+
+    - Django 4.2 的批量删除对每个对象写一条操作日志（一次 INSERT），这里先攒起来，删除前一次 bulk_create；
+    - 删除确认页默认逐个列出所有级联删除的对象（每个一个链接），几千个任务及其运行记录时确认页本身就会超时；
+      对象较多时只列出各类对象的数量（子类实现 _deletion_counts(queryset)，返回 [(模型, 数量), ...]）。
+    """
+    delete_confirmation_list_limit = 100
+
+    def get_deleted_objects(self, objs, request):
+        queryset = objs if isinstance(objs, QuerySet) else self.model.objects.filter(pk__in=[obj.pk for obj in objs])
+        counts = self._deletion_counts(queryset)
+        if sum(count for _, count in counts) <= self.delete_confirmation_list_limit:
+            return super().get_deleted_objects(objs, request)
+        perms_needed = {
+            model._meta.verbose_name for model, count in counts
+            if count and not request.user.has_perm('{}.delete_{}'.format(model._meta.app_label, model._meta.model_name))
+        }
+        summary = ['{} 个{}'.format(count, model._meta.verbose_name) for model, count in counts if count]
+        model_count = {model._meta.verbose_name_plural: count for model, count in counts if count}
+        return summary, model_count, perms_needed, []
+
+    def log_deletion(self, request, obj, object_repr):
+        entries = request.__dict__.setdefault('_pending_deletion_logs', [])
+        entries.append(LogEntry(
+            user_id=request.user.pk,
+            content_type_id=get_content_type_for_model(obj).pk,
+            object_id=str(obj.pk),
+            object_repr=object_repr[:200],
+            action_flag=DELETION,
+        ))
+
+    def _flush_deletion_logs(self, request):
+        entries = request.__dict__.pop('_pending_deletion_logs', [])
+        LogEntry.objects.bulk_create(entries, batch_size=1000)
+
+    def delete_queryset(self, request, queryset):
+        self._flush_deletion_logs(request)
+        self.delete_objects(queryset)
+
+    def delete_model(self, request, obj):
+        self._flush_deletion_logs(request)
+        self.delete_objects(self.model.objects.filter(pk=obj.pk))
 
 
 class TaskGroupInline(admin.TabularInline):
@@ -32,6 +97,14 @@ class ProjectAdmin(admin.ModelAdmin):
         return {}
 
 
+class TaskGroupListFilter(admin.RelatedFieldListFilter):
+    """分组筛选：分组名带项目名，一次 join 取回，不为每个分组单独查项目。"""
+
+    def field_choices(self, field, request, model_admin):
+        groups = TaskGroup.objects.select_related('project').order_by('project__name', 'name', 'id')
+        return [(group.pk, str(group)) for group in groups]
+
+
 class GPUTaskInline(admin.TabularInline):
     model = GPUTask
     fields = (
@@ -52,6 +125,16 @@ class GPUTaskInline(admin.TabularInline):
     extra = 0
     show_change_link = True
 
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        field = super().formfield_for_foreignkey(db_field, request, **kwargs)
+        if db_field.name == 'assign_server':
+            # 每行一个服务器下拉框：同一请求内共用一次查询的结果，而不是每行各查一次
+            cache = request.__dict__.setdefault('_gputask_inline_choices', {})
+            if db_field.name not in cache:
+                cache[db_field.name] = list(field.choices)
+            field.choices = cache[db_field.name]
+        return field
+
 
 @admin.register(TaskGroup)
 class TaskGroupAdmin(admin.ModelAdmin):
@@ -74,23 +157,90 @@ class TaskGroupAdmin(admin.ModelAdmin):
 
     def save_formset(self, request, form, formset, change):
         instances = formset.save(commit=False)
+        # 新增的任务一次 bulk_create，已有的逐条保存
+        new_tasks = []
         for obj in instances:
             if isinstance(obj, GPUTask):
                 if not obj.user_id:
                     obj.user = request.user
+                if obj.pk is None:
+                    obj._normalize_cmd()
+                    new_tasks.append(obj)
+                    continue
             obj.save()
+        if new_tasks:
+            GPUTask.objects.bulk_create(new_tasks)
+            if any(task.status == 0 for task in new_tasks):
+                notify_scheduler()
+        deleted_tasks = [obj.pk for obj in formset.deleted_objects if isinstance(obj, GPUTask)]
+        if deleted_tasks:
+            delete_tasks(GPUTask.objects.filter(pk__in=deleted_tasks))
         for obj in formset.deleted_objects:
-            obj.delete()
+            if not isinstance(obj, GPUTask):
+                obj.delete()
         formset.save_m2m()
 
 
+# 列表里优先展示的指标，其余按名称排序
+_METRIC_ORDER = ('loss', 'train_loss', 'val_loss', 'eval_loss', 'acc', 'accuracy', 'val_acc', 'lr', 'epoch', 'step')
+
+
+def _metric_items(metrics):
+    items = [(k, v) for k, v in metrics.items() if not k.endswith('_total') and k != 'percent']
+    rank = {name: i for i, name in enumerate(_METRIC_ORDER)}
+    return sorted(items, key=lambda kv: (rank.get(kv[0], len(rank)), kv[0]))
+
+
+def _format_value(value):
+    return str(value) if isinstance(value, int) else '{:.4g}'.format(value)
+
+
+def format_metrics(metrics_json, progress, limit=4):
+    """进度条 + 最新指标摘要。"""
+    try:
+        metrics = json.loads(metrics_json) if metrics_json else {}
+    except ValueError:
+        metrics = {}
+    parts = []
+    if progress is not None:
+        parts.append(format_html(
+            '<progress value="{}" max="1" style="width:80px;"></progress> {}%',
+            '{:.3f}'.format(progress), '{:.0f}'.format(progress * 100),
+        ))
+    items = _metric_items(metrics)[:limit]
+    if items:
+        parts.append(format_html_join(' ', '{}={}', ((k, _format_value(v)) for k, v in items)))
+    return format_html_join(format_html('<br>'), '{}', ((p,) for p in parts)) if parts else '-'
+
+
+def _sparkline(points, width=160, height=28):
+    values = [v for _, v in points if isinstance(v, (int, float))]
+    if len(values) < 2:
+        return ''
+    lo, hi = min(values), max(values)
+    span = (hi - lo) or 1.0
+    step = width / float(len(values) - 1)
+    coords = ' '.join(
+        '{:.1f},{:.1f}'.format(i * step, height - 2 - (v - lo) / span * (height - 4)) for i, v in enumerate(values)
+    )
+    return format_html(
+        '<svg width="{}" height="{}" style="vertical-align:middle;">'
+        '<polyline points="{}" fill="none" stroke="#409eff" stroke-width="1.5"/></svg>',
+        width, height, coords,
+    )
+
+
 class GPUTaskRunningLogInline(admin.TabularInline):
     model = GPUTaskRunningLog
-    fields = ('index', 'server', 'gpus', 'log_file_path', 'remark', 'color_status', 'start_at', 'update_at',)
-    readonly_fields = ('index', 'server', 'gpus', 'log_file_path', 'color_status', 'start_at', 'update_at',)
+    fields = ('index', 'server', 'gpus', 'log_file_path', 'remark', 'color_status', 'metrics_summary', 'start_at', 'update_at',)
+    readonly_fields = ('index', 'server', 'gpus', 'log_file_path', 'color_status', 'metrics_summary', 'start_at', 'update_at',)
 
     show_change_link = True
 
+    def get_queryset(self, request):
+        # 每行标题显示 str(运行记录)，会用到 task.name
+        return super().get_queryset(request).select_related('task', 'server')
+
     verbose_name = '运行记录'
     verbose_name_plural = '运行记录'
 
@@ -124,14 +274,21 @@ class GPUTaskRunningLogInline(admin.TabularInline):
     color_status.short_description = '状态'
     color_status.admin_order_field = 'status'
 
+    def metrics_summary(self, obj):
+        return format_metrics(obj.metrics, obj.progress)
+
+    metrics_summary.short_description = '进度/指标'
+
 
 @admin.register(GPUTask)
-class GPUTaskAdmin(admin.ModelAdmin):
-    list_display = ('id', 'name', 'workspace', 'gpu_requirement', 'exclusive_gpu', 'memory_requirement', 'utilization_requirement', 'assign_server', 'priority', 'color_status', 'create_at', 'update_at',)
-    list_filter = ('group', 'gpu_requirement', 'status', 'assign_server', 'priority')
+class GPUTaskAdmin(SetBasedDeleteMixin, admin.ModelAdmin):
+    list_display = ('id', 'name', 'workspace', 'gpu_requirement', 'exclusive_gpu', 'memory_requirement', 'utilization_requirement', 'assign_server', 'priority', 'color_status', 'latest_metrics', 'create_at', 'update_at',)
+    list_filter = (('group', TaskGroupListFilter), 'gpu_requirement', 'status', 'assign_server', 'priority')
+    # assign_server 可为空，Django 默认的 select_related() 不会跟随，需要显式列出
+    list_select_related = ('assign_server',)
     search_fields = ('name', 'status',)
     list_display_links = ('name',)
-    readonly_fields = ('create_at', 'update_at', 'user',)
+    readonly_fields = ('create_at', 'update_at', 'queued_at', 'user',)
     inlines = (GPUTaskRunningLogInline,)
     actions = ('move_to_group', 'copy_task', 'restart_task',)
 
@@ -148,13 +305,23 @@ class GPUTaskAdmin(admin.ModelAdmin):
             'all': ('css/admin/custom.css', )
         }
 
-    def get_queryset(self, request):
+    def _visible_tasks(self, request):
         qs = super().get_queryset(request)
         if request.user.is_superuser:
-            base = qs
-        else:
-            base = qs.filter(user=request.user)
+            return qs
+        return qs.filter(user=request.user)
 
+    def get_queryset(self, request):
+        # 最近一次运行的进度与指标：用子查询随列表一起取回
+        latest_run = GPUTaskRunningLog.objects.filter(task=OuterRef('pk')).order_by('-id')
+        base = self._visible_tasks(request).annotate(
+            latest_run_metrics=Subquery(latest_run.values('metrics')[:1]),
+            latest_run_progress=Subquery(latest_run.values('progress')[:1]),
+        )
+
+        fixed_array_id = getattr(request, '_fixed_array_id', None)
+        if fixed_array_id:
+            return base.filter(array_id=fixed_array_id)
         fixed_group_id = getattr(request, '_fixed_taskgroup_id', None) or request.GET.get('taskgroup')
         if fixed_group_id:
             return base.filter(group_id=fixed_group_id)
@@ -176,9 +343,23 @@ class GPUTaskAdmin(admin.ModelAdmin):
                 self.admin_site.admin_view(self.group_view),
                 name='task_gputask_group_view',
             ),
+            path(
+                'array/<int:array_id>/',
+                self.admin_site.admin_view(self.array_view),
+                name='task_gputask_array_view',
+            ),
         ]
         return extra + urls
 
+    def _task_counts(self, request, prefix):
+        """prefix 指向任务关系（如 'tasks'、'groups__tasks'）；非超级用户只统计自己的任务。"""
+        visible = Q() if request.user.is_superuser else Q(**{prefix + '__user': request.user})
+        return {
+            'task_count': Count(prefix, filter=visible, distinct=True),
+            'running_count': Count(prefix, filter=visible & Q(**{prefix + '__status': 1}), distinct=True),
+            'ready_count': Count(prefix, filter=visible & Q(**{prefix + '__status': 0}), distinct=True),
+        }
+
     def project_view(self, request, project_id: int):
         """Project -> Group 列表页（不用 query 传参，兼容 SimpleUI hash 路由）。"""
         try:
@@ -188,7 +369,11 @@ class GPUTaskAdmin(admin.ModelAdmin):
 
         groups = TaskGroup.objects.none()
         if project is not None:
-            groups = TaskGroup.objects.filter(project=project).order_by('archived', 'name', 'id')
+            groups = (
+                TaskGroup.objects.filter(project=project)
+                .annotate(**self._task_counts(request, 'tasks'))
+                .order_by('archived', 'name', 'id')
+            )
 
         context = {
             **self.admin_site.each_context(request),
@@ -210,6 +395,11 @@ class GPUTaskAdmin(admin.ModelAdmin):
             pass
         return super().changelist_view(request, extra_context=extra_context)
 
+    def array_view(self, request, array_id: int):
+        """任务数组的子任务列表。"""
+        request._fixed_array_id = str(array_id)
+        return super().changelist_view(request)
+
     def changelist_view(self, request, extra_context=None):
         project_id = request.GET.get('project')
         taskgroup_id = request.GET.get('taskgroup')
@@ -227,25 +417,17 @@ class GPUTaskAdmin(admin.ModelAdmin):
 
         if project_id:
             try:
-                project = Project.objects.get(id=project_id)
-            except Project.DoesNotExist:
-                project = None
-
-            groups = TaskGroup.objects.none()
-            if project is not None:
-                groups = TaskGroup.objects.filter(project=project).order_by('archived', 'name', 'id')
-
-            context = {
-                **self.admin_site.each_context(request),
-                'title': 'Task Groups',
-                'project': project,
-                'groups': groups,
-            }
-            return TemplateResponse(request, 'admin/task/gputask/project.html', context)
-
-        projects = Project.objects.all().order_by('archived', 'name', 'id')
+                return self.project_view(request, int(project_id))
+            except ValueError:
+                raise Http404
+
+        # 项目卡片上的分组数/任务数用聚合一次算出；最近任务不需要列表上的指标子查询
+        projects = (
+            Project.objects.annotate(group_count=Count('groups', distinct=True), **self._task_counts(request, 'groups__tasks'))
+            .order_by('archived', 'name', 'id')
+        )
         recent_tasks = (
-            self.get_queryset(request)
+            self._visible_tasks(request)
             .select_related('group__project')
             .order_by('-update_at', '-id')[:20]
         )
@@ -285,10 +467,21 @@ class GPUTaskAdmin(admin.ModelAdmin):
     move_to_group.icon = 'el-icon-folder'
     move_to_group.type = 'primary'
 
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == 'group':
+            # 下拉项显示“项目 / 分组”，一次 join 取回
+            kwargs['queryset'] = TaskGroup.objects.select_related('project')
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
     def save_model(self, request, obj, form, change):
         if not change:
             obj.user = request.user
+        if obj.status == 0 and (not change or 'status' in form.changed_data):
+            # 重新进入排队，排队时长从现在算起
+            obj.queued_at = timezone.now()
         super().save_model(request, obj, form, change)
+        if obj.status == 0:
+            notify_scheduler()
 
     def color_status(self, obj):
         if obj.status == -2:
@@ -317,54 +510,186 @@ class GPUTaskAdmin(admin.ModelAdmin):
     color_status.short_description = '状态'
     color_status.admin_order_field = 'status'
 
-    def delete_queryset(self, request, queryset):
-        for task in queryset:
-            for running_task in task.task_logs.all():
-                running_task.delete_log_file()
-            task.delete()
+    def latest_metrics(self, obj):
+        return format_metrics(getattr(obj, 'latest_run_metrics', ''), getattr(obj, 'latest_run_progress', None), limit=2)
+
+    latest_metrics.short_description = '进度/指标'
+
+    def _deletion_counts(self, queryset):
+        return [
+            (GPUTask, queryset.count()),
+            (GPUTaskRunningLog, GPUTaskRunningLog.objects.filter(task__in=queryset.values('pk')).count()),
+        ]
+
+    def delete_objects(self, queryset):
+        # 日志文件交给后台清理线程
+        delete_tasks(queryset)
+
+    # 复制时从任务上带过去的字段
+    COPY_FIELDS = (
+        'user_id', 'group_id', 'workspace', 'cmd', 'metric_patterns', 'exclusive_gpu', 'gpu_requirement',
+        'memory_requirement', 'utilization_requirement', 'assign_server_id', 'priority',
+    )
 
     def copy_task(self, request, queryset):
-        for task in queryset:
-            new_task = GPUTask(
-                name=task.name + '_copy',
-                user=task.user,
-                group=task.group,
-                workspace=task.workspace,
-                cmd=task.cmd,
-                exclusive_gpu=task.exclusive_gpu,
-                gpu_requirement=task.gpu_requirement,
-                memory_requirement=task.memory_requirement,
-                utilization_requirement=task.utilization_requirement,
-                assign_server=task.assign_server,
-                priority=task.priority,
-                status=-2
-            )
-            new_task.save()
+        copies = [
+            GPUTask(name=values.pop('name')[:95] + '_copy', status=-2, **values)
+            for values in queryset.values('name', *self.COPY_FIELDS).iterator()
+        ]
+        GPUTask.objects.bulk_create(copies, batch_size=1000)
+        self.message_user(request, '已复制 {} 个任务（状态为未就绪）'.format(len(copies)), level=messages.SUCCESS)
 
     copy_task.short_description = '复制任务'
     copy_task.icon = 'el-icon-document-copy'
     copy_task.type = 'success'
 
     def restart_task(self, request, queryset):
-        for task in queryset:
-            task.status = 0
-            task.save()
+        now = timezone.now()
+        restarted = queryset.update(status=0, dispatching_at=None, queued_at=now, update_at=now)
+        notify_scheduler()
+        self.message_user(request, '已重新开始 {} 个任务'.format(restarted), level=messages.SUCCESS)
 
     restart_task.short_description = '重新开始'
     restart_task.icon = 'el-icon-refresh-left'
     restart_task.type = 'success'
 
 
+LOG_SEARCH_PREFIX = 'log:'
+
+
+@admin.register(TaskArray)
+class TaskArrayAdmin(SetBasedDeleteMixin, admin.ModelAdmin):
+    list_display = ('id', 'name', 'group', 'gpu_requirement', 'priority', 'array_progress', 'array_status', 'children', 'create_at',)
+    list_filter = (('group', TaskGroupListFilter), 'active', 'priority')
+    list_select_related = ('group__project',)
+    search_fields = ('name',)
+    list_display_links = ('name',)
+    readonly_fields = ('user', 'size', 'materialized', 'create_at', 'update_at',)
+    actions = ('cancel_array', 'restart_array',)
+
+    # 子任务展开后，决定子任务内容的字段不再允许修改
+    TEMPLATE_FIELDS = ('name', 'workspace', 'cmd', 'params')
+
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        if not request.user.is_superuser:
+            qs = qs.filter(user=request.user)
+        # 数组状态与进度由子任务按状态聚合得出，随列表一次查询取回
+        return qs.annotate(
+            done_count=Count('tasks', filter=Q(tasks__status=2)),
+            failed_count=Count('tasks', filter=Q(tasks__status__in=(-1, -4))),
+            running_count=Count('tasks', filter=Q(tasks__status=1)),
+            ready_count=Count('tasks', filter=Q(tasks__status=0)),
+        )
+
+    def get_readonly_fields(self, request, obj=None):
+        readonly = super().get_readonly_fields(request, obj)
+        if obj is not None and obj.materialized:
+            return tuple(readonly) + self.TEMPLATE_FIELDS
+        return readonly
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == 'group':
+            kwargs['queryset'] = TaskGroup.objects.select_related('project')
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            obj.user = request.user
+        super().save_model(request, obj, form, change)
+        if obj.active:
+            notify_scheduler()
+
+    def _deletion_counts(self, queryset):
+        arrays = queryset.values('pk')
+        return [
+            (TaskArray, queryset.count()),
+            (GPUTask, GPUTask.objects.filter(array__in=arrays).count()),
+            (GPUTaskRunningLog, GPUTaskRunningLog.objects.filter(task__array__in=arrays).count()),
+        ]
+
+    def delete_objects(self, queryset):
+        with transaction.atomic():
+            journal_logs(GPUTaskRunningLog.objects.filter(task__array__in=queryset.values('pk')))
+            queryset.delete()
+
+    def array_progress(self, obj):
+        if not obj.size:
+            return '-'
+        text = '{} / {}'.format(obj.done_count, obj.size)
+        if obj.failed_count:
+            return format_html('{} <span style="color:red;">（失败 {}）</span>', text, obj.failed_count)
+        return text
+
+    array_progress.short_description = '完成/总数'
+
+    def array_status(self, obj):
+        if obj.size and obj.done_count == obj.size:
+            status, color_code = '已完成', 'green'
+        elif not obj.active:
+            status, color_code = '已取消', 'gray'
+        elif obj.running_count:
+            status, color_code = '运行中', '#ecc849'
+        elif obj.materialized >= obj.size and not obj.ready_count:
+            status, color_code = ('有失败', 'red') if obj.failed_count else ('已结束', 'gray')
+        else:
+            status, color_code = '排队中', 'blue'
+        return format_html('<span style="color:{};">{}</span>', color_code, status)
+
+    array_status.short_description = '状态'
+
+    def children(self, obj):
+        url = reverse('admin:task_gputask_array_view', args=(obj.pk,))
+        return format_html('<a href="{}">{} 个已展开</a>', url, obj.materialized)
+
+    children.short_description = '子任务'
+
+    def cancel_array(self, request, queryset):
+        arrays = list(queryset.values_list('pk', flat=True))
+        TaskArray.objects.filter(pk__in=arrays).update(active=False, update_at=timezone.now())
+        # 运行中的子任务只记下结束请求，由调度器在后台 ssh 结束，大数组也不会让请求超时
+        cancelled, kill_queued = cancel_tasks(GPUTask.objects.filter(array__in=arrays))
+        if kill_queued:
+            notify_scheduler()
+        self.message_user(request, '已取消 {} 个数组：{} 个排队中的子任务改为未就绪，{} 个运行中的子任务将由调度器结束'.format(
+            len(arrays), cancelled, kill_queued), level=messages.SUCCESS)
+
+    cancel_array.short_description = '取消数组'
+    cancel_array.icon = 'el-icon-circle-close'
+    cancel_array.type = 'danger'
+    cancel_array.confirm = '取消后排队中的子任务不再调度，运行中的子任务会被结束，是否继续？'
+
+    def restart_array(self, request, queryset):
+        arrays = list(queryset.values_list('pk', flat=True))
+        TaskArray.objects.filter(pk__in=arrays).update(active=True, update_at=timezone.now())
+        # 失败、失联与被取消的子任务重新排队；尚未展开的子任务由调度器继续展开
+        now = timezone.now()
+        restarted = GPUTask.objects.filter(array__in=arrays, status__in=(-2, -1, -4)).update(
+            status=0, dispatching_at=None, queued_at=now, update_at=now)
+        notify_scheduler()
+        self.message_user(request, '已重新开始 {} 个数组，{} 个子任务重新排队'.format(len(arrays), restarted),
+                          level=messages.SUCCESS)
+
+    restart_array.short_description = '重新开始'
+    restart_array.icon = 'el-icon-refresh-left'
+    restart_array.type = 'success'
+
+
 @admin.register(GPUTaskRunningLog)
-class GPUTaskRunningLogAdmin(admin.ModelAdmin):
-    list_display = ('id', 'index', 'task', 'server', 'gpus', 'log_file_path', 'remark', 'color_status', 'start_at', 'update_at',)
+class GPUTaskRunningLogAdmin(SetBasedDeleteMixin, admin.ModelAdmin):
+    list_display = ('id', 'index', 'task', 'server', 'gpus', 'log_file_path', 'remark', 'color_status', 'metrics_summary', 'start_at', 'update_at',)
     list_filter = ('task', 'server', 'status')
-    search_fields = ('task', 'server',)
+    search_fields = ('task__name', 'server__ip',)
+    search_help_text = '按任务名/服务器 IP 搜索；以 log: 开头时全文搜索日志内容，用 | 分隔多个短语，如 log:CUDA out of memory | NCCL error'
     list_display_links = ('task',)
-    readonly_fields = ('start_at', 'update_at', 'log', 'task', 'index', 'server', 'gpus', 'status', 'log_file_path', 'pid', 'remote_pid', 'remote_pgid')
+    # server 可为空，Django 默认的 select_related() 不会跟随，需要显式列出
+    list_select_related = ('task', 'server')
+    readonly_fields = ('start_at', 'update_at', 'log', 'task', 'index', 'server', 'gpus', 'status', 'log_file_path', 'pid', 'remote_pid', 'remote_pgid', 'metrics_view', 'timeline_view')
     fieldsets = (
         ('基本信息', {'fields': ['task', 'index', 'server', 'gpus', 'pid', 'remote_pid', 'remote_pgid']}),
         ('状态信息', {'fields': ['status', 'start_at', 'update_at']}),
+        ('时间线', {'fields': ['timeline_view']}),
+        ('训练指标', {'fields': ['metrics_view']}),
         ('备注', {'fields': ['remark']}),
         ('日志', {'fields': ['log_file_path', 'log']}),
     )
@@ -381,10 +706,47 @@ class GPUTaskRunningLogAdmin(admin.ModelAdmin):
     def has_add_permission(self, request):
         return False
 
-    def delete_queryset(self, request, queryset):
-        for running_task in queryset:
-            running_task.delete_log_file()
-            running_task.delete()
+    def _log_search_text(self, request):
+        term = request.GET.get('q', '').strip()
+        return term[len(LOG_SEARCH_PREFIX):] if term.startswith(LOG_SEARCH_PREFIX) else None
+
+    def get_search_results(self, request, queryset, search_term):
+        text = self._log_search_text(request)
+        if text is None:
+            return super().get_search_results(request, queryset, search_term)
+        # 全文检索：命中的块暂存在 request 上，列表里的“日志匹配”列按需回读片段
+        try:
+            with LogSearchIndex() as index:
+                request._log_search_hits = index.search(text)
+        except sqlite3.Error as exc:
+            self.message_user(request, '日志全文检索不可用：{}'.format(exc), messages.ERROR)
+            request._log_search_hits = {}
+        return queryset.filter(id__in=list(request._log_search_hits)), False
+
+    def get_list_display(self, request):
+        list_display = super().get_list_display(request)
+        text = self._log_search_text(request)
+        if text is None:
+            return list_display
+
+        def log_matches(obj):
+            chunks = getattr(request, '_log_search_hits', {}).get(obj.pk, [])
+            lines = log_search_snippets(obj.log_file_path, chunks, text)
+            url = reverse('admin:task_gputaskrunninglog_change', args=(obj.pk,))
+            return format_html_join(
+                format_html('<br>'),
+                '<a href="{}#line={}">{}</a>: {}',
+                ((url, line_no + 1, line_no + 1, line[:200]) for line_no, line in lines),
+            )
+
+        log_matches.short_description = '日志匹配'
+        return tuple(list_display) + (log_matches,)
+
+    def _deletion_counts(self, queryset):
+        return [(GPUTaskRunningLog, queryset.count())]
+
+    def delete_objects(self, queryset):
+        delete_running_logs(queryset)
 
     def color_status(self, obj):
         if obj.status == -1:
@@ -407,15 +769,162 @@ class GPUTaskRunningLogAdmin(admin.ModelAdmin):
     color_status.short_description = '状态'
     color_status.admin_order_field = 'status'
 
+    def get_urls(self):
+        urls = super().get_urls()
+        extra = [
+            path(
+                '<path:object_id>/log/stream/',
+                self.admin_site.admin_view(self.log_stream_view),
+                name='task_gputaskrunninglog_log_stream',
+            ),
+            path(
+                '<path:object_id>/log/',
+                self.admin_site.admin_view(self.log_view),
+                name='task_gputaskrunninglog_log',
+            ),
+        ]
+        return extra + urls
+
     def log(self, obj):
+        # 只渲染日志末尾，更早的内容由页面按需向 log_view 翻页加载
         try:
-            with open(obj.log_file_path, 'r') as f:
-                return f.read()
+            with LogReader.open(obj.log_file_path) as reader:
+                page = reader.tail(DEFAULT_TAIL_LINES)
         except Exception:
             return 'Error: Cannot open log file'
+        return format_html(
+            '<div class="gputasker-log" data-url="{}" data-stream-url="{}" data-live="{}" data-start="{}" data-end="{}">'
+            '<div class="gputasker-log-toolbar">'
+            '<button type="button" class="gputasker-log-earlier"{}>加载更早</button> '
+            '<input type="number" min="1" class="gputasker-log-line" placeholder="跳转到行号"> '
+            '<button type="button" class="gputasker-log-goto">跳转</button> '
+            '<span class="gputasker-log-info">{} / {} 字节</span> '
+            '<span class="gputasker-log-live"></span>'
+            '</div>'
+            '<pre class="gputasker-log-text">{}</pre>'
+            '</div>',
+            reverse('admin:task_gputaskrunninglog_log', args=(obj.pk,)),
+            reverse('admin:task_gputaskrunninglog_log_stream', args=(obj.pk,)),
+            '1' if obj.status in (1, -2) else '0',
+            page.start,
+            page.end,
+            '' if page.has_more_before else ' disabled',
+            page.start,
+            page.size,
+            page.text,
+        )
 
     log.short_description = '日志'
 
+    def metrics_summary(self, obj):
+        return format_metrics(obj.metrics, obj.progress)
+
+    metrics_summary.short_description = '进度/指标'
+    metrics_summary.admin_order_field = 'progress'
+
+    def metrics_view(self, obj):
+        """最新指标 + 最近的变化曲线（来自 <日志>.metrics 采样序列）。"""
+        series = read_series(obj.log_file_path)
+        try:
+            latest = json.loads(obj.metrics) if obj.metrics else {}
+        except ValueError:
+            latest = {}
+        rows = []
+        for name, value in _metric_items(latest):
+            rows.append((name, _format_value(value), _sparkline(series.get(name, []))))
+        summary = format_metrics('', obj.progress) if obj.progress is not None else ''
+        if not rows:
+            return summary or '-'
+        return format_html(
+            '{}<table style="margin-top:6px;">{}</table>',
+            summary,
+            format_html_join('', '<tr><td>{}</td><td>{}</td><td>{}</td></tr>', rows),
+        )
+
+    metrics_view.short_description = '训练指标'
+
+    def timeline_view(self, obj):
+        """入队 → 释放GPU 各时间点，以及与上一个时间点的间隔。"""
+        rows = [
+            (label, value.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3] if value else '-',
+             '+{:.3f}s'.format(delta) if delta is not None else '')
+            for label, value, delta in timeline(obj)
+        ]
+        return format_html(
+            '<table>{}</table>',
+            format_html_join('', '<tr><td>{}</td><td>{}</td><td>{}</td></tr>', rows),
+        )
+
+    timeline_view.short_description = '时间线'
+
+    def log_view(self, request, object_id):
+        """分页读取日志：before=偏移（加载更早）、after=偏移（加载更多）或 line=行号（跳转），lines=行数。"""
+        obj = self.get_queryset(request).filter(pk=object_id).only('id', 'log_file_path').first()
+        if obj is None or not self.has_view_permission(request, obj):
+            raise Http404
+        lines = request.GET.get('lines', DEFAULT_TAIL_LINES)
+        try:
+            with LogReader.open(obj.log_file_path) as reader:
+                if request.GET.get('line'):
+                    # 行号从 1 开始；索引按预算增量构建，未覆盖到时提示稍后重试
+                    line_no = max(1, int(request.GET['line'])) - 1
+                    complete = reader.update_index()
+                    page = reader.page_at_line(line_no, lines)
+                    if page is None:
+                        indexed, line_count = reader.index_status()
+                        return JsonResponse({
+                            'ok': False,
+                            'error': 'line_out_of_range' if complete else 'line_not_indexed',
+                            'indexed_bytes': indexed,
+                            'indexed_lines': line_count,
+                        })
+                elif request.GET.get('after'):
+                    page = reader.page_after(int(request.GET['after']), lines)
+                elif request.GET.get('before'):
+                    page = reader.page_before(int(request.GET['before']), lines)
+                else:
+                    page = reader.tail(lines)
+        except ValueError:
+            return JsonResponse({'ok': False, 'error': 'invalid_params'}, status=400)
+        except OSError:
+            return JsonResponse({'ok': False, 'error': 'log_unavailable'}, status=404)
+        return JsonResponse({'ok': True, **page.as_dict()})
+
+    def log_stream_view(self, request, object_id):
+        """SSE 实时推送日志增量：从 Last-Event-ID（或 offset 参数）给出的字节偏移续传。"""
+        obj = self.get_queryset(request).filter(pk=object_id).only('id', 'log_file_path', 'status').first()
+        if obj is None or not self.has_view_permission(request, obj):
+            raise Http404
+        offset = request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('offset')
+        try:
+            if offset in (None, ''):
+                # 未给偏移：从当前末尾开始，只推新内容
+                offset = log_size(obj.log_file_path)
+            offset = int(offset)
+        except ValueError:
+            return JsonResponse({'ok': False, 'error': 'invalid_params'}, status=400)
+        except OSError:
+            return JsonResponse({'ok': False, 'error': 'log_unavailable'}, status=404)
+
+        # 先占全站名额：推送期间占住一个 worker，不能让实时 tail 把 worker 占满
+        stream_slot = acquire_stream_slot()
+        if stream_slot is None:
+            response = JsonResponse({'ok': False, 'error': 'too_many_streams'}, status=503)
+            response['Retry-After'] = '10'
+            return response
+        slot = acquire_watcher_slot(obj.log_file_path)
+        if slot is None:
+            stream_slot.release()
+            response = JsonResponse({'ok': False, 'error': 'too_many_watchers'}, status=429)
+            response['Retry-After'] = '10'
+            return response
+        stream = LogEventStream(obj.log_file_path, offset, slots=(stream_slot, slot), live=obj.status in (1, -2))
+        response = StreamingHttpResponse(stream, content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # 关闭 nginx 的响应缓冲，事件才能即时到达浏览器
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
     def kill_button(self, request, queryset):
         for running_task in queryset:
             if running_task.status in (1, -2):
@@ -446,3 +955,121 @@ class GPUTaskRunningLogAdmin(admin.ModelAdmin):
     kill_button.icon = 'el-icon-error'
     kill_button.type = 'danger'
     kill_button.confirm = '是否执意结束选中进程？'
+
+
+@admin.register(Notification)
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'address', 'event', 'task_name', 'status', 'attempts', 'next_attempt_at', 'short_error', 'create_at',)
+    list_filter = ('status', 'event')
+    search_fields = ('address', 'task_name', 'subject',)
+    list_select_related = ('user',)
+    readonly_fields = ('user', 'address', 'event', 'task_name', 'digest_key', 'subject', 'body', 'status', 'attempts', 'next_attempt_at', 'last_error', 'create_at')
+    actions = ('resend',)
+
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        if request.user.is_superuser:
+            return qs
+        return qs.filter(user=request.user)
+
+    def has_add_permission(self, request):
+        return False
+
+    def short_error(self, obj):
+        return obj.last_error.splitlines()[-1][:100] if obj.last_error else ''
+
+    short_error.short_description = '错误信息'
+
+    def resend(self, request, queryset):
+        # 等待汇总的通知由汇总统一发送，不单独重发
+        resent = queryset.exclude(status=1).update(status=0, attempts=0, next_attempt_at=timezone.now())
+        self.message_user(request, '已重新加入发送队列 {} 封'.format(resent), level=messages.SUCCESS)
+
+    resend.short_description = '重新发送'
+    resend.icon = 'el-icon-message'
+    resend.type = 'success'
+
+
+@admin.register(GPUUsage)
+class GPUUsageAdmin(admin.ModelAdmin):
+    list_display = ('day', 'user', 'project', 'group', 'server', 'runs', 'gpu_hours_display', 'wall_hours_display',)
+    list_filter = ('server', 'user')
+    date_hierarchy = 'day'
+    # 维度外键都可为空，需要显式列出
+    list_select_related = ('user', 'project', 'group', 'server')
+    actions = ('export_csv',)
+
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        if request.user.is_superuser:
+            return qs
+        return qs.filter(user=request.user)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def gpu_hours_display(self, obj):
+        return '{:.2f}'.format(obj.gpu_hours)
+
+    gpu_hours_display.short_description = 'GPU·小时'
+    gpu_hours_display.admin_order_field = 'gpu_seconds'
+
+    def wall_hours_display(self, obj):
+        return '{:.2f}'.format(obj.wall_seconds / 3600.0)
+
+    wall_hours_display.short_description = '运行时长(小时)'
+    wall_hours_display.admin_order_field = 'wall_seconds'
+
+    def export_csv(self, request, queryset):
+        rows = [
+            {
+                'day': usage.day.isoformat(),
+                'user': usage.user.username if usage.user else None,
+                'project': usage.project.name if usage.project else None,
+                'group': usage.group.name if usage.group else None,
+                'server': usage.server.ip if usage.server else None,
+                'runs': usage.runs,
+                'gpu_hours': round(usage.gpu_hours, 3),
+                'wall_hours': round(usage.wall_seconds / 3600.0, 3),
+            }
+            for usage in queryset.select_related('user', 'project', 'group', 'server').order_by('day', 'id')
+        ]
+        out = io.StringIO()
+        write_csv(out, rows, ('day', 'user', 'project', 'group', 'server'))
+        response = HttpResponse(out.getvalue(), content_type='text/csv; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename="gpu_usage.csv"'
+        return response
+
+    export_csv.short_description = '导出 CSV'
+    export_csv.icon = 'el-icon-download'
+    export_csv.type = 'success'
+
+
+@admin.register(SchedulerInstance)
+class SchedulerInstanceAdmin(admin.ModelAdmin):
+    list_display = ('name', 'hostname', 'pid', 'started_at', 'renewed_at', 'expires_at', 'alive_display', 'servers_display',)
+
+    def has_module_permission(self, request):
+        return request.user.is_superuser
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def alive_display(self, obj):
+        return obj.expires_at >= timezone.now()
+
+    alive_display.short_description = '存活'
+    alive_display.boolean = True
+
+    def servers_display(self, obj):
+        # 实例数很少，逐行按当前存活实例重新计算即可
+        shards = assign_servers(live_members(), GPUServer.objects.values_list('id', flat=True))
+        return len(shards.get(obj.name, []))
+
+    servers_display.short_description = '分到的节点数'
@@ -0,0 +1,218 @@
+"""任务提交 API（批量提交 / 列表 / 取消）的解析、校验与写库。
+
+超参数搜索一次要提交成千上万个任务，后台表单逐个提交、逐行 save 太慢：
+
+- 鉴权用 UserConfig.api_token（请求头 `Authorization: Bearer <token>`），列表也接受后台登录会话；
+- 请求体为 JSON（`{"defaults": {...}, "tasks": [...]}` 或任务数组）或 JSON Lines（每行一个任务）；
+- 先整体校验（字段级校验逐条执行，外键按 id 批量查），有任何错误则整批拒绝并返回出错的下标；
+- 校验通过后在一个事务里按块 bulk_create，返回新任务 id，并唤醒调度器。
+"""
+import json
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import Max
+
+from base.models import UserConfig
+from base.utils import env_int
+from gpu_info.models import GPUServer
+from .models import GPUTask, TaskGroup
+
+# 可由请求设置的字段及其 JSON 类型
+SUBMIT_FIELDS = {
+    'name': str,
+    'cmd': str,
+    'workspace': str,
+    'metric_patterns': str,
+    'gpu_requirement': int,
+    'exclusive_gpu': bool,
+    'memory_requirement': int,
+    'utilization_requirement': int,
+    'priority': int,
+    'group': int,
+    'assign_server': (int, str),
+    'ready': bool,
+}
+# 外键由批量查询校验，不走 full_clean 的逐条查询
+_CLEAN_EXCLUDE = ('user', 'group', 'assign_server')
+MAX_REPORTED_ERRORS = 100
+
+
+class SubmitError(Exception):
+    """整批拒绝；error 为错误码，details 为逐条错误。"""
+
+    def __init__(self, error, status=400, details=None):
+        super().__init__(error)
+        self.error = error
+        self.status = status
+        self.details = details or []
+
+
+def max_tasks_per_request():
+    return env_int('GPUTASKER_TASK_SUBMIT_MAX', 5000, 1)
+
+
+def insert_chunk_size():
+    return env_int('GPUTASKER_TASK_SUBMIT_CHUNK', 1000, 1)
+
+
+def authenticate(request, allow_session=False):
+    """按 Bearer token 找到用户；allow_session 时也接受已登录的后台会话。失败返回 None。"""
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    scheme, _, token = header.partition(' ')
+    token = token.strip()
+    if scheme.lower() in ('bearer', 'token') and token:
+        config = UserConfig.objects.select_related('user').filter(api_token=token).first()
+        if config is not None and config.user.is_active:
+            return config.user
+        return None
+    if allow_session and request.user.is_authenticated:
+        return request.user
+    return None
+
+
+def parse_submission(body, content_type=''):
+    """返回 (defaults, items)。JSON Lines 按 Content-Type（ndjson/jsonl）识别。"""
+    try:
+        text = body.decode('utf-8')
+        if 'ndjson' in content_type or 'jsonl' in content_type:
+            return {}, [json.loads(line) for line in text.splitlines() if line.strip()]
+        payload = json.loads(text or '{}')
+    except (UnicodeDecodeError, ValueError):
+        raise SubmitError('invalid_json')
+    if isinstance(payload, list):
+        return {}, payload
+    if not isinstance(payload, dict):
+        raise SubmitError('invalid_payload')
+    defaults = payload.get('defaults') or {}
+    items = payload.get('tasks')
+    if not isinstance(defaults, dict) or not isinstance(items, list):
+        raise SubmitError('invalid_payload')
+    return defaults, items
+
+
+def _check_types(item):
+    errors = {}
+    for key, value in item.items():
+        expected = SUBMIT_FIELDS.get(key)
+        if expected is None:
+            errors[key] = ['未知字段']
+        elif value is not None and (not isinstance(value, expected) or (expected is int and isinstance(value, bool))):
+            errors[key] = ['类型错误']
+    for key in ('cmd', 'workspace'):
+        if not item.get(key):
+            errors.setdefault(key, []).append('必填')
+    return errors
+
+
+def _resolve_servers(refs):
+    """assign_server 可以是 id 或 IP；同一 IP 有多个端口时视为有歧义。"""
+    ids = {r for r in refs if isinstance(r, int)}
+    ips = {r for r in refs if isinstance(r, str)}
+    found = {pk: pk for pk in GPUServer.objects.filter(id__in=ids).values_list('id', flat=True)}
+    by_ip = {}
+    for pk, ip in GPUServer.objects.filter(ip__in=ips).values_list('id', 'ip'):
+        by_ip.setdefault(ip, []).append(pk)
+    for ip, pks in by_ip.items():
+        if len(pks) == 1:
+            found[ip] = pks[0]
+    return found
+
+
+def build_tasks(user, defaults, items):
+    """校验并构造未保存的 GPUTask 列表；有错误时抛出 SubmitError（含出错的下标）。"""
+    if not items:
+        raise SubmitError('empty_tasks')
+    if len(items) > max_tasks_per_request():
+        raise SubmitError('too_many_tasks', status=413)
+    errors = []
+    merged = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append({'index': index, 'errors': {'__all__': ['应为对象']}})
+            merged.append(None)
+            continue
+        data = dict(defaults)
+        data.update(item)
+        field_errors = _check_types(data)
+        if field_errors:
+            errors.append({'index': index, 'errors': field_errors})
+            merged.append(None)
+            continue
+        merged.append(data)
+
+    groups = set(
+        TaskGroup.objects.filter(id__in={d['group'] for d in merged if d and d.get('group') is not None})
+        .values_list('id', flat=True)
+    )
+    servers = _resolve_servers({d['assign_server'] for d in merged if d and d.get('assign_server') is not None})
+
+    tasks = []
+    for index, data in enumerate(merged):
+        if data is None:
+            continue
+        data = dict(data)
+        ready = data.pop('ready', True)
+        group = data.pop('group', None)
+        server = data.pop('assign_server', None)
+        field_errors = {}
+        if group is not None and group not in groups:
+            field_errors['group'] = ['分组不存在']
+        if server is not None and server not in servers:
+            field_errors['assign_server'] = ['服务器不存在或 IP 有歧义']
+        task = GPUTask(
+            user=user, group_id=group, assign_server_id=servers.get(server), status=0 if ready else -2,
+            **{k: v for k, v in data.items() if v is not None},
+        )
+        if not task.name:
+            task.name = task.cmd.strip().splitlines()[0][:100] if task.cmd.strip() else 'task'
+        task._normalize_cmd()
+        try:
+            task.full_clean(exclude=_CLEAN_EXCLUDE, validate_unique=False, validate_constraints=False)
+        except ValidationError as exc:
+            for field, messages in exc.message_dict.items():
+                field_errors.setdefault(field, []).extend(messages)
+        if field_errors:
+            errors.append({'index': index, 'errors': field_errors})
+        else:
+            tasks.append(task)
+    if errors:
+        errors.sort(key=lambda e: e['index'])
+        raise SubmitError('invalid_tasks', details=errors[:MAX_REPORTED_ERRORS])
+    return tasks
+
+
+def create_tasks(user, tasks, chunk_size=None):
+    """在一个事务里按块 bulk_create，返回新任务 id（与 tasks 顺序一致）。"""
+    chunk_size = chunk_size or insert_chunk_size()
+    with transaction.atomic():
+        returns_ids = connection.features.can_return_rows_from_bulk_insert
+        if not returns_ids:
+            # MySQL 不回填自增 id：锁住用户行串行化同一用户的提交，插入后按 id 区间取回
+            list(User.objects.select_for_update().filter(pk=user.pk).values_list('pk', flat=True))
+            last_id = GPUTask.objects.filter(user=user).aggregate(last=Max('id'))['last'] or 0
+        for i in range(0, len(tasks), chunk_size):
+            GPUTask.objects.bulk_create(tasks[i:i + chunk_size])
+        if returns_ids:
+            return [task.pk for task in tasks]
+        return list(
+            GPUTask.objects.filter(user=user, id__gt=last_id).order_by('id').values_list('id', flat=True)[:len(tasks)]
+        )
+
+
+def task_as_dict(task):
+    return {
+        'id': task.id,
+        'name': task.name,
+        'status': task.status,
+        'status_display': task.get_status_display(),
+        'priority': task.priority,
+        'gpu_requirement': task.gpu_requirement,
+        'group': task.group_id,
+        'array': task.array_id,
+        'assign_server': task.assign_server_id,
+        'create_at': task.create_at.isoformat() if task.create_at else None,
+        'queued_at': task.queued_at.isoformat() if task.queued_at else None,
+        'update_at': task.update_at.isoformat() if task.update_at else None,
+    }
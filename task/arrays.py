@@ -0,0 +1,88 @@
+"""任务数组的参数展开：一个命令模板 + 参数网格/列表，按序号惰性生成子任务。
+
+参数为 JSON：
+- 对象表示网格，如 {"lr": [0.1, 0.01], "bs": [32, 64]}，按笛卡尔积展开（与 itertools.product 顺序一致，
+  最后一个参数变化最快）；
+- 数组表示参数列表，如 [{"lr": 0.1, "bs": 32}, {"lr": 0.01, "bs": 64}]，每项一个子任务。
+
+第 i 个子任务的参数由 params_at 直接按混合进制算出，不需要展开整个网格。
+命令与名称模板中的 {参数名} 替换为参数值，{index} 为子任务序号；其他花括号（如 shell 的 ${HOME}）原样保留。
+"""
+import json
+import re
+
+from django.core.exceptions import ValidationError
+
+MAX_ARRAY_SIZE = 1000000
+_PLACEHOLDER = re.compile(r'\{(\w+)\}')
+_KEY = re.compile(r'^\w+$')
+
+
+def parse_params(text):
+    """解析并校验参数；不合法时抛出 ValueError。"""
+    try:
+        spec = json.loads(text or '')
+    except ValueError:
+        raise ValueError('参数不是合法的 JSON')
+    if isinstance(spec, dict):
+        if not spec:
+            raise ValueError('参数网格不能为空')
+        for key, values in spec.items():
+            if not _KEY.match(key):
+                raise ValueError('参数名只能包含字母、数字和下划线：{}'.format(key))
+            if not isinstance(values, list) or not values:
+                raise ValueError('网格中每个参数的取值应为非空数组：{}'.format(key))
+    elif isinstance(spec, list):
+        if not spec:
+            raise ValueError('参数列表不能为空')
+        for item in spec:
+            if not isinstance(item, dict) or not all(_KEY.match(key) for key in item):
+                raise ValueError('参数列表的每一项应为对象，键只能包含字母、数字和下划线')
+    else:
+        raise ValueError('参数应为对象（网格）或数组（列表）')
+    if array_size(spec) > MAX_ARRAY_SIZE:
+        raise ValueError('子任务数不能超过 {}'.format(MAX_ARRAY_SIZE))
+    return spec
+
+
+def validate_params(text):
+    try:
+        parse_params(text)
+    except ValueError as exc:
+        raise ValidationError(str(exc))
+
+
+def array_size(spec):
+    if isinstance(spec, list):
+        return len(spec)
+    size = 1
+    for values in spec.values():
+        size *= len(values)
+    return size
+
+
+def params_at(spec, index):
+    """第 index 个子任务的参数。"""
+    if isinstance(spec, list):
+        return spec[index]
+    params = {}
+    for key in reversed(list(spec)):
+        values = spec[key]
+        index, digit = divmod(index, len(values))
+        params[key] = values[digit]
+    return {key: params[key] for key in spec}
+
+
+def _format_value(value):
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def render(template, params, index):
+    def replace(m):
+        key = m.group(1)
+        if key in params:
+            return _format_value(params[key])
+        if key == 'index':
+            return str(index)
+        return m.group(0)
+    return _PLACEHOLDER.sub(replace, template)
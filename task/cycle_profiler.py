@@ -0,0 +1,206 @@
+"""调度循环的分阶段计时、按阶段统计查询数，以及慢循环记录。
+
+一轮调度偶尔要 40 秒时，只看总耗时分不清是心跳超时扫描、ssh 刷新 GPU、认领循环还是数据库锁等待。
+CycleProfiler 在每轮循环里：
+
+- lap(phase) 记录阶段耗时（同时写入 gputasker_scheduler_phase_seconds），以及该阶段主循环线程执行的查询数与查询耗时
+  （查询耗时包含等待 SQLite 写锁的时间）；派发出去的 run_task 线程不计入；
+- 一轮超过 GPUTASKER_SLOW_CYCLE_SECONDS（默认 30）秒时，向 GPUTASKER_SLOW_CYCLE_LOG（默认 server_log/slow_cycles.jsonl）
+  追加一行 JSON：各阶段耗时/查询数与最慢的若干条查询；开启 cProfile 时另存 .prof 文件（可用 snakeviz/pstats 查看）。
+
+模式由 GPUTASKER_CYCLE_PROFILE 设定初始值：off（只计阶段耗时）、timing（默认，加查询统计与慢循环记录）、
+profile（再加 cProfile）。运行中无需重启即可切换：
+
+    kill -USR1 <调度器 pid>   # 在 timing 与 profile 之间切换
+    kill -USR2 <调度器 pid>   # 下一轮无论快慢都写一条记录（开启 cProfile 时含 .prof）
+"""
+import cProfile
+import heapq
+import json
+import logging
+import os
+import signal
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+task_logger = logging.getLogger('django.task')
+
+MODES = ('off', 'timing', 'profile')
+SLOWEST_QUERIES = 10
+SQL_MAX_LENGTH = 500
+
+
+def slow_cycle_seconds():
+    try:
+        return max(0.0, float(os.getenv('GPUTASKER_SLOW_CYCLE_SECONDS', '30')))
+    except ValueError:
+        return 30.0
+
+
+def slow_cycle_log():
+    return os.getenv('GPUTASKER_SLOW_CYCLE_LOG') or os.path.join(settings.SERVER_LOG_DIR, 'slow_cycles.jsonl')
+
+
+def profile_keep():
+    try:
+        return max(1, int(os.getenv('GPUTASKER_CYCLE_PROFILE_KEEP', '20')))
+    except ValueError:
+        return 20
+
+
+def initial_mode():
+    mode = (os.getenv('GPUTASKER_CYCLE_PROFILE', 'timing') or 'timing').strip().lower()
+    return mode if mode in MODES else 'timing'
+
+
+class _QueryRecorder:
+    """connection.execute_wrapper：累计当前阶段的查询数/耗时，保留整轮最慢的查询。"""
+
+    def __init__(self):
+        self.phase_queries = 0
+        self.phase_seconds = 0.0
+        # 阶段名在 lap 时才知道，这里先记阶段序号
+        self.phase = 0
+        self.slowest = []
+        self._seq = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phase_queries += 1
+            self.phase_seconds += elapsed
+            self._seq += 1
+            item = (elapsed, self._seq, self.phase, sql)
+            if len(self.slowest) < SLOWEST_QUERIES:
+                heapq.heappush(self.slowest, item)
+            elif elapsed > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def take_phase(self):
+        counts = (self.phase_queries, self.phase_seconds)
+        self.phase_queries, self.phase_seconds = 0, 0.0
+        self.phase += 1
+        return counts
+
+
+class Cycle:
+    def __init__(self, profiler, histogram, mode, force_dump):
+        self.profiler = profiler
+        self.histogram = histogram
+        self.mode = mode
+        self.force_dump = force_dump
+        self.phases = []
+        self.started_at = timezone.now()
+        self._recorder = None
+        self._profile = None
+        if mode != 'off':
+            self._recorder = _QueryRecorder()
+            connection.execute_wrappers.append(self._recorder)
+        if mode == 'profile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self.start = self.last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        elapsed = now - self.last
+        self.last = now
+        if self.histogram is not None:
+            self.histogram.observe(elapsed, phase=phase)
+        record = {'phase': phase, 'seconds': round(elapsed, 6)}
+        if self._recorder is not None:
+            queries, query_seconds = self._recorder.take_phase()
+            record.update(queries=queries, query_seconds=round(query_seconds, 6))
+        self.phases.append(record)
+
+    def finish(self):
+        """结束本轮；超过阈值（或收到 USR2）时写慢循环记录。返回写入的记录或 None。"""
+        elapsed = time.perf_counter() - self.start
+        if self._profile is not None:
+            self._profile.disable()
+        if self._recorder is not None:
+            try:
+                connection.execute_wrappers.remove(self._recorder)
+            except ValueError:
+                pass
+        if self.histogram is not None:
+            self.histogram.observe(elapsed, phase='cycle')
+        threshold = slow_cycle_seconds()
+        if self.mode == 'off' or not (self.force_dump or elapsed >= threshold):
+            return None
+        record = {
+            'ts': self.started_at.isoformat(),
+            'seconds': round(elapsed, 6),
+            'threshold': threshold,
+            'forced': self.force_dump,
+            'phases': self.phases,
+            'slowest_queries': [
+                {
+                    'phase': self.phases[phase]['phase'] if phase < len(self.phases) else None,
+                    'seconds': round(seconds, 6),
+                    'sql': sql[:SQL_MAX_LENGTH],
+                }
+                for seconds, _, phase, sql in sorted(self._recorder.slowest, reverse=True)
+            ],
+            'profile': self._dump_profile(),
+        }
+        self.profiler.write_record(record)
+        return record
+
+    def _dump_profile(self):
+        if self._profile is None:
+            return None
+        directory = os.path.join(os.path.dirname(slow_cycle_log()), 'cycle_profiles')
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'cycle-{}.prof'.format(self.started_at.strftime('%Y%m%d-%H%M%S-%f')))
+        self._profile.dump_stats(path)
+        # 只保留最近的若干份
+        dumps = sorted(name for name in os.listdir(directory) if name.endswith('.prof'))
+        for name in dumps[:-profile_keep()]:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+        return path
+
+
+class CycleProfiler:
+    def __init__(self, histogram=None, mode=None):
+        self.histogram = histogram
+        self.mode = mode or initial_mode()
+        self._dump_next = False
+
+    def start_cycle(self):
+        force_dump, self._dump_next = self._dump_next, False
+        # off 模式下收到 USR2：只有这一轮统计查询
+        mode = 'timing' if force_dump and self.mode == 'off' else self.mode
+        return Cycle(self, self.histogram, mode, force_dump)
+
+    def toggle_profile(self, *_):
+        self.mode = 'timing' if self.mode == 'profile' else 'profile'
+        task_logger.info('cycle profiler mode: %s', self.mode)
+
+    def dump_next(self, *_):
+        self._dump_next = True
+        task_logger.info('cycle profiler: next cycle will be recorded')
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGUSR1, self.toggle_profile)
+        signal.signal(signal.SIGUSR2, self.dump_next)
+
+    def write_record(self, record):
+        path = slow_cycle_log()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        slowest = max(record['phases'], key=lambda p: p['seconds'], default=None)
+        task_logger.warning(
+            'slow scheduler cycle: %.1fs (slowest phase %s %.1fs), details in %s',
+            record['seconds'], slowest['phase'] if slowest else '-', slowest['seconds'] if slowest else 0, path,
+        )
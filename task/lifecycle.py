@@ -0,0 +1,112 @@
+"""任务生命周期时间点与调度开销统计。
+
+每条运行记录依次记下：入队、认领、占用GPU、SSH启动、远端进程启动（读到 __GPUTASKER_REMOTE__ 标记）、
+首行输出、结束、释放GPU。以前只有 start_at/update_at，分不清 GPU 空闲到任务真正开始的时间花在了
+排队、抢 GPU 还是 ssh 建连上。这里把相邻时间点的差值按天/按服务器汇总成分位数：
+
+- queue_wait：入队 → 认领，排队等待；
+- lock：认领 → 占用GPU，选卡与加锁；
+- ssh：SSH启动 → 远端进程启动，ssh 建连与远端 python 启动；
+- launch：认领 → 远端进程启动，整段调度开销；
+- first_output：远端进程启动 → 首行输出；
+- release：结束 → 释放GPU。
+
+查询：后台 /api/v1/dispatch_stats/、`python manage.py dispatch_stats`；单条记录的时间线见运行记录详情页。
+升级前的运行记录没有这些时间点，不计入统计。
+"""
+from collections import OrderedDict
+
+from .models import GPUTaskRunningLog
+
+STAGES = (
+    ('queued_at', '入队'),
+    ('claimed_at', '认领'),
+    ('gpus_locked_at', '占用GPU'),
+    ('spawned_at', 'SSH启动'),
+    ('marker_at', '远端进程启动'),
+    ('first_output_at', '首行输出'),
+    ('finished_at', '结束'),
+    ('gpus_released_at', '释放GPU'),
+)
+
+# 指标名 -> (起点, 终点)
+INTERVALS = OrderedDict((
+    ('queue_wait', ('queued_at', 'claimed_at')),
+    ('lock', ('claimed_at', 'gpus_locked_at')),
+    ('ssh', ('spawned_at', 'marker_at')),
+    ('launch', ('claimed_at', 'marker_at')),
+    ('first_output', ('marker_at', 'first_output_at')),
+    ('release', ('finished_at', 'gpus_released_at')),
+))
+
+PERCENTILES = (50, 90, 99)
+GROUP_BY = ('day', 'server')
+
+
+def percentile(values, p):
+    """最近秩法分位数；values 需已排序。"""
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * p // 100))
+    return values[min(rank, len(values)) - 1]
+
+
+def summarize(values):
+    values = sorted(values)
+    summary = {'count': len(values)}
+    for p in PERCENTILES:
+        value = percentile(values, p)
+        summary['p{}'.format(p)] = round(value, 3) if value is not None else None
+    summary['max'] = round(values[-1], 3) if values else None
+    return summary
+
+
+def dispatch_stats(start, end, group_by=GROUP_BY, server_id=None):
+    """统计 [start, end) 内开始的运行记录，按 group_by（day / server 的子集）分组，返回分组列表。"""
+    fields = [name for name, _ in STAGES]
+    qs = GPUTaskRunningLog.objects.filter(start_at__gte=start, start_at__lt=end, claimed_at__isnull=False)
+    if server_id is not None:
+        qs = qs.filter(server_id=server_id)
+    groups = {}
+    for row in qs.order_by().values_list('start_at', 'server__ip', *fields).iterator():
+        stamps = dict(zip(fields, row[2:]))
+        key = (
+            row[0].date().isoformat() if 'day' in group_by else None,
+            (row[1] or '-') if 'server' in group_by else None,
+        )
+        samples = groups.get(key)
+        if samples is None:
+            samples = groups[key] = {name: [] for name in INTERVALS}
+            samples['_runs'] = 0
+        samples['_runs'] += 1
+        for name, (begin, finish) in INTERVALS.items():
+            if stamps[begin] is not None and stamps[finish] is not None:
+                samples[name].append(max(0.0, (stamps[finish] - stamps[begin]).total_seconds()))
+
+    result = []
+    for (day, server), samples in sorted(groups.items(), key=lambda item: (item[0][0] or '', item[0][1] or '')):
+        row = OrderedDict()
+        if 'day' in group_by:
+            row['day'] = day
+        if 'server' in group_by:
+            row['server'] = server
+        row['runs'] = samples['_runs']
+        for name in INTERVALS:
+            row[name] = summarize(samples[name])
+        result.append(row)
+    return result
+
+
+def timeline(running_log):
+    """单条运行记录的时间线：[(阶段, 时间, 距上一个已记录时间点的秒数)]，未记录的阶段时间为 None。"""
+    items = []
+    previous = None
+    for field, label in STAGES:
+        value = getattr(running_log, field)
+        delta = None
+        if value is not None:
+            if previous is not None:
+                delta = (value - previous).total_seconds()
+            previous = value
+        items.append((label, value, delta))
+    return items
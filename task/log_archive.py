@@ -0,0 +1,310 @@
+"""已结束运行日志的压缩归档与保留策略。
+
+归档格式（<日志>.gz）是标准 gzip，可直接 zcat：
+- 原文按 frame_size（默认 256KB）切块，每块是一个独立的 gzip member，可单独解压；
+- 文件末尾追加一个空的 gzip member，在其 FEXTRA 字段里记录每块的压缩偏移（帧表），
+  读取时只需读文件尾部即可定位任意偏移所在的块，不用从头解压。
+
+行索引（<日志>.idx）记录的是原文偏移，压缩后仍然有效，不需要重建。
+日志查看器通过 LogReader.open 透明读取：原文件存在时读原文件，否则读归档。
+
+压缩与清理由调度器按 GPUTASKER_LOG_COMPACT_SECONDS 限频在后台线程执行，也可以用
+`python manage.py compact_logs` 手动执行：
+- 已结束（运行失败/已完成）且超过 GPUTASKER_LOG_COMPRESS_AFTER_SECONDS 未写入的日志被压缩；
+- 归档超过 GPUTASKER_LOG_RETENTION_DAYS 天（0 表示不按时间清理）的被删除；
+- 归档总量超过 GPUTASKER_LOG_RETENTION_MAX_MB（0 表示不限）时从最旧的开始删除。
+运行中/节点失联的日志不会被压缩或清理。
+"""
+import collections
+import logging
+import os
+import struct
+import time
+import zlib
+
+from base.utils import PeriodicJob, env_float
+
+ARCHIVE_SUFFIX = '.gz'
+FRAME_SIZE = 256 << 10
+# 帧表放在 gzip FEXTRA 子字段里，长度上限 65535 字节，超过这么多块时按比例放大块大小
+MAX_FRAMES = 8000
+COMPRESS_LEVEL = 6
+
+_FOOTER_MAGIC = b'GTLGZ1\0\0'
+# total_size, frame_size, frame_count, magic
+_FOOTER = struct.Struct('<QII8s')
+_OFFSET = struct.Struct('<Q')
+# 空 deflate 块 + CRC32(0) + ISIZE(0)
+_EMPTY_MEMBER_TAIL = b'\x03\x00' + b'\0' * 8
+_CACHED_FRAMES = 4
+
+task_logger = logging.getLogger('django.task')
+
+
+def archive_path(log_file_path):
+    return log_file_path + ARCHIVE_SUFFIX
+
+
+def _footer_member(offsets, total_size, frame_size):
+    data = b''.join(_OFFSET.pack(o) for o in offsets)
+    data += _FOOTER.pack(total_size, frame_size, len(offsets) - 1, _FOOTER_MAGIC)
+    subfield = b'GT' + struct.pack('<H', len(data)) + data
+    # ID1 ID2 CM=deflate FLG=FEXTRA MTIME=0 XFL=0 OS=unknown XLEN
+    header = b'\x1f\x8b\x08\x04' + b'\0' * 4 + b'\x00\xff' + struct.pack('<H', len(subfield))
+    return header + subfield + _EMPTY_MEMBER_TAIL
+
+
+def compress_log(log_file_path, frame_size=FRAME_SIZE, level=COMPRESS_LEVEL):
+    """把日志压缩为可随机读取的归档并删除原文件，返回 (原大小, 压缩后大小)。"""
+    total = os.path.getsize(log_file_path)
+    while (total + frame_size - 1) // frame_size > MAX_FRAMES:
+        frame_size *= 2
+    target = archive_path(log_file_path)
+    tmp = target + '.tmp'
+    offsets = []
+    written = 0
+    try:
+        with open(log_file_path, 'rb') as src, open(tmp, 'wb') as out:
+            while True:
+                chunk = src.read(frame_size)
+                if not chunk:
+                    break
+                comp = zlib.compressobj(level, zlib.DEFLATED, 31)
+                member = comp.compress(chunk) + comp.flush()
+                offsets.append(written)
+                out.write(member)
+                written += len(member)
+            offsets.append(written)
+            total = src.tell()
+            out.write(_footer_member(offsets, total, frame_size))
+            out.flush()
+            os.fsync(out.fileno())
+        st = os.stat(log_file_path)
+        if st.st_size != total:
+            # 压缩期间文件仍在被写入：放弃这次压缩，下次再试
+            os.remove(tmp)
+            return None
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, target)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.remove(log_file_path)
+    return total, os.path.getsize(target)
+
+
+class GzipFrameSource:
+    """归档日志作为 LogReader 的字节来源：按帧表定位并只解压涉及的块。"""
+
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, 'rb')
+        try:
+            self._load_footer()
+        except Exception:
+            self._f.close()
+            raise
+        self._cache = collections.OrderedDict()
+
+    def _load_footer(self):
+        file_size = os.fstat(self._f.fileno()).st_size
+        tail_len = _FOOTER.size + len(_EMPTY_MEMBER_TAIL)
+        if file_size < tail_len:
+            raise OSError('not a gputasker log archive: {}'.format(self.path))
+        self._f.seek(file_size - tail_len)
+        raw = self._f.read(_FOOTER.size)
+        total, frame_size, count, magic = _FOOTER.unpack(raw)
+        if magic != _FOOTER_MAGIC or frame_size <= 0:
+            raise OSError('not a gputasker log archive: {}'.format(self.path))
+        table_len = (count + 1) * _OFFSET.size
+        self._f.seek(file_size - tail_len - table_len)
+        table = self._f.read(table_len)
+        self._offsets = [o for (o,) in _OFFSET.iter_unpack(table)]
+        self._total = total
+        self.frame_size = frame_size
+
+    def size(self):
+        return self._total
+
+    def _frame(self, i):
+        data = self._cache.get(i)
+        if data is not None:
+            self._cache.move_to_end(i)
+            return data
+        start, end = self._offsets[i], self._offsets[i + 1]
+        self._f.seek(start)
+        data = zlib.decompress(self._f.read(end - start), 31)
+        self._cache[i] = data
+        if len(self._cache) > _CACHED_FRAMES:
+            self._cache.popitem(last=False)
+        return data
+
+    def read_at(self, offset, length):
+        end = min(self._total, offset + length)
+        parts = []
+        pos = max(0, offset)
+        while pos < end:
+            i = pos // self.frame_size
+            frame = self._frame(i)
+            base = i * self.frame_size
+            parts.append(frame[pos - base:end - base])
+            pos = base + len(frame)
+        return b''.join(parts)
+
+    def close(self):
+        self._f.close()
+        self._cache.clear()
+
+
+def open_log_source(log_file_path):
+    """原文件存在时返回 None（由调用方按普通文件读取），否则打开归档。"""
+    if os.path.exists(log_file_path):
+        return None
+    target = archive_path(log_file_path)
+    if os.path.exists(target):
+        return GzipFrameSource(target)
+    raise FileNotFoundError(log_file_path)
+
+
+def log_size(log_file_path):
+    """日志原文大小（已归档时读取帧表中的原始大小）。"""
+    try:
+        return os.path.getsize(log_file_path)
+    except FileNotFoundError:
+        source = GzipFrameSource(archive_path(log_file_path))
+        try:
+            return source.size()
+        finally:
+            source.close()
+
+
+def remove_archive(log_file_path):
+    for path in (archive_path(log_file_path), archive_path(log_file_path) + '.tmp'):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# ---- 后台压缩与保留策略 ----
+
+_UNFINISHED_STATUSES = (1, -2)
+
+
+def compress_after_seconds():
+    return env_float('GPUTASKER_LOG_COMPRESS_AFTER_SECONDS', 600)
+
+
+def retention_days():
+    return env_float('GPUTASKER_LOG_RETENTION_DAYS', 0)
+
+
+def retention_max_bytes():
+    return int(env_float('GPUTASKER_LOG_RETENTION_MAX_MB', 0) * (1 << 20))
+
+
+def compact_seconds():
+    return env_float('GPUTASKER_LOG_COMPACT_SECONDS', 300, 1.0)
+
+
+def _scan(log_dir):
+    logs, archives = [], []
+    try:
+        entries = list(os.scandir(log_dir))
+    except FileNotFoundError:
+        return logs, archives
+    for entry in entries:
+        if not entry.is_file():
+            continue
+        if entry.name.endswith('.log'):
+            logs.append(entry)
+        elif entry.name.endswith('.log' + ARCHIVE_SUFFIX):
+            archives.append(entry)
+    return logs, archives
+
+
+def compact_logs(log_dir=None, now=None, dry_run=False):
+    """压缩已结束的日志并执行保留策略，返回统计 dict。"""
+    # 延迟导入：models 依赖 log_reader，log_reader 又依赖本模块
+    from gpu_tasker.settings import RUNNING_LOG_DIR
+    from . import log_search
+    from .log_reader import remove_index
+    from .metrics import remove_series
+    from .models import GPUTaskRunningLog
+
+    log_dir = RUNNING_LOG_DIR if log_dir is None else log_dir
+    now = time.time() if now is None else now
+    stats = {'compressed': 0, 'bytes_before': 0, 'bytes_after': 0, 'deleted': 0, 'bytes_deleted': 0}
+    if not dry_run:
+        # 压缩前先推进全文索引：读原文比读归档便宜
+        try:
+            log_search.run_indexer()
+        except Exception as exc:
+            task_logger.error('log search indexing before compaction failed: %s', exc)
+    logs, archives = _scan(log_dir)
+
+    idle_before = now - compress_after_seconds()
+    candidates = {e.path: e for e in logs if e.stat().st_mtime < idle_before}
+    # 运行记录里存的是 RUNNING_LOG_DIR/<文件名>
+    by_name = {os.path.join(RUNNING_LOG_DIR, os.path.basename(p)): p for p in candidates}
+    busy = set()
+    names = list(by_name)
+    for i in range(0, len(names), 500):
+        rows = GPUTaskRunningLog.objects.filter(
+            log_file_path__in=names[i:i + 500], status__in=_UNFINISHED_STATUSES,
+        ).values_list('log_file_path', flat=True)
+        busy.update(by_name[p] for p in rows)
+    for path, entry in candidates.items():
+        if path in busy:
+            continue
+        size = entry.stat().st_size
+        if dry_run:
+            stats['compressed'] += 1
+            stats['bytes_before'] += size
+            continue
+        try:
+            result = compress_log(path)
+        except OSError as exc:
+            task_logger.error('compress log %s failed: %s', path, exc)
+            continue
+        if result is None:
+            continue
+        stats['compressed'] += 1
+        stats['bytes_before'] += result[0]
+        stats['bytes_after'] += result[1]
+
+    # 保留策略只作用于归档（即已结束的运行）
+    archives = sorted(_scan(log_dir)[1], key=lambda e: e.stat().st_mtime)
+    expire_before = now - retention_days() * 86400 if retention_days() > 0 else None
+    max_bytes = retention_max_bytes()
+    total = sum(e.stat().st_size for e in archives)
+    for entry in archives:
+        expired = expire_before is not None and entry.stat().st_mtime < expire_before
+        if not expired and not (max_bytes and total > max_bytes):
+            continue
+        size = entry.stat().st_size
+        total -= size
+        stats['deleted'] += 1
+        stats['bytes_deleted'] += size
+        if not dry_run:
+            log_file_path = entry.path[:-len(ARCHIVE_SUFFIX)]
+            remove_archive(log_file_path)
+            remove_index(log_file_path)
+            remove_series(log_file_path)
+            log_search.forget(log_file_path)
+    return stats
+
+
+def _compact():
+    stats = compact_logs()
+    if stats['compressed'] or stats['deleted']:
+        task_logger.info(
+            'log compaction: compressed %d logs (%d -> %d bytes), deleted %d archives (%d bytes)',
+            stats['compressed'], stats['bytes_before'], stats['bytes_after'],
+            stats['deleted'], stats['bytes_deleted'],
+        )
+
+
+COMPACT_JOB = PeriodicJob('log-compactor', _compact, compact_seconds)
+maybe_compact_in_background = COMPACT_JOB.maybe_start
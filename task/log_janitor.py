@@ -0,0 +1,106 @@
+"""删除任务/运行记录时的日志文件清理。
+
+后台批量删除任务时，逐条删日志文件（还有压缩归档、行索引、指标序列与全文索引）会让请求随任务数线性变慢，
+删除一个几千任务的分组会超时。现在删除分两步：
+
+- 请求内：在同一个事务里把要删除的运行记录的日志路径写入删除日志（LogDeletion），再用查询集整体删除记录；
+- 后台：调度器每隔 GPUTASKER_LOG_JANITOR_SECONDS（默认 30）秒在后台线程按批清理删除日志里的文件，
+  清理完删除对应的删除日志行。进程中途退出时未完成的条目留在表里，下次继续。
+
+手动执行：`python manage.py purge_deleted_logs`。
+"""
+import logging
+import os
+
+from django.db import transaction
+
+from base.utils import PeriodicJob, env_float
+
+from . import log_search
+from .models import GPUTaskRunningLog, LogDeletion, remove_log_files
+
+BATCH_SIZE = 1000
+
+task_logger = logging.getLogger('django.task')
+
+
+def janitor_seconds():
+    return env_float('GPUTASKER_LOG_JANITOR_SECONDS', 30, 1.0)
+
+
+def journal_logs(running_logs):
+    """把这些运行记录的日志路径写入删除日志，返回条数。应与删除运行记录在同一事务中调用。"""
+    entries = [
+        LogDeletion(log_file_path=path)
+        for path in running_logs.values_list('log_file_path', flat=True).iterator()
+        if path
+    ]
+    LogDeletion.objects.bulk_create(entries, batch_size=BATCH_SIZE)
+    return len(entries)
+
+
+def delete_running_logs(running_logs):
+    """删除运行记录，日志文件交给后台清理。返回删除的运行记录数。"""
+    with transaction.atomic():
+        journal_logs(running_logs)
+        return running_logs.delete()[0]
+
+
+def delete_tasks(tasks):
+    """删除任务（运行记录随之级联删除），日志文件交给后台清理。返回删除的任务数。"""
+    with transaction.atomic():
+        journal_logs(GPUTaskRunningLog.objects.filter(task__in=tasks.values('pk')))
+        return tasks.delete()[1].get(tasks.model._meta.label, 0)
+
+
+def _remove_files(paths):
+    """删除这些日志及其派生文件（压缩归档、行索引、观看名额、指标序列）。
+
+    派生文件都是“<日志>.log<后缀>”，按目录列一次就能找全；逐个调用 remove_log_files 时
+    查找观看名额文件要对每个日志列一遍目录，日志多时是平方复杂度。
+    """
+    by_dir = {}
+    for path in paths:
+        if path.endswith('.log'):
+            by_dir.setdefault(os.path.dirname(path), set()).add(os.path.basename(path))
+        else:
+            remove_log_files(path, forget_search=False)
+    for directory, names in by_dir.items():
+        try:
+            entries = list(os.scandir(directory or '.'))
+        except OSError:
+            continue
+        for entry in entries:
+            i = entry.name.rfind('.log')
+            if i >= 0 and entry.name[:i + 4] in names:
+                try:
+                    os.remove(entry.path)
+                except OSError as exc:
+                    task_logger.warning('remove %s failed: %s', entry.path, exc)
+
+
+def purge_deleted_logs(batch_size=BATCH_SIZE, max_batches=None):
+    """清理删除日志中的文件，返回清理的条数。"""
+    purged = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        entries = list(LogDeletion.objects.order_by('id').values_list('id', 'log_file_path')[:batch_size])
+        if not entries:
+            break
+        paths = sorted({path for _, path in entries})
+        _remove_files(paths)
+        log_search.forget(*paths)
+        LogDeletion.objects.filter(id__in=[pk for pk, _ in entries]).delete()
+        purged += len(entries)
+        batches += 1
+    return purged
+
+
+def _purge():
+    purged = purge_deleted_logs()
+    if purged:
+        task_logger.info('log janitor: removed files of %d deleted runs', purged)
+
+
+PURGE_JOB = PeriodicJob('log-janitor', _purge, janitor_seconds)
+maybe_purge_in_background = PURGE_JOB.maybe_start
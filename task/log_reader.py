@@ -0,0 +1,350 @@
+"""运行日志的按需读取：tail、字节区间、向前/向后翻页与行号跳转。
+
+训练日志可能有数 GB，后台页面只 seek 读取需要的部分，不再整份读入内存。
+已结束运行的日志可能被压缩归档（见 task.log_archive），LogReader.open 会透明切换数据来源。
+行号相关的操作依赖旁路的稀疏行索引（<日志>.idx）：每隔 INDEX_EVERY 行记录一次行首偏移，
+随日志增长增量构建，单次构建有字节预算，避免在一个请求里扫完整个大文件。
+"""
+import itertools
+import os
+import struct
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - 非 POSIX 平台不加锁
+    fcntl = None
+
+from .log_archive import open_log_source
+
+
+DEFAULT_TAIL_LINES = 200
+MAX_PAGE_LINES = 5000
+MAX_PAGE_BYTES = 256 * 1024
+
+INDEX_SUFFIX = '.idx'
+INDEX_EVERY = 1000
+INDEX_BUDGET_BYTES = 256 * 1024 * 1024
+
+_READ_CHUNK = 64 * 1024
+_INDEX_MAGIC = b'GTLIDX1\0'
+# magic, every, indexed_bytes, line_count
+_INDEX_HEADER = struct.Struct('<8sIQQ')
+_INDEX_ENTRY = struct.Struct('<Q')
+
+
+class FileLogSource:
+    """本地文件作为日志字节来源。其他来源（如压缩后的日志）实现同样的 size/read_at/close 即可。"""
+
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, 'rb')
+
+    def size(self):
+        return os.fstat(self._f.fileno()).st_size
+
+    def read_at(self, offset, length):
+        self._f.seek(offset)
+        return self._f.read(length)
+
+    def close(self):
+        self._f.close()
+
+
+class LogPage:
+    """一段按行对齐的日志内容，[start, end) 为字节区间。"""
+
+    __slots__ = ('start', 'end', 'size', 'data', 'first_line')
+
+    def __init__(self, start, end, size, data, first_line=None):
+        self.start = start
+        self.end = end
+        self.size = size
+        self.data = data
+        self.first_line = first_line
+
+    @property
+    def text(self):
+        return self.data.decode('utf-8', errors='replace')
+
+    @property
+    def has_more_before(self):
+        return self.start > 0
+
+    @property
+    def has_more_after(self):
+        return self.end < self.size
+
+    def as_dict(self):
+        return {
+            'start': self.start,
+            'end': self.end,
+            'size': self.size,
+            'first_line': self.first_line,
+            'has_more_before': self.has_more_before,
+            'has_more_after': self.has_more_after,
+            'text': self.text,
+        }
+
+
+def _clamp_lines(lines):
+    try:
+        lines = int(lines)
+    except (TypeError, ValueError):
+        lines = DEFAULT_TAIL_LINES
+    return max(1, min(MAX_PAGE_LINES, lines))
+
+
+class LogReader:
+    def __init__(self, source, index_path=None, index_every=INDEX_EVERY):
+        self.source = source
+        self.index_path = index_path
+        self.index_every = index_every
+
+    @classmethod
+    def open(cls, path, **kwargs):
+        # 已压缩归档的日志透明读取归档；行索引记录的是原文偏移，对两者通用
+        source = open_log_source(path) or FileLogSource(path)
+        return cls(source, index_path=path + INDEX_SUFFIX, **kwargs)
+
+    @property
+    def archived(self):
+        return not isinstance(self.source, FileLogSource)
+
+    def close(self):
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def size(self):
+        return self.source.size()
+
+    # ---- 按字节/按行读取 ----
+
+    def read_range(self, start, end=None, max_bytes=MAX_PAGE_BYTES):
+        size = self.size()
+        start = max(0, min(int(start), size))
+        end = size if end is None else max(start, min(int(end), size))
+        end = min(end, start + max_bytes)
+        return LogPage(start, end, size, self.source.read_at(start, end - start))
+
+    def page_before(self, offset, lines=DEFAULT_TAIL_LINES, max_bytes=MAX_PAGE_BYTES):
+        """读取结束于 offset 的最后 lines 行（“加载更早”）。"""
+        size = self.size()
+        end = max(0, min(int(offset), size))
+        lines = _clamp_lines(lines)
+        start = self._seek_lines_back(end, lines, max_bytes)
+        return LogPage(start, end, size, self.source.read_at(start, end - start))
+
+    def tail(self, lines=DEFAULT_TAIL_LINES, max_bytes=MAX_PAGE_BYTES):
+        return self.page_before(self.size(), lines, max_bytes)
+
+    def page_after(self, offset, lines=DEFAULT_TAIL_LINES, max_bytes=MAX_PAGE_BYTES):
+        """读取起始于 offset 的 lines 行（“加载更多”/跟随）；到达文件末尾时包含不完整的最后一行。"""
+        size = self.size()
+        start = max(0, min(int(offset), size))
+        lines = _clamp_lines(lines)
+        limit = min(size, start + max_bytes)
+        end = self._seek_lines_forward(start, lines, limit)
+        if end == start and limit - start >= max_bytes:
+            # 单行超过 max_bytes，只能截断返回
+            end = limit
+        return LogPage(start, end, size, self.source.read_at(start, end - start))
+
+    def _seek_lines_back(self, end, lines, max_bytes):
+        """从 end 往前数 lines 行，返回第一行的行首偏移。"""
+        floor = max(0, end - max_bytes)
+        pos = end
+        # end 前的换行符是最后一行的结尾，不算作分隔
+        if pos > 0 and self.source.read_at(pos - 1, 1) == b'\n':
+            pos -= 1
+        remaining = lines
+        while pos > floor:
+            chunk_start = max(floor, pos - _READ_CHUNK)
+            chunk = self.source.read_at(chunk_start, pos - chunk_start)
+            idx = len(chunk)
+            while True:
+                idx = chunk.rfind(b'\n', 0, idx)
+                if idx < 0:
+                    break
+                remaining -= 1
+                if remaining == 0:
+                    return chunk_start + idx + 1
+            pos = chunk_start
+        if floor == 0:
+            return 0
+        # 超出字节上限：从上限处对齐到下一行行首（若整段都是一行，则直接截断）
+        head = self.source.read_at(floor, min(_READ_CHUNK, end - floor))
+        idx = head.find(b'\n')
+        if idx < 0 or floor + idx + 1 >= end:
+            return floor
+        return floor + idx + 1
+
+    def _seek_lines_forward(self, start, lines, limit):
+        """从 start 往后数 lines 行，返回最后一行结尾（换行符之后）的偏移，不超过 limit。"""
+        pos = start
+        last_line_end = start
+        remaining = lines
+        while pos < limit:
+            chunk = self.source.read_at(pos, min(_READ_CHUNK, limit - pos))
+            if not chunk:
+                break
+            idx = -1
+            while True:
+                idx = chunk.find(b'\n', idx + 1)
+                if idx < 0:
+                    break
+                last_line_end = pos + idx + 1
+                remaining -= 1
+                if remaining == 0:
+                    return last_line_end
+            pos += len(chunk)
+        if limit >= self.size():
+            # 已到文件末尾：不完整的最后一行也一并返回（日志可能没有结尾换行）
+            return limit
+        return last_line_end
+
+    # ---- 稀疏行索引 ----
+
+    def update_index(self, budget_bytes=INDEX_BUDGET_BYTES):
+        """把行索引推进到最多 budget_bytes 之后，返回索引是否已覆盖整个文件。"""
+        if not self.index_path:
+            return False
+        size = self.size()
+        fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+b') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                header = self._read_header(f)
+                if header is None or header[2] > size:
+                    # 新建，或日志被截断/替换：重建
+                    f.seek(0)
+                    f.truncate()
+                    header = (_INDEX_MAGIC, self.index_every, 0, 0)
+                    f.write(_INDEX_HEADER.pack(*header))
+                _, every, indexed, line_count = header
+                stop = min(size, indexed + budget_bytes)
+                entries = []
+                pos = indexed
+                while pos < stop:
+                    chunk = self.source.read_at(pos, min(_READ_CHUNK * 16, stop - pos))
+                    if not chunk:
+                        break
+                    parts = chunk.split(b'\n')
+                    n = len(parts) - 1
+                    first = every - line_count % every - 1
+                    if first < n:
+                        # 只在检查点处回到 Python 层，逐行累加交给 C 实现
+                        ends = list(itertools.accumulate(map(len, parts[:n])))
+                        entries.extend(pos + ends[i] + i + 1 for i in range(first, n, every))
+                    line_count += n
+                    pos += len(chunk)
+                if entries:
+                    f.seek(0, os.SEEK_END)
+                    f.write(b''.join(_INDEX_ENTRY.pack(e) for e in entries))
+                f.seek(0)
+                f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, every, pos, line_count))
+                return pos >= size
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def index_status(self):
+        """返回 (已索引字节数, 已索引行数)；没有索引时返回 (0, 0)。"""
+        header = self._load_header()
+        if header is None:
+            return 0, 0
+        return header[2], header[3]
+
+    def offset_of_line(self, line_no):
+        """行号（从 0 开始）对应的行首偏移；超出已索引范围时返回 None。"""
+        header = self._load_header()
+        line_no = int(line_no)
+        if header is None or line_no < 0:
+            return None
+        _, every, indexed, line_count = header
+        if line_no > line_count:
+            return None
+        k = line_no // every
+        offset = self._entry(k, every) if k else 0
+        if offset is None:
+            return None
+        skip = line_no - k * every
+        if skip:
+            offset = self._seek_lines_forward(offset, skip, indexed)
+        return offset
+
+    def line_of_offset(self, offset):
+        """offset 所在行的行号（从 0 开始）；超出已索引范围时返回 None。"""
+        header = self._load_header()
+        if header is None:
+            return None
+        _, every, indexed, line_count = header
+        offset = int(offset)
+        if offset < 0 or offset > indexed:
+            return None
+        # 在检查点里二分找到 <= offset 的最后一个
+        lo, hi = 0, line_count // every
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self._entry(mid, every) <= offset:
+                lo = mid
+            else:
+                hi = mid - 1
+        base = self._entry(lo, every) if lo else 0
+        count = 0
+        pos = base
+        while pos < offset:
+            chunk = self.source.read_at(pos, min(_READ_CHUNK, offset - pos))
+            if not chunk:
+                break
+            count += chunk.count(b'\n')
+            pos += len(chunk)
+        return lo * every + count
+
+    def page_at_line(self, line_no, lines=DEFAULT_TAIL_LINES, max_bytes=MAX_PAGE_BYTES):
+        offset = self.offset_of_line(line_no)
+        if offset is None:
+            return None
+        page = self.page_after(offset, lines, max_bytes)
+        page.first_line = int(line_no)
+        return page
+
+    def _entry(self, k, every):
+        with open(self.index_path, 'rb') as f:
+            f.seek(_INDEX_HEADER.size + (k - 1) * _INDEX_ENTRY.size)
+            raw = f.read(_INDEX_ENTRY.size)
+        if len(raw) != _INDEX_ENTRY.size:
+            return None
+        return _INDEX_ENTRY.unpack(raw)[0]
+
+    def _load_header(self):
+        if not self.index_path or not os.path.isfile(self.index_path):
+            return None
+        with open(self.index_path, 'rb') as f:
+            header = self._read_header(f)
+        if header is None or header[2] > self.size():
+            return None
+        return header
+
+    @staticmethod
+    def _read_header(f):
+        f.seek(0)
+        raw = f.read(_INDEX_HEADER.size)
+        if len(raw) != _INDEX_HEADER.size:
+            return None
+        header = _INDEX_HEADER.unpack(raw)
+        if header[0] != _INDEX_MAGIC or header[1] <= 0:
+            return None
+        return header
+
+
+def remove_index(log_file_path):
+    try:
+        os.remove(log_file_path + INDEX_SUFFIX)
+    except OSError:
+        pass
@@ -0,0 +1,356 @@
+"""运行日志全文检索：SQLite FTS5 旁路库（默认 running_log/search.sqlite3）。
+
+- 日志按行对齐切成约 CHUNK_BYTES 的块，每块一条 FTS 记录；FTS 表是无内容表（content=''），
+  只存倒排索引，不重复保存日志原文，命中后按块的字节区间回读日志（含压缩归档）生成片段；
+- 索引按运行记录增量推进（记录已索引到的字节偏移），运行中的日志只索引到最后一个完整行，
+  运行结束且追平后标记完成，不再检查；
+- 数字不进索引（step/loss 等数值会让索引膨胀数倍），按字母词短语检索，生成片段时再按原文核对；
+- 调度器按 GPUTASKER_LOG_SEARCH_INDEX_SECONDS 限频在后台线程推进索引，每次最多读取
+  GPUTASKER_LOG_SEARCH_BUDGET_MB；日志压缩前也会先追平索引。
+
+无内容 FTS 表不能按内容删除记录：删除日志时只删块表，倒排里残留的记录在查询时被过滤，
+`python manage.py log_search rebuild` 可以重建索引回收空间。
+"""
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from base.utils import PeriodicJob, env_float
+from gpu_tasker.settings import RUNNING_LOG_DIR
+
+CHUNK_BYTES = 16 * 1024
+MAX_RESULTS = 1000
+MAX_SNIPPETS = 3
+# 常见词会命中大量块：最多扫描这么多块来凑齐结果
+MAX_SCAN_CHUNKS = 200000
+_READ_BLOCK = 1 << 20
+# 与 FTS 分词一致：字母段（数字、下划线、标点都是分隔符）
+_FTS_TOKEN = re.compile(r'[^\W\d_]+')
+# 生成片段时逐行精确匹配，数字也参与比较
+_LINE_TOKEN = re.compile(r'[^\W_]+')
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS runs ('
+    ' run_id INTEGER PRIMARY KEY, path TEXT NOT NULL,'
+    ' indexed_bytes INTEGER NOT NULL DEFAULT 0, line_count INTEGER NOT NULL DEFAULT 0,'
+    ' done INTEGER NOT NULL DEFAULT 0)',
+    'CREATE INDEX IF NOT EXISTS runs_pending_idx ON runs(done) WHERE done = 0',
+    'CREATE INDEX IF NOT EXISTS runs_path_idx ON runs(path)',
+    # AUTOINCREMENT：块 id 即 FTS rowid，不能复用已删除块的 id，否则残留的倒排会命中新块
+    'CREATE TABLE IF NOT EXISTS chunks ('
+    ' id INTEGER PRIMARY KEY AUTOINCREMENT, run_id INTEGER NOT NULL,'
+    ' start INTEGER NOT NULL, "end" INTEGER NOT NULL, first_line INTEGER NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS chunks_run_idx ON chunks(run_id)',
+    # 数字作为分隔符不进索引：训练日志里大量 step/loss 数值只会让词表膨胀（索引体积约为 1/4）
+    'CREATE VIRTUAL TABLE IF NOT EXISTS chunk_text USING fts5('
+    " text, content='', columnsize=0, tokenize=\"unicode61 separators '0123456789'\")",
+)
+
+task_logger = logging.getLogger('django.task')
+
+
+def enabled():
+    return os.getenv('GPUTASKER_LOG_SEARCH_ENABLED', '1') == '1'
+
+
+def index_seconds():
+    return env_float('GPUTASKER_LOG_SEARCH_INDEX_SECONDS', 30, 1.0)
+
+
+def budget_bytes():
+    return int(env_float('GPUTASKER_LOG_SEARCH_BUDGET_MB', 256) * (1 << 20))
+
+
+def default_db_path():
+    return os.getenv('GPUTASKER_LOG_SEARCH_DB') or os.path.join(RUNNING_LOG_DIR, 'search.sqlite3')
+
+
+def parse_query(text):
+    """把搜索框输入转成 FTS5 查询：整体按短语匹配，用 | 分隔多个候选短语（任一命中即可）。
+
+    数字不进索引，索引只按字母词匹配，片段阶段再按含数字的完整短语逐行核对。
+    返回 (FTS5 查询串, 每个短语的小写词序列)；没有可检索的词时返回 (None, [])。
+    """
+    fts_phrases = []
+    phrases = []
+    for part in text.split('|'):
+        fts_tokens = _FTS_TOKEN.findall(part)
+        if fts_tokens:
+            # 词只含字母，不会包含双引号等 FTS5 语法字符
+            fts_phrases.append('"{}"'.format(' '.join(fts_tokens)))
+            phrases.append([t.lower() for t in _LINE_TOKEN.findall(part)])
+    if not fts_phrases:
+        return None, []
+    return ' OR '.join(fts_phrases), phrases
+
+
+def _line_matches(line, phrases):
+    tokens = [t.lower() for t in _LINE_TOKEN.findall(line)]
+    for phrase in phrases:
+        n = len(phrase)
+        for i in range(len(tokens) - n + 1):
+            if tokens[i:i + n] == phrase:
+                return True
+    return False
+
+
+def _split_chunks(data, base, first_line):
+    """把按行对齐的 data 切成约 CHUNK_BYTES 的块，产出 (start, end, first_line, text)。"""
+    pos = 0
+    line = first_line
+    while pos < len(data):
+        cut = data.find(b'\n', pos + CHUNK_BYTES - 1)
+        cut = len(data) if cut < 0 else cut + 1
+        chunk = data[pos:cut]
+        yield base + pos, base + cut, line, chunk.decode('utf-8', errors='replace')
+        line += chunk.count(b'\n')
+        pos = cut
+
+
+class LogSearchIndex:
+    def __init__(self, path=None):
+        self.path = default_db_path() if path is None else path
+        self._conn = None
+
+    def connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for sql in _SCHEMA:
+                conn.execute(sql)
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ---- 写入 ----
+
+    def index_pending(self, budget=None):
+        """发现新的运行记录并推进未完成的索引，返回 (本次索引的字节数, 本次完成的运行数)。"""
+        from .log_reader import LogReader
+        from .models import GPUTaskRunningLog
+
+        budget = budget_bytes() if budget is None else budget
+        conn = self.connect()
+        watermark = conn.execute('SELECT COALESCE(MAX(run_id), 0) FROM runs').fetchone()[0]
+        new_runs = list(
+            GPUTaskRunningLog.objects.filter(id__gt=watermark).order_by('id').values_list('id', 'log_file_path')
+        )
+        if new_runs:
+            conn.executemany('INSERT OR IGNORE INTO runs(run_id, path) VALUES (?, ?)', new_runs)
+
+        pending = conn.execute('SELECT run_id, path FROM runs WHERE done = 0 ORDER BY run_id').fetchall()
+        running = set()
+        existing = set()
+        ids = [run_id for run_id, _ in pending]
+        for i in range(0, len(ids), 500):
+            for run_id, status in GPUTaskRunningLog.objects.filter(id__in=ids[i:i + 500]).values_list('id', 'status'):
+                existing.add(run_id)
+                if status in (1, -2):
+                    running.add(run_id)
+
+        indexed_total = 0
+        finished = 0
+        for run_id, path in pending:
+            if indexed_total >= budget:
+                break
+            if run_id not in existing:
+                # 运行记录已删除
+                self._drop_run(conn, run_id)
+                continue
+            try:
+                reader = LogReader.open(path)
+            except OSError:
+                if run_id not in running:
+                    conn.execute('UPDATE runs SET done = 1 WHERE run_id = ?', (run_id,))
+                    finished += 1
+                continue
+            with reader:
+                n, complete = self._index_run(conn, run_id, reader, budget - indexed_total, run_id not in running)
+            indexed_total += n
+            finished += complete
+        return indexed_total, finished
+
+    def _index_run(self, conn, run_id, reader, budget, final):
+        indexed = 0
+        while indexed < budget:
+            # 每读一段提交一个事务，并在事务里重读进度，多进程同时索引也不会重复写入
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                offset, line_count = conn.execute(
+                    'SELECT indexed_bytes, line_count FROM runs WHERE run_id = ?', (run_id,)
+                ).fetchone()
+                size = reader.size()
+                data = reader.source.read_at(offset, min(_READ_BLOCK, size - offset)) if size > offset else b''
+                cut = data.rfind(b'\n') + 1
+                if cut == 0 and data and (len(data) >= _READ_BLOCK or final):
+                    # 超长的一行，或运行结束后没有结尾换行的最后一行
+                    cut = len(data)
+                data = data[:cut]
+                if not data:
+                    done = final and offset >= size
+                    if done:
+                        conn.execute('UPDATE runs SET done = 1 WHERE run_id = ?', (run_id,))
+                    conn.execute('COMMIT')
+                    return indexed, int(done)
+                for start, end, first_line, text in _split_chunks(data, offset, line_count):
+                    cur = conn.execute(
+                        'INSERT INTO chunks(run_id, start, "end", first_line) VALUES (?, ?, ?, ?)',
+                        (run_id, start, end, first_line),
+                    )
+                    conn.execute('INSERT INTO chunk_text(rowid, text) VALUES (?, ?)', (cur.lastrowid, text))
+                conn.execute(
+                    'UPDATE runs SET indexed_bytes = ?, line_count = ? WHERE run_id = ?',
+                    (offset + len(data), line_count + data.count(b'\n'), run_id),
+                )
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            indexed += len(data)
+        return indexed, 0
+
+    @staticmethod
+    def _drop_run(conn, run_id):
+        conn.execute('DELETE FROM chunks WHERE run_id = ?', (run_id,))
+        conn.execute('DELETE FROM runs WHERE run_id = ?', (run_id,))
+
+    def forget(self, log_file_path):
+        """日志被删除：丢弃其索引块，并标记为已完成，不再重新索引。"""
+        conn = self.connect()
+        rows = conn.execute('SELECT run_id FROM runs WHERE path = ?', (log_file_path,)).fetchall()
+        for (run_id,) in rows:
+            conn.execute('DELETE FROM chunks WHERE run_id = ?', (run_id,))
+            conn.execute('UPDATE runs SET done = 1 WHERE run_id = ?', (run_id,))
+
+    def rebuild(self):
+        """清空并从头重建（回收删除日志后残留的倒排记录）。"""
+        conn = self.connect()
+        conn.execute("INSERT INTO chunk_text(chunk_text) VALUES ('delete-all')")
+        conn.execute('DELETE FROM chunks')
+        conn.execute('UPDATE runs SET indexed_bytes = 0, line_count = 0, done = 0')
+        conn.execute('VACUUM')
+
+    # ---- 查询 ----
+
+    def search(self, text, limit=MAX_RESULTS):
+        """返回按时间倒序的 {run_id: [(start, end, first_line), ...]}，每个运行最多 MAX_SNIPPETS 个块。"""
+        query, _ = parse_query(text)
+        if query is None:
+            return OrderedDict()
+        conn = self.connect()
+        # FTS5 原生支持按 rowid 倒序扫描，不需要对全部命中排序；块 id 越大越新。
+        # 边扫边去重，凑够 limit 个运行即停
+        cur = conn.execute(
+            'SELECT c.run_id, c.start, c."end", c.first_line'
+            ' FROM chunk_text CROSS JOIN chunks c ON c.id = chunk_text.rowid'
+            ' WHERE chunk_text MATCH ? ORDER BY chunk_text.rowid DESC',
+            (query,),
+        )
+        hits = OrderedDict()
+        scanned = 0
+        try:
+            while scanned < MAX_SCAN_CHUNKS:
+                rows = cur.fetchmany(1000)
+                if not rows:
+                    break
+                scanned += len(rows)
+                for run_id, start, end, first_line in rows:
+                    chunks = hits.get(run_id)
+                    if chunks is None:
+                        if len(hits) >= limit:
+                            return hits
+                        chunks = hits[run_id] = []
+                    if len(chunks) < MAX_SNIPPETS:
+                        chunks.append((start, end, first_line))
+        finally:
+            cur.close()
+        return hits
+
+    def stats(self):
+        conn = self.connect()
+        runs, done, indexed = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(done), 0), COALESCE(SUM(indexed_bytes), 0) FROM runs'
+        ).fetchone()
+        chunks = conn.execute('SELECT COUNT(*) FROM chunks').fetchone()[0]
+        return {'runs': runs, 'done': done, 'indexed_bytes': indexed, 'chunks': chunks}
+
+
+def snippets(log_file_path, chunks, text, max_lines=MAX_SNIPPETS):
+    """从命中的块里找出匹配的行，返回 [(行号（从 0 开始）, 行内容), ...]。"""
+    from .log_reader import LogReader
+
+    _, phrases = parse_query(text)
+    result = []
+    try:
+        reader = LogReader.open(log_file_path)
+    except OSError:
+        return result
+    with reader:
+        for start, end, first_line in chunks:
+            data = reader.source.read_at(start, end - start).decode('utf-8', errors='replace')
+            for i, line in enumerate(data.split('\n')):
+                if _line_matches(line, phrases):
+                    result.append((first_line + i, line))
+                    if len(result) >= max_lines:
+                        return result
+    return result
+
+
+def forget(*log_file_paths):
+    """丢弃这些日志的索引；多个路径在一个事务里处理（日志清理线程批量调用）。"""
+    if not log_file_paths or not enabled() or not os.path.exists(default_db_path()):
+        return
+    try:
+        with LogSearchIndex() as index:
+            conn = index.connect()
+            conn.execute('BEGIN')
+            for log_file_path in log_file_paths:
+                index.forget(log_file_path)
+            conn.execute('COMMIT')
+    except sqlite3.Error as exc:
+        task_logger.error('log search forget %d logs failed: %s', len(log_file_paths), exc)
+
+
+_index_lock = threading.Lock()
+
+
+def run_indexer(budget=None):
+    """推进一次索引；同一进程内串行执行（后台线程、日志压缩前都会调用）。"""
+    if not enabled():
+        return 0, 0
+    with _index_lock:
+        with LogSearchIndex() as index:
+            return index.index_pending(budget)
+
+
+def _index():
+    started = time.monotonic()
+    indexed, finished = run_indexer()
+    if indexed:
+        task_logger.info('log search: indexed %d bytes, %d runs finished in %.1fs',
+                         indexed, finished, time.monotonic() - started)
+
+
+def _can_index():
+    # 日志压缩前正在同步推进索引时跳过本轮
+    return enabled() and not _index_lock.locked()
+
+
+INDEX_JOB = PeriodicJob('log-search-indexer', _index, index_seconds, enabled=_can_index)
+maybe_index_in_background = INDEX_JOB.maybe_start
@@ -0,0 +1,293 @@
+"""运行日志的实时推送（Server-Sent Events）。
+
+- 客户端通过 Last-Event-ID（或 offset 参数）给出已读到的字节偏移，断线重连后从该处续传；
+- 等待新内容时优先用 inotify 在文件增长时唤醒，不可用时退化为 stat 轮询，都不会重读整个文件；
+- 单次响应时长不超过 GPUTASKER_LOG_STREAM_SECONDS（默认 20 秒，小于 uwsgi harakiri），
+  到时通知客户端重连，避免长连接长期占住 uwsgi worker；
+- 每份日志的同时观看数受 GPUTASKER_LOG_STREAM_MAX_WATCHERS 限制（默认 3）；
+  全站同时推送的连接数受 GPUTASKER_LOG_STREAM_MAX_STREAMS 限制（默认 2，0 表示不限）。每个连接在推送期间
+  占住一个同步 uwsgi worker（默认 5 个），总数要明显小于 worker 数，其余 worker 才能照常处理页面与上报；
+- 名额都用 flock 槽位文件实现，跨 uwsgi 进程生效，进程退出时自动释放。
+"""
+import ctypes
+import ctypes.util
+import errno
+import glob
+import json
+import os
+import select
+import struct
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - 非 POSIX 平台不限制观看数
+    fcntl = None
+
+from django.conf import settings
+
+from base.utils import env_float
+
+from .log_reader import LogReader, MAX_PAGE_BYTES, MAX_PAGE_LINES
+
+WATCH_SUFFIX = '.watch'
+# 全站推送名额的槽位文件（<RUNNING_LOG_DIR>/.log_stream.watch.<n>）
+STREAM_SLOT_NAME = '.log_stream'
+KEEPALIVE_SECONDS = 10
+RETRY_MILLISECONDS = 1000
+
+
+def stream_seconds():
+    return env_float('GPUTASKER_LOG_STREAM_SECONDS', 20)
+
+
+def max_watchers():
+    return int(env_float('GPUTASKER_LOG_STREAM_MAX_WATCHERS', 3))
+
+
+def max_streams():
+    return int(env_float('GPUTASKER_LOG_STREAM_MAX_STREAMS', 2))
+
+
+def poll_seconds():
+    return max(0.05, env_float('GPUTASKER_LOG_STREAM_POLL_SECONDS', 0.5))
+
+
+class WatcherSlot:
+    """一份日志的一个观看名额。"""
+
+    def __init__(self, fd, path):
+        self._fd = fd
+        self.path = path
+
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+
+def acquire_watcher_slot(log_file_path, limit=None):
+    """抢占一个观看名额，名额已满时返回 None。"""
+    limit = max_watchers() if limit is None else limit
+    if fcntl is None or limit <= 0:
+        return WatcherSlot(None, None)
+    for i in range(limit):
+        path = '{}{}.{:d}'.format(log_file_path, WATCH_SUFFIX, i)
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as exc:
+            os.close(fd)
+            if exc.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                continue
+            raise
+        return WatcherSlot(fd, path)
+    return None
+
+
+def acquire_stream_slot(limit=None):
+    """抢占一个全站推送名额，名额已满时返回 None。"""
+    limit = max_streams() if limit is None else limit
+    return acquire_watcher_slot(os.path.join(settings.RUNNING_LOG_DIR, STREAM_SLOT_NAME), limit)
+
+
+def remove_watcher_slots(log_file_path):
+    for path in glob.glob(glob.escape(log_file_path + WATCH_SUFFIX) + '.*'):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class _Inotify:
+    """基于 ctypes 的最小 inotify 封装，只用来“文件有写入时醒来”。"""
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVE_SELF = 0x00000800
+    IN_DELETE_SELF = 0x00000400
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    _EVENT = struct.Struct('iIII')
+
+    _libc = None
+
+    @classmethod
+    def _load(cls):
+        if cls._libc is None:
+            name = ctypes.util.find_library('c')
+            libc = ctypes.CDLL(name, use_errno=True) if name else None
+            if libc is None or not hasattr(libc, 'inotify_init1'):
+                cls._libc = False
+            else:
+                cls._libc = libc
+        return cls._libc or None
+
+    def __init__(self, path):
+        libc = self._load()
+        if libc is None:
+            raise OSError('inotify unavailable')
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVE_SELF | self.IN_DELETE_SELF
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, 'inotify_add_watch failed')
+
+    def wait(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class GrowthWaiter:
+    """等待文件变大：inotify 可用时事件唤醒，否则按 poll_seconds 轮询文件大小。"""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            self._inotify = _Inotify(path)
+        except OSError:
+            self._inotify = None
+
+    def wait(self, size, timeout):
+        """等到文件大小不等于 size 或超时，返回是否有变化。"""
+        deadline = time.monotonic() + timeout
+        while True:
+            if self._current_size() != size:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self._inotify is not None:
+                # inotify 事件只是提示，醒来后仍以文件大小为准
+                self._inotify.wait(min(remaining, KEEPALIVE_SECONDS))
+            else:
+                time.sleep(min(remaining, poll_seconds()))
+
+    def _current_size(self):
+        try:
+            return os.stat(self.path).st_size
+        except OSError:
+            return -1
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+
+def _utf8_safe_end(data):
+    """去掉末尾被截断的 UTF-8 多字节字符，返回可安全解码的长度。"""
+    n = len(data)
+    for back in range(1, min(4, n) + 1):
+        byte = data[n - back]
+        if byte < 0x80:
+            return n
+        if byte >= 0xC0:
+            need = 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+            return n if back >= need else n - back
+    return n
+
+
+def _event(name, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append('id: {}'.format(event_id))
+    lines.append('event: {}'.format(name))
+    lines.append('data: {}'.format(json.dumps(data, ensure_ascii=False)))
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+
+class LogEventStream:
+    """SSE 事件流，交给 StreamingHttpResponse。
+
+    以对象而非裸生成器交出，是为了让 Django 在响应关闭时调用 close()：
+    即使客户端在第一个字节前就断开（生成器从未启动），持有的名额（slots）也会被释放。
+    """
+
+    def __init__(self, log_file_path, offset, slots=(), live=True, duration=None):
+        self.log_file_path = log_file_path
+        self.offset = max(0, int(offset))
+        self.slots = list(slots)
+        self.live = live
+        self.duration = stream_seconds() if duration is None else duration
+        self._gen = None
+
+    def __iter__(self):
+        self._gen = self._events()
+        return self._gen
+
+    def close(self):
+        try:
+            if self._gen is not None:
+                self._gen.close()
+        finally:
+            slots, self.slots = self.slots, []
+            for slot in slots:
+                slot.release()
+
+    def _events(self):
+        yield 'retry: {:d}\n\n'.format(RETRY_MILLISECONDS).encode('ascii')
+        try:
+            reader = LogReader.open(self.log_file_path)
+        except OSError:
+            yield _event('end', {'reason': 'log_unavailable'})
+            return
+        # 已归档的日志不会再增长
+        live = self.live and not reader.archived
+        waiter = GrowthWaiter(self.log_file_path)
+        deadline = time.monotonic() + self.duration
+        offset = self.offset
+        try:
+            while True:
+                size = reader.size()
+                if size < offset:
+                    # 日志被截断/替换：从头重新推送
+                    offset = 0
+                    yield _event('reset', {'size': size}, event_id=0)
+                if size > offset:
+                    page = reader.page_after(offset, MAX_PAGE_LINES, MAX_PAGE_BYTES)
+                    end = page.start + _utf8_safe_end(page.data)
+                    if end > offset:
+                        data = page.data[:end - page.start]
+                        yield _event(
+                            'log',
+                            {'start': offset, 'end': end, 'size': size, 'text': data.decode('utf-8', errors='replace')},
+                            event_id=end,
+                        )
+                        offset = end
+                        # 追赶积压内容时不等待，但同样受总时长约束
+                        if time.monotonic() < deadline:
+                            continue
+                if not live and offset >= size:
+                    yield _event('end', {'reason': 'finished', 'offset': offset})
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if not waiter.wait(size, min(remaining, KEEPALIVE_SECONDS)):
+                    # 注释行作为心跳，防止代理断开空闲连接
+                    yield b': keepalive\n\n'
+        finally:
+            waiter.close()
+            reader.close()
+        yield _event('reconnect', {'offset': offset}, event_id=offset)
@@ -0,0 +1,242 @@
+"""任务输出落盘：按字节块读取、缓冲写入、按时间/大小批量刷盘。
+
+旧实现按行读取文本、每行 flush 一次，tqdm 一类每秒重绘上千次的进度条会让
+master 在几百个并发任务上产生大量 syscall。这里：
+
+- 从管道按块读取字节（os.read），不做逐行解码；
+- 内容先攒在内存里，超过 GPUTASKER_LOG_FLUSH_BYTES（默认 64KB）
+  或距上次刷盘超过 GPUTASKER_LOG_FLUSH_SECONDS（默认 1 秒）时一次性写入；
+- 折叠回车重绘：同一行里以 \\r 覆盖的旧内容直接丢弃，只保留最终状态；
+  长时间不换行的进度条每个刷盘周期最多落一次快照，便于实时查看进度。
+
+写盘后可选地把“已落盘的输入行数”记到 <日志>.lines（OutputCheckpoint），
+调度器重启后据此从远端输出副本的下一行续接（见 task.supervisor）。
+"""
+import logging
+import os
+import re
+import select
+import time
+
+from base.utils import env_float
+
+_READ_SIZE = 64 * 1024
+# 一行里最后一个重绘 \r 及其之前的内容（\r\n 是正常换行，不算重绘）；
+# 从行首一次匹配到最后一个 \r，避免逐个位置回溯
+_REDRAW = re.compile(rb'(?m)^(?:[^\n]*\r(?!\n))+')
+# 单行最长保留这么多字节，超过则直接落盘，避免无换行输出撑爆内存
+_MAX_PENDING = 1024 * 1024
+
+
+def flush_seconds():
+    return env_float('GPUTASKER_LOG_FLUSH_SECONDS', 1.0)
+
+
+def flush_bytes():
+    return int(env_float('GPUTASKER_LOG_FLUSH_BYTES', 64 * 1024))
+
+
+def _collapse(data):
+    if b'\r' not in data:
+        return data
+    return _REDRAW.sub(b'', data).replace(b'\r\n', b'\n')
+
+
+class BufferedLogWriter:
+    """把字节流折叠回车重绘后缓冲写入二进制文件对象。"""
+
+    def __init__(self, out, flush_interval=None, flush_size=None, clock=time.monotonic, observer=None):
+        self.out = out
+        # 每次写盘前收到即将写出的字节（已折叠重绘、按行对齐），用于指标提取
+        self.observer = observer
+        self.flush_interval = flush_seconds() if flush_interval is None else flush_interval
+        self.flush_size = flush_bytes() if flush_size is None else flush_size
+        self._clock = clock
+        self._buf = bytearray()
+        # 当前还没换行的一行（已折叠重绘）
+        self._pending = b''
+        self._pending_redrawn = False
+        self._snapshot = None
+        self._last_flush = clock()
+        self.bytes_in = 0
+        # 收到的完整输入行数（按原始输入的换行计，不受折叠重绘与快照影响）
+        self.lines_in = 0
+        self.bytes_out = 0
+        self.writes = 0
+
+    def feed(self, data):
+        if not data:
+            return
+        self.bytes_in += len(data)
+        self.lines_in += data.count(b'\n')
+        idx = data.rfind(b'\n')
+        if idx < 0:
+            self._feed_partial(data)
+        else:
+            head = self._pending + data[:idx + 1]
+            if self._pending_redrawn or b'\r' in head:
+                head = _collapse(head)
+            if self._snapshot is not None:
+                # 已经作为快照落过盘的最终状态不再重复写
+                nl = head.find(b'\n')
+                if head[:nl] == self._snapshot:
+                    head = head[nl + 1:]
+            self._buf += head
+            self._pending = b''
+            self._pending_redrawn = False
+            self._snapshot = None
+            self._feed_partial(data[idx + 1:])
+        if len(self._buf) >= self.flush_size:
+            self.flush()
+        elif self._clock() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def _feed_partial(self, data):
+        if not data:
+            return
+        pending = self._pending + data
+        if b'\r' in pending:
+            # 末尾的 \r 可能是被切开的 \r\n，先留着等下一块数据
+            keep_cr = pending.endswith(b'\r')
+            body = pending[:-1] if keep_cr else pending
+            cut = body.rfind(b'\r')
+            if cut >= 0:
+                body = body[cut + 1:]
+                self._pending_redrawn = True
+            pending = body + b'\r' if keep_cr else body
+        if len(pending) > _MAX_PENDING:
+            self._buf += pending
+            pending = b''
+            self._pending_redrawn = False
+            self._snapshot = None
+        self._pending = pending
+
+    def flush(self):
+        """写出缓冲内容；重绘中的进度条按当前状态落一行快照。"""
+        if self._pending_redrawn:
+            current = self._pending.rstrip(b'\r')
+            if current and current != self._snapshot:
+                self._buf += current + b'\n'
+                self._snapshot = current
+        if self._buf:
+            if self.observer is not None:
+                try:
+                    self.observer(self._buf)
+                except Exception:
+                    # 观察者出错不能影响日志落盘
+                    logging.getLogger('django.task').exception('log observer failed, disabled')
+                    self.observer = None
+            self.out.write(self._buf)
+            self.bytes_out += len(self._buf)
+            self.writes += 1
+            self._buf = bytearray()
+        self._last_flush = self._clock()
+
+    def time_to_flush(self):
+        """距离下一次定时刷盘的秒数；没有待写内容时返回 None（可以无限期等待）。"""
+        if not self._buf and not self._pending_redrawn:
+            return None
+        return max(0.0, self.flush_interval - (self._clock() - self._last_flush))
+
+    def close(self):
+        # 进程结束：不完整的最后一行也要写出去
+        if self._pending:
+            # 先去掉末尾的 \r 再折叠，否则最后一个进度条状态会被当作重绘掉的一段丢弃
+            tail = _collapse(self._pending.rstrip(b'\r'))
+            if tail and tail != self._snapshot:
+                self._buf += tail + b'\n'
+            self._pending = b''
+            self._pending_redrawn = False
+        self.flush()
+
+
+CHECKPOINT_SUFFIX = '.lines'
+CHECKPOINT_SECONDS = 5.0
+
+
+def checkpoint_path(log_path):
+    return log_path + CHECKPOINT_SUFFIX
+
+
+def read_checkpoint(log_path):
+    """日志已落盘的远端输出行数；没有记录时返回 0。"""
+    try:
+        with open(checkpoint_path(log_path)) as f:
+            return max(0, int(f.read().strip() or 0))
+    except (OSError, ValueError):
+        return 0
+
+
+class OutputCheckpoint:
+    """写盘后记录已落盘的远端输出行数：base + writer.lines_in。
+
+    最多每 interval 秒写一次，因此续接时可能重复最后几秒的输出，但不会丢。
+    首次启动时首行是调度标记（不在远端输出副本里），base 传 -1。
+    """
+
+    def __init__(self, log_path, base=0, interval=CHECKPOINT_SECONDS, clock=time.monotonic):
+        self.path = checkpoint_path(log_path)
+        self.base = base
+        self.interval = interval
+        self._clock = clock
+        self._last = None
+        self._written = None
+
+    def __call__(self, writer, force=False):
+        lines = max(0, self.base + writer.lines_in)
+        if lines == self._written:
+            return
+        now = self._clock()
+        if not force and self._last is not None and now - self._last < self.interval:
+            return
+        try:
+            with open(self.path, 'w') as f:
+                f.write(str(lines))
+        except OSError:
+            return
+        self._last = now
+        self._written = lines
+
+
+def stream_to_file(fd, path, first_line=b'', writer_kwargs=None, observer=None, on_first_output=None,
+                   checkpoint=None):
+    """把管道 fd 的输出持续写入 path，直到 EOF。返回 BufferedLogWriter（含统计）。
+
+    on_first_output：首次从管道读到输出（first_line 之后）时调用一次；
+    checkpoint：每次写盘后以 writer 调用（见 OutputCheckpoint），结束时带 force=True 再调用一次。
+    """
+    with open(path, 'ab', buffering=0) as out:
+        writer = BufferedLogWriter(out, observer=observer, **(writer_kwargs or {}))
+        if first_line:
+            writer.feed(first_line if first_line.endswith(b'\n') else first_line + b'\n')
+        writes = writer.writes
+        while True:
+            if checkpoint is not None and writer.writes != writes:
+                writes = writer.writes
+                checkpoint(writer)
+            timeout = writer.time_to_flush()
+            if timeout is not None and timeout > 0:
+                ready, _, _ = select.select([fd], [], [], timeout)
+                if not ready:
+                    writer.flush()
+                    continue
+            elif timeout is not None:
+                writer.flush()
+                continue
+            try:
+                data = os.read(fd, _READ_SIZE)
+            except InterruptedError:
+                continue
+            if not data:
+                break
+            if on_first_output is not None:
+                callback, on_first_output = on_first_output, None
+                try:
+                    callback()
+                except Exception:
+                    logging.getLogger('django.task').exception('first output callback failed')
+            writer.feed(data)
+        writer.close()
+    if checkpoint is not None:
+        checkpoint(writer, force=True)
+    return writer
@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from base.benchmark import format_latency_ms
+from task.log_archive import archive_path, compress_log
+from task.log_reader import LogReader, DEFAULT_TAIL_LINES
+
+
+class Command(BaseCommand):
+    help = 'Benchmark finished-log compression: disk saved and viewer read latency (plain file vs archive).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='', help='Existing log file (copied, not modified); default: generate one.')
+        parser.add_argument('--size-mb', type=float, default=1024.0, help='Size of the generated log (MB).')
+        parser.add_argument('--reads', type=int, default=50, help='Random reads per operation.')
+
+    def handle(self, *args, **options):
+        tmpdir = tempfile.mkdtemp(prefix='gputasker_bench_archive_')
+        path = os.path.join(tmpdir, 'bench.log')
+        try:
+            if options['path']:
+                shutil.copyfile(options['path'], path)
+            else:
+                self._generate(path, int(options['size_mb'] * (1 << 20)))
+            size = os.path.getsize(path)
+            with LogReader.open(path) as reader:
+                while not reader.update_index():
+                    pass
+            plain = self._bench_reads(path, options['reads'])
+
+            t0 = time.perf_counter()
+            original, compressed = compress_log(path)
+            elapsed = time.perf_counter() - t0
+            self.stdout.write('[compress] {:.1f} MB -> {:.1f} MB ({:.1f}% saved, ratio {:.1f}x) in {:.2f}s ({:.0f} MB/s)'.format(
+                original / (1 << 20), compressed / (1 << 20), 100.0 * (1 - compressed / original),
+                original / compressed, elapsed, size / (1 << 20) / elapsed,
+            ))
+            assert os.path.exists(archive_path(path)) and not os.path.exists(path)
+            archived = self._bench_reads(path, options['reads'])
+            for name in plain:
+                self.stdout.write('[{}] plain {} | archive {}'.format(
+                    name, format_latency_ms(plain[name]), format_latency_ms(archived[name])))
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    @staticmethod
+    def _bench_reads(path, reads):
+        rng = random.Random(1)
+        result = {'tail': [], 'earlier': [], 'range': [], 'goto': []}
+        for _ in range(reads):
+            # 每次都重新打开：与后台页面的每个请求一致，不依赖进程内缓存
+            t0 = time.perf_counter()
+            with LogReader.open(path) as reader:
+                page = reader.tail(DEFAULT_TAIL_LINES)
+            result['tail'].append(time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            with LogReader.open(path) as reader:
+                reader.page_before(page.start, DEFAULT_TAIL_LINES)
+            result['earlier'].append(time.perf_counter() - t0)
+
+            offset = rng.randrange(page.size)
+            t0 = time.perf_counter()
+            with LogReader.open(path) as reader:
+                reader.page_after(offset, DEFAULT_TAIL_LINES)
+            result['range'].append(time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            with LogReader.open(path) as reader:
+                line_count = reader.index_status()[1]
+                reader.page_at_line(rng.randrange(line_count), DEFAULT_TAIL_LINES)
+            result['goto'].append(time.perf_counter() - t0)
+        return result
+
+    @staticmethod
+    def _generate(path, size):
+        rng = random.Random(0)
+        block_lines = []
+        for i in range(20000):
+            if i % 10 == 0:
+                block_lines.append('Epoch {}: 100%|##########| 500/500 [01:23<00:00, 6.01it/s, loss={:.4f}]'.format(
+                    i // 10, rng.random()))
+            else:
+                block_lines.append('step {} loss={:.5f} lr={:.2e} grad_norm={:.3f} {}'.format(
+                    i, rng.random(), rng.random() * 1e-3, rng.random() * 10, 'x' * rng.randint(0, 80)))
+        block = ('\n'.join(block_lines) + '\n').encode()
+        with open(path, 'wb') as f:
+            written = 0
+            while written < size:
+                f.write(block)
+                written += len(block)
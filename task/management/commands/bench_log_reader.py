@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import os
+import random
+import resource
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from base.benchmark import format_latency_ms
+from task.log_reader import LogReader, DEFAULT_TAIL_LINES, INDEX_BUDGET_BYTES, INDEX_SUFFIX
+
+
+def _max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the running-log viewer on a large log file (tail, paging, line index, line jumps).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='', help='Existing log file; default: generate one in a temp dir.')
+        parser.add_argument('--size-gb', type=float, default=5.0, help='Size of the generated log (GB).')
+        parser.add_argument('--pages', type=int, default=20, help='"Load earlier" pages to read after the tail.')
+        parser.add_argument('--jumps', type=int, default=50, help='Random line jumps after the index is built.')
+        parser.add_argument('--keep', action='store_true', help='Keep the generated log file.')
+        parser.add_argument(
+            '--compare-full-read',
+            action='store_true',
+            help='Also time the old behaviour (read the whole file into memory). Needs RAM >= log size.',
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+        generated = not path
+        if generated:
+            fd, path = tempfile.mkstemp(prefix='gputasker_bench_', suffix='.log')
+            os.close(fd)
+            t0 = time.perf_counter()
+            self._generate(path, int(options['size_gb'] * (1 << 30)))
+            self.stdout.write('[generate] {} {:.2f} GB in {:.1f}s'.format(
+                path, os.path.getsize(path) / (1 << 30), time.perf_counter() - t0))
+        try:
+            self._bench(path, options)
+        finally:
+            if generated and not options['keep']:
+                for p in (path, path + INDEX_SUFFIX):
+                    try:
+                        os.remove(p)
+                    except OSError:
+                        pass
+
+    @staticmethod
+    def _generate(path, size):
+        rng = random.Random(0)
+        block_lines = []
+        for i in range(20000):
+            if i % 10 == 0:
+                block_lines.append('Epoch {}: 100%|##########| 500/500 [01:23<00:00, 6.01it/s, loss={:.4f}]'.format(
+                    i // 10, rng.random()))
+            else:
+                block_lines.append('step {} loss={:.5f} lr={:.2e} grad_norm={:.3f} {}'.format(
+                    i, rng.random(), rng.random() * 1e-3, rng.random() * 10, 'x' * rng.randint(0, 80)))
+        block = ('\n'.join(block_lines) + '\n').encode()
+        with open(path, 'wb') as f:
+            written = 0
+            while written < size:
+                f.write(block)
+                written += len(block)
+
+    def _bench(self, path, options):
+        size = os.path.getsize(path)
+        rss_before = _max_rss_mb()
+
+        t0 = time.perf_counter()
+        with LogReader.open(path) as reader:
+            page = reader.tail(DEFAULT_TAIL_LINES)
+        self.stdout.write('[tail] open + last {} lines: {:.3f}ms ({} bytes)'.format(
+            DEFAULT_TAIL_LINES, (time.perf_counter() - t0) * 1000, len(page.data)))
+
+        latencies = []
+        with LogReader.open(path) as reader:
+            start = page.start
+            for _ in range(options['pages']):
+                t0 = time.perf_counter()
+                p = reader.page_before(start, DEFAULT_TAIL_LINES)
+                latencies.append(time.perf_counter() - t0)
+                start = p.start
+        self.stdout.write('[earlier] {} pages x {} lines: {}'.format(
+            options['pages'], DEFAULT_TAIL_LINES, format_latency_ms(latencies)))
+
+        rng = random.Random(1)
+        latencies = []
+        with LogReader.open(path) as reader:
+            for _ in range(options['jumps']):
+                offset = rng.randrange(size)
+                t0 = time.perf_counter()
+                reader.page_after(offset, DEFAULT_TAIL_LINES)
+                latencies.append(time.perf_counter() - t0)
+        self.stdout.write('[range] random offset + {} lines: {}'.format(DEFAULT_TAIL_LINES, format_latency_ms(latencies)))
+
+        # 行索引按请求预算增量构建：统计每次增量的耗时与总耗时
+        try:
+            os.remove(path + INDEX_SUFFIX)
+        except OSError:
+            pass
+        steps = []
+        with LogReader.open(path) as reader:
+            done = False
+            while not done:
+                t0 = time.perf_counter()
+                done = reader.update_index(INDEX_BUDGET_BYTES)
+                steps.append(time.perf_counter() - t0)
+            indexed, lines = reader.index_status()
+        total = sum(steps)
+        self.stdout.write(
+            '[index] {} lines, {} steps of {} MB: total {:.2f}s ({:.0f} MB/s), per step {}, sidecar {} KB'.format(
+                lines, len(steps), INDEX_BUDGET_BYTES >> 20, total, size / (1 << 20) / total if total else 0.0,
+                format_latency_ms(steps), os.path.getsize(path + INDEX_SUFFIX) >> 10,
+            )
+        )
+
+        latencies = []
+        with LogReader.open(path) as reader:
+            t0 = time.perf_counter()
+            reader.update_index()
+            noop = time.perf_counter() - t0
+            for _ in range(options['jumps']):
+                line_no = rng.randrange(lines)
+                t0 = time.perf_counter()
+                reader.page_at_line(line_no, DEFAULT_TAIL_LINES)
+                latencies.append(time.perf_counter() - t0)
+        self.stdout.write('[goto] incremental no-op update {:.3f}ms; random line jump: {}'.format(
+            noop * 1000, format_latency_ms(latencies)))
+        self.stdout.write('[memory] max RSS {:.0f} MB (before {:.0f} MB)'.format(_max_rss_mb(), rss_before))
+
+        if options['compare_full_read']:
+            t0 = time.perf_counter()
+            with open(path, 'r') as f:
+                text = f.read()
+            elapsed = time.perf_counter() - t0
+            del text
+            self.stdout.write('[full-read] old admin behaviour: {:.2f}s, max RSS {:.0f} MB'.format(
+                elapsed, _max_rss_mb()))
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from base.benchmark import temporary_database, format_latency_ms
+from gpu_info.models import GPUServer
+from task.log_search import LogSearchIndex, snippets
+from task.models import GPUTask, GPUTaskRunningLog
+
+_ERRORS = (
+    'RuntimeError: CUDA out of memory. Tried to allocate 2.00 GiB (GPU 0; 79.15 GiB total capacity)',
+    'NCCL error in: ../torch/csrc/distributed/c10d/ProcessGroupNCCL.cpp:1269, unhandled system error',
+    'Segmentation fault (core dumped)',
+)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the running-log full-text index: indexing throughput, index size and query latency.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=200, help='Number of runs (log files).')
+        parser.add_argument('--mb-per-run', type=float, default=5.0, help='Log size per run (MB).')
+        parser.add_argument('--error-rate', type=float, default=0.05, help='Fraction of runs that hit an error.')
+        parser.add_argument('--queries', type=int, default=20, help='Repetitions per query.')
+
+    def handle(self, *args, **options):
+        tmpdir = tempfile.mkdtemp(prefix='gputasker_bench_search_')
+        rng = random.Random(0)
+        try:
+            with temporary_database():
+                user = User.objects.create(username='bench')
+                server = GPUServer.objects.create(ip='10.0.0.1', report_token='bench')
+                task = GPUTask.objects.create(name='bench', user=user, workspace='~', cmd='true', gpu_requirement=1)
+                size = int(options['mb_per_run'] * (1 << 20))
+                block = self._block(rng)
+                runs = []
+                expected = {text: 0 for text in _ERRORS}
+                for i in range(options['runs']):
+                    path = os.path.join(tmpdir, '{}.log'.format(i))
+                    error = rng.choice(_ERRORS) if rng.random() < options['error_rate'] else None
+                    with open(path, 'wb') as f:
+                        written = 0
+                        while written < size:
+                            f.write(block)
+                            written += len(block)
+                        if error:
+                            f.write(error.encode() + b'\n')
+                            expected[error] += 1
+                    runs.append(GPUTaskRunningLog(
+                        index=i, task=task, server=server, pid=1, gpus='0', log_file_path=path, status=2,
+                    ))
+                GPUTaskRunningLog.objects.bulk_create(runs)
+                total = sum(os.path.getsize(r.log_file_path) for r in runs)
+
+                db_path = os.path.join(tmpdir, 'search.sqlite3')
+                with LogSearchIndex(db_path) as index:
+                    t0 = time.perf_counter()
+                    indexed, finished = index.index_pending(budget=total * 2)
+                    elapsed = time.perf_counter() - t0
+                    db_size = sum(os.path.getsize(db_path + s) for s in ('', '-wal') if os.path.exists(db_path + s))
+                    self.stdout.write(
+                        '[index] {} runs, {:.0f} MB in {:.2f}s ({:.1f} MB/s), index {:.1f} MB ({:.1f}% of logs)'.format(
+                            finished, indexed / (1 << 20), elapsed, indexed / (1 << 20) / elapsed,
+                            db_size / (1 << 20), 100.0 * db_size / total,
+                        )
+                    )
+                    t0 = time.perf_counter()
+                    index.index_pending()
+                    self.stdout.write('[index] no-op incremental pass: {:.2f}ms'.format((time.perf_counter() - t0) * 1000))
+
+                    paths = {r.pk: r.log_file_path for r in GPUTaskRunningLog.objects.all()}
+                    for text in ('CUDA out of memory', 'NCCL error', 'CUDA out of memory | NCCL error', 'loss'):
+                        latencies = []
+                        for _ in range(options['queries']):
+                            t0 = time.perf_counter()
+                            hits = index.search(text, limit=100)
+                            latencies.append(time.perf_counter() - t0)
+                        t0 = time.perf_counter()
+                        lines = sum(len(snippets(paths[run_id], chunks, text)) for run_id, chunks in hits.items())
+                        snippet_ms = (time.perf_counter() - t0) * 1000
+                        want = sum(n for e, n in expected.items() if any(p.strip() in e for p in text.split('|')))
+                        self.stdout.write('[query] {!r}: {} runs (expected {}), {}; snippets for {} lines {:.2f}ms'.format(
+                            text, len(hits), want if text != 'loss' else '>=100', format_latency_ms(latencies),
+                            lines, snippet_ms,
+                        ))
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    @staticmethod
+    def _block(rng):
+        lines = []
+        for i in range(5000):
+            lines.append('step {} loss={:.5f} lr={:.2e} grad_norm={:.3f} tokens/s={}'.format(
+                i, rng.random(), rng.random() * 1e-3, rng.random() * 10, rng.randint(1000, 9000)))
+        return ('\n'.join(lines) + '\n').encode()
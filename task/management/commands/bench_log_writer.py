@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import os
+import random
+import shlex
+import subprocess
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from task.log_writer import stream_to_file
+from task.metrics import MetricExtractor
+
+
+def _old_stream(cmd, path):
+    """旧实现：文本模式逐行读取，每行 write + flush。"""
+    proc = subprocess.Popen(
+        cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        text=True, bufsize=1, encoding='utf-8', errors='replace',
+    )
+    writes = 0
+    with open(path, 'a', encoding='utf-8', errors='replace') as out:
+        for line in proc.stdout:
+            out.write(line)
+            if not line.endswith('\n'):
+                out.write('\n')
+            out.flush()
+            writes += 1
+    proc.wait()
+    return writes
+
+
+def _new_stream(cmd, path, observer=None):
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=0)
+    writer = stream_to_file(proc.stdout.fileno(), path, observer=observer)
+    proc.stdout.close()
+    proc.wait()
+    return writer.writes
+
+
+def _new_stream_with_metrics(cmd, path):
+    with open(path + '.metrics', 'wb') as series:
+        extractor = MetricExtractor(series)
+        writes = _new_stream(cmd, path, observer=extractor.feed)
+        extractor.close()
+    os.remove(path + '.metrics')
+    return writes
+
+
+class Command(BaseCommand):
+    help = 'Benchmark master-side CPU cost of streaming task output to the running log (old per-line vs buffered).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mb', type=float, default=200.0, help='Size of each synthetic output (MB).')
+        parser.add_argument('--mode', choices=('tqdm', 'plain', 'both'), default='both',
+                            help='tqdm: progress bars redrawn with \\r; plain: ordinary log lines.')
+
+    def handle(self, *args, **options):
+        modes = ('tqdm', 'plain') if options['mode'] == 'both' else (options['mode'],)
+        size = int(options['mb'] * (1 << 20))
+        tmpdir = tempfile.mkdtemp(prefix='gputasker_bench_writer_')
+        try:
+            for mode in modes:
+                src = os.path.join(tmpdir, mode + '.out')
+                self._generate(src, size, mode)
+                mb = os.path.getsize(src) / (1 << 20)
+                for name, fn in (('old', _old_stream), ('new', _new_stream), ('new+metrics', _new_stream_with_metrics)):
+                    dst = os.path.join(tmpdir, '{}.{}.log'.format(mode, name))
+                    cpu0, wall0 = time.process_time(), time.perf_counter()
+                    writes = fn('cat ' + shlex.quote(src), dst)
+                    cpu = time.process_time() - cpu0
+                    wall = time.perf_counter() - wall0
+                    self.stdout.write(
+                        '[{}/{}] {:.0f} MB in: master CPU {:.2f}s ({:.2f} ms/MB), wall {:.2f}s, '
+                        'log {:.1f} MB, {} writes'.format(
+                            mode, name, mb, cpu, cpu * 1000 / mb, wall,
+                            os.path.getsize(dst) / (1 << 20), writes,
+                        )
+                    )
+                    os.remove(dst)
+                os.remove(src)
+        finally:
+            os.rmdir(tmpdir)
+
+    @staticmethod
+    def _generate(path, size, mode):
+        rng = random.Random(0)
+        parts = []
+        if mode == 'tqdm':
+            # 每个 epoch 一条进度条，重绘 500 次后换行，再打一行汇总
+            for epoch in range(20):
+                for step in range(1, 501):
+                    parts.append('\rEpoch {}: {:3d}%|{:<10}| {}/500 [00:{:02d}<00:00, {:.2f}it/s, loss={:.4f}]'.format(
+                        epoch, step // 5, '#' * (step // 50), step, step % 60, rng.random() * 10, rng.random()))
+                parts.append('\nepoch {} val_loss={:.5f}\n'.format(epoch, rng.random()))
+        else:
+            for i in range(20000):
+                parts.append('step {} loss={:.5f} lr={:.2e} grad_norm={:.3f} {}\n'.format(
+                    i, rng.random(), rng.random() * 1e-3, rng.random() * 10, 'x' * rng.randint(0, 80)))
+        block = ''.join(parts).encode()
+        with open(path, 'wb') as f:
+            written = 0
+            while written < size:
+                f.write(block)
+                written += len(block)
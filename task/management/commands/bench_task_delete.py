@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import os
+import shutil
+import tempfile
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from base.benchmark import bulk_insert, temporary_database
+from task.log_janitor import delete_tasks, purge_deleted_logs
+from task.models import GPUTask, GPUTaskRunningLog, Project, TaskGroup
+
+
+class Command(BaseCommand):
+    help = 'Benchmark deleting a large task group: per-task delete with synchronous file removal vs set-based delete + janitor.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tasks', type=int, default=3000, help='Tasks in the deleted group.')
+        parser.add_argument('--runs', type=int, default=3, help='Running logs (with files) per task.')
+
+    def handle(self, *args, **options):
+        tmpdir = tempfile.mkdtemp(prefix='gputasker_bench_delete_')
+        try:
+            with temporary_database():
+                user = User.objects.create(username='bench')
+                project = Project.objects.create(name='bench')
+                old = self._seed(user, TaskGroup.objects.create(project=project, name='old'), tmpdir, options)
+                new = self._seed(user, TaskGroup.objects.create(project=project, name='new'), tmpdir, options)
+
+                # 旧实现：逐个任务同步删文件，再逐个 delete() 级联
+                t0 = time.perf_counter()
+                for task in GPUTask.objects.filter(group=old):
+                    for running_task in task.task_logs.all():
+                        running_task.delete_log_file()
+                    task.delete()
+                self._report('per-task delete', options, time.perf_counter() - t0)
+
+                t0 = time.perf_counter()
+                delete_tasks(GPUTask.objects.filter(group=new))
+                self._report('set-based delete (request)', options, time.perf_counter() - t0)
+                t0 = time.perf_counter()
+                purged = purge_deleted_logs()
+                self._report('janitor ({} logs)'.format(purged), options, time.perf_counter() - t0)
+                assert not GPUTask.objects.exists() and not os.listdir(tmpdir)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _report(self, name, options, elapsed):
+        self.stdout.write('[{}] {} tasks x {} runs: {:.2f}s'.format(name, options['tasks'], options['runs'], elapsed))
+
+    @staticmethod
+    def _seed(user, group, tmpdir, options):
+        now = timezone.now()
+        bulk_insert(
+            GPUTask,
+            ['name', 'user', 'group', 'workspace', 'cmd', 'metric_patterns', 'gpu_requirement', 'exclusive_gpu',
+             'memory_requirement', 'utilization_requirement', 'priority', 'status', 'create_at', 'update_at'],
+            (('t{}'.format(i), user.pk, group.pk, '~', 'true\n', '', 1, False, 0, 0, 0, 2, now, now)
+             for i in range(options['tasks'])),
+        )
+        rows = []
+        for task_id in GPUTask.objects.filter(group=group).values_list('id', flat=True):
+            for index in range(options['runs']):
+                path = os.path.join(tmpdir, '{}_{}.log'.format(task_id, index))
+                with open(path, 'w') as f:
+                    f.write('epoch 1 loss=0.5\n')
+                rows.append((index, task_id, 1, '0', path, '', '', 2, now, now))
+        bulk_insert(
+            GPUTaskRunningLog,
+            ['index', 'task', 'pid', 'gpus', 'log_file_path', 'remark', 'metrics', 'status', 'start_at', 'update_at'],
+            rows,
+        )
+        return group
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test import Client
+
+from base.benchmark import temporary_database
+from base.models import UserConfig
+from task.models import GPUTask, Project, TaskGroup
+
+
+class Command(BaseCommand):
+    help = 'Benchmark bulk task submission through /api/v1/tasks/ against per-row save().'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tasks', type=int, default=10000, help='Tasks to submit.')
+        parser.add_argument('--batch', type=int, default=5000, help='Tasks per API request.')
+        parser.add_argument('--jsonl', action='store_true', help='Send JSON Lines instead of a JSON document.')
+        parser.add_argument('--baseline', type=int, default=2000,
+                            help='Tasks saved one by one for comparison (0 to skip).')
+
+    def handle(self, *args, **options):
+        with temporary_database(), mock.patch.dict(os.environ, {'GPUTASKER_TASK_SUBMIT_MAX': str(options['batch'])}):
+            user = User.objects.create(username='bench')
+            token = UserConfig.objects.create(user=user, server_username='bench', server_private_key='-').api_token
+            group = TaskGroup.objects.create(project=Project.objects.create(name='bench'), name='sweep')
+
+            if options['baseline']:
+                t0 = time.perf_counter()
+                for i in range(options['baseline']):
+                    GPUTask(name='row {}'.format(i), user=user, group=group, workspace='~/proj',
+                            cmd='python train.py --seed {}'.format(i)).save()
+                elapsed = time.perf_counter() - t0
+                self.stdout.write('[save()] {} tasks in {:.2f}s ({:.0f} tasks/s)'.format(
+                    options['baseline'], elapsed, options['baseline'] / elapsed))
+
+            # 请求体提前序列化，只计服务端（解析、校验、写库）的耗时
+            bodies = []
+            for start in range(0, options['tasks'], options['batch']):
+                items = [{'cmd': 'python train.py --lr {} --seed {}'.format(10 ** -(i % 5), i)}
+                         for i in range(start, min(start + options['batch'], options['tasks']))]
+                if options['jsonl']:
+                    body = '\n'.join(json.dumps(dict(item, workspace='~/proj', group=group.pk)) for item in items)
+                    bodies.append((body, 'application/x-ndjson'))
+                else:
+                    body = json.dumps({'defaults': {'workspace': '~/proj', 'group': group.pk}, 'tasks': items})
+                    bodies.append((body, 'application/json'))
+
+            client = Client()
+            created = 0
+            t0 = time.perf_counter()
+            for body, content_type in bodies:
+                response = client.post('/api/v1/tasks/', body, content_type=content_type,
+                                       HTTP_AUTHORIZATION='Bearer ' + token)
+                assert response.status_code == 201, response.content[:500]
+                created += response.json()['created']
+            elapsed = time.perf_counter() - t0
+            assert GPUTask.objects.filter(group=group).count() == created + options['baseline']
+            self.stdout.write('[api] {} tasks in {} requests, {:.2f}s ({:.0f} tasks/s)'.format(
+                created, len(bodies), elapsed, created / elapsed))
@@ -0,0 +1,20 @@
+from __future__ import annotations
+
+from django.core.management.base import BaseCommand
+
+from task import log_archive
+
+
+class Command(BaseCommand):
+    help = 'Compress finished running logs and apply the retention policy (same as the scheduler background job).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be compressed/deleted.')
+
+    def handle(self, *args, **options):
+        stats = log_archive.compact_logs(dry_run=options['dry_run'])
+        prefix = '[dry-run] ' if options['dry_run'] else ''
+        self.stdout.write('{}compressed {} logs ({:.1f} MB -> {:.1f} MB), deleted {} archives ({:.1f} MB)'.format(
+            prefix, stats['compressed'], stats['bytes_before'] / (1 << 20), stats['bytes_after'] / (1 << 20),
+            stats['deleted'], stats['bytes_deleted'] / (1 << 20),
+        ))
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import json
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from task.lifecycle import GROUP_BY, INTERVALS, PERCENTILES, dispatch_stats
+
+
+class Command(BaseCommand):
+    help = 'Print queue-wait and dispatch-overhead percentiles of recent runs, per day and/or per server.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help='Look back this many days (default 7).')
+        parser.add_argument('--group-by', default=','.join(GROUP_BY), help='Comma separated subset of day,server; empty for overall.')
+        parser.add_argument('--server', type=int, default=None, help='Only runs on this server id.')
+        parser.add_argument('--json', action='store_true', help='Print JSON instead of a table.')
+
+    def handle(self, *args, **options):
+        group_by = tuple(g for g in options['group_by'].split(',') if g)
+        if any(g not in GROUP_BY for g in group_by):
+            raise CommandError('--group-by accepts day and/or server')
+        end = timezone.now()
+        start = end - timedelta(days=max(1, options['days']))
+        groups = dispatch_stats(start, end, group_by, options['server'])
+        if options['json']:
+            self.stdout.write(json.dumps(groups, ensure_ascii=False, indent=2))
+            return
+        if not groups:
+            self.stdout.write('no runs with lifecycle timestamps in the last {} days'.format(options['days']))
+            return
+
+        columns = list(group_by) + ['runs', 'metric', 'count'] + ['p{}'.format(p) for p in PERCENTILES] + ['max']
+        rows = []
+        for group in groups:
+            for name in INTERVALS:
+                summary = group[name]
+                if not summary['count']:
+                    continue
+                rows.append(
+                    [str(group[g]) for g in group_by] + [str(group['runs']), name, str(summary['count'])]
+                    + ['{:.3f}'.format(summary[c]) for c in columns[len(group_by) + 3:]]
+                )
+        widths = [max(len(c), *(len(r[i]) for r in rows)) if rows else len(c) for i, c in enumerate(columns)]
+        self.stdout.write('  '.join(c.ljust(w) for c, w in zip(columns, widths)))
+        for row in rows:
+            self.stdout.write('  '.join(v.ljust(w) for v, w in zip(row, widths)))
@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from task.log_search import LogSearchIndex, snippets
+from task.models import GPUTaskRunningLog
+
+
+class Command(BaseCommand):
+    help = 'Maintain and query the running-log full-text index (index / rebuild / query / stats).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['index', 'rebuild', 'query', 'stats'], help='index/rebuild/query/stats')
+        parser.add_argument('text', nargs='?', default='', help='Query text (query); use | to separate phrases.')
+        parser.add_argument('--budget-mb', type=float, default=None, help='Bytes to index per pass (index/rebuild).')
+        parser.add_argument('--limit', type=int, default=20, help='Max runs to print (query).')
+
+    def handle(self, *args, **options):
+        action = options['action']
+        budget = None if options['budget_mb'] is None else int(options['budget_mb'] * (1 << 20))
+        with LogSearchIndex() as index:
+            if action == 'rebuild':
+                index.rebuild()
+                action = 'index'
+            if action == 'index':
+                t0 = time.perf_counter()
+                indexed, finished = index.index_pending(budget)
+                self.stdout.write('indexed {:.1f} MB, {} runs finished in {:.2f}s'.format(
+                    indexed / (1 << 20), finished, time.perf_counter() - t0))
+                self.stdout.write(str(index.stats()))
+                return
+            if action == 'stats':
+                self.stdout.write(str(index.stats()))
+                return
+            if not options['text'].strip():
+                raise CommandError('query requires text')
+            t0 = time.perf_counter()
+            hits = index.search(options['text'], limit=options['limit'])
+            elapsed = time.perf_counter() - t0
+        paths = dict(GPUTaskRunningLog.objects.filter(id__in=list(hits)).values_list('id', 'log_file_path'))
+        for run_id, chunks in hits.items():
+            if run_id not in paths:
+                continue
+            for line_no, line in snippets(paths[run_id], chunks, options['text']):
+                self.stdout.write('{}:{}: {}'.format(run_id, line_no + 1, line[:200]))
+        self.stdout.write('{} runs in {:.2f}ms'.format(len(hits), elapsed * 1000))
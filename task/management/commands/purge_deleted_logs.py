@@ -0,0 +1,19 @@
+from __future__ import annotations
+
+from django.core.management.base import BaseCommand
+
+from task import log_janitor
+from task.models import LogDeletion
+
+
+class Command(BaseCommand):
+    help = 'Remove log files left by deleted tasks/runs (same as the scheduler background janitor).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many deleted runs are pending.')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            self.stdout.write('[dry-run] {} deleted runs pending'.format(LogDeletion.objects.count()))
+            return
+        self.stdout.write('removed files of {} deleted runs'.format(log_janitor.purge_deleted_logs()))
@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from task import accounting
+
+
+class Command(BaseCommand):
+    help = 'Recompute the GPU usage ledger from all finished running logs, committing one chunk at a time.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=accounting.REBUILD_CHUNK_SIZE,
+                            help='Running logs fetched and committed per transaction.')
+        parser.add_argument('--flush-keys', type=int, default=accounting.REBUILD_FLUSH_KEYS,
+                            help='Write accumulated rollups once this many keys are held in memory.')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        runs, rows = accounting.rebuild(chunk_size=max(1, options['chunk_size']), flush_keys=max(1, options['flush_keys']))
+        self.stdout.write('accounted {} running logs into {} usage rows in {:.1f}s'.format(
+            runs, rows, time.perf_counter() - start))
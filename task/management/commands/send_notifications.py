@@ -0,0 +1,28 @@
+from __future__ import annotations
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from notification import outbox
+from task.models import Notification
+
+
+class Command(BaseCommand):
+    help = 'Build due digests and send pending notification emails (same as the scheduler background worker).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report the outbox size.')
+        parser.add_argument('--retry-failed', action='store_true', help='Requeue notifications that gave up.')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            counts = {label: Notification.objects.filter(status=status).count()
+                      for status, label in Notification.STATUS_CHOICE}
+            self.stdout.write('[dry-run] ' + ', '.join('{}: {}'.format(k, v) for k, v in counts.items()))
+            return
+        if options['retry_failed']:
+            requeued = Notification.objects.filter(status=outbox.FAILED).update(
+                status=outbox.PENDING, attempts=0, next_attempt_at=timezone.now())
+            self.stdout.write('requeued {} failed notifications'.format(requeued))
+        digests, sent = outbox.process_outbox()
+        self.stdout.write('{} digests built, {} emails sent'.format(digests, sent))
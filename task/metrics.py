@@ -0,0 +1,281 @@
+"""从任务输出中提取训练指标（loss、epoch、step、学习率等）。
+
+提取器挂在日志写入器上（见 task.log_writer），每次批量写盘时处理写出的那一段字节，
+不回读日志。一次写盘至多约 1 秒的输出，每个指标只取这段里的最后一个值：
+- 内置规则（常见的 loss/acc/lr 等 `名称=数值`、`epoch x/y`、`step x/y`、tqdm 百分比）
+  先用 rfind 从末尾找关键字，只在命中位置上执行正则，不在每个字节位置尝试匹配；
+  包含更短关键字的（如 val_loss 含 loss）在短关键字整段都没出现时直接跳过；
+- 任务上配置的自定义规则（metric_patterns，每行一条正则）对整段执行 findall，
+  含 name/value 两个命名分组时 name 为指标名、value 为数值，否则分组名即指标名。
+以 _total 结尾的指标与同名指标一起用于估算进度，优先级 epoch > step > 其他；
+tqdm 进度条的百分比记为 percent，没有总数时用它作为进度。
+
+提取对每段输出都要整段扫描多次，默认只对配置了 metric_patterns 的任务开启（内置规则随之生效）；
+GPUTASKER_METRICS_ALL_TASKS=1 时所有任务都用内置规则提取。
+
+结果：
+- 最新值与进度按 GPUTASKER_METRIC_FLUSH_SECONDS（默认 30 秒）限频写回运行记录；
+- 时间序列按 GPUTASKER_METRIC_SAMPLE_SECONDS（默认 10 秒）采样追加到 <日志>.metrics（JSON Lines），
+  每行 {"t": 时间戳, 指标: 值, ...}，只记录这段时间内有变化的指标。
+"""
+import json
+import logging
+import os
+import re
+import time
+from operator import itemgetter
+
+from django.core.exceptions import ValidationError
+
+from base.utils import env_float
+
+METRICS_SUFFIX = '.metrics'
+NUMBER = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+
+KNOWN_METRICS = (
+    'loss', 'train_loss', 'val_loss', 'eval_loss', 'test_loss', 'acc', 'accuracy', 'val_acc', 'top1', 'top5',
+    'lr', 'learning_rate', 'ppl', 'perplexity', 'grad_norm', 'bleu', 'f1', 'miou', 'reward',
+)
+_COUNTER_TAIL = rb'\s*[\[(:=]?\s*(\d+)\s*(?:/|of)\s*(\d+)'
+# 内置规则：(小写关键字, 紧跟关键字之后的正则, 各分组对应的指标名)；关键字前不能是字母数字或下划线
+BUILTIN_RULES = tuple(
+    (name.encode(), re.compile(rb'\s*[=:]\s*(' + NUMBER.encode() + rb')'), (name,)) for name in KNOWN_METRICS
+) + (
+    (b'epoch', re.compile(rb's?' + _COUNTER_TAIL), ('epoch', 'epoch_total')),
+    (b'step', re.compile(rb's?' + _COUNTER_TAIL), ('step', 'step_total')),
+    (b'iter', re.compile(rb'(?:ation)?s?' + _COUNTER_TAIL), ('step', 'step_total')),
+)
+# 规则的前置关键字：前面某条规则的关键字是本关键字的子串时，前者整段未出现即可跳过本条
+_RULE_GATES = tuple(
+    next((other for other, _, _ in BUILTIN_RULES[:i] if other in keyword), None)
+    for i, (keyword, _, _) in enumerate(BUILTIN_RULES)
+)
+_WORD_BYTES = frozenset(b'abcdefghijklmnopqrstuvwxyz0123456789_')
+_PERCENT = re.compile(rb'(\d{1,3})$')
+# 同一关键字最多向前尝试这么多次（关键字大量出现在无关上下文中时放弃本段）
+_MAX_TRIES = 32
+# 序列文件只保留最近这么多字节用于页面展示
+_SERIES_TAIL_BYTES = 256 * 1024
+
+task_logger = logging.getLogger('django.task')
+
+
+def enabled():
+    return os.getenv('GPUTASKER_METRICS_ENABLED', '1') == '1'
+
+
+def all_tasks():
+    """没有配置 metric_patterns 的任务是否也用内置规则提取。"""
+    return os.getenv('GPUTASKER_METRICS_ALL_TASKS', '0') == '1'
+
+
+def sample_seconds():
+    return env_float('GPUTASKER_METRIC_SAMPLE_SECONDS', 10)
+
+
+def flush_seconds():
+    return env_float('GPUTASKER_METRIC_FLUSH_SECONDS', 30)
+
+
+def series_path(log_file_path):
+    return log_file_path + METRICS_SUFFIX
+
+
+def compile_patterns(text=''):
+    """每行一条的自定义规则；无效的正则抛出 re.error。"""
+    sources = [line.strip() for line in (text or '').splitlines() if line.strip()]
+    return [re.compile(source.encode('utf-8')) for source in sources]
+
+
+def validate_patterns(text):
+    try:
+        patterns = compile_patterns(text)
+    except re.error as exc:
+        raise ValidationError('无效的正则表达式：{}'.format(exc))
+    for pattern in patterns:
+        if not pattern.groupindex:
+            raise ValidationError('规则需要命名分组：{}'.format(pattern.pattern.decode('utf-8')))
+
+
+def _last_match(lower, keyword, tail):
+    """关键字在 lower 中最后一次（作为独立词开头）出现且后面满足 tail 的匹配；关键字整段未出现时返回 False。"""
+    end = len(lower)
+    for _ in range(_MAX_TRIES):
+        i = lower.rfind(keyword, 0, end)
+        if i < 0:
+            return False if end == len(lower) else None
+        if i == 0 or lower[i - 1] not in _WORD_BYTES:
+            m = tail.match(lower, i + len(keyword))
+            if m is not None:
+                return m
+        end = i
+    return None
+
+
+def progress_of(values):
+    for name in ('epoch', 'step'):
+        total = values.get(name + '_total')
+        if name in values and total:
+            return max(0.0, min(1.0, values[name] / total))
+    for name, total in values.items():
+        base = name[:-len('_total')]
+        if name.endswith('_total') and total and base in values:
+            return max(0.0, min(1.0, values[base] / total))
+    if 'percent' in values:
+        return max(0.0, min(1.0, values['percent'] / 100.0))
+    return None
+
+
+class MetricExtractor:
+    """增量提取指标；feed 接收按行对齐的输出字节。
+
+    on_flush(latest, progress) 在需要写回最新值时调用（由调用方决定写到哪里）。
+    """
+
+    def __init__(self, series_file=None, patterns=None, on_flush=None, clock=time.time,
+                 sample_interval=None, flush_interval=None):
+        self.series_file = series_file
+        self.patterns = [] if patterns is None else patterns
+        self._compiled = [self._prepare(p) for p in self.patterns]
+        self.on_flush = on_flush
+        self._clock = clock
+        self.sample_interval = sample_seconds() if sample_interval is None else sample_interval
+        self.flush_interval = flush_seconds() if flush_interval is None else flush_interval
+        self.latest = {}
+        self._changed = {}
+        self._dirty = False
+        self._last_sample = None
+        self._last_flush = None
+
+    @staticmethod
+    def _prepare(pattern):
+        """findall 按分组顺序返回元组（只有一个分组时返回字符串），这里记下如何取值。"""
+        groups = pattern.groupindex
+        if 'name' in groups and 'value' in groups:
+            if pattern.groups == 2 and groups['name'] == 1:
+                return pattern, True, None
+            return pattern, True, (groups['name'] - 1, groups['value'] - 1)
+        names = [None] * pattern.groups
+        for name, index in groups.items():
+            names[index - 1] = name
+        return pattern, False, tuple(names)
+
+    @property
+    def progress(self):
+        return progress_of(self.latest)
+
+    def feed(self, data):
+        # bytes.lower 只转换 ASCII，字节位置不变
+        lower = data.lower()
+        absent = set()
+        for (keyword, tail, names), gate in zip(BUILTIN_RULES, _RULE_GATES):
+            if gate in absent:
+                continue
+            m = _last_match(lower, keyword, tail)
+            if m is False:
+                absent.add(keyword)
+            elif m is not None:
+                for name, value in zip(names, m.groups()):
+                    self._set(name, value)
+        i = data.rfind(b'%|')
+        if i > 0:
+            m = _PERCENT.search(data, max(0, i - 3), i)
+            if m is not None:
+                self._set('percent', m.group(1))
+        # 自定义规则：findall + dict 在 C 里完成，每个指标同样只取最后一个值
+        for pattern, generic, names in self._compiled:
+            matches = pattern.findall(data)
+            if not matches:
+                continue
+            if generic:
+                if names is not None:
+                    matches = zip(map(itemgetter(names[0]), matches), map(itemgetter(names[1]), matches))
+                for name, value in dict(matches).items():
+                    self._set(name.decode('ascii', errors='replace').lower(), value)
+            else:
+                last = matches[-1]
+                if len(names) == 1:
+                    last = (last,)
+                for name, value in zip(names, last):
+                    if name and value:
+                        self._set(name, value)
+        if self._dirty or self._changed:
+            self._maybe_emit()
+
+    def _set(self, name, raw):
+        try:
+            value = float(raw)
+        except ValueError:
+            return
+        if value.is_integer() and abs(value) < 1 << 53:
+            value = int(value)
+        if self.latest.get(name) == value:
+            return
+        self.latest[name] = value
+        self._changed[name] = value
+        self._dirty = True
+
+    def _maybe_emit(self, force=False):
+        now = self._clock()
+        if self._changed and (force or self._last_sample is None or now - self._last_sample >= self.sample_interval):
+            self._last_sample = now
+            if self.series_file is not None:
+                record = {'t': int(now)}
+                record.update(self._changed)
+                self.series_file.write((json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8'))
+                self.series_file.flush()
+            self._changed = {}
+        if self._dirty and (force or self._last_flush is None or now - self._last_flush >= self.flush_interval):
+            self._last_flush = now
+            self._dirty = False
+            if self.on_flush is not None:
+                self.on_flush(dict(self.latest), self.progress)
+
+    def close(self):
+        self._maybe_emit(force=True)
+        if self.series_file is not None:
+            self.series_file.close()
+            self.series_file = None
+
+
+def open_extractor(log_file_path, patterns_text='', on_flush=None):
+    """为一份运行日志创建提取器；自定义规则无效时只用内置规则。"""
+    try:
+        patterns = compile_patterns(patterns_text)
+    except re.error as exc:
+        task_logger.error('invalid metric patterns, using built-in rules only: %s', exc)
+        patterns = []
+    series_file = open(series_path(log_file_path), 'ab')
+    return MetricExtractor(series_file, patterns, on_flush)
+
+
+def read_series(log_file_path, max_points=200):
+    """读取最近的指标序列，返回 {指标: [(t, value), ...]}，每个指标最多 max_points 个点。"""
+    path = series_path(log_file_path)
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            start = max(0, size - _SERIES_TAIL_BYTES)
+            f.seek(start)
+            data = f.read()
+    except OSError:
+        return {}
+    if start:
+        data = data[data.find(b'\n') + 1:]
+    series = {}
+    for line in data.splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        t = record.pop('t', None)
+        for name, value in record.items():
+            series.setdefault(name, []).append((t, value))
+    return {name: points[-max_points:] for name, points in series.items()}
+
+
+def remove_series(log_file_path):
+    try:
+        os.remove(series_path(log_file_path))
+    except OSError:
+        pass
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-19 15:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task', '0005_dispatching_at_and_remove_scheduling_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='gputask',
+            index=models.Index(fields=['status', '-priority', 'create_at'], name='gputask_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gputask',
+            index=models.Index(condition=models.Q(('status', 0)), fields=['dispatching_at'], name='gputask_ready_claim_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gputaskrunninglog',
+            index=models.Index(fields=['status', 'last_heartbeat_at'], name='runlog_status_hb_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-19 15:42
+
+from django.db import migrations, models
+import task.metrics
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task', '0006_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gputask',
+            name='metric_patterns',
+            field=models.TextField(blank=True, default='', help_text='每行一条正则，用命名分组标出指标，如 (?P<name>wer)=(?P<value>[0-9.]+) 或 Round (?P<round>\\d+)/(?P<round_total>\\d+)。内置规则已覆盖常见的 loss/lr/acc、epoch x/y、step x/y 与 tqdm 进度条', validators=[task.metrics.validate_patterns], verbose_name='指标提取规则'),
+        ),
+        migrations.AddField(
+            model_name='gputaskrunninglog',
+            name='metrics',
+            field=models.TextField(blank=True, default='', verbose_name='最新指标'),
+        ),
+        migrations.AddField(
+            model_name='gputaskrunninglog',
+            name='progress',
+            field=models.FloatField(blank=True, null=True, verbose_name='进度'),
+        ),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 4.2.30 on 2026-10-19 16:01
+
+from django.conf import settings
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+import task.arrays
+import task.metrics
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('gpu_info', '0006_gpuinfo_server_index'),
+        ('task', '0007_run_metrics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskArray',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='子任务名称为“名称[序号]”；名称中含 {参数名} 或 {index} 时按模板替换', max_length=90, verbose_name='数组名称')),
+                ('workspace', models.CharField(max_length=200, verbose_name='工作目录')),
+                ('cmd', models.TextField(help_text='用 {参数名} 引用参数，{index} 为子任务序号；其他花括号原样保留', verbose_name='命令模板')),
+                ('params', models.TextField(help_text='JSON。对象表示网格，按笛卡尔积展开，如 {"lr": [0.1, 0.01], "bs": [32, 64]}；数组表示参数列表，每项一个子任务，如 [{"lr": 0.1}, {"lr": 0.01}]', validators=[task.arrays.validate_params], verbose_name='参数')),
+                ('metric_patterns', models.TextField(blank=True, default='', validators=[task.metrics.validate_patterns], verbose_name='指标提取规则')),
+                ('gpu_requirement', models.PositiveSmallIntegerField(default=1, validators=[django.core.validators.MaxValueValidator(8), django.core.validators.MinValueValidator(0)], verbose_name='GPU数量需求')),
+                ('exclusive_gpu', models.BooleanField(default=False, verbose_name='独占显卡')),
+                ('memory_requirement', models.PositiveSmallIntegerField(default=0, verbose_name='显存需求(MB)')),
+                ('utilization_requirement', models.PositiveSmallIntegerField(default=0, verbose_name='利用率需求(%)')),
+                ('priority', models.SmallIntegerField(default=0, verbose_name='优先级')),
+                ('max_pending', models.PositiveSmallIntegerField(default=8, help_text='同时处于“准备就绪”的子任务上限；调度器还会按空闲 GPU 数进一步限制', validators=[django.core.validators.MinValueValidator(1)], verbose_name='最多排队子任务数')),
+                ('active', models.BooleanField(default=True, help_text='取消后不再展开新的子任务', verbose_name='调度中')),
+                ('size', models.PositiveIntegerField(default=0, editable=False, verbose_name='子任务总数')),
+                ('materialized', models.PositiveIntegerField(default=0, editable=False, verbose_name='已展开')),
+                ('create_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('update_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '任务数组',
+                'verbose_name_plural': '任务数组',
+            },
+        ),
+        migrations.AddField(
+            model_name='gputask',
+            name='array_index',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='数组序号'),
+        ),
+        migrations.AddField(
+            model_name='taskarray',
+            name='assign_server',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='gpu_info.gpuserver', verbose_name='指定服务器'),
+        ),
+        migrations.AddField(
+            model_name='taskarray',
+            name='group',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='arrays', to='task.taskgroup', verbose_name='分组'),
+        ),
+        migrations.AddField(
+            model_name='taskarray',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='task_arrays', to=settings.AUTH_USER_MODEL, verbose_name='用户'),
+        ),
+        migrations.AddField(
+            model_name='gputask',
+            name='array',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='tasks', to='task.taskarray', verbose_name='任务数组'),
+        ),
+        migrations.AddIndex(
+            model_name='taskarray',
+            index=models.Index(fields=['active', '-priority', 'create_at'], name='taskarray_active_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='gputask',
+            constraint=models.UniqueConstraint(fields=('array', 'array_index'), name='uniq_gputask_array_index'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-19 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task', '0008_taskarray'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LogDeletion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('log_file_path', models.CharField(max_length=255, verbose_name='日志文件')),
+                ('create_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+            ],
+            options={
+                'verbose_name': '待清理日志',
+                'verbose_name_plural': '待清理日志',
+            },
+        ),
+    ]
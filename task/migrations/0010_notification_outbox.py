@@ -0,0 +1,40 @@
+# Generated by Django 4.2.30 on 2026-10-19 16:13
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('task', '0009_log_deletion_journal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.EmailField(max_length=254, verbose_name='收件地址')),
+                ('event', models.CharField(choices=[('start', '开始运行'), ('finish', '运行完成'), ('fail', '运行失败'), ('digest', '汇总')], max_length=10, verbose_name='事件')),
+                ('task_name', models.CharField(blank=True, default='', max_length=100, verbose_name='任务名称')),
+                ('subject', models.CharField(max_length=255, verbose_name='标题')),
+                ('body', models.TextField(verbose_name='内容')),
+                ('digest_key', models.CharField(blank=True, default='', max_length=32, verbose_name='汇总')),
+                ('status', models.SmallIntegerField(choices=[(-1, '发送失败'), (0, '待发送'), (1, '等待汇总')], default=0, verbose_name='状态')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='发送次数')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='下次发送时间')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='错误信息')),
+                ('create_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to=settings.AUTH_USER_MODEL, verbose_name='用户')),
+            ],
+            options={
+                'verbose_name': '通知发件箱',
+                'verbose_name_plural': '通知发件箱',
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='notification_due_idx'), models.Index(fields=['status', 'digest_key'], name='notification_digest_idx')],
+            },
+        ),
+    ]
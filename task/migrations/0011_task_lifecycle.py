@@ -0,0 +1,69 @@
+from django.db import migrations, models
+from django.db.models import F
+import django.utils.timezone
+
+
+def backfill_queued_at(apps, schema_editor):
+    GPUTask = apps.get_model('task', 'GPUTask')
+    # 已有任务的入队时间取创建时间（之后的排队时长从下一次入队开始才准确）
+    GPUTask.objects.update(queued_at=F('create_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task', '0010_notification_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gputask',
+            name='queued_at',
+            field=models.DateTimeField(blank=True, default=django.utils.timezone.now, null=True, verbose_name='入队时间'),
+        ),
+        migrations.RunPython(backfill_queued_at, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='gputaskrunninglog',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='认领时间'),
+        ),
+        migrations.AddField(
+            model_name='gputaskrunninglog',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='结束时间'),
+        ),
+        migrations.AddField(
+            model_name='gputaskrunninglog',
+            name='first_output_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='首行输出时间'),
+        ),
+        migrations.AddField(
+            model_name='gputaskrunninglog',
+            name='gpus_locked_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='占用GPU时间'),
+        ),
+        migrations.AddField(
+            model_name='gputaskrunninglog',
+            name='gpus_released_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='释放GPU时间'),
+        ),
+        migrations.AddField(
+            model_name='gputaskrunninglog',
+            name='marker_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='远端进程启动时间'),
+        ),
+        migrations.AddField(
+            model_name='gputaskrunninglog',
+            name='queued_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='入队时间'),
+        ),
+        migrations.AddField(
+            model_name='gputaskrunninglog',
+            name='spawned_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='SSH启动时间'),
+        ),
+        migrations.AddIndex(
+            model_name='gputaskrunninglog',
+            index=models.Index(fields=['start_at'], name='runlog_start_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.30 on 2026-10-19 16:27
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('gpu_info', '0006_gpuinfo_server_index'),
+        ('task', '0011_task_lifecycle'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gputaskrunninglog',
+            name='accounted_until',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='用量记账截止'),
+        ),
+        migrations.CreateModel(
+            name='GPUUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='日期')),
+                ('key', models.CharField(max_length=100, unique=True, verbose_name='汇总键')),
+                ('runs', models.PositiveIntegerField(default=0, verbose_name='运行次数')),
+                ('gpu_seconds', models.FloatField(default=0, verbose_name='GPU·秒')),
+                ('wall_seconds', models.FloatField(default=0, verbose_name='运行时长(秒)')),
+                ('update_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('group', models.ForeignKey(blank=True, db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='task.taskgroup', verbose_name='分组')),
+                ('project', models.ForeignKey(blank=True, db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='task.project', verbose_name='项目')),
+                ('server', models.ForeignKey(blank=True, db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='gpu_info.gpuserver', verbose_name='服务器')),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='用户')),
+            ],
+            options={
+                'verbose_name': 'GPU用量',
+                'verbose_name_plural': 'GPU用量',
+                'ordering': ('-day', 'user', 'id'),
+                'indexes': [models.Index(fields=['day'], name='gpuusage_day_idx')],
+            },
+        ),
+    ]
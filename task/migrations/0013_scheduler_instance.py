@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-19 16:51
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task', '0012_gpu_usage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SchedulerInstance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True, verbose_name='实例名')),
+                ('hostname', models.CharField(blank=True, default='', max_length=100, verbose_name='主机名')),
+                ('pid', models.IntegerField(default=0, verbose_name='PID')),
+                ('started_at', models.DateTimeField(auto_now_add=True, verbose_name='启动时间')),
+                ('renewed_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='续约时间')),
+                ('expires_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='租约到期')),
+            ],
+            options={
+                'verbose_name': '调度器实例',
+                'verbose_name_plural': '调度器实例',
+                'ordering': ('id',),
+            },
+        ),
+        migrations.AddField(
+            model_name='gputaskrunninglog',
+            name='scheduler',
+            field=models.CharField(blank=True, max_length=100, null=True, verbose_name='调度器实例'),
+        ),
+    ]
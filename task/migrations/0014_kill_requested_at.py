@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 17:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task', '0013_scheduler_instance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gputaskrunninglog',
+            name='kill_requested_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='请求结束时间'),
+        ),
+    ]
@@ -2,9 +2,17 @@ import os
 import signal
 
 from django.db import models
+from django.db.models import Q
 from django.core.validators import MaxValueValidator, MinValueValidator
+from django.utils import timezone
 
 from gpu_info.models import GPUServer, GPUInfo
+from . import log_search
+from .arrays import array_size, params_at, parse_params, render, validate_params as validate_array_params
+from .log_archive import remove_archive
+from .log_reader import remove_index
+from .log_stream import remove_watcher_slots
+from .metrics import remove_series, validate_patterns as validate_metric_patterns
 from django.contrib.auth.models import User
 
 
@@ -42,6 +50,97 @@ class TaskGroup(models.Model):
         return f'{self.project.name} / {self.name}'
 
 
+class TaskArray(models.Model):
+    """参数化任务数组：子任务由调度器按空闲资源逐批展开（见 task.utils.materialize_arrays）。"""
+    name = models.CharField(
+        '数组名称', max_length=90,
+        help_text='子任务名称为“名称[序号]”；名称中含 {参数名} 或 {index} 时按模板替换',
+    )
+    user = models.ForeignKey(User, verbose_name='用户', on_delete=models.CASCADE, related_name='task_arrays')
+    group = models.ForeignKey(
+        TaskGroup,
+        verbose_name='分组',
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        related_name='arrays'
+    )
+    workspace = models.CharField('工作目录', max_length=200)
+    cmd = models.TextField('命令模板', help_text='用 {参数名} 引用参数，{index} 为子任务序号；其他花括号原样保留')
+    params = models.TextField(
+        '参数',
+        validators=[validate_array_params],
+        help_text='JSON。对象表示网格，按笛卡尔积展开，如 {"lr": [0.1, 0.01], "bs": [32, 64]}；'
+                  '数组表示参数列表，每项一个子任务，如 [{"lr": 0.1}, {"lr": 0.01}]',
+    )
+    metric_patterns = models.TextField('指标提取规则', blank=True, default='', validators=[validate_metric_patterns])
+    gpu_requirement = models.PositiveSmallIntegerField(
+        'GPU数量需求',
+        default=1,
+        validators=[MaxValueValidator(8), MinValueValidator(0)]
+    )
+    exclusive_gpu = models.BooleanField('独占显卡', default=False)
+    memory_requirement = models.PositiveSmallIntegerField('显存需求(MB)', default=0)
+    utilization_requirement = models.PositiveSmallIntegerField('利用率需求(%)', default=0)
+    assign_server = models.ForeignKey(GPUServer, verbose_name='指定服务器', on_delete=models.SET_NULL, blank=True, null=True)
+    priority = models.SmallIntegerField('优先级', default=0)
+    max_pending = models.PositiveSmallIntegerField(
+        '最多排队子任务数',
+        default=8,
+        validators=[MinValueValidator(1)],
+        help_text='同时处于“准备就绪”的子任务上限；调度器还会按空闲 GPU 数进一步限制',
+    )
+    active = models.BooleanField('调度中', default=True, help_text='取消后不再展开新的子任务')
+    size = models.PositiveIntegerField('子任务总数', default=0, editable=False)
+    materialized = models.PositiveIntegerField('已展开', default=0, editable=False)
+    create_at = models.DateTimeField('创建时间', auto_now_add=True)
+    update_at = models.DateTimeField('更新时间', auto_now=True)
+
+    class Meta:
+        verbose_name = '任务数组'
+        verbose_name_plural = '任务数组'
+        indexes = [
+            # 调度器每轮只扫描还有子任务待展开的数组
+            models.Index(fields=['active', '-priority', 'create_at'], name='taskarray_active_idx'),
+        ]
+
+    def __str__(self):
+        return self.name
+
+    def save(self, *args, **kwargs):
+        self.cmd = self.cmd.replace('\r\n', '\n')
+        self.size = array_size(parse_params(self.params))
+        super().save(*args, **kwargs)
+
+    def build_children(self, start, stop):
+        """第 [start, stop) 个子任务（未保存）。"""
+        spec = parse_params(self.params)
+        named = '{' in self.name
+        children = []
+        for index in range(start, stop):
+            params = params_at(spec, index)
+            child = GPUTask(
+                name=render(self.name, params, index)[:100] if named else '{}[{}]'.format(self.name, index),
+                user_id=self.user_id,
+                group_id=self.group_id,
+                array=self,
+                array_index=index,
+                workspace=render(self.workspace, params, index),
+                cmd=render(self.cmd, params, index),
+                metric_patterns=self.metric_patterns,
+                gpu_requirement=self.gpu_requirement,
+                exclusive_gpu=self.exclusive_gpu,
+                memory_requirement=self.memory_requirement,
+                utilization_requirement=self.utilization_requirement,
+                assign_server_id=self.assign_server_id,
+                priority=self.priority,
+                status=0,
+            )
+            child._normalize_cmd()
+            children.append(child)
+        return children
+
+
 class GPUTask(models.Model):
     STATUS_CHOICE = (
         (-2, '未就绪'),
@@ -63,6 +162,15 @@ class GPUTask(models.Model):
     )
     workspace = models.CharField('工作目录', max_length=200)
     cmd = models.TextField('命令')
+    metric_patterns = models.TextField(
+        '指标提取规则',
+        blank=True,
+        default='',
+        validators=[validate_metric_patterns],
+        help_text='每行一条正则，用命名分组标出指标，如 (?P<name>wer)=(?P<value>[0-9.]+) 或 '
+                  'Round (?P<round>\\d+)/(?P<round_total>\\d+)。内置规则已覆盖常见的 loss/lr/acc、'
+                  'epoch x/y、step x/y 与 tqdm 进度条',
+    )
     gpu_requirement = models.PositiveSmallIntegerField(
         'GPU数量需求',
         default=1,
@@ -74,6 +182,17 @@ class GPUTask(models.Model):
     assign_server = models.ForeignKey(GPUServer, verbose_name='指定服务器', on_delete=models.SET_NULL, blank=True, null=True)
     priority = models.SmallIntegerField('优先级', default=0)
     status = models.SmallIntegerField('状态', choices=STATUS_CHOICE, default=0)
+    # 最近一次进入“准备就绪”的时间；排队时长 = 认领时间 - 入队时间
+    queued_at = models.DateTimeField('入队时间', default=timezone.now, blank=True, null=True)
+    array = models.ForeignKey(
+        TaskArray,
+        verbose_name='任务数组',
+        on_delete=models.CASCADE,
+        blank=True,
+        null=True,
+        related_name='tasks'
+    )
+    array_index = models.PositiveIntegerField('数组序号', blank=True, null=True)
     dispatching_at = models.DateTimeField('调度认领时间', blank=True, null=True)
     create_at = models.DateTimeField('创建时间', auto_now_add=True)
     update_at = models.DateTimeField('更新时间', auto_now=True)
@@ -81,6 +200,16 @@ class GPUTask(models.Model):
     class Meta:
         verbose_name = 'GPU任务'
         verbose_name_plural = 'GPU任务'
+        indexes = [
+            # 调度主循环：status=0 按 -priority, create_at 取队列（也覆盖后台按状态筛选）
+            models.Index(fields=['status', '-priority', 'create_at'], name='gputask_queue_idx'),
+            # 认领判断只关心“准备就绪”的任务；不支持部分索引的数据库（MySQL）会跳过，由上面的复合索引兜底
+            models.Index(fields=['dispatching_at'], condition=Q(status=0), name='gputask_ready_claim_idx'),
+        ]
+        constraints = [
+            # 同一序号只展开一次；也用于按数组聚合子任务状态
+            models.UniqueConstraint(fields=['array', 'array_index'], name='uniq_gputask_array_index'),
+        ]
 
     def __str__(self):
         return self.name
@@ -153,6 +282,23 @@ class GPUTaskRunningLog(models.Model):
     remark = models.CharField('备注', max_length=200, blank=True, default='')
     status = models.SmallIntegerField('状态', choices=STATUS_CHOICE, default=1)
     last_heartbeat_at = models.DateTimeField('最近心跳时间', blank=True, null=True)
+    metrics = models.TextField('最新指标', blank=True, default='')
+    progress = models.FloatField('进度', blank=True, null=True)
+    # 生命周期时间点（见 task.lifecycle）
+    queued_at = models.DateTimeField('入队时间', blank=True, null=True)
+    claimed_at = models.DateTimeField('认领时间', blank=True, null=True)
+    gpus_locked_at = models.DateTimeField('占用GPU时间', blank=True, null=True)
+    spawned_at = models.DateTimeField('SSH启动时间', blank=True, null=True)
+    marker_at = models.DateTimeField('远端进程启动时间', blank=True, null=True)
+    first_output_at = models.DateTimeField('首行输出时间', blank=True, null=True)
+    finished_at = models.DateTimeField('结束时间', blank=True, null=True)
+    gpus_released_at = models.DateTimeField('释放GPU时间', blank=True, null=True)
+    # 已计入用量汇总的截止时间（见 task.accounting）
+    accounted_until = models.DateTimeField('用量记账截止', blank=True, null=True)
+    # 启动或正在监管该运行记录的调度器实例（多实例模式下用于接管判断，见 task.sharding）
+    scheduler = models.CharField('调度器实例', max_length=100, blank=True, null=True)
+    # 取消任务时只记下结束请求，由调度器后台线程 ssh 结束远端进程（见 task.utils.kill_requested_runs）
+    kill_requested_at = models.DateTimeField('请求结束时间', blank=True, null=True)
     start_at = models.DateTimeField('开始时间', auto_now_add=True)
     update_at = models.DateTimeField('更新时间', auto_now=True)
 
@@ -160,6 +306,12 @@ class GPUTaskRunningLog(models.Model):
         ordering = ('-id',)
         verbose_name = 'GPU任务运行记录'
         verbose_name_plural = 'GPU任务运行记录'
+        indexes = [
+            # 心跳超时扫描：status=1 且 last_heartbeat_at 过旧
+            models.Index(fields=['status', 'last_heartbeat_at'], name='runlog_status_hb_idx'),
+            # 调度耗时统计按时间区间扫描
+            models.Index(fields=['start_at'], name='runlog_start_idx'),
+        ]
 
     def __str__(self):
         return self.task.name + '-' + str(self.index)
@@ -169,5 +321,124 @@ class GPUTaskRunningLog(models.Model):
         os.kill(self.pid, signal.SIGKILL)
     
     def delete_log_file(self):
-        if os.path.isfile(self.log_file_path):
-            os.remove(self.log_file_path)
+        remove_log_files(self.log_file_path)
+
+
+def remove_log_files(log_file_path, forget_search=True):
+    """删除日志文件及其压缩归档、日志查看器生成的行索引、观看名额文件与指标序列。"""
+    if os.path.isfile(log_file_path):
+        os.remove(log_file_path)
+    remove_archive(log_file_path)
+    remove_index(log_file_path)
+    remove_watcher_slots(log_file_path)
+    remove_series(log_file_path)
+    if forget_search:
+        log_search.forget(log_file_path)
+
+
+class LogDeletion(models.Model):
+    """删除日志：已删除的运行记录留下的日志文件，由后台清理（见 task.log_janitor）。"""
+    log_file_path = models.CharField('日志文件', max_length=255)
+    create_at = models.DateTimeField('创建时间', auto_now_add=True)
+
+    class Meta:
+        verbose_name = '待清理日志'
+        verbose_name_plural = '待清理日志'
+
+
+class Notification(models.Model):
+    """通知发件箱：run_task 只写入，由调度器后台线程发送（见 notification.outbox）。"""
+    STATUS_CHOICE = (
+        (-1, '发送失败'),
+        (0, '待发送'),
+        (1, '等待汇总'),
+    )
+    EVENT_CHOICE = (
+        ('start', '开始运行'),
+        ('finish', '运行完成'),
+        ('fail', '运行失败'),
+        ('digest', '汇总'),
+    )
+    user = models.ForeignKey(User, verbose_name='用户', on_delete=models.CASCADE, related_name='notifications')
+    address = models.EmailField('收件地址')
+    event = models.CharField('事件', max_length=10, choices=EVENT_CHOICE)
+    task_name = models.CharField('任务名称', max_length=100, blank=True, default='')
+    subject = models.CharField('标题', max_length=255)
+    body = models.TextField('内容')
+    # 非空时表示等待汇总，如 array:12、group:3
+    digest_key = models.CharField('汇总', max_length=32, blank=True, default='')
+    status = models.SmallIntegerField('状态', choices=STATUS_CHOICE, default=0)
+    attempts = models.PositiveSmallIntegerField('发送次数', default=0)
+    next_attempt_at = models.DateTimeField('下次发送时间', default=timezone.now)
+    last_error = models.TextField('错误信息', blank=True, default='')
+    create_at = models.DateTimeField('创建时间', auto_now_add=True)
+
+    class Meta:
+        verbose_name = '通知发件箱'
+        verbose_name_plural = '通知发件箱'
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='notification_due_idx'),
+            models.Index(fields=['status', 'digest_key'], name='notification_digest_idx'),
+        ]
+
+    def __str__(self):
+        return '{} {}'.format(self.get_event_display(), self.task_name or self.subject)
+
+
+class GPUUsage(models.Model):
+    """按天汇总的 GPU 用量：运行记录结束、失败或失联时增量累加（见 task.accounting）。
+
+    任务、分组删除后用量仍保留，因此维度外键不建数据库约束。
+    """
+    day = models.DateField('日期')
+    # 日期/用户/项目/分组/服务器，唯一；维度可为空，不能直接用联合唯一约束
+    key = models.CharField('汇总键', max_length=100, unique=True)
+    user = models.ForeignKey(
+        User, verbose_name='用户', on_delete=models.DO_NOTHING, db_constraint=False, related_name='+',
+    )
+    project = models.ForeignKey(
+        Project, verbose_name='项目', on_delete=models.DO_NOTHING, db_constraint=False, db_index=False,
+        related_name='+', blank=True, null=True,
+    )
+    group = models.ForeignKey(
+        TaskGroup, verbose_name='分组', on_delete=models.DO_NOTHING, db_constraint=False, db_index=False,
+        related_name='+', blank=True, null=True,
+    )
+    server = models.ForeignKey(
+        GPUServer, verbose_name='服务器', on_delete=models.DO_NOTHING, db_constraint=False, db_index=False,
+        related_name='+', blank=True, null=True,
+    )
+    runs = models.PositiveIntegerField('运行次数', default=0)
+    gpu_seconds = models.FloatField('GPU·秒', default=0)
+    wall_seconds = models.FloatField('运行时长(秒)', default=0)
+    update_at = models.DateTimeField('更新时间', auto_now=True)
+
+    class Meta:
+        ordering = ('-day', 'user', 'id')
+        verbose_name = 'GPU用量'
+        verbose_name_plural = 'GPU用量'
+        indexes = [
+            models.Index(fields=['day'], name='gpuusage_day_idx'),
+        ]
+
+    @property
+    def gpu_hours(self):
+        return self.gpu_seconds / 3600.0
+
+
+class SchedulerInstance(models.Model):
+    """多实例调度模式下的调度器租约：每个实例定期续约，过期的实例不再参与分片（见 task.sharding）。"""
+    name = models.CharField('实例名', max_length=100, unique=True)
+    hostname = models.CharField('主机名', max_length=100, blank=True, default='')
+    pid = models.IntegerField('PID', default=0)
+    started_at = models.DateTimeField('启动时间', auto_now_add=True)
+    renewed_at = models.DateTimeField('续约时间', default=timezone.now)
+    expires_at = models.DateTimeField('租约到期', default=timezone.now)
+
+    class Meta:
+        ordering = ('id',)
+        verbose_name = '调度器实例'
+        verbose_name_plural = '调度器实例'
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,336 @@
+"""常驻调度服务（main.py 的主体）。
+
+main.py 以前是一个裸的 while True：每轮重新读管理员配置、重建 GPUInfoUpdater（ssh 模式下的利用率历史随之丢失）；
+进程一重启，所有 run_task 线程和 ssh 会话跟着消失。SchedulerService 把调度循环收拢到一个对象里：
+
+- 跨轮保留状态：GPUInfoUpdater 只建一次（管理员 ssh 配置变化时原地更新账号），管理员配置每分钟重读一次；
+- 服务器与 GPU 保留在进程内缓存里（gpu_info.cluster_state），每轮按 update_at 增量刷新，run_task 选卡不查库；
+- 启动时先按运行记录重建运行中任务的视图并逐个接管（见 task.supervisor），之后每轮补接管漏掉的；
+- SIGTERM/SIGINT 时优雅退出：不再认领和启动新任务，等正在启动的任务拿到远端进程
+  （最多 GPUTASKER_SCHEDULER_DRAIN_SECONDS，默认 30 秒）后退出；运行中的任务留在节点上继续跑，下次启动时接管；
+- GPUTASKER_SCHEDULER_SHARDING=1 时可以同时运行多个实例：各自只在分到的节点上调度，全局的周期性工作只由 leader 做
+  （见 task.sharding）。
+"""
+import logging
+import os
+import signal
+import threading
+import time
+from datetime import timedelta
+
+from django.utils import timezone
+
+from base.utils import get_admin_config
+from gpu_info import timeseries as gpu_timeseries
+from gpu_info.cluster_state import ClusterState
+from gpu_info.utils import GPUInfoUpdater
+from notification import outbox as notification_outbox
+from . import log_archive, log_janitor, log_search, sharding, supervisor
+from .cycle_profiler import CycleProfiler
+from .models import GPUTask, GPUTaskRunningLog
+from .utils import DRAINING, SCHEDULER_PHASE_SECONDS, claim_task, mark_stale_running_tasks_as_lost, \
+    materialize_arrays, maybe_kill_in_background, ready_task_ids, run_task, shard_max_gpus
+from .wakeup import WakeupWaiter
+
+task_logger = logging.getLogger('django.task')
+
+ADMIN_CONFIG_REFRESH_SECONDS = 60
+
+
+def loop_interval_seconds():
+    try:
+        return max(1, int(os.getenv('GPUTASKER_LOOP_INTERVAL_SECONDS', '10')))
+    except ValueError:
+        return 10
+
+
+def gpu_update_mode():
+    mode = (os.getenv('GPUTASKER_GPU_UPDATE_MODE', 'report') or 'report').strip().lower()
+    return mode if mode in {'ssh', 'report'} else 'report'
+
+
+def claim_stale_seconds():
+    try:
+        return max(5, int(os.getenv('GPUTASKER_DISPATCH_CLAIM_STALE_SECONDS', '60')))
+    except ValueError:
+        return 60
+
+
+def drain_seconds():
+    try:
+        return max(0.0, float(os.getenv('GPUTASKER_SCHEDULER_DRAIN_SECONDS', '30')))
+    except ValueError:
+        return 30.0
+
+
+class SchedulerService:
+    def __init__(self, profiler=None, wakeup=None, lease=None, state=None):
+        # 分阶段计时与慢循环记录；kill -USR1 切换 cProfile，kill -USR2 记录下一轮
+        self.profiler = profiler or CycleProfiler(SCHEDULER_PHASE_SECONDS)
+        # 提交任务的接口会 touch 唤醒文件，休眠期间收到唤醒即提前开始下一轮
+        self.wakeup = wakeup or WakeupWaiter()
+        self.stopping = threading.Event()
+        self.gpu_updater = None
+        self._admin_config = None
+        self._admin_config_at = None
+        # 本进程派发的任务 id -> run_task 线程，退出时据此等待正在启动的任务
+        self._dispatched = {}
+        # 多实例模式的租约与本轮分片；单实例模式下都为 None，调度全部节点
+        self.lease = lease if lease is not None else (sharding.Lease() if sharding.enabled() else None)
+        self.shard = None
+        # 服务器与 GPU 的进程内缓存：每轮增量刷新，选卡不查库；refresh 失败的那一轮退回查库（None）
+        self.state = state or ClusterState()
+        self._placement_state = None
+
+    def install_signal_handlers(self):
+        self.profiler.install_signal_handlers()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def stop(self, *_):
+        # 信号处理函数里只置位，收尾在主循环里做
+        DRAINING.set()
+        self.stopping.set()
+
+    def admin_config(self):
+        now = time.monotonic()
+        if self._admin_config is None or now - self._admin_config_at >= ADMIN_CONFIG_REFRESH_SECONDS:
+            self._admin_config = get_admin_config()
+            self._admin_config_at = now
+        return self._admin_config
+
+    def updater(self):
+        server_username, server_private_key_path = self.admin_config()
+        if self.gpu_updater is None:
+            self.gpu_updater = GPUInfoUpdater(server_username, server_private_key_path)
+        else:
+            # 保留 utilization_history
+            self.gpu_updater.user = server_username
+            self.gpu_updater.private_key_path = server_private_key_path
+        return self.gpu_updater
+
+    @property
+    def is_leader(self):
+        return self.shard is None or self.shard.is_leader
+
+    @property
+    def server_ids(self):
+        return None if self.shard is None else self.shard.server_ids
+
+    def refresh_shard(self):
+        """多实例模式：续约并按存活实例重新分片；成员或分片变化时接管过期实例留下的运行记录。"""
+        if self.lease is None:
+            return None
+        previous = self.shard
+        self.shard = self.lease.shard()
+        if previous is not None and previous.members == self.shard.members \
+                and previous.server_ids == self.shard.server_ids:
+            return self.shard
+        task_logger.info('scheduler shard: %d server(s), %d live instance(s), leader %s',
+                         len(self.shard.server_ids), len(self.shard.members), self.shard.leader)
+        if previous is not None:
+            self.reattach(rebalance=True)
+        return self.shard
+
+    def reattach(self, startup=False, rebalance=False):
+        """接管本进程没有在监管的运行中任务，返回新起的监管线程数。
+
+        rebalance 为 True 时（多实例分片变化）按 recover 处理分片内已过期实例留下的运行记录。
+        """
+        others = None if self.shard is None else self.shard.others
+        if startup or rebalance:
+            # 重新分片时本实例自己的运行记录也不碰：pid 仍是 -1 的可能正在启动
+            ids, requeued, pending = supervisor.recover(
+                self.server_ids, others if startup else self.shard.members)
+            task_logger.info('reattach on %s: %d running, %d requeued, %d waiting for heartbeat',
+                             'startup' if startup else 'rebalance', len(ids), requeued, pending)
+        else:
+            ids = supervisor.unsupervised_runs(self.server_ids, others)
+        for running_log_id in ids:
+            threading.Thread(
+                target=supervisor.supervise, args=(running_log_id, others),
+                name='supervise-{}'.format(running_log_id), daemon=True,
+            ).start()
+        return len(ids)
+
+    def launching(self):
+        """本进程派发、还没拿到远端进程的任务数（认领后选卡中，或 ssh 已启动但还没读到远端标记）。"""
+        self._dispatched = {task_id: t for task_id, t in self._dispatched.items() if t.is_alive()}
+        if not self._dispatched:
+            return 0
+        task_ids = list(self._dispatched)
+        return (
+            GPUTask.objects.filter(pk__in=task_ids, status=0).count()
+            + GPUTaskRunningLog.objects.filter(task_id__in=task_ids, status=1, pid=-1).count()
+        )
+
+    def dispatch(self, task_id):
+        t = threading.Thread(
+            target=run_task, args=(task_id, self.server_ids, self._placement_state),
+            name='run-task-{}'.format(task_id), daemon=True)
+        self._dispatched[task_id] = t
+        t.start()
+
+    def cycle(self):
+        cycle = self.profiler.start_cycle()
+        try:
+            task_logger.info('Running processes: {:d}'.format(
+                threading.active_count() - 1
+            ))
+
+            # 多实例模式：续约、重新分片（租约表读取失败时沿用上一轮的分片）
+            try:
+                self.refresh_shard()
+            except Exception as exc:
+                task_logger.error('scheduler shard refresh failed: %s', exc)
+
+            # 运行中任务心跳超时处理（节点失联）
+            if self.is_leader:
+                try:
+                    mark_stale_running_tasks_as_lost()
+                except Exception as exc:
+                    task_logger.error('mark_stale_running_tasks_as_lost failed: %s', exc)
+            # 补接管：agent 补报了 remote_pid 的、监管线程异常退出的
+            try:
+                self.reattach()
+            except Exception as exc:
+                task_logger.error('reattach running tasks failed: %s', exc)
+            # 结束已取消的运行中任务（取消请求里只记下，后台线程 ssh 结束，不阻塞调度）
+            try:
+                maybe_kill_in_background(self.server_ids)
+            except Exception as exc:
+                task_logger.error('kill cancelled tasks failed: %s', exc)
+            cycle.lap('stale_scan')
+
+            if gpu_update_mode() == 'ssh':
+                self.updater().update_gpu_info(self.server_ids)
+                cycle.lap('gpu_update')
+            else:
+                self.admin_config()
+
+            try:
+                self.state.refresh()
+                self._placement_state = self.state
+            except Exception as exc:
+                task_logger.error('cluster state refresh failed: %s', exc)
+                self._placement_state = None
+            cycle.lap('cluster_state')
+
+            # 全局的周期性工作：多实例模式下只由 leader 做
+            if self.is_leader:
+                # GPU 历史采样的汇总与过期清理（后台线程执行，内部限频，默认每分钟一次）
+                try:
+                    gpu_timeseries.maybe_run_maintenance_in_background()
+                except Exception as exc:
+                    task_logger.error('gpu timeseries maintenance failed: %s', exc)
+
+                # 已结束运行日志的压缩与保留策略（后台线程执行，内部限频，默认每 5 分钟一次）
+                try:
+                    log_archive.maybe_compact_in_background()
+                except Exception as exc:
+                    task_logger.error('log compaction failed: %s', exc)
+
+                # 已删除运行记录的日志文件清理（后台线程执行，内部限频，默认每 30 秒一次）
+                try:
+                    log_janitor.maybe_purge_in_background()
+                except Exception as exc:
+                    task_logger.error('log janitor failed: %s', exc)
+
+                # 通知发件箱：汇总并发送邮件（后台线程执行，内部限频，默认每 10 秒一次）
+                try:
+                    notification_outbox.maybe_deliver_in_background()
+                except Exception as exc:
+                    task_logger.error('notification outbox failed: %s', exc)
+
+                # 运行日志全文索引（后台线程执行，内部限频，默认每 30 秒一次）
+                try:
+                    log_search.maybe_index_in_background()
+                except Exception as exc:
+                    task_logger.error('log search indexing failed: %s', exc)
+
+                # 兼容清理：旧版本会把任务置为 -3(调度中)。新版本已移除该状态，统一回收到“准备就绪”。
+                try:
+                    GPUTask.objects.filter(status=-3).update(status=0, dispatching_at=None, queued_at=timezone.now())
+                except Exception:
+                    pass
+            cycle.lap('housekeeping')
+            # 任务数组按空闲 GPU 展开下一批子任务，不一次性把整个参数网格塞进队列
+            if self.is_leader:
+                try:
+                    materialize_arrays()
+                except Exception as exc:
+                    task_logger.error('materialize task arrays failed: %s', exc)
+            cycle.lap('materialize')
+
+            # 任务原子认领：避免并发/多实例重复启动。
+            # 说明：历史上用 status=-3(调度中) 做中间态，容易在异常时卡死；现在用 dispatching_at 替代。
+            now = timezone.now()
+            stale_before = now - timedelta(seconds=claim_stale_seconds())
+
+            server_ids = self.server_ids
+            if server_ids is None:
+                ready_ids = ready_task_ids(stale_before)
+            elif server_ids:
+                max_gpus = self._placement_state.max_unlocked_gpus(server_ids) if self._placement_state is not None \
+                    else shard_max_gpus(server_ids)
+                ready_ids = ready_task_ids(stale_before, server_ids, max_gpus)
+            else:
+                # 实例比节点多：本实例没有分到节点
+                ready_ids = []
+            cycle.lap('ready_query')
+            for task_id in ready_ids:
+                if self.stopping.is_set():
+                    break
+                if not claim_task(task_id, now, stale_before):
+                    continue
+                self.dispatch(task_id)
+                self.stopping.wait(1)
+            cycle.lap('dispatch')
+        except Exception as e:
+            task_logger.error(str(e))
+        finally:
+            try:
+                cycle.finish()
+            except Exception as exc:
+                task_logger.error('cycle profiler failed: %s', exc)
+
+    def drain(self, timeout=None):
+        """等本进程正在启动的任务拿到远端进程，返回超时后仍在启动中的任务数。"""
+        deadline = time.monotonic() + (drain_seconds() if timeout is None else timeout)
+        while True:
+            remaining = self.launching()
+            if not remaining or time.monotonic() >= deadline:
+                break
+            time.sleep(0.5)
+        if remaining:
+            task_logger.warning('scheduler stopped with %d task(s) still launching', remaining)
+        task_logger.info('scheduler stopped; running tasks stay on their nodes and are reattached on next start')
+        return remaining
+
+    def run(self):
+        self.install_signal_handlers()
+        # 本进程的 GPU 占用/释放写穿到缓存
+        self.state.enable()
+        if self.lease is not None:
+            self.lease.start()
+            self.refresh_shard()
+        try:
+            self.reattach(startup=True)
+        except Exception as exc:
+            task_logger.error('reattach running tasks failed: %s', exc)
+        while not self.stopping.is_set():
+            start_time = time.time()
+            interval = loop_interval_seconds()
+            self.cycle()
+            # 确保至少间隔 N 秒，减少服务器负担；有新任务提交时提前唤醒
+            duration = time.time() - start_time
+            if duration < interval:
+                self.wakeup.wait(interval - duration, interrupt=self.stopping)
+        self.drain()
+        self.state.disable()
+        if self.lease is not None:
+            # 删除租约：其他实例下一轮即接手本实例的节点与运行中任务
+            try:
+                self.lease.release()
+            except Exception as exc:
+                task_logger.error('scheduler lease release failed: %s', exc)
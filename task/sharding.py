@@ -0,0 +1,165 @@
+"""多实例调度：数据库租约 + 按一致性哈希划分节点。
+
+dispatching_at 认领只保证同一个任务不会被两个调度器同时启动；多个实例仍会各自扫描整个队列、在同一批节点上抢 GPU。
+打开 GPUTASKER_SCHEDULER_SHARDING=1 后：
+
+- 每个实例在 SchedulerInstance 里登记一条租约（GPUTASKER_SCHEDULER_LEASE_SECONDS，默认 30 秒），
+  后台线程每 1/3 租期续约一次；正常退出时删除租约，其余实例下一轮即重新分片；
+- 租约未过期的实例构成哈希环（每个实例 VNODES 个虚拟节点），GPUServer 按 id 落到环上，
+  每个实例只把任务放到自己分到的节点上；实例增减时只有约 1/N 的节点换主；
+- 指定了服务器的任务只由该服务器所在分片的实例认领；未指定的任务各实例都可认领，只在本分片内选卡；
+- 租约最早的存活实例是 leader，负责全局的周期性工作（心跳超时扫描、任务数组展开、日志压缩与清理等）；
+- 运行记录上记下启动/监管它的实例（GPUTaskRunningLog.scheduler），租约过期后由接手该节点的实例重新接管。
+
+分片切换的瞬间两个实例可能短暂地都认为自己拥有同一节点，此时仍由任务认领与 GPU 原子占用保证不会重复启动。
+租约时间取各实例本机时钟，多主机部署时需要对时。
+"""
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import threading
+from datetime import timedelta
+
+from django.db import connection
+from django.utils import timezone
+
+from gpu_info.models import GPUServer
+from .models import SchedulerInstance
+
+task_logger = logging.getLogger('django.task')
+
+VNODES = 64
+
+
+def enabled():
+    return os.getenv('GPUTASKER_SCHEDULER_SHARDING', '0').strip().lower() in {'1', 'true', 'yes', 'on'}
+
+
+def lease_seconds():
+    try:
+        return max(5, int(os.getenv('GPUTASKER_SCHEDULER_LEASE_SECONDS', '30')))
+    except ValueError:
+        return 30
+
+
+def instance_name():
+    """本进程的实例名：GPUTASKER_SCHEDULER_NAME，默认 <主机名>:<pid>。"""
+    return (os.getenv('GPUTASKER_SCHEDULER_NAME') or '').strip() or '{}:{:d}'.format(socket.gethostname(), os.getpid())
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """一致性哈希环：owner(key) 返回 key 顺时针方向遇到的第一个成员。"""
+
+    def __init__(self, members, vnodes=VNODES):
+        self.members = sorted(set(members))
+        points = sorted((_hash('{}#{:d}'.format(m, i)), m) for m in self.members for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._owners = [m for _, m in points]
+
+    def owner(self, key):
+        if not self._owners:
+            return None
+        i = bisect.bisect(self._hashes, _hash(str(key))) % len(self._owners)
+        return self._owners[i]
+
+
+class Shard:
+    """一轮调度看到的分片：存活实例（按租约先后）、leader 与本实例拥有的节点 id。"""
+
+    def __init__(self, name, members, server_ids):
+        self.name = name
+        self.members = members
+        self.server_ids = server_ids
+
+    @property
+    def leader(self):
+        return self.members[0] if self.members else None
+
+    @property
+    def is_leader(self):
+        return self.leader == self.name
+
+    @property
+    def others(self):
+        return [m for m in self.members if m != self.name]
+
+
+def live_members(now=None):
+    now = now or timezone.now()
+    return list(SchedulerInstance.objects.filter(expires_at__gte=now).order_by('id').values_list('name', flat=True))
+
+
+def assign_servers(members, server_ids):
+    """按一致性哈希把节点分给各实例，返回 实例名 -> [节点 id]。"""
+    ring = HashRing(members)
+    shards = {m: [] for m in ring.members}
+    for pk in server_ids:
+        owner = ring.owner(pk)
+        if owner is not None:
+            shards[owner].append(pk)
+    return shards
+
+
+class Lease:
+    def __init__(self, name=None, ttl=None):
+        self.name = name or instance_name()
+        self.ttl = ttl or lease_seconds()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def renew(self):
+        """续约；租约已被清理（例如本实例卡顿超过租期）时重新登记。"""
+        now = timezone.now()
+        expires_at = now + timedelta(seconds=self.ttl)
+        if SchedulerInstance.objects.filter(name=self.name).update(renewed_at=now, expires_at=expires_at):
+            return
+        SchedulerInstance.objects.update_or_create(
+            name=self.name,
+            defaults={
+                'hostname': socket.gethostname(),
+                'pid': os.getpid(),
+                'renewed_at': now,
+                'expires_at': expires_at,
+            },
+        )
+
+    def _renew_loop(self):
+        try:
+            while not self._stop.wait(self.ttl / 3.0):
+                try:
+                    self.renew()
+                except Exception as exc:
+                    task_logger.error('scheduler lease renewal failed: %s', exc)
+        finally:
+            connection.close()
+
+    def start(self):
+        self.renew()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._renew_loop, name='scheduler-lease', daemon=True)
+        self._thread.start()
+
+    def release(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        SchedulerInstance.objects.filter(name=self.name).delete()
+
+    def shard(self, now=None):
+        """按当前存活实例计算本实例的分片；顺带清理过期已久的租约。"""
+        now = now or timezone.now()
+        members = live_members(now)
+        if self.name not in members:
+            self.renew()
+            members = live_members(now)
+        if members and members[0] == self.name:
+            SchedulerInstance.objects.filter(expires_at__lt=now - timedelta(seconds=self.ttl)).delete()
+        server_ids = sorted(GPUServer.objects.values_list('id', flat=True))
+        return Shard(self.name, members, assign_servers(members, server_ids).get(self.name, []))
@@ -0,0 +1,302 @@
+"""运行中任务的监管与调度器重启后的重新接管。
+
+以前调度器（main.py）一重启，所有 run_task 线程和 ssh 会话随之结束：远端任务要么写输出时因 SIGPIPE 退出，
+要么继续运行却没人收尾（运行记录一直“运行中”，GPU 一直被占用）。现在：
+
+- 远端任务的输出在节点上另存一份（<META_DIR>/<id>.out），退出码写到 <id>.exit（见 RemoteGPUProcessGroup）；
+- master 日志每次写盘后记下已落盘的远端输出行数（<日志>.lines，见 task.log_writer.OutputCheckpoint）；
+- 调度器启动时按 GPUTaskRunningLog（remote_pid/pgid、心跳）重建运行中任务的视图（recover）：
+  已知远端进程的，起线程 ssh 到节点 `tail -n +<下一行> --pid=<remote_pid> -F` 续接输出，
+  进程结束后读退出码收尾（更新状态、记账、通知、释放 GPU，与 run_task 相同）；
+  还没启动远端进程的运行记录作废并把任务放回队列；启动到一半（有 spawned_at、没有 remote_pid）的交给心跳判断，
+  agent 上报 remote_pid 后由后续的 unsupervised_runs 扫描接管；
+- run_task 的 ssh 会话意外断开（255）时同样交给这里，不再把仍在运行的任务判为失败；
+  节点上的退出码文件表明用户程序本身以 255 退出时照常收尾（见 exited_with）。
+
+多实例模式（见 task.sharding）下，运行记录的 scheduler 字段是正在监管它的实例：接管前比较后更新，
+其他存活实例监管中的记录不碰，实例租约过期后由分到该节点的实例接管。
+
+续接时可能重复最后几秒的输出（检查点最多每 5 秒写一次），不会丢。节点不可达时按指数退避重试，
+直到任务结束、被手动结束或调度器退出。
+"""
+import logging
+import os
+import traceback
+
+from django.db import connection
+from django.utils import timezone
+
+from gpu_info.models import release_gpus
+from gpu_info.utils import observe_ssh
+from notification.email_notification import send_task_fail_email, send_task_finish_email
+from .accounting import safe_account_run
+from . import sharding
+from .log_writer import OutputCheckpoint, checkpoint_path, read_checkpoint, stream_to_file
+from .models import GPUTask, GPUTaskRunningLog
+from .utils import DRAINING, RemoteGPUProcessGroup, RemoteProcess, _mark_gpus_released, _open_metric_extractor, \
+    _parse_gpu_list, attach, attached_ids, detach
+
+task_logger = logging.getLogger('django.task')
+
+RETRY_MIN_SECONDS = 5
+RETRY_MAX_SECONDS = 300
+UNKNOWN_EXIT_REMARK = '重新接管后未取得退出码'
+ABANDONED_REMARK = '调度器重启时远端进程尚未启动，已重新排队'
+
+
+def remote_paths(running_log_id):
+    """节点上的 (输出副本, 退出码文件) 路径（$HOME 由远端 shell 展开）。"""
+    prefix = '{}/{:d}'.format(RemoteGPUProcessGroup.META_DIR, running_log_id)
+    return prefix + '.out', prefix + '.exit'
+
+
+def _remote(running_log, cmd, output_file):
+    config = running_log.task.user.config
+    # output_file 非空时 ssh 的 stdout 走管道，由调用方读取
+    return RemoteProcess(
+        config.server_username,
+        running_log.server.ip,
+        cmd,
+        '~',
+        running_log.server.port,
+        config.server_private_key_path,
+        output_file=output_file,
+    )
+
+
+def _follow(running_log, start_line, announce):
+    """续接远端输出（从第 start_line + 1 行起）直到远端进程结束，返回 (ssh 退出码, 已落盘的行数)。"""
+    path = running_log.log_file_path
+    out_path, _ = remote_paths(running_log.id)
+    if announce:
+        with open(path, 'ab') as f:
+            f.write('[gputasker] {} 重新接管，从远端输出第 {} 行继续\n'.format(
+                timezone.now().strftime('%Y-%m-%d %H:%M:%S'), start_line + 1).encode('utf-8'))
+    process = _remote(
+        running_log,
+        'tail -n +{:d} --pid={:d} -F "{}" 2>/dev/null; true'.format(start_line + 1, running_log.remote_pid, out_path),
+        path,
+    )
+    observer = _open_metric_extractor(running_log, running_log.task)
+    try:
+        writer = stream_to_file(
+            process.proc.stdout.fileno(), path,
+            observer=observer.feed if observer else None,
+            checkpoint=OutputCheckpoint(path, base=start_line),
+        )
+    finally:
+        if observer is not None:
+            observer.close()
+    return process.get_return_code(), start_line + writer.lines_in
+
+
+def _probe(running_log):
+    """远端进程状态：('exited', 退出码)、('running', None)、('unknown', None)；ssh 失败时返回 None。
+
+    已结束的会顺带删除节点上的输出副本与退出码文件。
+    """
+    out_path, exit_path = remote_paths(running_log.id)
+    cmd = (
+        'if [ -f "{exit}" ]; then cat "{exit}"; rm -f "{exit}" "{out}"; '
+        'elif kill -0 {pid:d} 2>/dev/null; then echo running; '
+        'else echo unknown; rm -f "{out}"; fi'
+    ).format(exit=exit_path, out=out_path, pid=running_log.remote_pid)
+    process = _remote(running_log, cmd, os.devnull)
+    try:
+        with observe_ssh('supervise'):
+            output = process.proc.stdout.read().decode('utf-8', errors='replace').strip()
+            if process.get_return_code() == 255:
+                raise RuntimeError('ssh failed')
+    except RuntimeError:
+        return None
+    word = output.splitlines()[-1].strip() if output else 'unknown'
+    if word in ('running', 'unknown'):
+        return word, None
+    try:
+        return 'exited', int(word)
+    except ValueError:
+        return 'unknown', None
+
+
+def exited_with(running_log, return_code):
+    """远端进程是否已经以 return_code 退出（节点上的退出码文件）；是则删除节点上的输出副本与退出码文件。
+
+    ssh 自身失败也是 255：run_task 据此区分用户程序以 255 退出与 ssh 会话断开。ssh 失败或其他情况返回 False，
+    此时不动节点上的文件，留给 supervisor 续接输出。
+    """
+    out_path, exit_path = remote_paths(running_log.id)
+    cmd = 'if [ "$(cat "{exit}" 2>/dev/null)" = "{code:d}" ]; then rm -f "{exit}" "{out}"; echo exited; fi'.format(
+        exit=exit_path, out=out_path, code=return_code)
+    process = _remote(running_log, cmd, os.devnull)
+    try:
+        with observe_ssh('supervise'):
+            output = process.proc.stdout.read().decode('utf-8', errors='replace').strip()
+            if process.get_return_code() == 255:
+                raise RuntimeError('ssh failed')
+    except RuntimeError:
+        return False
+    return output.endswith('exited')
+
+
+def finish_run(running_log, return_code):
+    """远端进程已结束：与 run_task 相同地收尾。return_code 为 None 表示退出码未知，按失败处理。
+
+    只处理仍是“运行中/节点失联”的记录（期间被手动结束的不再覆盖），返回是否收尾。
+    """
+    ok = return_code == 0
+    now = timezone.now()
+    updated = GPUTaskRunningLog.objects.filter(pk=running_log.pk, status__in=(1, -2)).update(
+        status=2 if ok else -1,
+        finished_at=now,
+        update_at=now,
+        remark=running_log.remark if return_code is not None else UNKNOWN_EXIT_REMARK,
+    )
+    if updated:
+        safe_account_run(running_log.id)
+        if running_log.task_id:
+            GPUTask.objects.filter(pk=running_log.task_id, status__in=(1, -4)).update(
+                status=2 if ok else -1, update_at=now)
+        running_log.refresh_from_db()
+        task_logger.info('Task {:d} (running log {:d}) stopped after reattach, return_code: {}'.format(
+            running_log.task_id, running_log.id, return_code))
+        if ok:
+            send_task_finish_email(running_log)
+        else:
+            send_task_fail_email(running_log)
+    try:
+        gpus = _parse_gpu_list(running_log.gpus)
+        if running_log.server is not None and gpus:
+            release_gpus(running_log.server, gpus, busy_by_log_id=running_log.id)
+            _mark_gpus_released(running_log.id)
+    except Exception:
+        task_logger.error(traceback.format_exc())
+    try:
+        os.remove(checkpoint_path(running_log.log_file_path))
+    except OSError:
+        pass
+    return bool(updated)
+
+
+def _load(running_log_id):
+    return (
+        GPUTaskRunningLog.objects
+        .select_related('task', 'task__user', 'task__user__config', 'server')
+        .filter(pk=running_log_id)
+        .first()
+    )
+
+
+def _supervise(running_log_id):
+    delay = RETRY_MIN_SECONDS
+    lines = None
+    while not DRAINING.is_set():
+        running_log = _load(running_log_id)
+        if running_log is None or running_log.status not in (1, -2) or running_log.server is None \
+                or not running_log.remote_pid:
+            return False
+        announce = lines is None
+        if announce:
+            lines = read_checkpoint(running_log.log_file_path)
+        return_code, lines = _follow(running_log, lines, announce)
+        state = None if return_code == 255 else _probe(running_log)
+        if state is None:
+            # 节点不可达：指数退避后重试，期间心跳超时会照常把任务标记为失联
+            DRAINING.wait(delay)
+            delay = min(delay * 2, RETRY_MAX_SECONDS)
+            continue
+        if state[0] == 'running':
+            # tail 提前结束（例如 ssh 会话被节点断开），稍后继续
+            delay = RETRY_MIN_SECONDS
+            DRAINING.wait(delay)
+            continue
+        return finish_run(running_log, state[1])
+    return False
+
+
+def claim(running_log_id, others=None):
+    """把运行记录的监管者记为本实例；others 为其他存活实例，已由它们监管的不抢，返回是否成功。"""
+    qs = GPUTaskRunningLog.objects.filter(pk=running_log_id)
+    if others:
+        qs = qs.exclude(scheduler__in=others)
+    return qs.update(scheduler=sharding.instance_name()) == 1
+
+
+def supervise(running_log_id, others=None):
+    """监管一个已知远端进程的运行记录直到结束并收尾（阻塞）。
+
+    已有线程在监管、或已由其他存活实例（others）监管时直接返回 False。
+    """
+    if not attach(running_log_id):
+        return False
+    try:
+        if not claim(running_log_id, others):
+            return False
+        return _supervise(running_log_id)
+    except Exception:
+        task_logger.error(traceback.format_exc())
+        return False
+    finally:
+        detach(running_log_id)
+        connection.close()
+
+
+def _scope(qs, server_ids, others):
+    if server_ids is not None:
+        qs = qs.filter(server_id__in=server_ids)
+    if others:
+        qs = qs.exclude(scheduler__in=others)
+    return qs
+
+
+def unsupervised_runs(server_ids=None, others=None):
+    """运行中/失联、已知远端进程、但本进程没有线程在监管的运行记录 id（不含其他存活实例 others 的）。"""
+    qs = GPUTaskRunningLog.objects.filter(status__in=(1, -2), remote_pid__isnull=False, server__isnull=False)
+    qs = _scope(qs, server_ids, others)
+    attached = attached_ids()
+    return [pk for pk in qs.order_by('id').values_list('id', flat=True) if pk not in attached]
+
+
+def _abandon(running_log):
+    """远端进程还没启动的运行记录：作废、释放 GPU，任务放回“准备就绪”。"""
+    now = timezone.now()
+    if not GPUTaskRunningLog.objects.filter(pk=running_log.pk, status=1).update(
+            status=-1, finished_at=now, update_at=now, remark=ABANDONED_REMARK):
+        return False
+    safe_account_run(running_log.id)
+    GPUTask.objects.filter(pk=running_log.task_id, status=1).update(status=0, dispatching_at=None, update_at=now)
+    gpus = _parse_gpu_list(running_log.gpus)
+    if running_log.server is not None and gpus:
+        release_gpus(running_log.server, gpus, busy_by_log_id=running_log.id)
+        _mark_gpus_released(running_log.id)
+    return True
+
+
+def recover(server_ids=None, others=None):
+    """调度器启动时按运行记录重建运行中任务的视图，返回 (待接管的运行记录 id, 重新排队数, 交给心跳判断数)。
+
+    只能在本进程还没有派发任务时调用：pid 仍是 -1 的运行记录会被视为上一个调度器进程遗留的。
+    多实例模式下只处理本分片（server_ids）内、不属于其他存活实例（others）的运行记录。
+    """
+    qs = GPUTaskRunningLog.objects.select_related('server').filter(status__in=(1, -2))
+    qs = _scope(qs, server_ids, others)
+    attached = attached_ids()
+    supervise_ids = []
+    requeued = 0
+    pending = []
+    for running_log in qs.order_by('id'):
+        if running_log.id in attached:
+            continue
+        if running_log.remote_pid and running_log.server_id is not None:
+            supervise_ids.append(running_log.id)
+        elif running_log.status == 1 and running_log.pid == -1 and running_log.spawned_at is None:
+            try:
+                requeued += _abandon(running_log)
+            except Exception:
+                task_logger.error(traceback.format_exc())
+        elif running_log.last_heartbeat_at is None:
+            pending.append(running_log.id)
+    if pending:
+        # 远端进程可能已经启动：等 agent 心跳补上 remote_pid；一直没有心跳的，超时后照常标记为失联
+        GPUTaskRunningLog.objects.filter(pk__in=pending, last_heartbeat_at__isnull=True).update(
+            last_heartbeat_at=timezone.now())
+    return supervise_ids, requeued, len(pending)
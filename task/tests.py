@@ -1,3 +1,1825 @@
-from django.test import TestCase
+import itertools
+import json
+import os
+import pstats
+import shlex
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.admin.models import LogEntry
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.exceptions import ValidationError
+from django.core.mail.backends import locmem
+from django.db import DatabaseError, connection
+from django.db.models import Sum
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from base.benchmark import bulk_insert
+from base.models import UserConfig
+from base.telemetry import Histogram, Registry
+from base.testing import QueryPlanAssertionsMixin
+from gpu_info.cluster_state import ClusterState
+from gpu_info.models import GPUInfo, GPUServer
+from notification import outbox
+from notification.email_notification import send_task_fail_email, send_task_finish_email, send_task_start_email
+from . import accounting, metrics
+from .cycle_profiler import CycleProfiler
+from .arrays import params_at, render, validate_params as validate_array_params
+from .log_archive import archive_path, compact_logs, compress_log
+from .log_janitor import purge_deleted_logs
+from .log_reader import LogReader, INDEX_SUFFIX
+from .log_search import LogSearchIndex, snippets
+from .lifecycle import dispatch_stats, percentile, timeline
+from .log_writer import BufferedLogWriter, OutputCheckpoint, checkpoint_path, read_checkpoint, stream_to_file
+from .metrics import MetricExtractor, compile_patterns, read_series, series_path, validate_patterns
+from .log_stream import LogEventStream, acquire_stream_slot, acquire_watcher_slot, remove_watcher_slots
+from .models import GPUTask, GPUTaskRunningLog, GPUUsage, LogDeletion, Notification, Project, SchedulerInstance, \
+    TaskArray, TaskGroup
+from .scheduler import SchedulerService
+from .sharding import HashRing, Lease, assign_servers
+from .supervisor import UNKNOWN_EXIT_REMARK, claim, recover, supervise, unsupervised_runs
+from .utils import DRAINING, RemoteGPUProcessGroup, _claimable, _open_metric_extractor, ready_task_ids, claim_task, \
+    mark_stale_running_tasks_as_lost, materialize_arrays, expand_array, run_task, attach, attached_ids, detach, \
+    shard_max_gpus, kill_requested_runs
+from .views import ingest_task_heartbeats
+from .wakeup import WakeupWaiter, notify_scheduler
+
+# 默认按线上规模灌数据（约 10 秒）；本地快速迭代时可以调小
+SEED_TASKS = int(os.getenv('GPUTASKER_TEST_SEED_TASKS', '100000'))
+SEED_RUNNING_LOGS = int(os.getenv('GPUTASKER_TEST_SEED_RUNNING_LOGS', '500000'))
+
+
+class SchedulerHotPathTest(QueryPlanAssertionsMixin, TestCase):
+    """调度主循环、心跳超时扫描、心跳上报的查询预算与执行计划。"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='seed')
+        cls.server = GPUServer.objects.create(ip='10.0.0.1')
+        now = timezone.now()
+        cls.now = now
+
+        # 绝大多数任务已结束，约 2% 处于“准备就绪”
+        finished_status = (2, 2, 2, -1, 2, -4)
+        bulk_insert(
+            GPUTask,
+            ['name', 'user', 'workspace', 'cmd', 'metric_patterns', 'gpu_requirement', 'exclusive_gpu',
+             'memory_requirement', 'utilization_requirement', 'priority', 'status', 'create_at', 'update_at'],
+            (
+                ('seed-{}'.format(i), cls.user.pk, '~', 'true\n', '', 1, False, 0, 0, i % 5,
+                 0 if i % 50 == 0 else finished_status[i % len(finished_status)],
+                 now - timedelta(seconds=SEED_TASKS - i), now)
+                for i in range(SEED_TASKS)
+            ),
+        )
+        first_task_id = GPUTask.objects.order_by('id').values_list('id', flat=True).first()
+
+        # 约 1% 的运行记录仍在运行，且心跳新鲜
+        bulk_insert(
+            GPUTaskRunningLog,
+            ['index', 'task', 'server', 'pid', 'gpus', 'log_file_path', 'remark', 'metrics', 'status',
+             'last_heartbeat_at', 'start_at', 'update_at'],
+            (
+                (i // SEED_TASKS, first_task_id + i % SEED_TASKS, cls.server.pk, -1, '0', 'seed.log', '', '',
+                 1 if i % 100 == 0 else 2, now, now, now)
+                for i in range(SEED_RUNNING_LOGS)
+            ),
+        )
+
+    def test_ready_queue_budget_and_plan(self):
+        stale_before = timezone.now() - timedelta(seconds=60)
+        with self.assertNumQueries(1):
+            ids = ready_task_ids(stale_before)
+        self.assertEqual(len(ids), GPUTask.objects.filter(status=0).count())
+
+        priorities = list(GPUTask.objects.filter(id__in=ids[:50]).values_list('id', 'priority'))
+        priority_of = dict(priorities)
+        head = [priority_of[i] for i in ids[:50]]
+        self.assertEqual(head, sorted(head, reverse=True))
+
+        qs = _claimable(GPUTask.objects.all(), stale_before).order_by('-priority', 'create_at').values_list('id', flat=True)
+        self.assertUsesIndex(qs, 'gputask_queue_idx')
+        self.assertNoSortStep(qs)
+
+    def test_claim_is_single_atomic_update(self):
+        stale_before = timezone.now() - timedelta(seconds=60)
+        task_id = ready_task_ids(stale_before)[0]
+        now = timezone.now()
+        with self.assertNumQueries(1):
+            self.assertTrue(claim_task(task_id, now, stale_before))
+        with self.assertNumQueries(1):
+            self.assertFalse(claim_task(task_id, now, stale_before))
+        # 认领超时后可被重新认领
+        self.assertTrue(claim_task(task_id, now, now + timedelta(seconds=1)))
+
+    def test_stale_scan_budget_and_plan(self):
+        with self.assertNumQueries(1):
+            mark_stale_running_tasks_as_lost()
+
+        stale_before = timezone.now() - timedelta(seconds=180)
+        qs = GPUTaskRunningLog.objects.filter(status=1, last_heartbeat_at__lt=stale_before).order_by()
+        self.assertUsesIndex(qs, 'runlog_status_hb_idx')
+        self.assertNoSortStep(qs)
+
+    def test_stale_scan_marks_lost(self):
+        task = GPUTask.objects.create(name='lost', user=self.user, workspace='~', cmd='true', status=1)
+        log = GPUTaskRunningLog.objects.create(
+            index=0, task=task, server=self.server, pid=-1, gpus='0', log_file_path='lost.log', status=1,
+        )
+        GPUTaskRunningLog.objects.filter(pk=log.pk).update(last_heartbeat_at=timezone.now() - timedelta(hours=1))
+
+        # 1 次扫描 + 运行记录、任务各 1 次更新 + 用量记账（保存点 2 次、读取、比较后更新、补齐与累加汇总）
+        with self.assertNumQueries(9):
+            mark_stale_running_tasks_as_lost()
+        log.refresh_from_db()
+        task.refresh_from_db()
+        self.assertEqual(log.status, -2)
+        self.assertEqual(task.status, -4)
+
+    def test_heartbeat_ingest_budget(self):
+        log_ids = list(
+            GPUTaskRunningLog.objects.filter(status=1, server=self.server).values_list('id', flat=True)[:10]
+        )
+        payload = [{'running_log_id': log_id} for log_id in log_ids]
+        # 存活时间与可用标记走批量写回，不计入单次上报的预算
+        with mock.patch('gpu_info.report_auth.liveness.touch'):
+            with self.assertNumQueries(2 * len(log_ids)):
+                updated, revived = ingest_task_heartbeats(self.server, payload)
+        self.assertEqual(updated, len(log_ids))
+        self.assertEqual(revived, 0)
+
+
+class AdminQueryBudgetTest(QueryPlanAssertionsMixin, TestCase):
+    """后台热点页面（任务列表、Dashboard、项目页、运行记录）的查询数不随任务数增长。"""
+
+    TASKS = 5000
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'x')
+        cls.owner = User.objects.create(username='owner')
+        servers = [GPUServer.objects.create(ip='10.3.0.{}'.format(i)) for i in range(3)]
+        cls.project = Project.objects.create(name='p')
+        groups = [TaskGroup.objects.create(project=cls.project, name='g{}'.format(i)) for i in range(20)]
+        cls.group, cls.small_group = groups[0], groups[1]
+        now = timezone.now()
+        bulk_insert(
+            GPUTask,
+            ['name', 'user', 'group', 'workspace', 'cmd', 'metric_patterns', 'gpu_requirement', 'exclusive_gpu',
+             'memory_requirement', 'utilization_requirement', 'assign_server', 'priority', 'status',
+             'create_at', 'update_at'],
+            (
+                ('t{}'.format(i), cls.owner.pk, cls.group.pk if i >= 50 else cls.small_group.pk, '~', 'true', '',
+                 1, False, 0, 0, servers[i % 3].pk, 0, i % 3, now, now)
+                for i in range(cls.TASKS)
+            ),
+        )
+        task_ids = list(GPUTask.objects.order_by('-id').values_list('id', flat=True)[:300])
+        bulk_insert(
+            GPUTaskRunningLog,
+            ['index', 'task', 'server', 'pid', 'gpus', 'log_file_path', 'remark', 'metrics', 'progress', 'status',
+             'start_at', 'update_at'],
+            (
+                (0, task_id, servers[i % 3].pk, 1, '0', 'missing.log', '', '{"loss":0.5}', 0.5, 2, now, now)
+                for i, task_id in enumerate(task_ids)
+            ),
+        )
+        cls.task = GPUTask.objects.get(pk=task_ids[0])
+        for i in range(1, 20):
+            GPUTaskRunningLog.objects.create(index=i, task=cls.task, server=servers[i % 3], pid=1, gpus='0',
+                                             log_file_path='missing.log', status=2)
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def _get(self, url, budget):
+        with self.assertMaxNumQueries(budget):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        return response
+
+    def test_group_changelist(self):
+        response = self._get('/admin/task/gputask/group/{}/'.format(self.group.pk), 11)
+        self.assertEqual(response.context['cl'].result_count, self.TASKS - 50)
+        self.assertContains(response, 'loss=0.5')
+
+    def test_dashboard_and_project_counts(self):
+        response = self._get('/admin/task/gputask/', 5)
+        project = {p.pk: p for p in response.context['projects']}[self.project.pk]
+        self.assertEqual((project.group_count, project.task_count), (20, self.TASKS))
+        self.assertEqual(project.running_count, GPUTask.objects.filter(status=1).count())
+        response = self._get('/admin/task/gputask/project/{}/'.format(self.project.pk), 5)
+        counts = {g.pk: (g.task_count, g.ready_count) for g in response.context['groups']}
+        self.assertEqual(counts[self.small_group.pk], (50, 17))
+
+    def test_running_log_changelist(self):
+        self._get('/admin/task/gputaskrunninglog/', 8)
+
+    def test_change_pages(self):
+        self._get('/admin/task/gputask/{}/change/'.format(self.task.pk), 11)
+        self._get('/admin/task/taskgroup/{}/change/'.format(self.small_group.pk), 12)
+
+
+class LogReaderTest(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.log')
+        os.close(fd)
+        self.lines = ['line {} {}'.format(i, 'x' * (i % 37)) for i in range(5000)]
+        with open(self.path, 'w') as f:
+            f.write('\n'.join(self.lines) + '\n')
+
+    def tearDown(self):
+        for p in (self.path, self.path + INDEX_SUFFIX):
+            if os.path.exists(p):
+                os.remove(p)
+
+    def test_tail_and_earlier_pages(self):
+        with LogReader.open(self.path) as reader:
+            page = reader.tail(10)
+            self.assertEqual(page.text.splitlines(), self.lines[-10:])
+            earlier = reader.page_before(page.start, 10)
+            self.assertEqual(earlier.text.splitlines(), self.lines[-20:-10])
+            self.assertTrue(earlier.has_more_before)
+            self.assertEqual(reader.page_before(0, 10).data, b'')
+
+    def test_page_is_bounded_by_bytes(self):
+        with open(self.path, 'ab') as f:
+            f.write(b'y' * 100000 + b'\n')
+        with LogReader.open(self.path) as reader:
+            page = reader.tail(10, max_bytes=4096)
+            self.assertLessEqual(len(page.data), 4096)
+
+    def test_incremental_line_index(self):
+        with LogReader.open(self.path, index_every=100) as reader:
+            self.assertIsNone(reader.offset_of_line(10))
+            while not reader.update_index(budget_bytes=10000):
+                pass
+            self.assertEqual(reader.index_status()[1], len(self.lines))
+            page = reader.page_at_line(1234, 3)
+            self.assertEqual(page.text.splitlines(), self.lines[1234:1237])
+            self.assertEqual(reader.line_of_offset(page.start), 1234)
+
+            with open(self.path, 'a') as f:
+                f.write('appended\n')
+            self.assertTrue(reader.update_index())
+            self.assertEqual(reader.page_at_line(len(self.lines), 1).text, 'appended\n')
+
+    def test_archived_log_reads_transparently(self):
+        with LogReader.open(self.path, index_every=100) as reader:
+            reader.update_index()
+            expected = reader.page_at_line(1234, 3).text
+        compress_log(self.path, frame_size=4096)
+        self.assertFalse(os.path.exists(self.path))
+        with LogReader.open(self.path, index_every=100) as reader:
+            self.assertTrue(reader.archived)
+            self.assertEqual(reader.tail(10).text.splitlines(), self.lines[-10:])
+            self.assertEqual(reader.page_at_line(1234, 3).text, expected)
+        os.remove(archive_path(self.path))
+
+    def test_event_stream_resumes_from_offset(self):
+        offset = len(('\n'.join(self.lines[:-2]) + '\n').encode())
+        stream = LogEventStream(self.path, offset, live=False, duration=1)
+        body = b''.join(iter(stream)).decode()
+        stream.close()
+        self.assertIn('event: log', body)
+        self.assertIn(json.dumps('\n'.join(self.lines[-2:]) + '\n'), body)
+        self.assertNotIn(self.lines[-3], body)
+        self.assertIn('event: end', body)
+
+    def test_watcher_slots_are_capped(self):
+        first = acquire_watcher_slot(self.path, limit=1)
+        self.assertIsNotNone(first)
+        self.assertIsNone(acquire_watcher_slot(self.path, limit=1))
+        first.release()
+        again = acquire_watcher_slot(self.path, limit=1)
+        self.assertIsNotNone(again)
+        again.release()
+        remove_watcher_slots(self.path)
+
+    def test_streams_are_capped_across_logs(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'x')
+        task = GPUTask.objects.create(name='t', user=admin, workspace='~', cmd='true', status=1)
+        run = GPUTaskRunningLog.objects.create(index=0, task=task, server=GPUServer.objects.create(ip='10.9.4.1'),
+                                               pid=1, gpus='0', log_file_path=self.path, status=1)
+        url = reverse('admin:task_gputaskrunninglog_log_stream', args=(run.pk,))
+        self.client.force_login(admin)
+        use_temp_running_log_dir(self)
+        self.addCleanup(remove_watcher_slots, self.path)
+
+        with mock.patch.dict(os.environ, {'GPUTASKER_LOG_STREAM_MAX_STREAMS': '1'}):
+            # 其他日志的推送占满了全站名额
+            other = acquire_stream_slot()
+            response = self.client.get(url)
+            self.assertEqual((response.status_code, response.json()['error']), (503, 'too_many_streams'))
+            self.assertEqual(response['Retry-After'], '10')
+            other.release()
+
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIsNone(acquire_stream_slot())
+            # 响应关闭（客户端断开）时两个名额都释放
+            response.close()
+            slot = acquire_stream_slot()
+            self.assertIsNotNone(slot)
+            slot.release()
+
+
+class BufferedLogWriterTest(TestCase):
+    class _Out:
+        def __init__(self):
+            self.data = b''
+
+        def write(self, data):
+            self.data += bytes(data)
+
+    def _writer(self, clock):
+        out = self._Out()
+        return out, BufferedLogWriter(out, flush_interval=1.0, flush_size=1 << 20, clock=clock)
+
+    def test_collapses_redraws_and_split_crlf(self):
+        out, writer = self._writer(lambda: 0.0)
+        for chunk in (b'a\r', b'\nEpoch 1:  10%\rEpoch 1:  50%', b'\rEpoch 1: 100%\n', b'tail'):
+            writer.feed(chunk)
+        writer.close()
+        self.assertEqual(out.data, b'a\nEpoch 1: 100%\ntail\n')
+        self.assertEqual(writer.writes, 1)
+
+    def test_output_ending_in_cr_keeps_last_redraw(self):
+        out, writer = self._writer(lambda: 0.0)
+        writer.feed(b'eval 10%\reval 100%\r')
+        writer.close()
+        self.assertEqual(out.data, b'eval 100%\n')
+
+    def test_long_redraw_is_snapshotted_once_per_flush(self):
+        now = [0.0]
+        out, writer = self._writer(lambda: now[0])
+        writer.feed(b' 10%\r 20%\r')
+        now[0] = 1.5
+        writer.feed(b' 30%\r')
+        self.assertEqual(out.data, b' 30%\n')
+        writer.feed(b'100%\n')
+        writer.close()
+        self.assertEqual(out.data, b' 30%\n100%\n')
+
+
+class MetricExtractorTest(TestCase):
+    def _extractor(self, clock, patterns='', series=None):
+        flushed = []
+        extractor = MetricExtractor(
+            series, compile_patterns(patterns), on_flush=lambda latest, progress: flushed.append((latest, progress)),
+            clock=clock, sample_interval=10, flush_interval=30,
+        )
+        return extractor, flushed
+
+    def test_builtin_rules_keep_last_value(self):
+        extractor, flushed = self._extractor(lambda: 0.0)
+        extractor.feed(
+            b'Epoch 3/10 step 5/100 Loss: 0.9 lr=1e-4\n'
+            b'step 6/100 loss=0.5 train_loss=0.7 val_loss_scale=3\n'
+            b'Epoch 3: 40%|####      | 40/100\n'
+        )
+        self.assertEqual(extractor.latest, {
+            'epoch': 3, 'epoch_total': 10, 'step': 6, 'step_total': 100,
+            'loss': 0.5, 'lr': 0.0001, 'train_loss': 0.7, 'percent': 40,
+        })
+        # epoch 优先于 step 与百分比
+        self.assertEqual(flushed, [(extractor.latest, 0.3)])
+
+    def test_gated_rules_skip_only_when_short_keyword_is_absent(self):
+        extractor, _ = self._extractor(lambda: 0.0)
+        extractor.feed(b'val_loss=0.4 val_acc=0.8\n')
+        self.assertEqual(extractor.latest, {'val_loss': 0.4, 'val_acc': 0.8})
+        with mock.patch('task.metrics._last_match', wraps=metrics._last_match) as last_match:
+            extractor.feed(b'step 7 done\n')
+        scanned = {call.args[1] for call in last_match.call_args_list}
+        self.assertIn(b'loss', scanned)
+        self.assertFalse({b'train_loss', b'val_loss', b'accuracy', b'val_acc'} & scanned)
+
+    def test_extractor_only_opened_for_tasks_with_patterns(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            running_log = GPUTaskRunningLog(id=1, log_file_path=os.path.join(tmpdir, 'run.log'))
+            plain, custom = GPUTask(metric_patterns=''), GPUTask(metric_patterns=r'wer (?P<wer>[\d.]+)')
+            self.assertIsNone(_open_metric_extractor(running_log, plain))
+            extractor = _open_metric_extractor(running_log, custom)
+            self.assertIsInstance(extractor, MetricExtractor)
+            extractor.close()
+            with mock.patch.dict(os.environ, {'GPUTASKER_METRICS_ALL_TASKS': '1'}):
+                extractor = _open_metric_extractor(running_log, plain)
+            self.assertEqual(extractor.patterns, [])
+            extractor.close()
+
+    def test_custom_patterns(self):
+        extractor, _ = self._extractor(lambda: 0.0, r'(?P<name>wer|cer)\s+(?P<value>[\d.]+)' '\n' r'round (?P<round>\d+)')
+        extractor.feed(b'wer 0.3 cer 0.1\nround 2\nwer 0.25\n')
+        self.assertEqual(extractor.latest, {'wer': 0.25, 'cer': 0.1, 'round': 2})
+        validate_patterns(r'(?P<name>x)=(?P<value>\d+)')
+        for text in (r'(?P<bad', r'loss=(\d+)'):
+            with self.assertRaises(ValidationError):
+                validate_patterns(text)
+
+    def test_series_is_sampled_and_db_flush_throttled(self):
+        now = [0.0]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log = os.path.join(tmpdir, 'run.log')
+            extractor, flushed = self._extractor(lambda: now[0], series=open(series_path(log), 'ab'))
+            extractor.feed(b'loss=1.0\n')
+            now[0] = 5
+            extractor.feed(b'loss=0.9\n')
+            now[0] = 12
+            extractor.feed(b'loss=0.8 acc=0.5\n')
+            self.assertEqual(len(flushed), 1)
+            extractor.close()
+            self.assertEqual(flushed[-1][0], {'loss': 0.8, 'acc': 0.5})
+            self.assertEqual(read_series(log), {'loss': [(0, 1), (12, 0.8)], 'acc': [(12, 0.5)]})
+
+    def test_writer_observer_sees_flushed_bytes_and_failures_do_not_block_writes(self):
+        extractor, _ = self._extractor(lambda: 0.0)
+        out = BufferedLogWriterTest._Out()
+        writer = BufferedLogWriter(out, flush_interval=1.0, flush_size=1 << 20, clock=lambda: 0.0,
+                                   observer=extractor.feed)
+        writer.feed(b' 10%|#\r 90%|#########\r100%|##########| loss=0.2\n')
+        writer.close()
+        self.assertEqual(extractor.latest, {'percent': 100, 'loss': 0.2})
+
+        def fail(data):
+            raise ValueError(data)
+
+        out = BufferedLogWriterTest._Out()
+        writer = BufferedLogWriter(out, flush_interval=1.0, flush_size=1 << 20, clock=lambda: 0.0, observer=fail)
+        with self.assertLogs('django.task', 'ERROR'):
+            writer.feed(b'a\n')
+            writer.flush()
+        writer.feed(b'b\n')
+        writer.close()
+        self.assertEqual(out.data, b'a\nb\n')
+        self.assertIsNone(writer.observer)
+
+
+class LogCompactionTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.server = GPUServer.objects.create(ip='10.0.0.1', hostname='node1')
+        self.user = User.objects.create(username='alice')
+        self.task = GPUTask.objects.create(name='t', user=self.user, workspace='~', cmd='true', gpu_requirement=1)
+        # 压缩前会推进全文索引：索引库也放到临时目录
+        env = mock.patch.dict(os.environ, {'GPUTASKER_LOG_SEARCH_DB': os.path.join(self.dir, 'search.sqlite3')})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def tearDown(self):
+        for name in os.listdir(self.dir):
+            os.remove(os.path.join(self.dir, name))
+        os.rmdir(self.dir)
+
+    def _log(self, name, status, age):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write('x' * 10000 + '\n')
+        os.utime(path, (time.time() - age, time.time() - age))
+        GPUTaskRunningLog.objects.create(
+            index=0, task=self.task, server=self.server, pid=1, gpus='0', log_file_path=path, status=status,
+        )
+        return path
+
+    def test_only_idle_finished_logs_are_compressed(self):
+        done = self._log('done.log', 2, age=3600)
+        running = self._log('running.log', 1, age=3600)
+        fresh = self._log('fresh.log', -1, age=0)
+        with mock.patch('gpu_tasker.settings.RUNNING_LOG_DIR', self.dir), \
+                mock.patch.dict(os.environ, {'GPUTASKER_LOG_COMPRESS_AFTER_SECONDS': '600'}):
+            stats = compact_logs()
+        self.assertEqual(stats['compressed'], 1)
+        self.assertTrue(os.path.exists(archive_path(done)))
+        self.assertFalse(os.path.exists(done))
+        self.assertTrue(os.path.exists(running))
+        self.assertTrue(os.path.exists(fresh))
+
+    def test_retention_drops_oldest_archives_over_budget(self):
+        old = self._log('old.log', 2, age=7200)
+        new = self._log('new.log', 2, age=3600)
+        compress_log(old)
+        compress_log(new)
+        budget_mb = os.path.getsize(archive_path(new)) / float(1 << 20)
+        with mock.patch('gpu_tasker.settings.RUNNING_LOG_DIR', self.dir), \
+                mock.patch.dict(os.environ, {'GPUTASKER_LOG_RETENTION_MAX_MB': str(budget_mb)}):
+            stats = compact_logs()
+        self.assertEqual(stats['deleted'], 1)
+        self.assertFalse(os.path.exists(archive_path(old)))
+        self.assertTrue(os.path.exists(archive_path(new)))
+
+
+class LogSearchTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index = LogSearchIndex(os.path.join(self.dir, 'search.sqlite3'))
+        server = GPUServer.objects.create(ip='10.0.0.1', hostname='node1')
+        user = User.objects.create(username='alice')
+        self.task = GPUTask.objects.create(name='t', user=user, workspace='~', cmd='true', gpu_requirement=1)
+        self.server = server
+
+    def tearDown(self):
+        self.index.close()
+        for name in os.listdir(self.dir):
+            os.remove(os.path.join(self.dir, name))
+        os.rmdir(self.dir)
+
+    def _run(self, name, text, status=2):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return GPUTaskRunningLog.objects.create(
+            index=0, task=self.task, server=self.server, pid=1, gpus='0', log_file_path=path, status=status,
+        )
+
+    def test_phrase_search_returns_runs_and_line_snippets(self):
+        filler = ''.join('step {} loss=0.{}\n'.format(i, i) for i in range(3000))
+        oom = self._run('oom.log', filler + 'RuntimeError: CUDA out of memory. Tried to allocate 2.00 GiB\n' + filler)
+        nccl = self._run('nccl.log', 'NCCL error: unhandled system error\n')
+        self._run('ok.log', filler + 'CUDA memory is fine, out of nothing\n')
+        self.index.index_pending()
+
+        hits = self.index.search('CUDA out of memory')
+        self.assertEqual(list(hits), [oom.pk])
+        self.assertEqual(
+            snippets(oom.log_file_path, hits[oom.pk], 'CUDA out of memory'),
+            [(3000, 'RuntimeError: CUDA out of memory. Tried to allocate 2.00 GiB')],
+        )
+        # 多个短语任一命中；结果按新到旧
+        self.assertEqual(list(self.index.search('cuda out of memory | nccl error')), [nccl.pk, oom.pk])
+        self.assertEqual(self.index.search('!!!'), {})
+
+    def test_running_log_is_indexed_incrementally(self):
+        run = self._run('run.log', 'epoch 1\nNCCL err', status=1)
+        self.index.index_pending()
+        self.assertEqual(self.index.search('NCCL error'), {})
+        with open(run.log_file_path, 'a') as f:
+            f.write('or in allreduce\n')
+        self.index.index_pending()
+        self.assertEqual(list(self.index.search('NCCL error')), [run.pk])
+        self.assertEqual(self.index.stats()['done'], 0)
+
+        GPUTaskRunningLog.objects.filter(pk=run.pk).update(status=2)
+        self.index.index_pending()
+        self.assertEqual(self.index.stats()['done'], 1)
+        self.index.forget(run.log_file_path)
+        self.assertEqual(self.index.search('NCCL error'), {})
+
+
+class TaskSubmitApiTest(QueryPlanAssertionsMixin, TestCase):
+    """批量提交 / 列表 / 取消接口。"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='alice')
+        cls.token = UserConfig.objects.create(user=cls.user, server_username='alice', server_private_key='k').api_token
+        cls.server = GPUServer.objects.create(ip='10.4.0.1')
+        cls.group = TaskGroup.objects.create(project=Project.objects.create(name='sweep'), name='lr')
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.wakeup_file = os.path.join(self.dir, 'wakeup')
+        env = mock.patch.dict(os.environ, {'GPUTASKER_SCHEDULER_WAKEUP_FILE': self.wakeup_file})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def _post(self, path, body, content_type='application/json', token=None):
+        data = body if isinstance(body, (bytes, str)) else json.dumps(body)
+        return self.client.post(path, data, content_type=content_type,
+                                HTTP_AUTHORIZATION='Bearer ' + (token or self.token))
+
+    def test_token_generated_and_required(self):
+        self.assertTrue(self.token)
+        response = self.client.post('/api/v1/tasks/', '[]', content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+        response = self._post('/api/v1/tasks/', [{'cmd': 'true', 'workspace': '~'}], token='wrong')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.client.get('/api/v1/tasks/').status_code, 401)
+
+    def test_submit_json_with_defaults(self):
+        response = self._post('/api/v1/tasks/', {
+            'defaults': {'workspace': '~/proj', 'group': self.group.pk, 'gpu_requirement': 2},
+            'tasks': [
+                {'cmd': 'python train.py --lr 0.1'},
+                {'cmd': 'python train.py --lr 0.01', 'name': 'small', 'assign_server': '10.4.0.1', 'ready': False},
+            ],
+        })
+        self.assertEqual(response.status_code, 201)
+        ids = response.json()['ids']
+        first, second = GPUTask.objects.filter(pk__in=ids).order_by('id')
+        self.assertEqual([first.pk, second.pk], ids)
+        self.assertEqual((first.name, first.cmd, first.status), ('python train.py --lr 0.1', 'python train.py --lr 0.1\n', 0))
+        self.assertEqual((first.user, first.group, first.gpu_requirement), (self.user, self.group, 2))
+        self.assertEqual((second.name, second.assign_server, second.status), ('small', self.server, -2))
+        self.assertTrue(os.path.exists(self.wakeup_file))
+
+    def test_submit_jsonl_in_bounded_queries(self):
+        body = '\n'.join(json.dumps({'cmd': 'echo {}'.format(i), 'workspace': '~', 'group': self.group.pk})
+                         for i in range(2500))
+        # 查询数只随 INSERT 批数增长（SQLite 每条语句最多 999 个参数，会再细分批次）
+        fields = [f for f in GPUTask._meta.concrete_fields if not f.primary_key]
+        inserts = -(-2500 // min(1000, connection.ops.bulk_batch_size(fields, [GPUTask()] * 1000)))
+        with mock.patch.dict(os.environ, {'GPUTASKER_TASK_SUBMIT_CHUNK': '1000'}), \
+                self.assertMaxNumQueries(6 + inserts):
+            response = self._post('/api/v1/tasks/', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['created'], 2500)
+        self.assertEqual(GPUTask.objects.filter(user=self.user, group=self.group).count(), 2500)
+
+    def test_invalid_batch_is_rejected_with_indexes(self):
+        response = self._post('/api/v1/tasks/', [
+            {'cmd': 'true', 'workspace': '~'},
+            {'cmd': 'true'},
+            {'cmd': 'true', 'workspace': '~', 'group': 999999},
+            {'cmd': 'true', 'workspace': '~', 'gpu_requirement': 'two', 'oops': 1},
+        ])
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()['errors']
+        self.assertEqual([e['index'] for e in errors], [1, 2, 3])
+        self.assertIn('workspace', errors[0]['errors'])
+        self.assertIn('group', errors[1]['errors'])
+        self.assertEqual(set(errors[2]['errors']), {'gpu_requirement', 'oops'})
+        self.assertFalse(GPUTask.objects.filter(user=self.user).exists())
+        self.assertFalse(os.path.exists(self.wakeup_file))
+
+        with mock.patch.dict(os.environ, {'GPUTASKER_TASK_SUBMIT_MAX': '2'}):
+            response = self._post('/api/v1/tasks/', [{'cmd': 'true', 'workspace': '~'}] * 3)
+        self.assertEqual(response.status_code, 413)
+
+    def test_list_paginates_and_cancel(self):
+        ids = self._post('/api/v1/tasks/', {'defaults': {'workspace': '~'},
+                                           'tasks': [{'cmd': 'echo {}'.format(i)} for i in range(5)]}).json()['ids']
+        GPUTask.objects.filter(pk=ids[0]).update(status=2)
+        response = self.client.get('/api/v1/tasks/?status=0&limit=3', HTTP_AUTHORIZATION='Bearer ' + self.token)
+        page = response.json()
+        self.assertEqual([t['id'] for t in page['tasks']], ids[:0:-1][:3])
+        response = self.client.get('/api/v1/tasks/?status=0&before={}'.format(page['next_before']),
+                                   HTTP_AUTHORIZATION='Bearer ' + self.token)
+        self.assertEqual([t['id'] for t in response.json()['tasks']], [ids[1]])
+
+        other = User.objects.create(username='bob')
+        foreign = GPUTask.objects.create(name='x', user=other, workspace='~', cmd='true')
+        response = self._post('/api/v1/tasks/cancel/', {'ids': ids + [foreign.pk]})
+        self.assertEqual(response.json(), {'ok': True, 'cancelled': 4, 'kill_queued': 0})
+        self.assertEqual(GPUTask.objects.filter(pk__in=ids, status=-2).count(), 4)
+        self.assertEqual(GPUTask.objects.get(pk=foreign.pk).status, 0)
+
+    def test_cancel_queues_kills_for_the_scheduler(self):
+        other = GPUServer.objects.create(ip='10.4.0.2')
+        runs = []
+        for server in (self.server, other):
+            task = GPUTask.objects.create(name='t', user=self.user, workspace='~', cmd='true', status=1)
+            runs.append(GPUTaskRunningLog.objects.create(
+                index=0, task=task, server=server, pid=1, gpus='0', log_file_path='/dev/null', status=1))
+        ids = [run.task_id for run in runs]
+        # 请求里只做集合更新，不 ssh
+        # 鉴权 + 两条集合更新
+        with mock.patch('task.utils.kill_running_log') as kill, self.assertNumQueries(3):
+            response = self._post('/api/v1/tasks/cancel/', {'ids': ids})
+        kill.assert_not_called()
+        self.assertEqual(response.json(), {'ok': True, 'cancelled': 0, 'kill_queued': 2})
+        self.assertTrue(os.path.exists(self.wakeup_file))
+        # 重复取消不再重复排队
+        self.assertEqual(self._post('/api/v1/tasks/cancel/', {'ids': ids}).json()['kill_queued'], 0)
+
+        with mock.patch('task.utils.kill_running_log') as kill:
+            self.assertEqual(kill_requested_runs([other.pk]), 1)
+        self.assertEqual([call.args[0].pk for call in kill.call_args_list], [runs[1].pk])
+        GPUTaskRunningLog.objects.filter(pk=runs[1].pk).update(status=-1)
+        with mock.patch('task.utils.kill_running_log') as kill:
+            self.assertEqual(kill_requested_runs(), 1)
+        self.assertEqual([call.args[0].pk for call in kill.call_args_list], [runs[0].pk])
+
+
+class WakeupTest(TestCase):
+    def test_waiter_returns_early_on_notify(self):
+        path = os.path.join(tempfile.mkdtemp(), 'wakeup')
+        waiter = WakeupWaiter(path, poll_seconds=0.01)
+        self.assertFalse(waiter.wait(0.05))
+        notify_scheduler(path)
+        start = time.monotonic()
+        self.assertTrue(waiter.wait(5))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertFalse(waiter.wait(0.02))
+
+
+class TaskArrayTest(QueryPlanAssertionsMixin, TestCase):
+    """任务数组：惰性展开、按空闲 GPU 限量、聚合状态与整体取消/重启。"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'x')
+        cls.server = GPUServer.objects.create(ip='10.5.0.1', last_report_at=timezone.now())
+        GPUInfo.objects.bulk_create([
+            GPUInfo(uuid='GPU-arr-{}'.format(i), index=i, name='A100', utilization=0, memory_total=100,
+                    memory_used=0, server=cls.server, complete_free=True)
+            for i in range(4)
+        ])
+
+    def setUp(self):
+        env = mock.patch.dict(os.environ, {
+            'GPUTASKER_GPU_UPDATE_MODE': 'report',
+            'GPUTASKER_SCHEDULER_WAKEUP_FILE': os.path.join(tempfile.mkdtemp(), 'wakeup'),
+        })
+        env.start()
+        self.addCleanup(env.stop)
+        GPUServer.objects.filter(pk=self.server.pk).update(last_report_at=timezone.now())
+
+    def _array(self, params, **kwargs):
+        kwargs.setdefault('name', 'sweep')
+        return TaskArray.objects.create(user=self.admin, workspace='~/proj', params=json.dumps(params),
+                                        cmd='python train.py --lr {lr} --bs {bs} --out ${HOME}/{index}', **kwargs)
+
+    def test_params_expand_by_index(self):
+        grid = {'lr': [0.1, 0.01, 'auto'], 'bs': [32, 64]}
+        self.assertEqual([params_at(grid, i) for i in range(6)],
+                         [dict(zip(grid, combo)) for combo in itertools.product(*grid.values())])
+        self.assertEqual(params_at([{'lr': 1}, {'lr': 2}], 1), {'lr': 2})
+        self.assertEqual(render('{lr} {bs} {other} ${HOME} {index}', {'lr': 0.01, 'bs': 'x'}, 3),
+                         '0.01 x {other} ${HOME} 3')
+        for bad in ('', '[]', '{}', '{"lr": []}', '{"lr": 1}', '[1]', '{"a-b": [1]}', '"x"'):
+            with self.assertRaises(ValidationError, msg=bad):
+                validate_array_params(bad)
+        with self.assertRaises(ValidationError):
+            validate_array_params(json.dumps({'a': list(range(1001)), 'b': list(range(1001))}))
+
+    def test_materialize_follows_free_gpus(self):
+        array = self._array({'lr': [0.1, 0.01, 0.001], 'bs': [32, 64, 128, 256]}, max_pending=3)
+        self.assertEqual(array.size, 12)
+        self.assertEqual(materialize_arrays(), 3)  # 4 块空闲 GPU，但不超过 max_pending
+        first = GPUTask.objects.get(array=array, array_index=0)
+        self.assertEqual((first.name, first.user, first.status), ('sweep[0]', self.admin, 0))
+        self.assertEqual(first.cmd, 'python train.py --lr 0.1 --bs 32 --out ${HOME}/0\n')
+        self.assertEqual(GPUTask.objects.get(array=array, array_index=2).cmd.split()[2:4], ['--lr', '0.1'])
+        self.assertEqual(materialize_arrays(), 0)
+
+        # 排队的子任务开始运行后，剩余空闲 GPU 只够再展开 1 个
+        GPUTask.objects.filter(array=array).update(status=1)
+        GPUInfo.objects.filter(index__lt=3).update(use_by_self=True)
+        self.assertEqual(materialize_arrays(), 1)
+        # 没有空闲 GPU 时也保留 1 个排队的子任务
+        GPUInfo.objects.update(use_by_self=True)
+        GPUTask.objects.filter(array=array, status=0).update(status=2)
+        self.assertEqual(materialize_arrays(), 1)
+        self.assertEqual(materialize_arrays(), 0)
+        array.refresh_from_db()
+        self.assertEqual(array.materialized, 5)
+        self.assertEqual(sorted(GPUTask.objects.filter(array=array).values_list('array_index', flat=True)),
+                         list(range(5)))
+
+    def test_stale_scheduler_does_not_duplicate_children(self):
+        array = self._array([{'lr': i, 'bs': 1} for i in range(10)], max_pending=2)
+        stale = TaskArray.objects.get(pk=array.pk)
+        self.assertEqual(materialize_arrays(), 2)
+        self.assertFalse(expand_array(stale, 2))
+        self.assertEqual(GPUTask.objects.filter(array=array).count(), 2)
+
+    def test_admin_status_cancel_and_restart(self):
+        self.client.force_login(self.admin)
+        arrays = [self._array({'lr': list(range(20)), 'bs': [1]}, name='a{}'.format(i)) for i in range(5)]
+        materialize_arrays()
+        array = arrays[0]
+        GPUTask.objects.filter(array=array, array_index=0).update(status=2)
+        GPUTask.objects.filter(array=array, array_index=1).update(status=-1)
+
+        with self.assertMaxNumQueries(8):
+            response = self.client.get('/admin/task/taskarray/')
+        self.assertContains(response, '1 / 20')
+        self.assertContains(response, '失败 1')
+        response = self.client.get('/admin/task/gputask/array/{}/'.format(array.pk))
+        self.assertEqual(response.context['cl'].result_count, GPUTask.objects.filter(array=array).count())
+
+        child = GPUTask.objects.get(array=array, array_index=2)
+        GPUTask.objects.filter(pk=child.pk).update(status=1)
+        run = GPUTaskRunningLog.objects.create(index=0, task=child, pid=1, gpus='0', log_file_path='/dev/null', status=1)
+        with mock.patch('task.utils.kill_running_log') as kill:
+            self.client.post('/admin/task/taskarray/', {'action': 'cancel_array', '_selected_action': [array.pk]})
+        array.refresh_from_db()
+        self.assertFalse(array.active)
+        self.assertFalse(GPUTask.objects.filter(array=array, status=0).exists())
+        # 运行中的子任务交给调度器结束，请求里不 ssh
+        kill.assert_not_called()
+        run.refresh_from_db()
+        self.assertIsNotNone(run.kill_requested_at)
+        GPUTaskRunningLog.objects.filter(pk=run.pk).update(status=-1)
+        GPUTask.objects.filter(pk=child.pk).update(status=-1)
+        before = array.materialized
+        materialize_arrays()
+        array.refresh_from_db()
+        self.assertEqual(array.materialized, before)
+
+        self.client.post('/admin/task/taskarray/', {'action': 'restart_array', '_selected_action': [array.pk]})
+        array.refresh_from_db()
+        self.assertTrue(array.active)
+        self.assertEqual(GPUTask.objects.filter(array=array, status=0).count(), before - 1)
+        self.assertEqual(GPUTask.objects.get(array=array, array_index=0).status, 2)
+
+
+class BulkTaskActionTest(QueryPlanAssertionsMixin, TestCase):
+    """任务的批量删除/复制/重启是集合操作；日志文件由后台按删除日志清理。"""
+
+    TASKS = 3000
+    RUNS_PER_TASK = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'x')
+        cls.group = TaskGroup.objects.create(project=Project.objects.create(name='p'), name='big')
+        cls.other = TaskGroup.objects.create(project=cls.group.project, name='other')
+        now = timezone.now()
+        bulk_insert(
+            GPUTask,
+            ['name', 'user', 'group', 'workspace', 'cmd', 'metric_patterns', 'gpu_requirement', 'exclusive_gpu',
+             'memory_requirement', 'utilization_requirement', 'priority', 'status', 'create_at', 'update_at'],
+            (('t{}'.format(i), cls.admin.pk, cls.group.pk, '~', 'true\n', '', 1, False, 0, 0, 0, -1, now, now)
+             for i in range(cls.TASKS)),
+        )
+        cls.kept = GPUTask.objects.create(name='kept', user=cls.admin, group=cls.other, workspace='~', cmd='true')
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+        self.dir = tempfile.mkdtemp()
+        env = mock.patch.dict(os.environ, {
+            'GPUTASKER_SCHEDULER_WAKEUP_FILE': os.path.join(self.dir, 'wakeup'),
+            'GPUTASKER_LOG_SEARCH_DB': os.path.join(self.dir, 'search.sqlite3'),
+        })
+        env.start()
+        self.addCleanup(env.stop)
+
+    @staticmethod
+    def _batches(model, rows):
+        """bulk_create 按后端参数上限分批的语句数（SQLite 每条语句最多 999 个参数）。"""
+        fields = [f for f in model._meta.concrete_fields if not f.primary_key]
+        return -(-rows // min(1000, connection.ops.bulk_batch_size(fields, [model()] * rows)))
+
+    def _seed_runs(self):
+        now = timezone.now()
+        task_ids = list(GPUTask.objects.filter(group=self.group).values_list('id', flat=True))
+        paths = [os.path.join(self.dir, '{}_{}.log'.format(task_id, i))
+                 for task_id in task_ids for i in range(self.RUNS_PER_TASK)]
+        for path in paths[:300] + paths[-3:] + [paths[0] + INDEX_SUFFIX, paths[0] + '.watch.1']:
+            with open(path, 'w') as f:
+                f.write('x\n')
+        bulk_insert(
+            GPUTaskRunningLog,
+            ['index', 'task', 'server', 'pid', 'gpus', 'log_file_path', 'remark', 'metrics', 'status',
+             'start_at', 'update_at'],
+            ((i % self.RUNS_PER_TASK, int(os.path.basename(path).split('_')[0]), None, 1, '0', path, '', '', 2, now, now)
+             for i, path in enumerate(paths)),
+        )
+        return paths
+
+    def test_delete_group_is_set_based_and_files_are_purged_later(self):
+        paths = self._seed_runs()
+        url = '/admin/task/gputask/group/{}/'.format(self.group.pk)
+        action = {'action': 'delete_selected', 'select_across': '1',
+                  '_selected_action': [GPUTask.objects.filter(group=self.group).first().pk]}
+
+        # 确认页只列数量，不逐个列出 3000 个任务与 9000 条运行记录
+        with self.assertMaxNumQueries(15):
+            response = self.client.post(url, action)
+        self.assertContains(response, '{} 个GPU任务运行记录'.format(self.TASKS * self.RUNS_PER_TASK))
+
+        # 查询数只随批次数增长：删除日志与操作日志按后端上限分批插入，任务按每 100 行一批删除
+        runs = self.TASKS * self.RUNS_PER_TASK
+        budget = 20 + self._batches(LogDeletion, runs) + self._batches(LogEntry, self.TASKS) \
+            + 2 * -(-self.TASKS // GET_ITERATOR_CHUNK_SIZE)
+        with mock.patch('task.models.os.remove') as remove, self.assertMaxNumQueries(budget):
+            response = self.client.post(url, dict(action, post='yes'))
+        self.assertEqual(response.status_code, 302)
+        remove.assert_not_called()
+        self.assertEqual(list(GPUTask.objects.values_list('pk', flat=True)), [self.kept.pk])
+        self.assertFalse(GPUTaskRunningLog.objects.exists())
+        self.assertEqual(LogDeletion.objects.count(), len(paths))
+        self.assertTrue(os.path.exists(paths[0]))
+
+        self.assertEqual(purge_deleted_logs(batch_size=1000, max_batches=1), 1000)
+        self.assertEqual(purge_deleted_logs(), len(paths) - 1000)
+        self.assertFalse(LogDeletion.objects.exists())
+        self.assertFalse(any(os.path.exists(path) for path in paths[:300] + paths[-3:]))
+        self.assertEqual([name for name in os.listdir(self.dir) if '.log' in name], [])
+
+    def test_delete_single_task_journals_its_logs(self):
+        path = os.path.join(self.dir, 'single.log')
+        open(path, 'w').close()
+        GPUTaskRunningLog.objects.create(index=0, task=self.kept, pid=1, gpus='0', log_file_path=path, status=2)
+        response = self.client.post('/admin/task/gputask/{}/delete/'.format(self.kept.pk), {'post': 'yes'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(list(LogDeletion.objects.values_list('log_file_path', flat=True)), [path])
+        purge_deleted_logs()
+        self.assertFalse(os.path.exists(path))
+
+    def test_copy_and_restart_are_set_based(self):
+        url = '/admin/task/gputask/group/{}/'.format(self.group.pk)
+        first = GPUTask.objects.filter(group=self.group).order_by('id').first()
+        with self.assertMaxNumQueries(15 + self._batches(GPUTask, self.TASKS)):
+            self.client.post(url, {'action': 'copy_task', 'select_across': '1', '_selected_action': [first.pk]})
+        copies = GPUTask.objects.filter(group=self.group, name__endswith='_copy')
+        self.assertEqual(copies.count(), self.TASKS)
+        self.assertEqual(set(copies.values_list('status', flat=True)), {-2})
+        self.assertTrue(copies.filter(name='t0_copy', user=self.admin, cmd='true\n').exists())
+
+        with self.assertMaxNumQueries(10):
+            self.client.post(url, {'action': 'restart_task', 'select_across': '1', '_selected_action': [first.pk]})
+        self.assertEqual(GPUTask.objects.filter(group=self.group, status=0).count(), self.TASKS * 2)
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'wakeup')))
+
+
+class CountingEmailBackend(locmem.EmailBackend):
+    """记录打开的连接数；发往 failing_addresses 的邮件抛出异常。"""
+    opened = 0
+    failing_addresses = set()
+
+    def open(self):
+        CountingEmailBackend.opened += 1
+        return True
+
+    def send_messages(self, messages):
+        for message in messages:
+            if set(message.to) & self.failing_addresses:
+                raise OSError('550 mailbox unavailable')
+        return super().send_messages(messages)
+
+
+@override_settings(EMAIL_NOTIFICATION=True, EMAIL_BACKEND='task.tests.CountingEmailBackend')
+class NotificationOutboxTest(TestCase):
+    """通知发件箱：run_task 只写表，后台批量发送、复用连接、退避重试与按数组汇总。"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='alice', email='alice@example.com')
+        cls.config = UserConfig.objects.create(user=cls.user, server_username='alice', server_private_key='-')
+        cls.server = GPUServer.objects.create(ip='10.6.0.1')
+
+    def setUp(self):
+        CountingEmailBackend.opened = 0
+        CountingEmailBackend.failing_addresses = set()
+
+    def _run(self, task, status=2):
+        now = timezone.now()
+        return GPUTaskRunningLog.objects.create(index=0, task=task, server=self.server, pid=1, gpus='0',
+                                                log_file_path='/dev/null', status=status, start_at=now)
+
+    def test_run_task_only_writes_outbox_and_batch_reuses_connection(self):
+        for i in range(5):
+            task = GPUTask.objects.create(name='t{}'.format(i), user=self.user, workspace='~', cmd='true', status=2)
+            run = self._run(task)
+            send_task_start_email(run)
+            send_task_finish_email(run)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(Notification.objects.filter(status=0).count(), 10)
+
+        self.assertEqual(outbox.process_outbox(), (0, 10))
+        self.assertEqual(len(mail.outbox), 10)
+        self.assertEqual(CountingEmailBackend.opened, 1)
+        self.assertEqual(mail.outbox[1].subject, '任务运行完成')
+        self.assertFalse(Notification.objects.exists())
+
+    def test_failed_delivery_backs_off_then_gives_up(self):
+        CountingEmailBackend.failing_addresses = {'bob@example.com'}
+        task = GPUTask.objects.create(name='t', user=self.user, workspace='~', cmd='true')
+        ok = outbox.enqueue(task, 'alice@example.com', 'finish', 'a', 'a')
+        bad = outbox.enqueue(task, 'bob@example.com', 'finish', 'b', 'b')
+        with mock.patch.dict(os.environ, {'GPUTASKER_NOTIFY_RETRY_SECONDS': '30', 'GPUTASKER_NOTIFY_MAX_ATTEMPTS': '3'}):
+            self.assertEqual(outbox.deliver_pending(), 1)
+            bad.refresh_from_db()
+            self.assertEqual((bad.status, bad.attempts), (0, 1))
+            self.assertIn('550', bad.last_error)
+            self.assertGreater(bad.next_attempt_at, timezone.now() + timedelta(seconds=25))
+            self.assertFalse(Notification.objects.filter(pk=ok.pk).exists())
+
+            # 未到重试时间不发送；到期后再失败，间隔翻倍，直到放弃
+            self.assertEqual(outbox.deliver_pending(), 0)
+            delays = []
+            with self.assertLogs('django.task', 'ERROR'):
+                for _ in range(2):
+                    Notification.objects.filter(pk=bad.pk).update(next_attempt_at=timezone.now())
+                    before = timezone.now()
+                    outbox.deliver_pending()
+                    bad.refresh_from_db()
+                    delays.append((bad.next_attempt_at - before).total_seconds())
+        self.assertAlmostEqual(delays[0], 60, delta=5)
+        self.assertEqual((bad.status, bad.attempts), (-1, 3))
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_array_digest_sends_one_summary(self):
+        UserConfig.objects.filter(pk=self.config.pk).update(email_digest=1)
+        array = TaskArray.objects.create(name='lr-sweep', user=self.user, workspace='~', cmd='true {lr}',
+                                         params=json.dumps({'lr': [1, 2, 3, 4]}))
+        expand_array(array, 4)
+        tasks = list(array.tasks.order_by('array_index'))
+        loner = GPUTask.objects.create(name='loner', user=self.user, workspace='~', cmd='true', status=2)
+        GPUTask.objects.filter(pk__in=[t.pk for t in tasks[:3]]).update(status=2)
+        GPUTask.objects.filter(pk=tasks[1].pk).update(status=-1)
+        for task in tasks[:3] + [loner]:
+            task.refresh_from_db()
+            run = self._run(task, status=task.status)
+            send_task_start_email(run)
+            (send_task_finish_email if task.status == 2 else send_task_fail_email)(run)
+
+        # 开始通知被丢弃，数组内的结束通知等待汇总；不在数组里的任务照常发送
+        self.assertEqual(Notification.objects.filter(status=1).count(), 3)
+        self.assertEqual(outbox.process_outbox(), (0, 2))
+        tasks[3].status = 1
+        tasks[3].save()
+        self.assertEqual(outbox.collect_digests(), 0)
+
+        GPUTask.objects.filter(pk=tasks[3].pk).update(status=2)
+        tasks[3].refresh_from_db()
+        send_task_finish_email(self._run(tasks[3]))
+        self.assertEqual(outbox.process_outbox(), (1, 1))
+        digest = mail.outbox[-1]
+        self.assertEqual(digest.subject, '任务汇总：任务数组[lr-sweep]（完成 3，失败 1）')
+        self.assertIn(tasks[1].name, digest.body.split('运行完成的任务')[0])
+        self.assertFalse(Notification.objects.exists())
+
+    def test_group_digest_ignores_other_users_tasks(self):
+        UserConfig.objects.filter(pk=self.config.pk).update(email_digest=2)
+        group = TaskGroup.objects.create(project=Project.objects.create(name='shared'), name='lr')
+        bob = User.objects.create(username='bob')
+        GPUTask.objects.create(name='bob-run', user=bob, workspace='~', cmd='true', status=1, group=group)
+        task = GPUTask.objects.create(name='mine', user=self.user, workspace='~', cmd='true', status=2, group=group)
+        send_task_finish_email(self._run(task))
+
+        # 同一分组里别人的任务还在运行，不应让自己的汇总一直等下去
+        self.assertEqual(outbox.process_outbox(), (1, 1))
+        self.assertEqual(mail.outbox[-1].subject, '任务汇总：分组[{}]（完成 1，失败 0）'.format(group))
+
+
+class CycleProfilerTest(TestCase):
+    """调度循环分阶段计时：每阶段查询数、慢循环记录与 cProfile，运行中用信号切换。"""
+
+    def setUp(self):
+        self.log = os.path.join(tempfile.mkdtemp(), 'slow_cycles.jsonl')
+        env = mock.patch.dict(os.environ, {'GPUTASKER_SLOW_CYCLE_LOG': self.log, 'GPUTASKER_SLOW_CYCLE_SECONDS': '0'})
+        env.start()
+        self.addCleanup(env.stop)
+        self.histogram = Histogram('t_phase_seconds', 'phases', ('phase',), registry=Registry())
+        logger = mock.patch('task.cycle_profiler.task_logger')
+        logger.start()
+        self.addCleanup(logger.stop)
+
+    def _cycle(self, profiler):
+        cycle = profiler.start_cycle()
+        for _ in range(3):
+            GPUTask.objects.filter(status=0).exists()
+        cycle.lap('claim')
+        cycle.lap('idle')
+        return cycle.finish()
+
+    def _records(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            return [json.loads(line) for line in f]
+
+    def test_slow_cycle_record_has_phase_breakdown(self):
+        record = self._cycle(CycleProfiler(self.histogram, mode='timing'))
+        self.assertEqual(self._records(), [record])
+        self.assertEqual([(p['phase'], p['queries']) for p in record['phases']], [('claim', 3), ('idle', 0)])
+        self.assertEqual(len(record['slowest_queries']), 3)
+        self.assertEqual({q['phase'] for q in record['slowest_queries']}, {'claim'})
+        self.assertIn('gputask', record['slowest_queries'][0]['sql'])
+        self.assertIsNone(record['profile'])
+        self.assertEqual({key[0] for key, _ in self.histogram.values()}, {'claim', 'idle', 'cycle'})
+        self.assertEqual(connection.execute_wrappers, [])
+
+        with mock.patch.dict(os.environ, {'GPUTASKER_SLOW_CYCLE_SECONDS': '60'}):
+            self.assertIsNone(self._cycle(CycleProfiler(self.histogram, mode='timing')))
+        self.assertEqual(len(self._records()), 1)
+
+    def test_off_mode_only_times_phases(self):
+        profiler = CycleProfiler(self.histogram, mode='off')
+        with self.assertNumQueries(3):
+            self.assertIsNone(self._cycle(profiler))
+        self.assertEqual(self._records(), [])
+
+    def test_signals_switch_profile_and_force_a_record(self):
+        previous = (signal.getsignal(signal.SIGUSR1), signal.getsignal(signal.SIGUSR2))
+        self.addCleanup(signal.signal, signal.SIGUSR1, previous[0])
+        self.addCleanup(signal.signal, signal.SIGUSR2, previous[1])
+        profiler = CycleProfiler(self.histogram, mode='off')
+        profiler.install_signal_handlers()
+
+        with mock.patch.dict(os.environ, {'GPUTASKER_SLOW_CYCLE_SECONDS': '60'}):
+            os.kill(os.getpid(), signal.SIGUSR2)
+            record = self._cycle(profiler)
+            self.assertTrue(record['forced'])
+            self.assertEqual(record['phases'][0]['queries'], 3)
+            # 只影响一轮
+            self.assertIsNone(self._cycle(profiler))
+
+            os.kill(os.getpid(), signal.SIGUSR1)
+            self.assertEqual(profiler.mode, 'profile')
+            os.kill(os.getpid(), signal.SIGUSR2)
+            record = self._cycle(profiler)
+        stats = pstats.Stats(record['profile'])
+        self.assertTrue(any(func[2] == 'exists' for func in stats.stats))
+
+
+def use_temp_running_log_dir(test):
+    """run_task 把运行日志与指标序列写到 RUNNING_LOG_DIR：测试里改到临时目录，结束后删除。"""
+    path = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, path, True)
+    override = override_settings(RUNNING_LOG_DIR=path)
+    override.enable()
+    test.addCleanup(override.disable)
+    return path
+
+
+class _FakeProcessGroup:
+    """代替 ssh：首行是远端进程标记，随后立即有输出，退出码 0。"""
+    MARKER_PREFIX = '__GPUTASKER_REMOTE__'
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def start_streaming(self, observer=None, on_first_output=None, checkpoint=None):
+        self._first_line_at = timezone.now()
+        if observer is not None:
+            observer.close()
+        on_first_output()
+
+    def first_line_at(self):
+        return self._first_line_at
+
+    def pid(self):
+        return 4242
+
+    def first_line(self):
+        return '__GPUTASKER_REMOTE__ pid=77 pgid=77\n'
+
+    def get_return_code(self):
+        return 0
+
+    def remove_remote_files(self):
+        return True
+
+
+class TaskLifecycleTest(TestCase):
+    """运行记录的生命周期时间点，以及按天/按服务器的调度开销分位数。"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'x')
+        UserConfig.objects.create(user=cls.admin, server_username='admin', server_private_key='-')
+        cls.server = GPUServer.objects.create(ip='10.7.0.1')
+        cls.other = GPUServer.objects.create(ip='10.7.0.2')
+        cls.group = TaskGroup.objects.create(project=Project.objects.create(name='p'), name='g')
+
+    def setUp(self):
+        self.dir = use_temp_running_log_dir(self)
+        env = mock.patch.dict(os.environ, {'GPUTASKER_SCHEDULER_WAKEUP_FILE': os.path.join(self.dir, 'wakeup')})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def _task(self, **kwargs):
+        return GPUTask.objects.create(name='t', user=self.admin, workspace='~', cmd='true', **kwargs)
+
+    def test_run_task_places_from_cluster_state_without_reading_servers(self):
+        GPUServer.objects.filter(pk=self.server.pk).update(last_report_at=timezone.now())
+        GPUInfo.objects.create(uuid='GPU-s-0', index=0, name='A100', utilization=0, memory_total=100, memory_used=0,
+                               server=self.server, complete_free=True)
+        state = ClusterState()
+        state.load()
+        state.enable()
+        self.addCleanup(state.disable)
+        task = self._task(gpu_requirement=1)
+        locked = []
+        with mock.patch('task.utils.RemoteGPUProcessGroup', _FakeProcessGroup), \
+                mock.patch('task.utils.task_logger'), \
+                mock.patch('task.utils.send_task_start_email', side_effect=lambda run: locked.append(
+                    state.get(self.server.pk).gpu(0).use_by_self)), \
+                CaptureQueriesContext(connection) as ctx:
+            run_task(task.pk, None, state)
+        run = GPUTaskRunningLog.objects.get(task=task)
+        self.assertEqual((run.status, run.server_id, run.gpus), (2, self.server.pk, '0'))
+        # 选卡只读缓存；占用与释放经数据库条件更新后写穿到缓存
+        self.assertEqual([q['sql'] for q in ctx.captured_queries if 'FROM "gpu_info_gpu' in q['sql']], [])
+        self.assertEqual(locked, [True])
+        self.assertFalse(state.get(self.server.pk).gpu(0).use_by_self)
+
+    def test_run_task_records_every_stage_in_order(self):
+        task = self._task(assign_server=self.server)
+        queued = timezone.now() - timedelta(seconds=30)
+        GPUTask.objects.filter(pk=task.pk).update(queued_at=queued, dispatching_at=queued + timedelta(seconds=20))
+        with mock.patch('task.utils.RemoteGPUProcessGroup', _FakeProcessGroup), \
+                mock.patch('task.utils.try_lock_gpus', side_effect=lambda server, gpus, busy_by_log_id: len(gpus)), \
+                mock.patch('task.utils.release_gpus') as release, \
+                mock.patch.object(GPUServer, 'get_available_gpus', return_value=[0]), \
+                mock.patch('task.utils.task_logger'):
+            run_task(task.pk)
+        release.assert_called_once()
+
+        run = GPUTaskRunningLog.objects.get(task=task)
+        self.assertEqual(run.status, 2)
+        self.assertEqual(run.queued_at, queued)
+        self.assertEqual(run.claimed_at, queued + timedelta(seconds=20))
+        stamps = [value for _, value, _ in timeline(run)]
+        self.assertNotIn(None, stamps)
+        self.assertEqual(stamps, sorted(stamps))
+
+    @override_settings(EMAIL_NOTIFICATION=True)
+    def test_notification_failure_does_not_change_status(self):
+        task = self._task(assign_server=self.server)
+        with mock.patch('task.utils.RemoteGPUProcessGroup', _FakeProcessGroup), \
+                mock.patch('task.utils.try_lock_gpus', side_effect=lambda server, gpus, busy_by_log_id: len(gpus)), \
+                mock.patch('task.utils.release_gpus') as release, \
+                mock.patch.object(GPUServer, 'get_available_gpus', return_value=[0]), \
+                mock.patch('task.utils.task_logger'), \
+                mock.patch('notification.email_notification.task_logger') as logger, \
+                mock.patch('notification.email_notification.enqueue',
+                           side_effect=DatabaseError('database is locked')) as enqueue:
+            run_task(task.pk)
+        # 开始与完成通知都写发件箱失败，只记日志：运行与任务照常完成，GPU 只释放一次
+        self.assertEqual(enqueue.call_count, 2)
+        self.assertEqual(logger.exception.call_count, 2)
+        release.assert_called_once()
+        run = GPUTaskRunningLog.objects.get(task=task)
+        self.assertEqual(run.status, 2)
+        self.assertEqual(GPUTask.objects.get(pk=task.pk).status, 2)
+
+    def test_stream_calls_first_output_once(self):
+        calls = []
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b'epoch 1\n')
+        os.write(write_fd, b'epoch 2\n')
+        os.close(write_fd)
+        path = os.path.join(self.dir, 'out.log')
+        try:
+            stream_to_file(read_fd, path, b'marker\n', on_first_output=lambda: calls.append(1))
+        finally:
+            os.close(read_fd)
+        self.assertEqual(calls, [1])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'marker\nepoch 1\nepoch 2\n')
+
+    def test_restart_requeues_with_new_queued_at(self):
+        task = self._task(status=-1, group=self.group)
+        GPUTask.objects.filter(pk=task.pk).update(queued_at=timezone.now() - timedelta(days=1))
+        self.client.force_login(self.admin)
+        before = timezone.now()
+        self.client.post('/admin/task/gputask/group/{}/'.format(self.group.pk), {'action': 'restart_task', '_selected_action': [task.pk]})
+        task.refresh_from_db()
+        self.assertEqual(task.status, 0)
+        self.assertGreaterEqual(task.queued_at, before)
+
+    def _seed_runs(self, day, server, waits):
+        """每条运行记录：排队 wait 秒，认领后 1 秒占用 GPU、2 秒远端进程启动。"""
+        task = self._task(status=2)
+        for i, wait in enumerate(waits):
+            claimed = day + timedelta(minutes=i, seconds=wait)
+            run = GPUTaskRunningLog.objects.create(
+                index=i, task=task, server=server, pid=1, gpus='0', log_file_path='/dev/null', status=2,
+                queued_at=day + timedelta(minutes=i), claimed_at=claimed,
+                gpus_locked_at=claimed + timedelta(seconds=1), spawned_at=claimed + timedelta(seconds=1),
+                marker_at=claimed + timedelta(seconds=2),
+            )
+            GPUTaskRunningLog.objects.filter(pk=run.pk).update(start_at=claimed)
+
+    def test_percentiles_per_day_and_server(self):
+        self.assertEqual(percentile(list(range(1, 101)), 99), 99)
+        self.assertEqual(percentile([5], 50), 5)
+        self.assertIsNone(percentile([], 90))
+
+        day1 = timezone.now().replace(hour=1, minute=0, second=0, microsecond=0) - timedelta(days=2)
+        day2 = day1 + timedelta(days=1)
+        self._seed_runs(day1, self.server, range(1, 11))
+        self._seed_runs(day1, self.other, [100])
+        self._seed_runs(day2, self.server, [3, 3])
+        # 升级前的运行记录没有时间点，不计入
+        GPUTaskRunningLog.objects.create(index=0, task=self._task(), server=self.server, pid=1, gpus='0',
+                                         log_file_path='/dev/null', status=2)
+
+        start, end = day1 - timedelta(hours=1), day2 + timedelta(hours=1)
+        with self.assertNumQueries(1):
+            groups = dispatch_stats(start, end)
+        self.assertEqual(
+            [(g['day'], g['server'], g['runs']) for g in groups],
+            [(day1.date().isoformat(), '10.7.0.1', 10), (day1.date().isoformat(), '10.7.0.2', 1),
+             (day2.date().isoformat(), '10.7.0.1', 2)],
+        )
+        wait = groups[0]['queue_wait']
+        self.assertEqual((wait['count'], wait['p50'], wait['p90'], wait['p99'], wait['max']), (10, 5, 9, 10, 10))
+        self.assertEqual(groups[0]['launch']['p50'], 2)
+        self.assertEqual(groups[0]['ssh']['p99'], 1)
+        self.assertEqual(groups[0]['release']['count'], 0)
+
+        overall = dispatch_stats(start, end, group_by=())
+        self.assertEqual(len(overall), 1)
+        self.assertEqual(overall[0]['runs'], 13)
+        self.assertEqual(overall[0]['queue_wait']['max'], 100)
+
+        self.client.force_login(self.admin)
+        response = self.client.get('/api/v1/dispatch_stats/', {
+            'start': int(start.timestamp()), 'end': int(end.timestamp()), 'group_by': 'server',
+        })
+        data = response.json()
+        self.assertEqual([(g['server'], g['runs']) for g in data['groups']], [('10.7.0.1', 12), ('10.7.0.2', 1)])
+        self.assertEqual(self.client.get('/api/v1/dispatch_stats/', {'group_by': 'user'}).status_code, 400)
+        self.client.logout()
+        self.assertEqual(self.client.get('/api/v1/dispatch_stats/').status_code, 302)
+
+
+class GPUUsageAccountingTest(TestCase):
+    """GPU 用量记账：运行记录结束/失联时按天增量累加，可从历史重建，报表只读汇总表。"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'x')
+        cls.bob = User.objects.create(username='bob')
+        UserConfig.objects.create(user=cls.bob, server_username='bob', server_private_key='-', api_token='bob-token')
+        cls.server = GPUServer.objects.create(ip='10.8.0.1')
+        cls.group = TaskGroup.objects.create(project=Project.objects.create(name='vision'), name='resnet')
+        cls.midnight = (timezone.now() - timedelta(days=3)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def _run(self, user, gpus='0,1', begin_hours=-1, status=1, group=None):
+        task = GPUTask.objects.create(name='t', user=user, group=group, workspace='~', cmd='true', status=status)
+        return GPUTaskRunningLog.objects.create(
+            index=0, task=task, server=self.server, pid=1, gpus=gpus, log_file_path='/dev/null', status=status,
+            marker_at=self.midnight + timedelta(hours=begin_hours),
+        )
+
+    def _finish(self, run, hours, status=2):
+        GPUTaskRunningLog.objects.filter(pk=run.pk).update(
+            status=status, finished_at=self.midnight + timedelta(hours=hours))
+
+    def _usage(self):
+        return list(GPUUsage.objects.order_by('key').values_list('day', 'user_id', 'project_id', 'runs', 'gpu_seconds'))
+
+    def test_split_days(self):
+        day = self.midnight
+        self.assertEqual(accounting.split_days(day - timedelta(hours=1), day + timedelta(hours=2)),
+                         [((day - timedelta(days=1)).date(), 3600.0), (day.date(), 7200.0)])
+        self.assertEqual(accounting.split_days(day, day), [])
+
+    def test_finished_run_is_split_by_day_and_counted_once(self):
+        run = self._run(self.bob, group=self.group)
+        self._finish(run, 2)
+        self.assertEqual(accounting.account_run(run.pk), 3 * 3600 * 2)
+        # 重复记账（例如 kill 与 run_task 收尾都调用）不会重复累加
+        self.assertEqual(accounting.account_run(run.pk), 0)
+        yesterday, today = (self.midnight - timedelta(days=1)).date(), self.midnight.date()
+        project = self.group.project_id
+        self.assertEqual(self._usage(), [
+            (yesterday, self.bob.pk, project, 1, 7200.0),
+            (today, self.bob.pk, project, 0, 14400.0),
+        ])
+
+    def test_lost_then_revived_run_is_completed_on_finish(self):
+        run = self._run(self.bob, gpus='3', status=1)
+        GPUTaskRunningLog.objects.filter(pk=run.pk).update(last_heartbeat_at=self.midnight - timedelta(minutes=30))
+        mark_stale_running_tasks_as_lost()
+        self.assertEqual(sum(g for *_, g in self._usage()), 1800.0)
+
+        # 心跳恢复后正常结束：补记失联之后的部分，运行次数不变
+        self._finish(run, 1)
+        self.assertEqual(accounting.account_run(run.pk), 5400.0)
+        self.assertEqual(GPUUsage.objects.aggregate(n=Sum('runs'), s=Sum('gpu_seconds')), {'n': 1, 's': 7200.0})
+
+    def test_rebuild_matches_incremental_ledger_with_bounded_batches(self):
+        runs = [self._run(self.bob, group=self.group), self._run(self.bob, gpus='0'), self._run(self.admin, gpus='0,1,2,3')]
+        for i, run in enumerate(runs):
+            self._finish(run, i + 1, status=2 if i else -1)
+            accounting.account_run(run.pk)
+        self._run(self.admin)  # 仍在运行，不计入
+        incremental = self._usage()
+
+        GPUUsage.objects.filter(user=self.admin).update(gpu_seconds=0)
+        with mock.patch('task.accounting._rebuild_batch', wraps=accounting._rebuild_batch) as batch:
+            self.assertEqual(accounting.rebuild(chunk_size=1, flush_keys=1), (3, len(incremental)))
+        # 每条运行记录单独一个事务提交（外加最后一次空批次），不是一个大事务
+        self.assertEqual(batch.call_count, 4)
+        self.assertEqual(self._usage(), incremental)
+        # 重建后回填了记账截止时间，再次记账不会重复
+        self.assertEqual(accounting.account_run(runs[0].pk), 0)
+
+    def test_rebuild_retries_batch_accounted_concurrently(self):
+        runs = [self._run(self.bob), self._run(self.admin)]
+        for i, run in enumerate(runs):
+            self._finish(run, i + 1)
+            accounting.account_run(run.pk)
+        incremental = self._usage()
+        apply = accounting._apply
+        raced = []
+
+        def racing_apply(totals):
+            # 第一批写汇总时第二条运行记录被抢先记账：这一批整体回滚后重试（测试里同一连接，抢先的写入一并回滚）
+            if not raced:
+                raced.append(True)
+                accounting.account_run(runs[1].pk)
+            return apply(totals)
+
+        with mock.patch('task.accounting._apply', side_effect=racing_apply) as applied:
+            self.assertEqual(accounting.rebuild(chunk_size=2), (2, len(incremental)))
+        # 第一批、抢先的记账、重试的一批
+        self.assertEqual(applied.call_count, 3)
+        self.assertEqual(self._usage(), incremental)
+
+    def test_report_api_reads_rollups_only(self):
+        self._finish(self._run(self.bob, group=self.group), 1)
+        self._finish(self._run(self.admin), 1)
+        for run_id in GPUTaskRunningLog.objects.values_list('id', flat=True):
+            accounting.account_run(run_id)
+        params = {
+            'start': (self.midnight - timedelta(days=1)).date().isoformat(), 'end': self.midnight.date().isoformat(),
+            'group_by': 'user,project',
+        }
+
+        self.client.force_login(self.admin)
+        with self.assertNumQueries(3):  # 会话、用户 + 一次汇总查询
+            data = self.client.get('/api/v1/gpu_usage/', params).json()
+        self.assertEqual(
+            [(r['user'], r['project'], r['runs'], r['gpu_hours']) for r in data['rows']],
+            [('admin', None, 1, 4.0), ('bob', 'vision', 1, 4.0)],
+        )
+        response = self.client.get('/api/v1/gpu_usage/', dict(params, format='csv'))
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertEqual(response.content.decode().splitlines(), [
+            'user,project,runs,gpu_hours,wall_hours', 'admin,,1,4.0,2.0', 'bob,vision,1,4.0,2.0',
+        ])
+        self.client.logout()
+
+        # 普通用户用 API token 只能看到自己的用量
+        data = self.client.get('/api/v1/gpu_usage/', dict(params, group_by='user'),
+                               HTTP_AUTHORIZATION='Bearer bob-token').json()
+        self.assertEqual([r['user'] for r in data['rows']], ['bob'])
+        self.assertEqual(self.client.get('/api/v1/gpu_usage/').status_code, 401)
+        self.assertEqual(self.client.get('/api/v1/gpu_usage/', {'group_by': 'task'},
+                                         HTTP_AUTHORIZATION='Bearer bob-token').status_code, 400)
+
+
+class _DroppedSshProcessGroup(_FakeProcessGroup):
+    """远端进程已启动，但 ssh 会话断开（ssh 自身退出码 255）。"""
+
+    def get_return_code(self):
+        return 255
+
+
+class _UserExit255ProcessGroup(_DroppedSshProcessGroup):
+    """用户程序自己以 255 退出：节点上的退出码文件同样是 255（$HOME 即测试的“节点”目录）。"""
+
+    def __init__(self, *args, running_log_id=None, **kwargs):
+        self.running_log_id = running_log_id
+
+    def get_return_code(self):
+        prefix = os.path.join(os.environ['HOME'], '.gputasker', 'running_tasks', str(self.running_log_id))
+        for suffix, content in (('.out', 'step 1\n'), ('.exit', '255\n')):
+            with open(prefix + suffix, 'w') as f:
+                f.write(content)
+        return super().get_return_code()
+
+
+class SchedulerReattachTest(TestCase):
+    """调度器重启后按运行记录接管运行中的任务：续接输出、取退出码收尾；SIGTERM 时不丢任务。"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'x')
+        UserConfig.objects.create(user=cls.admin, server_username='admin', server_private_key='-')
+        cls.server = GPUServer.objects.create(ip='10.7.0.1')
+
+    def setUp(self):
+        use_temp_running_log_dir(self)
+        self.dir = tempfile.mkdtemp()
+        self.remote_dir = os.path.join(self.dir, '.gputasker', 'running_tasks')
+        os.makedirs(self.remote_dir)
+        env = mock.patch.dict(os.environ, {
+            'GPUTASKER_SCHEDULER_WAKEUP_FILE': os.path.join(self.dir, 'wakeup'),
+            # “节点”就是本机：远端命令用 bash 在本地执行，$HOME 指向临时目录
+            'HOME': self.dir,
+        })
+        env.start()
+        self.addCleanup(env.stop)
+        for target in ('task.utils.generate_ssh_cmd', 'task.utils.task_logger', 'task.supervisor.task_logger',
+                       'task.scheduler.task_logger'):
+            patcher = mock.patch(
+                target, side_effect=lambda host, user, cmd, port, key: 'bash -c {}'.format(shlex.quote(cmd)),
+            ) if target.endswith('generate_ssh_cmd') else mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(DRAINING.clear)
+
+    def _run(self, status=1, **kwargs):
+        task = GPUTask.objects.create(name='t', user=self.admin, workspace='~', cmd='true', status=1 if status in (1, 2) else -4)
+        kwargs.setdefault('log_file_path', os.path.join(self.dir, 'run.log'))
+        return GPUTaskRunningLog.objects.create(index=0, task=task, server=self.server, pid=kwargs.pop('pid', 100),
+                                                gpus='0,1', status=status, **kwargs)
+
+    def _dead_pid(self):
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        return proc.pid
+
+    def test_recover_classifies_running_logs(self):
+        remote = self._run(remote_pid=77, remote_pgid=77)
+        lost = self._run(status=-2, remote_pid=78)
+        never_started = self._run(pid=-1)
+        spawning = self._run(pid=-1, spawned_at=timezone.now())
+        self._run(status=2, remote_pid=79)
+        with mock.patch('task.supervisor.release_gpus') as release:
+            ids, requeued, pending = recover()
+        self.assertEqual(ids, [remote.pk, lost.pk])
+        self.assertEqual((requeued, pending), (1, 1))
+        release.assert_called_once_with(self.server, [0, 1], busy_by_log_id=never_started.pk)
+
+        never_started.refresh_from_db()
+        self.assertEqual((never_started.status, never_started.task.status), (-1, 0))
+        self.assertIsNotNone(never_started.gpus_released_at)
+        # 启动到一半的交给心跳判断：补上心跳时间，超时后照常标记为失联
+        spawning.refresh_from_db()
+        self.assertEqual(spawning.status, 1)
+        self.assertIsNotNone(spawning.last_heartbeat_at)
+
+        # 已在监管的不重复接管
+        attach(remote.pk)
+        self.addCleanup(detach, remote.pk)
+        self.assertEqual(unsupervised_runs(), [lost.pk])
+
+    def test_supervise_resumes_output_and_finishes(self):
+        run = self._run(remote_pid=self._dead_pid())
+        out_path = os.path.join(self.remote_dir, '{}.out'.format(run.pk))
+        exit_path = os.path.join(self.remote_dir, '{}.exit'.format(run.pk))
+        # master 日志已落盘标记行和远端输出的第 1 行；调度器停机期间远端又输出了 2 行后以 3 退出
+        with open(run.log_file_path, 'wb') as f:
+            f.write(b'__GPUTASKER_REMOTE__ pid=1 pgid=1\nepoch 1\n')
+        with open(checkpoint_path(run.log_file_path), 'w') as f:
+            f.write('1')
+        with open(out_path, 'wb') as f:
+            f.write(b'epoch 1\nepoch 2\nepoch 3\n')
+        with open(exit_path, 'w') as f:
+            f.write('3\n')
+
+        with mock.patch('task.supervisor.release_gpus') as release:
+            self.assertTrue(supervise(run.pk))
+        release.assert_called_once_with(self.server, [0, 1], busy_by_log_id=run.pk)
+        with open(run.log_file_path, 'rb') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[1], b'epoch 1')
+        self.assertIn('重新接管'.encode('utf-8'), lines[2])
+        self.assertEqual(lines[3:], [b'epoch 2', b'epoch 3'])
+        run.refresh_from_db()
+        self.assertEqual((run.status, run.task.status), (-1, -1))
+        self.assertIsNotNone(run.finished_at)
+        self.assertFalse(os.path.exists(out_path) or os.path.exists(exit_path))
+        self.assertFalse(os.path.exists(checkpoint_path(run.log_file_path)))
+        # 已收尾的不再接管
+        self.assertFalse(supervise(run.pk))
+
+    def test_supervise_follows_live_process_until_exit(self):
+        run = self._run()
+        out_path = os.path.join(self.remote_dir, '{}.out'.format(run.pk))
+        exit_path = os.path.join(self.remote_dir, '{}.exit'.format(run.pk))
+        with open(out_path, 'w') as f:
+            f.write('step 1\n')
+        job = subprocess.Popen(['bash', '-c', 'sleep 0.5; echo step 2 >> {0}; echo 0 > {1}'.format(
+            shlex.quote(out_path), shlex.quote(exit_path))])
+        # 真实的远端进程不是本进程的子进程：及时回收，免得僵尸进程让 tail --pid 一直等
+        threading.Thread(target=job.wait, daemon=True).start()
+        GPUTaskRunningLog.objects.filter(pk=run.pk).update(remote_pid=job.pid)
+
+        with mock.patch('task.supervisor.release_gpus'):
+            self.assertTrue(supervise(run.pk))
+        with open(run.log_file_path, 'rb') as f:
+            self.assertEqual(f.read().splitlines()[1:], [b'step 1', b'step 2'])
+        run.refresh_from_db()
+        self.assertEqual((run.status, run.task.status), (2, 2))
+
+    def test_unknown_exit_code_fails_with_remark(self):
+        run = self._run(status=-2, remote_pid=self._dead_pid())
+        with mock.patch('task.supervisor.release_gpus'):
+            self.assertTrue(supervise(run.pk))
+        run.refresh_from_db()
+        self.assertEqual((run.status, run.task.status, run.remark), (-1, -1, UNKNOWN_EXIT_REMARK))
+
+    def _dispatch(self, task, process_group):
+        with mock.patch('task.utils.RemoteGPUProcessGroup', process_group), \
+                mock.patch('task.utils.try_lock_gpus', side_effect=lambda server, gpus, busy_by_log_id: len(gpus)), \
+                mock.patch('task.utils.release_gpus') as release, \
+                mock.patch.object(GPUServer, 'get_available_gpus', return_value=[0]), \
+                mock.patch('task.supervisor.supervise') as handed_off:
+            run_task(task.pk)
+        return release, handed_off
+
+    def test_run_task_hands_off_when_ssh_drops(self):
+        task = GPUTask.objects.create(name='t', user=self.admin, workspace='~', cmd='true', assign_server=self.server)
+        release, handed_off = self._dispatch(task, _DroppedSshProcessGroup)
+        run = GPUTaskRunningLog.objects.get(task=task)
+        # 远端进程可能仍在运行：不判失败、不释放 GPU，交给 supervisor
+        self.assertEqual((run.status, run.remote_pid), (1, 77))
+        self.assertEqual(GPUTask.objects.get(pk=task.pk).status, 1)
+        release.assert_not_called()
+        handed_off.assert_called_once_with(run.pk)
+        self.assertEqual(attached_ids(), set())
+
+    def test_run_task_removes_node_copies_only_when_it_finishes_the_run(self):
+        for process_group, finished in ((_FakeProcessGroup, True), (_DroppedSshProcessGroup, False)):
+            task = GPUTask.objects.create(name='t', user=self.admin, workspace='~', cmd='true',
+                                          assign_server=self.server)
+            with mock.patch.object(_FakeProcessGroup, 'remove_remote_files', return_value=True) as removed:
+                self._dispatch(task, process_group)
+            self.assertEqual(removed.called, finished)
+
+    def test_remote_copies_are_removed_over_ssh(self):
+        path = os.path.join(self.dir, 'run.log')
+        process = RemoteGPUProcessGroup('admin', '10.7.0.1', [0], 'echo hi', '~', 22, None, path, running_log_id=5)
+        process.start_streaming()
+        self.assertEqual(process.get_return_code(), 0)
+        self.assertEqual(sorted(os.listdir(self.remote_dir)), ['5.exit', '5.out'])
+        self.assertTrue(process.remove_remote_files())
+        self.assertEqual(os.listdir(self.remote_dir), [])
+
+    def test_run_task_fails_when_user_program_exits_255(self):
+        task = GPUTask.objects.create(name='t', user=self.admin, workspace='~', cmd='exit 255',
+                                      assign_server=self.server)
+        release, handed_off = self._dispatch(task, _UserExit255ProcessGroup)
+        run = GPUTaskRunningLog.objects.get(task=task)
+        # 节点上的退出码就是 255：照常判失败、释放 GPU，并清掉节点上的副本
+        self.assertEqual((run.status, GPUTask.objects.get(pk=task.pk).status), (-1, -1))
+        release.assert_called_once()
+        handed_off.assert_not_called()
+        self.assertEqual(os.listdir(self.remote_dir), [])
+
+    def test_draining_scheduler_stops_launching_and_exits(self):
+        service = SchedulerService(wakeup=mock.Mock())
+        task = GPUTask.objects.create(name='t', user=self.admin, workspace='~', cmd='true', assign_server=self.server)
+        GPUTask.objects.filter(pk=task.pk).update(dispatching_at=timezone.now())
+        service.stop()
+        self.assertTrue(DRAINING.is_set())
+        release, _ = self._dispatch(task, _FakeProcessGroup)
+        # 选好卡但还没启动远端进程：放回 GPU，任务留在队列里
+        release.assert_called_once()
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.dispatching_at), (0, None))
+        self.assertFalse(GPUTaskRunningLog.objects.filter(task=task).exists())
+
+        # 主循环不再认领，直接进入退出流程
+        with mock.patch('task.scheduler.supervisor.recover', return_value=([], 0, 0)), \
+                mock.patch.object(SchedulerService, 'install_signal_handlers'), \
+                mock.patch.object(SchedulerService, 'cycle') as cycle:
+            service.run()
+        cycle.assert_not_called()
+        self.assertEqual(service.drain(timeout=0), 0)
+
+    def test_checkpoint_counts_remote_lines(self):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b'a\nprogress 1\rprogress 2\nb\npartial')
+        os.close(write_fd)
+        path = os.path.join(self.dir, 'out.log')
+        try:
+            stream_to_file(read_fd, path, b'__GPUTASKER_REMOTE__ pid=1 pgid=1\n',
+                           checkpoint=OutputCheckpoint(path, base=-1))
+        finally:
+            os.close(read_fd)
+        # 首行标记不在远端副本里；不完整的最后一行续接时重新读取
+        self.assertEqual(read_checkpoint(path), 3)
+
+
+class ShardedSchedulerTest(TestCase):
+    """多实例调度：租约、一致性哈希分片、只在本分片内放置，实例过期后重新分片并接管其运行中任务。"""
+    GPU = {'name': 'A100', 'utilization': 0, 'memory_total': 100, 'memory_used': 0}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'x')
+        UserConfig.objects.create(user=cls.admin, server_username='admin', server_private_key='-')
+        cls.servers = [GPUServer.objects.create(ip='10.8.0.{}'.format(i)) for i in range(1, 9)]
+
+    def setUp(self):
+        use_temp_running_log_dir(self)
+        self.dir = tempfile.mkdtemp()
+        env = mock.patch.dict(os.environ, {
+            'GPUTASKER_SCHEDULER_WAKEUP_FILE': os.path.join(self.dir, 'wakeup'),
+            'GPUTASKER_SCHEDULER_NAME': 'a',
+        })
+        env.start()
+        self.addCleanup(env.stop)
+        for target in ('task.scheduler.task_logger', 'task.utils.task_logger'):
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.a = Lease('a', ttl=30)
+        self.b = Lease('b', ttl=30)
+        self.a.renew()
+        self.b.renew()
+
+    def _task(self, **kwargs):
+        return GPUTask.objects.create(name='t', user=self.admin, workspace='~', cmd='true', **kwargs)
+
+    def _expire(self, name, seconds=31):
+        SchedulerInstance.objects.filter(name=name).update(expires_at=timezone.now() - timedelta(seconds=seconds))
+
+    def test_hash_ring_moves_only_servers_of_the_new_member(self):
+        keys = range(1, 401)
+        before = {k: HashRing(['a', 'b', 'c']).owner(k) for k in keys}
+        after = {k: HashRing(['a', 'b', 'c', 'd']).owner(k) for k in keys}
+        moved = [k for k in keys if before[k] != after[k]]
+        self.assertTrue(all(after[k] == 'd' for k in moved))
+        self.assertTrue(40 < len(moved) < 200, len(moved))
+        self.assertIsNone(HashRing([]).owner(1))
+
+    def test_shards_cover_all_servers_and_rebalance_on_expiry(self):
+        all_ids = sorted(s.id for s in self.servers)
+        shard_a, shard_b = self.a.shard(), self.b.shard()
+        self.assertEqual(shard_a.members, ['a', 'b'])
+        self.assertTrue(shard_a.is_leader)
+        self.assertFalse(shard_b.is_leader)
+        self.assertEqual(sorted(shard_a.server_ids + shard_b.server_ids), all_ids)
+        self.assertFalse(set(shard_a.server_ids) & set(shard_b.server_ids))
+
+        # b 的租约过期：a 接手全部节点；过期超过一个租期的租约由 leader 清理
+        self._expire('b', seconds=61)
+        shard_a = self.a.shard()
+        self.assertEqual((shard_a.members, shard_a.server_ids), (['a'], all_ids))
+        self.assertFalse(SchedulerInstance.objects.filter(name='b').exists())
+
+        # a 卡顿超过租期：b 暂时接手全部节点；a 下一次计算分片时续约，恢复原来的分片
+        self.b.renew()
+        self._expire('a', seconds=5)
+        self.assertEqual((self.b.shard().server_ids, self.b.shard().leader), (all_ids, 'b'))
+        self.assertEqual(self.a.shard().members, ['a', 'b'])
+        self.assertEqual(self.b.shard().leader, 'a')
+        self.a.release()
+        self.assertEqual(self.b.shard().server_ids, all_ids)
+
+    def test_ready_tasks_and_placement_stay_in_shard(self):
+        mine, theirs = self.servers[0], self.servers[1]
+        for i in range(4):
+            GPUInfo.objects.create(uuid='m{}'.format(i), index=i, server=mine, use_by_self=i >= 2, **self.GPU)
+        for i in range(8):
+            GPUInfo.objects.create(uuid='t{}'.format(i), index=i, server=theirs, **self.GPU)
+        on_mine = self._task(assign_server=mine)
+        self._task(assign_server=theirs)
+        small = self._task(gpu_requirement=2)
+        self._task(gpu_requirement=4)
+        stale_before = timezone.now() - timedelta(seconds=60)
+        self.assertEqual(shard_max_gpus([mine.id]), 2)
+        self.assertEqual(
+            ready_task_ids(stale_before, [mine.id], shard_max_gpus([mine.id])), [on_mine.pk, small.pk])
+        self.assertEqual(len(ready_task_ids(stale_before)), 4)
+
+        checked = []
+
+        def available(server, *args):
+            checked.append(server.id)
+            return [0, 1]
+
+        with mock.patch('task.utils.RemoteGPUProcessGroup', _FakeProcessGroup), \
+                mock.patch('task.utils.try_lock_gpus', side_effect=lambda server, gpus, busy_by_log_id: len(gpus)), \
+                mock.patch('task.utils.release_gpus'), \
+                mock.patch.object(GPUServer, 'get_available_gpus', autospec=True, side_effect=available):
+            run_task(small.pk, [mine.id])
+        self.assertEqual(checked, [mine.id])
+        run = GPUTaskRunningLog.objects.get(task=small)
+        self.assertEqual((run.server_id, run.scheduler), (mine.id, 'a'))
+
+    def test_each_instance_dispatches_its_own_shard_and_only_leader_does_housekeeping(self):
+        tasks = {s.id: self._task(assign_server=s).pk for s in self.servers}
+        dispatched = {}
+        leader_jobs = {}
+        for name in ('a', 'b'):
+            service = SchedulerService(profiler=mock.Mock(), wakeup=mock.Mock(), lease=Lease(name, ttl=30))
+            with mock.patch.object(service, 'dispatch') as dispatch, \
+                    mock.patch.object(service.stopping, 'wait'), \
+                    mock.patch('task.scheduler.mark_stale_running_tasks_as_lost') as stale, \
+                    mock.patch('task.scheduler.materialize_arrays') as materialize, \
+                    mock.patch('task.scheduler.gpu_timeseries'), mock.patch('task.scheduler.log_archive'), \
+                    mock.patch('task.scheduler.log_janitor'), mock.patch('task.scheduler.log_search'), \
+                    mock.patch('task.scheduler.notification_outbox'):
+                service.cycle()
+            dispatched[name] = sorted(c.args[0] for c in dispatch.call_args_list)
+            self.assertEqual(dispatched[name], sorted(tasks[pk] for pk in service.server_ids))
+            leader_jobs[name] = (stale.call_count, materialize.call_count)
+        self.assertEqual(sorted(dispatched['a'] + dispatched['b']), sorted(tasks.values()))
+        self.assertEqual(leader_jobs, {'a': (1, 1), 'b': (0, 0)})
+
+    def test_runs_of_expired_instance_are_taken_over(self):
+        shard = assign_servers(['a', 'b'], [s.id for s in self.servers])
+        server = GPUServer.objects.get(pk=shard['b'][0])
+        task = self._task(status=1)
+        run = GPUTaskRunningLog.objects.create(index=0, task=task, server=server, pid=100, remote_pid=77, gpus='0',
+                                               status=1, scheduler='b', log_file_path=os.path.join(self.dir, 'r.log'))
+        # b 存活时 a 不碰它的运行记录，比较后更新也抢不到
+        self.assertEqual(unsupervised_runs(others=['b']), [])
+        self.assertFalse(claim(run.pk, others=['b']))
+
+        service = SchedulerService(profiler=mock.Mock(), wakeup=mock.Mock(), lease=self.a)
+        service.refresh_shard()
+        self.assertNotIn(server.id, service.server_ids)
+        self._expire('b')
+        with mock.patch('task.scheduler.supervisor.supervise') as supervised:
+            service.refresh_shard()
+        self.assertIn(server.id, service.server_ids)
+        supervised.assert_called_once_with(run.pk, [])
+        self.assertTrue(claim(run.pk, others=service.shard.others))
+        self.assertEqual(GPUTaskRunningLog.objects.get(pk=run.pk).scheduler, 'a')
@@ -8,19 +8,43 @@ import logging
 import base64
 import threading
 import re
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, F, Q, Sum
 from django.utils import timezone
 
-from gpu_tasker.settings import RUNNING_LOG_DIR
-from .models import GPUTask, GPUTaskRunningLog
+from base.telemetry import Counter, Histogram
+from base.utils import PeriodicJob
+from .models import GPUTask, GPUTaskRunningLog, TaskArray
+from .accounting import safe_account_run
+from .log_writer import OutputCheckpoint, stream_to_file
+from . import metrics, sharding
 from notification.email_notification import \
     send_task_start_email, send_task_finish_email, send_task_fail_email
 
-from gpu_info.models import GPUServer
+from gpu_info.models import GPUServer, GPUInfo, gpu_update_mode, node_stale_seconds
 from gpu_info.models import try_lock_gpus, release_gpus
+from gpu_info.utils import SSH_FAILURES, observe_ssh
 
 
 task_logger = logging.getLogger('django.task')
 
+# 调度器正在退出：ssh 会话结束时不收尾、不释放 GPU，留给下次启动重新接管（见 task.supervisor）
+DRAINING = threading.Event()
+# 本进程正在监管（run_task 或 supervisor）的运行记录 id
+_attached = set()
+_attached_lock = threading.Lock()
+
+SCHEDULER_PHASE_SECONDS = Histogram(
+    'gputasker_scheduler_phase_seconds', '调度循环各阶段耗时（秒），phase=cycle 为整轮', ('phase',))
+TASK_CLAIMS = Counter(
+    'gputasker_task_claims_total', '任务认领次数：won 认领成功，lost 已被其他调度线程/实例认领', ('result',))
+DISPATCH_RESULTS = Counter(
+    'gputasker_dispatch_total', '派发结果：started 已启动，no_gpu 没有可用 GPU，conflict 状态已变化，error 异常', ('result',))
+DISPATCH_SECONDS = Histogram(
+    'gputasker_dispatch_seconds', '从认领任务到远端进程启动（读到首行）的耗时（秒）')
+
 
 def generate_ssh_cmd(host, user, exec_cmd, port=22, private_key_path=None):
     exec_cmd = exec_cmd.replace('$', '\\$')
@@ -39,18 +63,17 @@ class RemoteProcess:
         self.output_file = output_file
         self._stream_thread = None
         self._first_line = None
+        self._first_line_at = None
 
         if output_file is not None:
             # 需要解析远端 PID/PGID，同时持续把输出写入 log 文件
+            # 输出按字节读取（见 task.log_writer），不经过 Python 的缓冲与解码
             self.proc = subprocess.Popen(
                 self.cmd,
                 shell=True,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1,
-                encoding='utf-8',
-                errors='replace',
+                bufsize=0,
             )
         else:
             self.proc = subprocess.Popen(self.cmd, shell=True)
@@ -61,6 +84,10 @@ class RemoteProcess:
     def first_line(self):
         return self._first_line
 
+    def first_line_at(self):
+        """读到首行的时间（输出线程启动之前）。"""
+        return self._first_line_at
+
     def kill(self):
         # os.killpg(os.getpgid(self.proc.pid), signal.SIGKILL)
         os.kill(self.proc.pid, signal.SIGKILL)
@@ -82,12 +109,20 @@ class RemoteGPUProcessGroup(RemoteProcess):
 
     远端进程会前置输出一行：
       __GPUTASKER_REMOTE__ pid=<pid> pgid=<pgid>
+
+    带 running_log_id 时，输出另存一份到节点的 <META_DIR>/<id>.out（tee -p：ssh 断开后继续写文件、
+    任务不会因 SIGPIPE 退出），退出码写到 <id>.exit；调度器重启后据此续接输出并收尾（见 task.supervisor）。
     """
 
     MARKER_PREFIX = '__GPUTASKER_REMOTE__'
+    META_DIR = '$HOME/.gputasker/running_tasks'
+    # 节点上输出副本与退出码文件的保留天数（新任务启动时顺带清理）
+    REMOTE_KEEP_DAYS = 7
 
     def __init__(self, user, host, gpus, cmd, workspace='~', port=22, private_key_path=None, output_file=None, running_log_id=None):
         env = 'export CUDA_VISIBLE_DEVICES={}'.format(','.join(map(str, gpus)))
+        self._ssh = (user, host, port, private_key_path)
+        self._meta_id = None
         # 在 node 上写入“运行中任务元数据”，供 agent 扫描并上报心跳
         # 文件会在任务退出时自动删除（trap EXIT）。
         meta_prefix = ''
@@ -97,17 +132,23 @@ class RemoteGPUProcessGroup(RemoteProcess):
             except Exception:
                 rid = None
             if rid and rid > 0:
+                self._meta_id = rid
                 meta_prefix = (
-                    'META_DIR="$HOME/.gputasker/running_tasks"\n'
+                    'META_DIR="{meta_dir}"\n'
                     'mkdir -p "$META_DIR"\n'
+                    'find "$META_DIR" -maxdepth 1 \\( -name "*.out" -o -name "*.exit" \\) -mtime +{keep} -delete 2>/dev/null\n'
                     'META_PATH="$META_DIR/{rid}.json"\n'
+                    'OUT_PATH="$META_DIR/{rid}.out"\n'
+                    'EXIT_PATH="$META_DIR/{rid}.exit"\n'
                     'REMOTE_PID="$$"\n'
                     'REMOTE_PGID="$(ps -o pgid= -p $$ | tr -d " ")"\n'
                     'cat > "$META_PATH" <<EOF\n'
                     '{{"running_log_id":{rid},"remote_pid":' + '"$REMOTE_PID"' + ',"remote_pgid":' + '"$REMOTE_PGID"' + ',"timestamp":' + '"$(date +%s)"' + '}}\n'
                     'EOF\n'
-                    'trap "rm -f \"$META_PATH\"" EXIT\n'
-                ).format(rid=rid)
+                    'trap \'echo $? > "$EXIT_PATH"; rm -f "$META_PATH"\' EXIT\n'
+                    # 不支持 tee -p 的节点（如 busybox）不留副本，ssh 断开时任务行为同旧版本
+                    'if tee -p /dev/null </dev/null >/dev/null 2>&1; then exec > >(tee -a -p "$OUT_PATH") 2>&1; fi\n'
+                ).format(rid=rid, meta_dir=self.META_DIR, keep=self.REMOTE_KEEP_DAYS)
 
         script = '{}\n{}\n{}\n'.format(env, meta_prefix, cmd)
         payload = base64.b64encode(script.encode('utf-8')).decode('ascii')
@@ -125,38 +166,63 @@ class RemoteGPUProcessGroup(RemoteProcess):
         remote_cmd = "python3 -c '{}' {} || python -c '{}' {}".format(py_code, payload, py_code, payload)
         super(RemoteGPUProcessGroup, self).__init__(user, host, remote_cmd, workspace, port, private_key_path, output_file)
 
-    def start_streaming(self):
+    def start_streaming(self, observer=None, on_first_output=None, checkpoint=None):
+        """observer：可选的输出观察者（feed/close），例如指标提取器；on_first_output：首行输出后的回调；
+        checkpoint：写盘后记录已落盘行数（见 task.log_writer.OutputCheckpoint）。"""
         if self.output_file is None or self.proc.stdout is None:
+            if observer is not None:
+                observer.close()
             return
         os.makedirs(os.path.dirname(self.output_file), exist_ok=True)
 
-        # 1) 同步读首行，便于解析远端 pid/pgid
+        # 1) 同步读首行，便于解析远端 pid/pgid（无缓冲的原始管道，readline 不会多读）
+        first_line = b''
         try:
-            self._first_line = self.proc.stdout.readline()
+            first_line = self.proc.stdout.readline()
+            self._first_line_at = timezone.now()
+            self._first_line = first_line.decode('utf-8', errors='replace')
         except Exception:
             self._first_line = None
 
-        # 2) 启动后台线程持续 drain stdout，并写入日志文件
-        def _stream_rest(stdout, path, first_line):
-            with open(path, 'a', encoding='utf-8', errors='replace') as out:
-                if first_line:
-                    out.write(first_line)
-                    if not first_line.endswith('\n'):
-                        out.write('\n')
-                    out.flush()
-                for line in stdout:
-                    out.write(line)
-                    if not line.endswith('\n'):
-                        out.write('\n')
-                    out.flush()
+        # 2) 启动后台线程持续 drain stdout，按块缓冲写入日志文件
+        def _stream_rest(stdout, path, first_line, observer):
+            try:
+                stream_to_file(
+                    stdout.fileno(), path, first_line,
+                    observer=observer.feed if observer else None, on_first_output=on_first_output,
+                    checkpoint=checkpoint,
+                )
+            except Exception:
+                task_logger.error(traceback.format_exc())
+            finally:
+                if observer is not None:
+                    try:
+                        observer.close()
+                    except Exception:
+                        task_logger.error(traceback.format_exc())
+                # 指标写回会在本线程打开数据库连接
+                connection.close()
 
         self._stream_thread = threading.Thread(
             target=_stream_rest,
-            args=(self.proc.stdout, self.output_file, self._first_line),
+            args=(self.proc.stdout, self.output_file, first_line, observer),
             daemon=True,
         )
         self._stream_thread.start()
 
+    def remove_remote_files(self):
+        """run_task 已收到完整输出并收尾：删除节点上的输出副本与退出码文件，返回是否成功。
+
+        交给 supervisor 接管的运行不调用，副本留着续接输出（见 task.supervisor）。
+        """
+        if self._meta_id is None:
+            return True
+        user, host, port, private_key_path = self._ssh
+        prefix = '{}/{:d}'.format(self.META_DIR, self._meta_id)
+        process = RemoteProcess(user, host, 'rm -f "{0}.out" "{0}.exit"'.format(prefix), '~', port, private_key_path)
+        with observe_ssh('cleanup'):
+            return process.get_return_code() == 0
+
     def get_return_code(self):
         rc = super().get_return_code()
         if self._stream_thread is not None:
@@ -167,6 +233,37 @@ class RemoteGPUProcessGroup(RemoteProcess):
         return rc
 
 
+def _open_metric_extractor(running_log, task):
+    # 提取要整段扫描每次写出的输出，只给配置了指标规则的任务开（或显式对所有任务打开）
+    if not metrics.enabled() or not (task.metric_patterns.strip() or metrics.all_tasks()):
+        return None
+    run_id = running_log.id
+
+    def save(latest, progress):
+        try:
+            GPUTaskRunningLog.objects.filter(pk=run_id).update(
+                metrics=json.dumps(latest, separators=(',', ':')), progress=progress,
+            )
+        except Exception:
+            task_logger.error(traceback.format_exc())
+
+    try:
+        return metrics.open_extractor(running_log.log_file_path, task.metric_patterns, on_flush=save)
+    except OSError:
+        task_logger.error(traceback.format_exc())
+        return None
+
+
+def _exited_with(running_log, return_code):
+    """ssh 以 255 结束时确认是不是用户程序自己以 255 退出（读节点上的退出码文件，见 task.supervisor）。"""
+    from .supervisor import exited_with
+    try:
+        return exited_with(running_log, return_code)
+    except Exception:
+        task_logger.error(traceback.format_exc())
+        return False
+
+
 def _parse_remote_marker(line: str):
     if not line:
         return None, None
@@ -204,6 +301,16 @@ def _parse_gpu_list(gpus: str):
     return res
 
 
+def _wait_remote_kill(process):
+    try:
+        with observe_ssh('kill'):
+            # 255 为 ssh 自身失败（连不上、认证失败）；kill 命令本身总是返回 0
+            if process.get_return_code() == 255:
+                raise RuntimeError('ssh failed')
+    except Exception:
+        pass
+
+
 def kill_running_log(running_log: GPUTaskRunningLog):
     """通过 ssh kill 远端进程组，并释放 GPU。
 
@@ -229,10 +336,7 @@ def kill_running_log(running_log: GPUTaskRunningLog):
                 task.user.config.server_private_key_path,
                 output_file=None,
             )
-            try:
-                p1.get_return_code()
-            except Exception:
-                pass
+            _wait_remote_kill(p1)
             time.sleep(1)
             p2 = RemoteProcess(
                 task.user.config.server_username,
@@ -243,10 +347,7 @@ def kill_running_log(running_log: GPUTaskRunningLog):
                 task.user.config.server_private_key_path,
                 output_file=None,
             )
-            try:
-                p2.get_return_code()
-            except Exception:
-                pass
+            _wait_remote_kill(p2)
         elif server is not None and running_log.remote_pid:
             cmd = 'kill -TERM {} 2>/dev/null || true; sleep 1; kill -KILL {} 2>/dev/null || true'.format(
                 int(running_log.remote_pid),
@@ -261,10 +362,7 @@ def kill_running_log(running_log: GPUTaskRunningLog):
                 task.user.config.server_private_key_path,
                 output_file=None,
             )
-            try:
-                p.get_return_code()
-            except Exception:
-                pass
+            _wait_remote_kill(p)
         else:
             # 最后兜底：杀 master 本地 ssh pid
             if running_log.pid and running_log.pid > 0:
@@ -274,9 +372,11 @@ def kill_running_log(running_log: GPUTaskRunningLog):
     finally:
         try:
             running_log.status = -1
-            running_log.save(update_fields=['status', 'update_at'])
+            running_log.finished_at = running_log.finished_at or timezone.now()
+            running_log.save(update_fields=['status', 'finished_at', 'update_at'])
         except Exception:
             pass
+        safe_account_run(running_log.id)
         try:
             if task.status == 1:
                 task.status = -1
@@ -286,11 +386,173 @@ def kill_running_log(running_log: GPUTaskRunningLog):
         try:
             if server is not None and gpu_list:
                 release_gpus(server, gpu_list, busy_by_log_id=running_log.id)
+                _mark_gpus_released(running_log.id)
+        except Exception:
+            task_logger.error(traceback.format_exc())
+
+
+def attach(running_log_id):
+    """登记本进程开始监管该运行记录；已有线程在监管时返回 False。"""
+    with _attached_lock:
+        if running_log_id in _attached:
+            return False
+        _attached.add(running_log_id)
+        return True
+
+
+def detach(running_log_id):
+    with _attached_lock:
+        _attached.discard(running_log_id)
+
+
+def attached_ids():
+    with _attached_lock:
+        return set(_attached)
+
+
+def _mark_gpus_released(running_log_id):
+    # kill 与 run_task 收尾都会释放一次，以先到的为准
+    GPUTaskRunningLog.objects.filter(id=running_log_id, gpus_released_at__isnull=True).update(
+        gpus_released_at=timezone.now())
+
+
+def _mark_first_output(running_log_id):
+    GPUTaskRunningLog.objects.filter(id=running_log_id, first_output_at__isnull=True).update(
+        first_output_at=timezone.now())
+
+
+def _claimable(qs, stale_before):
+    """未被认领，或认领已超时（调度线程异常退出）的“准备就绪”任务。"""
+    return qs.filter(status=0).filter(Q(dispatching_at__isnull=True) | Q(dispatching_at__lt=stale_before))
+
+
+def ready_task_ids(stale_before, server_ids=None, max_gpus=None):
+    """按优先级、创建时间列出可认领的任务 id（走 gputask_queue_idx）。
+
+    多实例模式下 server_ids 为本实例分到的节点：指定了其他节点的任务不列出；
+    max_gpus 为分片内单个节点最多可用的 GPU 数，未指定节点且需求更多的任务不列出。
+    """
+    qs = _claimable(GPUTask.objects.all(), stale_before)
+    if server_ids is not None:
+        qs = qs.filter(Q(assign_server__isnull=True) | Q(assign_server_id__in=server_ids))
+    if max_gpus is not None:
+        qs = qs.filter(Q(assign_server__isnull=False) | Q(gpu_requirement__lte=max_gpus))
+    return list(qs.order_by('-priority', 'create_at').values_list('id', flat=True))
+
+
+def shard_max_gpus(server_ids):
+    """分片内单个节点上未被本系统占用的 GPU 数的最大值（选卡的上限，用于跳过本分片放不下的任务）。"""
+    counts = (
+        GPUInfo.objects.filter(server_id__in=server_ids, use_by_self=False)
+        .values('server_id').annotate(n=Count('uuid')).values_list('n', flat=True)
+    )
+    return max(counts, default=0)
+
+
+def claim_task(task_id, now, stale_before):
+    """原子认领任务：写入 dispatching_at，成功返回 True。避免并发/多实例重复启动。"""
+    won = _claimable(GPUTask.objects.filter(id=task_id), stale_before).update(dispatching_at=now) == 1
+    TASK_CLAIMS.inc(result='won' if won else 'lost')
+    return won
+
+
+def cancel_tasks(tasks):
+    """排队中的任务改为“未就绪”，运行中的任务记下结束请求。tasks 为 GPUTask 查询集，返回 (取消数, 待结束数)。
+
+    结束一个远端进程要两次 ssh 加等待，在 Web 请求里逐个结束会超时：这里只做两条集合更新，
+    由调度器在后台线程里结束（kill_requested_runs），调用方随后唤醒调度器。
+    """
+    now = timezone.now()
+    cancelled = tasks.filter(status=0).update(status=-2, dispatching_at=None, update_at=now)
+    queued = GPUTaskRunningLog.objects.filter(
+        task__in=tasks, status__in=(1, -2), kill_requested_at__isnull=True,
+    ).update(kill_requested_at=now, update_at=now)
+    return cancelled, queued
+
+
+def kill_requested_runs(server_ids=None):
+    """结束已请求结束的运行中任务，返回结束数；server_ids 非空时只处理这些节点上的（多实例分片）。"""
+    qs = GPUTaskRunningLog.objects.filter(status__in=(1, -2), kill_requested_at__isnull=False)
+    if server_ids is not None:
+        qs = qs.filter(server_id__in=server_ids)
+    killed = 0
+    for running_log in qs.select_related('task__user__config', 'server').order_by('kill_requested_at'):
+        try:
+            kill_running_log(running_log)
+            killed += 1
         except Exception:
             task_logger.error(traceback.format_exc())
+    if killed:
+        task_logger.info('killed %d cancelled running tasks', killed)
+    return killed
+
+
+KILL_JOB = PeriodicJob('task-killer', kill_requested_runs, lambda: 0.0)
+maybe_kill_in_background = KILL_JOB.maybe_start
 
 
-def run_task(task_id, _available_server_unused=None):
+def free_gpu_count():
+    """可调度节点上完全空闲且未被本系统占用的 GPU 数。"""
+    servers = GPUServer.objects.filter(can_use=True)
+    if gpu_update_mode() == 'report':
+        servers = servers.filter(last_report_at__gte=timezone.now() - timedelta(seconds=node_stale_seconds()))
+    else:
+        servers = servers.filter(valid=True)
+    return GPUInfo.objects.filter(server__in=servers, use_by_self=False, complete_free=True).count()
+
+
+def materialize_arrays():
+    """为调度中的任务数组展开下一批子任务，返回新建的子任务数。
+
+    每个数组“准备就绪”的子任务不超过 max_pending，并按空闲 GPU 数扣除已排队任务的需求折算；
+    没有空闲容量时每个数组也保留 1 个排队的子任务，GPU 释放后可以立即开始。
+    """
+    arrays = list(TaskArray.objects.filter(active=True, materialized__lt=F('size')).order_by('-priority', 'create_at'))
+    if not arrays:
+        return 0
+    pending = dict(
+        GPUTask.objects.filter(array__in=arrays, status=0).values('array').annotate(n=Count('id'))
+        .values_list('array', 'n')
+    )
+    queued_demand = GPUTask.objects.filter(status=0).aggregate(n=Sum('gpu_requirement'))['n'] or 0
+    capacity = free_gpu_count() - queued_demand
+    created = 0
+    for array in arrays:
+        per_task = max(1, array.gpu_requirement)
+        queued = pending.get(array.pk, 0)
+        count = min(array.max_pending - queued, array.size - array.materialized, max(0, capacity // per_task))
+        if queued == 0:
+            count = max(count, 1)
+        if count <= 0:
+            continue
+        if expand_array(array, count):
+            created += count
+            capacity -= count * per_task
+    return created
+
+
+def expand_array(array, count):
+    """展开数组接下来的 count 个子任务。
+
+    乐观认领序号区间：array.materialized 已过期（其他调度器实例先展开了）时不创建，返回 False。
+    """
+    start = array.materialized
+    with transaction.atomic():
+        claimed = TaskArray.objects.filter(pk=array.pk, active=True, materialized=start).update(
+            materialized=start + count)
+        if claimed != 1:
+            return False
+        GPUTask.objects.bulk_create(array.build_children(start, start + count))
+    array.materialized = start + count
+    return True
+
+
+def run_task(task_id, server_ids=None, state=None):
+    """启动一个已认领的任务。
+
+    server_ids 非空时只在这些节点上选卡（多实例模式下为本实例的分片）；
+    state 为调度器的集群状态缓存（gpu_info.cluster_state.ClusterState），给定时选卡只读内存、不查库。
+    """
     # 线程里重新加载，避免主线程的对象过期
     task = GPUTask.objects.select_related('user', 'assign_server', 'user__config').get(id=task_id)
 
@@ -311,11 +573,22 @@ def run_task(task_id, _available_server_unused=None):
         return s[:limit]
 
     # 选 server + GPU，并尝试原子占用
-    candidate_servers = []
-    if task.assign_server is not None:
-        candidate_servers = [task.assign_server]
+    # candidates：[(GPUServer, 提供 get_available_gpus 的对象)]
+    if state is not None:
+        wanted = server_ids
+        if task.assign_server_id is not None:
+            wanted = [task.assign_server_id] if server_ids is None or task.assign_server_id in server_ids else []
+        candidates = [(record.to_model(), record) for record in state.servers(wanted)]
     else:
-        candidate_servers = list(GPUServer.objects.all())
+        if task.assign_server is not None:
+            candidate_servers = [task.assign_server]
+        elif server_ids is not None:
+            candidate_servers = list(GPUServer.objects.filter(id__in=server_ids))
+        else:
+            candidate_servers = list(GPUServer.objects.all())
+        if server_ids is not None:
+            candidate_servers = [s for s in candidate_servers if s.id in server_ids]
+        candidates = [(s, s) for s in candidate_servers]
 
     server = None
     gpus = None
@@ -324,8 +597,8 @@ def run_task(task_id, _available_server_unused=None):
     # 先创建 running_log 拿到 id，用于 GPU busy_by_log_id 归属
     index = task.task_logs.all().count()
     try:
-        for s in candidate_servers:
-            available_gpus = s.get_available_gpus(
+        for s, source in candidates:
+            available_gpus = source.get_available_gpus(
                 task.gpu_requirement,
                 task.exclusive_gpu,
                 task.memory_requirement,
@@ -335,7 +608,7 @@ def run_task(task_id, _available_server_unused=None):
                 continue
             chosen = available_gpus[:task.gpu_requirement]
             log_file_path = os.path.join(
-                RUNNING_LOG_DIR,
+                settings.RUNNING_LOG_DIR,
                 '{:d}_{:s}_{:s}_{:d}_{:d}.log'.format(task.id, _safe_filename(task.name), s.ip, index, int(time.time()))
             )
 
@@ -350,6 +623,9 @@ def run_task(task_id, _available_server_unused=None):
                 log_file_path=log_file_path,
                 remark='',
                 status=1,
+                queued_at=task.queued_at,
+                claimed_at=task.dispatching_at,
+                scheduler=sharding.instance_name(),
             )
             tmp_log.save()
 
@@ -358,6 +634,7 @@ def run_task(task_id, _available_server_unused=None):
                 server = s
                 gpus = chosen
                 running_log = tmp_log
+                running_log.gpus_locked_at = timezone.now()
                 break
 
             # 可能部分占用成功，需要按 busy_by_log_id 精确释放
@@ -373,6 +650,7 @@ def run_task(task_id, _available_server_unused=None):
                 pass
     except Exception:
         # 选 GPU/写运行记录阶段异常：清理认领锁，避免任务卡住
+        DISPATCH_RESULTS.inc(result='error')
         try:
             GPUTask.objects.filter(id=task.id, status=0).update(dispatching_at=None)
         except Exception:
@@ -381,14 +659,27 @@ def run_task(task_id, _available_server_unused=None):
 
     if server is None or gpus is None or running_log is None:
         # 没有可用 GPU：保持“准备就绪”，并释放认领锁
+        DISPATCH_RESULTS.inc(result='no_gpu')
         GPUTask.objects.filter(id=task.id, status=0).update(dispatching_at=None)
         return
 
+    if DRAINING.is_set():
+        # 调度器正在退出：不再启动新的远端进程，已占用的 GPU 放回，任务留在队列里
+        try:
+            release_gpus(server, gpus, busy_by_log_id=running_log.id)
+            running_log.delete()
+        finally:
+            GPUTask.objects.filter(id=task.id, status=0).update(dispatching_at=None)
+        return
+
     log_file_path = running_log.log_file_path
+    attach(running_log.id)
+    detached = False
     try:
         # 标记为运行中（只从准备就绪切换，避免并发覆盖），并清理认领锁
         started = GPUTask.objects.filter(id=task.id, status=0).update(status=1, dispatching_at=None)
         if started != 1:
+            DISPATCH_RESULTS.inc(result='conflict')
             try:
                 running_log.status = -1
                 running_log.save(update_fields=['status', 'update_at'])
@@ -401,6 +692,10 @@ def run_task(task_id, _available_server_unused=None):
             return
 
         # run process (remote process group)
+        # 先落库 spawned_at：调度器在这之后重启时，据此判断远端进程可能已经启动（见 task.supervisor）
+        running_log.spawned_at = timezone.now()
+        GPUTaskRunningLog.objects.filter(pk=running_log.pk).update(
+            gpus_locked_at=running_log.gpus_locked_at, spawned_at=running_log.spawned_at)
         process = RemoteGPUProcessGroup(
             task.user.config.server_username,
             server.ip,
@@ -412,12 +707,24 @@ def run_task(task_id, _available_server_unused=None):
             log_file_path,
             running_log_id=running_log.id,
         )
-        # 同步读取首行并开始落盘输出
-        process.start_streaming()
+        # 同步读取首行并开始落盘输出（同时提取训练指标）
+        process.start_streaming(
+            _open_metric_extractor(running_log, task),
+            on_first_output=lambda: _mark_first_output(running_log.id),
+            checkpoint=OutputCheckpoint(log_file_path, base=-1),
+        )
 
         pid = process.pid()
         first_line = process.first_line() or ''
         remote_pid, remote_pgid = _parse_remote_marker(first_line)
+        if remote_pid is not None:
+            running_log.marker_at = process.first_line_at()
+        DISPATCH_RESULTS.inc(result='started')
+        if task.dispatching_at is not None:
+            DISPATCH_SECONDS.observe((timezone.now() - task.dispatching_at).total_seconds())
+        if remote_pid is None:
+            # 没读到远端进程标记，多半是 ssh 没连上
+            SSH_FAILURES.inc(op='launch')
         task_logger.info(
             'Task {:d}-{:s} is running, ssh_pid: {:d}, remote_pid: {}, remote_pgid: {}'.format(
                 task.id,
@@ -433,32 +740,53 @@ def run_task(task_id, _available_server_unused=None):
         running_log.remote_pid = remote_pid
         running_log.remote_pgid = remote_pgid
         running_log.last_heartbeat_at = timezone.now()
-        running_log.save(update_fields=['pid', 'remote_pid', 'remote_pgid', 'last_heartbeat_at', 'update_at'])
+        running_log.save(update_fields=[
+            'pid', 'remote_pid', 'remote_pgid', 'last_heartbeat_at',
+            'gpus_locked_at', 'spawned_at', 'marker_at', 'update_at',
+        ])
 
         # send email
         send_task_start_email(running_log)
 
         # wait for return
         return_code = process.get_return_code()
-        task_logger.info('Task {:d}-{:s} stopped, return_code: {:d}'.format(task.id, task.name, return_code))
+        if remote_pid is not None and (DRAINING.is_set() or return_code < 0 or (
+                return_code == 255 and not _exited_with(running_log, return_code))):
+            # ssh 断开（255，且节点上的退出码不是用户程序的 255）、被信号结束或调度器正在退出：
+            # 远端进程可能仍在运行，不收尾、不释放 GPU，交给 supervisor 按节点上的输出副本与退出码接管
+            detached = True
+            task_logger.warning('Task {:d}-{:s} ssh session ended ({:d}), remote process {} left to supervisor'.format(
+                task.id, task.name, return_code, remote_pid))
+        else:
+            task_logger.info('Task {:d}-{:s} stopped, return_code: {:d}'.format(task.id, task.name, return_code))
 
-        # save process status
-        running_log.refresh_from_db()
-        task.refresh_from_db()
+            # save process status
+            running_log.refresh_from_db()
+            task.refresh_from_db()
 
-        if running_log.status == 1:
-            running_log.status = 2 if return_code == 0 else -1
-            running_log.save(update_fields=['status', 'update_at'])
+            if running_log.status == 1:
+                running_log.status = 2 if return_code == 0 else -1
+                running_log.finished_at = timezone.now()
+                running_log.save(update_fields=['status', 'finished_at', 'update_at'])
+                safe_account_run(running_log.id)
 
-        if task.status == 1:
-            task.status = 2 if return_code == 0 else -1
-            task.save(update_fields=['status', 'update_at'])
+            if task.status == 1:
+                task.status = 2 if return_code == 0 else -1
+                task.save(update_fields=['status', 'update_at'])
 
-        # send email
-        if return_code == 0:
-            send_task_finish_email(running_log)
-        else:
-            send_task_fail_email(running_log)
+            # 输出已经完整收到：节点上的副本不再需要，不等新任务启动时的过期清理（255 的已由 _exited_with 删除）
+            if remote_pid is not None and return_code != 255:
+                try:
+                    if not process.remove_remote_files():
+                        task_logger.warning('Task {:d}-{:s} remote output copy not removed'.format(task.id, task.name))
+                except Exception:
+                    task_logger.error(traceback.format_exc())
+
+            # send email
+            if return_code == 0:
+                send_task_finish_email(running_log)
+            else:
+                send_task_fail_email(running_log)
     except Exception:
         es = traceback.format_exc()
         task_logger.error(es)
@@ -469,9 +797,11 @@ def run_task(task_id, _available_server_unused=None):
             pass
         try:
             running_log.status = -1
-            running_log.save(update_fields=['status', 'update_at'])
+            running_log.finished_at = running_log.finished_at or timezone.now()
+            running_log.save(update_fields=['status', 'finished_at', 'update_at'])
         except Exception:
             pass
+        safe_account_run(running_log.id)
         try:
             task.status = -1
             task.save(update_fields=['status', 'update_at'])
@@ -481,10 +811,16 @@ def run_task(task_id, _available_server_unused=None):
             f.write('\n')
             f.write(es)
     finally:
-        try:
-            release_gpus(server, gpus, busy_by_log_id=running_log.id)
-        except Exception:
-            task_logger.error(traceback.format_exc())
+        detach(running_log.id)
+        if not detached:
+            try:
+                release_gpus(server, gpus, busy_by_log_id=running_log.id)
+                _mark_gpus_released(running_log.id)
+            except Exception:
+                task_logger.error(traceback.format_exc())
+    if detached and not DRAINING.is_set():
+        from .supervisor import supervise
+        supervise(running_log.id)
 
 
 def mark_stale_running_tasks_as_lost():
@@ -495,27 +831,23 @@ def mark_stale_running_tasks_as_lost():
     stale_seconds = int(os.getenv('GPUTASKER_TASK_HEARTBEAT_STALE_SECONDS', '180'))
     now = timezone.now()
 
+    # 仅处理“已经进入心跳体系”的任务：last_heartbeat_at 为空的老任务不会命中 __lt，
+    # 避免升级瞬间大面积误判。条件在库里过滤，走 runlog_status_hb_idx。
     qs = (
         GPUTaskRunningLog.objects
         .select_related('task', 'server')
-        .filter(status=1)
+        .filter(status=1, last_heartbeat_at__lt=now - timedelta(seconds=stale_seconds))
+        .order_by()
     )
     for running_log in qs:
-        # 仅处理“已经进入心跳体系”的任务。
-        # 老任务（未写入 last_heartbeat_at）不自动标记失联，避免升级瞬间大面积误判。
-        if running_log.last_heartbeat_at is None:
-            continue
-        last = running_log.last_heartbeat_at
-        delta = now - last
-        if delta.total_seconds() <= stale_seconds:
-            continue
-
         # 标记运行记录失联
         try:
             running_log.status = -2
             running_log.save(update_fields=['status', 'update_at'])
         except Exception:
             task_logger.error(traceback.format_exc())
+        # 失联：用量记到最后一次心跳，恢复后结束时再补记
+        safe_account_run(running_log.id)
 
         # 仅当 task 仍是“运行中”时才迁移，避免覆盖“已完成/失败”
         try:
@@ -1,47 +1,46 @@
+import io
 import json
 import time
+from datetime import date, datetime
 
-from django.http import JsonResponse, HttpResponseNotAllowed
-from django.utils import timezone
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse, JsonResponse, HttpResponseNotAllowed
 from django.views.decorators.csrf import csrf_exempt
 
-from gpu_info.models import GPUServer
-from .models import GPUTaskRunningLog
+from gpu_info.report_auth import resolve_report_token, peek_report_token, record_report
+from gpu_info.ingest import ingest_executor, instrument_db, instrument_report, IngestOverloaded
+from gpu_info.views import overloaded_response
+from .accounting import DIMENSIONS, usage_report, write_csv
+from .lifecycle import GROUP_BY, dispatch_stats as lifecycle_stats
+from .api import SubmitError, authenticate, build_tasks, create_tasks, max_tasks_per_request, parse_submission, task_as_dict
+from .models import GPUTask, GPUTaskRunningLog
+from .utils import cancel_tasks as cancel_task_queryset
+from .wakeup import notify_scheduler
 
 
-@csrf_exempt
-def report_tasks(request):
-	"""Node 侧定期上报“运行中任务心跳”。
-
-	鉴权：使用 GPUServer.report_token（与 report_gpu 相同）。
-	"""
-	if request.method != 'POST':
-		return HttpResponseNotAllowed(['POST'])
-
+def _parse_tasks_payload(body):
+	"""解析并校验 report_tasks 请求体，返回 (token, tasks, error_response)。"""
 	try:
-		payload = json.loads(request.body.decode('utf-8') or '{}')
+		payload = json.loads(body.decode('utf-8') or '{}')
 	except Exception:
-		return JsonResponse({'ok': False, 'error': 'invalid_json'}, status=400)
+		return None, None, JsonResponse({'ok': False, 'error': 'invalid_json'}, status=400)
 
 	token = payload.get('token')
 	tasks = payload.get('tasks')
 	if not token or not isinstance(token, str):
-		return JsonResponse({'ok': False, 'error': 'missing_token'}, status=401)
+		return None, None, JsonResponse({'ok': False, 'error': 'missing_token'}, status=401)
 	if tasks is None:
-		return JsonResponse({'ok': False, 'error': 'missing_tasks'}, status=400)
+		return None, None, JsonResponse({'ok': False, 'error': 'missing_tasks'}, status=400)
 	if not isinstance(tasks, list):
-		return JsonResponse({'ok': False, 'error': 'invalid_tasks'}, status=400)
+		return None, None, JsonResponse({'ok': False, 'error': 'invalid_tasks'}, status=400)
+	return token, tasks, None
 
-	try:
-		server = GPUServer.objects.get(report_token=token)
-	except GPUServer.DoesNotExist:
-		return JsonResponse({'ok': False, 'error': 'invalid_token'}, status=403)
 
-	now = timezone.now()
+@instrument_db('report_tasks')
+def ingest_task_heartbeats(server, tasks):
+	"""把一次任务心跳上报写入数据库，返回 (updated, revived)。WSGI/ASGI 两条入口共用。"""
 	# 任务心跳同样可作为节点存活信号
-	server.valid = True
-	server.last_report_at = now
-	server.save(update_fields=['valid', 'last_report_at'])
+	now = record_report(server)
 
 	updated = 0
 	revived = 0
@@ -99,5 +98,184 @@ def report_tasks(request):
 				running_log.task.save(update_fields=['status', 'update_at'])
 
 		updated += 1
+	return updated, revived
+
 
+def _tasks_report_response(updated, revived):
 	return JsonResponse({'ok': True, 'updated': updated, 'revived': revived, 'ts': int(time.time())})
+
+
+@csrf_exempt
+@instrument_report('report_tasks')
+def report_tasks(request):
+	"""Node 侧定期上报“运行中任务心跳”。
+
+	鉴权：使用 GPUServer.report_token（与 report_gpu 相同）。
+	"""
+	if request.method != 'POST':
+		return HttpResponseNotAllowed(['POST'])
+
+	token, tasks, error = _parse_tasks_payload(request.body)
+	if error is not None:
+		return error
+
+	server = resolve_report_token(token)
+	if server is None:
+		return JsonResponse({'ok': False, 'error': 'invalid_token'}, status=403)
+
+	updated, revived = ingest_task_heartbeats(server, tasks)
+	return _tasks_report_response(updated, revived)
+
+
+@instrument_report('report_tasks')
+async def report_tasks_async(request):
+	"""report_tasks 的异步版本，供独立的 ASGI 上报服务使用。"""
+	if request.method != 'POST':
+		return HttpResponseNotAllowed(['POST'])
+
+	token, tasks, error = _parse_tasks_payload(request.body)
+	if error is not None:
+		return error
+
+	try:
+		hit, server = peek_report_token(token)
+		if not hit:
+			server = await ingest_executor.run(resolve_report_token, token)
+		if server is None:
+			return JsonResponse({'ok': False, 'error': 'invalid_token'}, status=403)
+		updated, revived = await ingest_executor.run(ingest_task_heartbeats, server, tasks)
+	except IngestOverloaded:
+		return overloaded_response()
+	return _tasks_report_response(updated, revived)
+
+
+# Django 4.2 的 csrf_exempt 会把协程函数包成同步函数，这里直接打标记
+report_tasks_async.csrf_exempt = True
+
+
+def _api_error(error, status=400, **extra):
+	return JsonResponse({'ok': False, 'error': error, **extra}, status=status)
+
+
+def _list_tasks(request):
+	"""?status=0,1&group=<id>&before=<id>&limit=<n>，按 id 倒序分页。"""
+	user = authenticate(request, allow_session=True)
+	if user is None:
+		return _api_error('unauthorized', 401)
+	params = request.GET
+	qs = GPUTask.objects.filter(user=user)
+	try:
+		if params.get('status'):
+			qs = qs.filter(status__in=[int(s) for s in params['status'].split(',')])
+		if params.get('group'):
+			qs = qs.filter(group_id=int(params['group']))
+		if params.get('before'):
+			qs = qs.filter(id__lt=int(params['before']))
+		limit = min(max(1, int(params.get('limit') or 100)), 1000)
+	except ValueError:
+		return _api_error('invalid_params')
+	tasks = list(qs.order_by('-id')[:limit])
+	return JsonResponse({
+		'ok': True,
+		'tasks': [task_as_dict(task) for task in tasks],
+		'next_before': tasks[-1].id if len(tasks) == limit else None,
+	})
+
+
+@csrf_exempt
+def tasks_api(request):
+	"""GET 列出自己的任务；POST 批量提交任务（JSON / JSON Lines，需 API token）。"""
+	if request.method == 'GET':
+		return _list_tasks(request)
+	if request.method != 'POST':
+		return HttpResponseNotAllowed(['GET', 'POST'])
+
+	# 写操作只认 token：会话鉴权的跨站 POST 没有 CSRF 保护
+	user = authenticate(request)
+	if user is None:
+		return _api_error('unauthorized', 401)
+	try:
+		defaults, items = parse_submission(request.body, request.content_type)
+		tasks = build_tasks(user, defaults, items)
+		ids = create_tasks(user, tasks)
+	except SubmitError as exc:
+		return _api_error(exc.error, exc.status, errors=exc.details)
+	if any(task.status == 0 for task in tasks):
+		notify_scheduler()
+	return JsonResponse({'ok': True, 'created': len(ids), 'ids': ids}, status=201)
+
+
+@csrf_exempt
+def cancel_tasks(request):
+	"""POST {"ids": [...]}：排队中的任务改为“未就绪”，运行中的任务交给调度器在后台结束进程。"""
+	if request.method != 'POST':
+		return HttpResponseNotAllowed(['POST'])
+	user = authenticate(request)
+	if user is None:
+		return _api_error('unauthorized', 401)
+	try:
+		ids = json.loads(request.body.decode('utf-8') or '{}').get('ids')
+	except (UnicodeDecodeError, ValueError, AttributeError):
+		return _api_error('invalid_json')
+	if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+		return _api_error('invalid_ids')
+	if len(ids) > max_tasks_per_request():
+		return _api_error('too_many_tasks', 413)
+
+	cancelled, kill_queued = cancel_task_queryset(GPUTask.objects.filter(user=user, id__in=ids))
+	if kill_queued:
+		notify_scheduler()
+	return JsonResponse({'ok': True, 'cancelled': cancelled, 'kill_queued': kill_queued})
+
+
+@staff_member_required
+def dispatch_stats(request):
+	"""调度开销分位数：start/end 为秒级时间戳（默认最近 7 天），group_by=day,server（可留空），server=<id>。"""
+	params = request.GET
+	try:
+		end = int(params.get('end') or time.time())
+		start = int(params.get('start') or end - 7 * 86400)
+		server_id = int(params['server']) if params.get('server') else None
+	except ValueError:
+		return _api_error('invalid_params')
+	if start >= end:
+		return _api_error('invalid_range')
+	group_by = tuple(g for g in params.get('group_by', ','.join(GROUP_BY)).split(',') if g)
+	if any(g not in GROUP_BY for g in group_by):
+		return _api_error('invalid_group_by')
+
+	groups = lifecycle_stats(datetime.fromtimestamp(start), datetime.fromtimestamp(end), group_by, server_id)
+	return JsonResponse({'ok': True, 'start': start, 'end': end, 'group_by': list(group_by), 'groups': groups})
+
+
+def gpu_usage(request):
+	"""GPU 用量（只读汇总表）：?start=YYYY-MM-DD&end=YYYY-MM-DD（默认本月）&group_by=user,project&format=csv。
+
+	管理员看全部用户，其他用户（API token 或后台登录）只看自己的用量。
+	"""
+	user = authenticate(request, allow_session=True)
+	if user is None:
+		return _api_error('unauthorized', 401)
+	params = request.GET
+	today = date.today()
+	try:
+		start = date.fromisoformat(params['start']) if params.get('start') else today.replace(day=1)
+		end = date.fromisoformat(params['end']) if params.get('end') else today
+	except ValueError:
+		return _api_error('invalid_params')
+	if start > end:
+		return _api_error('invalid_range')
+	group_by = tuple(g for g in params.get('group_by', 'user').split(',') if g)
+	if any(g not in DIMENSIONS for g in group_by):
+		return _api_error('invalid_group_by')
+
+	rows = usage_report(start, end, group_by, user_id=None if user.is_staff else user.pk)
+	if params.get('format') == 'csv':
+		out = io.StringIO()
+		write_csv(out, rows, group_by)
+		response = HttpResponse(out.getvalue(), content_type='text/csv; charset=utf-8')
+		response['Content-Disposition'] = 'attachment; filename="gpu_usage_{}_{}.csv"'.format(start, end)
+		return response
+	return JsonResponse({
+		'ok': True, 'start': start.isoformat(), 'end': end.isoformat(), 'group_by': list(group_by), 'rows': rows,
+	})
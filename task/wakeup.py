@@ -0,0 +1,59 @@
+"""调度器唤醒：提交任务后不必等满一个主循环间隔。
+
+Web 与调度器是两个进程，这里用一个文件的 mtime 作信号：提交方 touch 该文件，
+调度器在两轮之间休眠时每隔 poll 秒 stat 一次，发现变化就提前开始下一轮。
+文件默认放在运行日志目录（Web 与调度器共享），可用 GPUTASKER_SCHEDULER_WAKEUP_FILE 指定。
+"""
+import logging
+import os
+import time
+
+from gpu_tasker.settings import RUNNING_LOG_DIR
+
+task_logger = logging.getLogger('django.task')
+
+
+def wakeup_path():
+    return os.getenv('GPUTASKER_SCHEDULER_WAKEUP_FILE') or os.path.join(RUNNING_LOG_DIR, '.scheduler_wakeup')
+
+
+def notify_scheduler(path=None):
+    path = path or wakeup_path()
+    try:
+        with open(path, 'a'):
+            pass
+        os.utime(path, None)
+    except OSError as exc:
+        # 唤醒只是加速，失败时任务仍会在下一轮被调度
+        task_logger.warning('wake up scheduler failed: %s', exc)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class WakeupWaiter:
+    """调度器侧：wait(timeout) 在超时或收到唤醒时返回，收到唤醒返回 True；interrupt（threading.Event）被置位时立即返回。"""
+
+    def __init__(self, path=None, poll_seconds=0.5):
+        self.path = path or wakeup_path()
+        self.poll_seconds = poll_seconds
+        self._seen = _mtime(self.path)
+
+    def wait(self, timeout, interrupt=None):
+        deadline = time.monotonic() + timeout
+        while True:
+            current = _mtime(self.path)
+            if current != self._seen:
+                self._seen = current
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if interrupt is None:
+                time.sleep(min(self.poll_seconds, remaining))
+            elif interrupt.wait(min(self.poll_seconds, remaining)):
+                return False